@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import logging
+import signal
+import boto3
+from botocore.exceptions import ClientError
+from datetime import datetime,timezone
+
+# Import local modules - see ../PythonUtilities
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PythonUtilities'))
+import modules.output as output
+import modules.aws_connect as aws_utils
+import modules.profiling as profiling
+import modules.scheduler as scheduler
+
+# Global Variables
+log_level=logging.INFO
+log_format='%(asctime)s [%(levelname)s] (%(threadName)s) %(message)s'
+log_file="/dev/null"
+log_json_file=None
+session=None
+assumed_roles=None
+
+# Handle command line arguments
+all_args = argparse.ArgumentParser(description='AWS EC2 AMI Backup Scheduler')
+connection_group = all_args.add_argument_group('AWS Connection Details')
+connection_group.add_argument('--aws-profile', '-a', required=False, default='default', help='AWS Profile: default = default (Example: -a vcra-prod)', type=str)
+connection_group.add_argument('--region', '-r', required=False, default='us-east-1',help="AWS Region of policies that do not list regions: default = us-east-1 (Example: -r us-east-2)", type=str)
+policy_group = all_args.add_argument_group('Policy Options')
+policy_group.add_argument('--policies', '-P', required=True, help='YAML or JSON file of backup policies (Example: -P ./policies.yml)', type=str)
+policy_group.add_argument('--once', required=False, action='store_true', help='[Flag] Run the open or next window of each policy, wait for its AMIs, then exit')
+policy_group.add_argument('--dry-run', required=False, action='store_true', help='[Flag] Log when each instance would be backed up without creating AMIs')
+spread_group = all_args.add_argument_group('Load Spreading Options')
+spread_group.add_argument('--jitter', required=False, default=scheduler.DEFAULT_JITTER, help='Random offset of each backup within its slot of the window, 0 for evenly spaced backups up to 1: default = 0.5', type=float)
+spread_group.add_argument('--max-per-account', required=False, default=0, help='Maximum in-flight snapshots per account, 0 for no limit: default = 0', type=int)
+spread_group.add_argument('--max-per-region', required=False, default=100, help='Maximum in-flight snapshots per account and region, 0 for no limit: default = 100', type=int)
+spread_group.add_argument('--max-per-az', required=False, default=40, help='Maximum in-flight snapshots per account and availability zone, 0 for no limit: default = 40', type=int)
+spread_group.add_argument('--create-rate', required=False, default=scheduler.DEFAULT_CREATE_RATE, help='Maximum CreateImage requests per second: default = 2', type=float)
+spread_group.add_argument('--workers', required=False, default=scheduler.DEFAULT_WORKERS, help='Worker threads creating AMIs: default = 8', type=int)
+spread_group.add_argument('--poll-interval', required=False, default=scheduler.DEFAULT_POLL_INTERVAL, help='Seconds between checks of pending AMIs: default = 60', type=int)
+spread_group.add_argument('--image-timeout', required=False, default=scheduler.DEFAULT_IMAGE_TIMEOUT, help='Seconds an AMI may stay pending before it is counted as failed and its snapshots stop counting towards the limits: default = 86400', type=int)
+org_group = all_args.add_argument_group('Account Options (policies listing accounts)')
+org_group.add_argument('--role-name', required=False, default=aws_utils.DEFAULT_ROLE_NAME, help='Role assumed in the accounts listed by policies: default = OrganizationAccountAccessRole', type=str)
+org_group.add_argument('--external-id', required=False, help='External ID required by the role trust policy', type=str)
+org_group.add_argument('--role-duration', required=False, default=aws_utils.DEFAULT_ROLE_DURATION, help='Seconds assumed role credentials are requested for, they are refreshed before they expire: default = 3600', type=int)
+log_group = all_args.add_argument_group('Log Options')
+log_group.add_argument('--log-file', '-l', required=False, help='Log file location (Example: -l /tmp/backup-scheduler.log)', type=str)
+log_group.add_argument('--log-level', '-ll', required=False, default='INFO', help='Log level: default = INFO (Example: -ll DEBUG)', type=str)
+log_group.add_argument('--log-json', '-lj', required=False, help='Structured JSON Lines log file location (Example: -lj /tmp/backup-scheduler.jsonl)', type=str)
+profile_group = all_args.add_argument_group('Profile Options')
+profile_group.add_argument('--profile', required=False, choices=['cpu', 'mem', 'wall'], help='Profile the run and save the reports alongside the log file, or in the current directory: cpu = cProfile of every thread, mem = tracemalloc top allocations, wall = sampled stacks of every thread', type=str)
+args=all_args.parse_args()
+
+# Parse passed arguments and update logging variables if needed
+for key, value in vars(args).items():
+    if (key == 'log_file' and not value is None):
+        log_file=value
+    if (key == 'log_json' and not value is None):
+        log_json_file=value
+    if key == 'log_level':
+        log_level=value.upper()
+
+# Configure logging - records are queued and written by a background listener thread
+output.configure_logging(log_level=log_level, log_format=log_format, log_file=log_file, json_file=log_json_file)
+
+def main(): # Main function
+    logging.info("===================")
+    logging.info("Scheduling AMI Backups")
+    logging.info("===================")
+    print_args(args) # Print arguments passed from command line
+    policies = load_policies() # Read and validate the backup policies
+    aws_connect(args) # Connect to AWS
+    backup_scheduler = scheduler.BackupScheduler(policies, account_session, scheduler.InFlightLimits(per_account=args.max_per_account, per_region=args.max_per_region, per_az=args.max_per_az), jitter=args.jitter, poll_interval=args.poll_interval, image_timeout=args.image_timeout, create_rate=args.create_rate, workers=args.workers, dry_run=args.dry_run)
+    # Stop scheduling on SIGTERM (systemd, docker stop) or Ctrl+C, AMIs already started are completed by EC2
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda signal_number, frame: stop(backup_scheduler, signal_number))
+    stats = backup_scheduler.run(once=args.once)
+    logging.info("===================")
+    logging.info("All done!")
+    sys.exit(1 if stats['failed'] or stats['errors'] else 0)
+
+def print_args(args): # Print arguments passed from command line
+    logging.info("Supplied arguments")
+    logging.info("===================")
+    for key, value in vars(args).items():
+        # Replace _ with space and capitalize first letter of each word
+        key = key.replace("_"," ").title()
+        logging.info('%s : %s', key, value)
+    logging.info("===================")
+
+def load_policies(): # Read the backup policies file
+    try:
+        policies = scheduler.load_policies(args.policies, default_regions=[args.region])
+        for policy in policies:
+            logging.info("Policy %s: every %g minutes from %s UTC within %g minutes, %s regions, %s accounts", policy.name, policy.every / 60.0, datetime.fromtimestamp(policy.start, timezone.utc).strftime('%H:%M'), policy.window / 60.0, len(policy.regions), len([account for account in policy.accounts if account]) or 'default')
+        if not policies:
+            logging.error("No policies found in %s", args.policies)
+            sys.exit(1)
+        return policies
+    except (OSError, ValueError, TypeError) as e:
+        logging.error("Error in load_policies: %s", e)
+        sys.exit(1)
+
+def aws_connect(args): # Connect to AWS
+    try:
+        global session, assumed_roles
+        logging.info("Connecting to AWS")
+        session = boto3.Session(profile_name=args.aws_profile,region_name=args.region)
+        assumed_roles = aws_utils.AssumedRoleSessions(session, role_name=args.role_name, session_name='BackupScheduler', duration=args.role_duration, external_id=args.external_id)
+        logging.info("Connected to AWS")
+        logging.info("Session Details: %s", session)
+        logging.info("===================")
+    except (ClientError, OSError, ValueError) as e:
+        logging.error("Error in aws_connect: %s", e)
+        sys.exit(1)
+    except:
+        logging.error("Unexpected error in aws_connect: %s", sys.exc_info()[0])
+        sys.exit(1)
+
+def account_session(account): # Session for an account listed by a policy, or the profile's session for policies without accounts
+    if account is None:
+        return session
+    return assumed_roles.get(account)
+
+def stop(backup_scheduler, signal_number): # Stop scheduling new backups
+    logging.info("Received signal %s, stopping", signal_number)
+    backup_scheduler.stop()
+
+with profiling.Profiler(args.profile, profiling.profile_prefix(os.path.dirname(args.log_file) if args.log_file else None, 'BackupScheduler-{}-UTC'.format(datetime.now(timezone.utc).strftime('%Y-%m-%d_%H%M%S')))): # Profile the run when --profile is set
+    main() # Call main function
@@ -1,27 +1,58 @@
 #!/usr/bin/env python3
+import os
 import sys
 import argparse
 import logging
-import time
+import asyncio
 import concurrent.futures
+import functools
+import subprocess
 import boto3
 from botocore.exceptions import ClientError,ParamValidationError
 from datetime import datetime,timezone
 
+# Import local modules - see ../PythonUtilities
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PythonUtilities'))
+import modules.output as output
+import modules.aws_connect as aws_utils
+import modules.cassette as cassette_utils
+import modules.profiling as profiling
+import modules.progress as progress_utils
+import modules.ec2 as ec2_utils
+import modules.ec2_async as ec2_async
+import modules.ebs as ebs
+import modules.jobs as jobs_utils
+
 # Global Variables
 log_level=logging.INFO
 log_format='%(asctime)s [%(levelname)s] %(message)s'
 log_file="/dev/null"
+log_json_file=None
+cassette=None
 date = datetime.now().strftime('%Y-%m-%d')
 timestamp = datetime.now(timezone.utc).strftime('%H:%M')
 instance_ids=[]
 instance_amis={}
+existing_images=None
+region_images={}
+image_regions={}
+snapshot_sets={}
+# Arguments that are options rather than tag filters
+non_filter_args = ['aws_profile', 'region', 'log_file', 'log_level', 'log_json', 'list_only', 'wait', 'instance_ids', 'extra_tags', 'add_tags', 'copy_to_regions', 'copy_kms_key_id', 'copy_max_concurrent', 'engine', 'max_concurrency', 'reuse_window', 'if_unchanged', 'change_threshold', 'image_mode', 'record', 'replay', 'replay_latency', 'profile', 'org', 'accounts', 'account', 'role_name', 'external_id', 'role_duration', 'org_max_workers', 'event_queue', 'event_fallback_interval', 'progress', 'progress_interval', 'stall_after', 'jobs', 'jobs_max_workers']
 
 # Handle command line arguments
 all_args = argparse.ArgumentParser(description='AWS EC2 AMI Creation and Tagging')
 connection_group = all_args.add_argument_group('AWS Connection Details')
 connection_group.add_argument('--aws-profile', '-a', required=False, default='default', help='AWS Profile: default = default (Example: -a vcra-prod)', type=str)
 connection_group.add_argument('--region', '-r', required=False, default='us-east-1',help="AWS Region: default = us-east-1 (Example: -r us-east-2)", type=str)
+org_group = all_args.add_argument_group('Organization Options (assume a role in each account)')
+org_group.add_argument('--org', required=False, help='Create AMIs in every active account in the AWS Organization, assuming --role-name in each', action='store_true')
+org_group.add_argument('--accounts', required=False, help='Comma separated account IDs, or a file with one account ID per line, to create AMIs in instead of the organization (Example: --accounts 111111111111,222222222222)', type=str)
+org_group.add_argument('--account', required=False, help='Create AMIs in this account only, assuming --role-name in it (Example: --account 111111111111)', type=str)
+org_group.add_argument('--role-name', required=False, default=aws_utils.DEFAULT_ROLE_NAME, help='Role assumed in each account: default = OrganizationAccountAccessRole', type=str)
+org_group.add_argument('--external-id', required=False, help='External ID required by the role trust policy', type=str)
+org_group.add_argument('--role-duration', required=False, default=aws_utils.DEFAULT_ROLE_DURATION, help='Seconds assumed role credentials are requested for, they are refreshed before they expire: default = 3600', type=int)
+org_group.add_argument('--org-max-workers', required=False, default=aws_utils.DEFAULT_ACCOUNT_WORKERS, help='Maximum accounts processed at once: default = 8', type=int)
 instance_group = all_args.add_argument_group('Instance Details (Tags and/or Instance IDs)')
 instance_group.add_argument('--product', '-p', required=False,help="EC2 Instance Product Tag (Example: -p holodeck)", type=str)
 instance_group.add_argument('--environment', '-e', required=False,help="EC2 Instance Environment Tag (Example: -e sse)", type=str)
@@ -32,9 +63,41 @@ instance_group.add_argument('--name', '-n', required=False,help="EC2 Instance Na
 instance_group.add_argument('--extra-tags', '-x', required=False, help='Other tags that can be used to search for AMI images as a comma separated key=value list (Example: -x key1=value1,key2=value2)', type=str)
 instance_group.add_argument('--instance-ids', '-i', required=False, help='Instance IDs to create AMI from as a comma separated list (Example: -i id-123456,id-654321)', type=str)
 instance_group.add_argument('--add-tags', '-at', required=False, help='Additional tags to add to AMI as a comma separated key=value list (Example: -at key1=value1,key2=value2)', type=str)
+jobs_group = all_args.add_argument_group('Batch Job Options (many filter sets from one discovery pass per region)')
+jobs_group.add_argument('--jobs', required=False, help='YAML or JSON file of named jobs, each with its own tag filters, instance IDs and additional tags, used instead of the tag and instance ID options (Example: --jobs ./nightly-jobs.yml)', type=str)
+jobs_group.add_argument('--jobs-max-workers', required=False, default=16, help='Maximum AMIs created and tagged at once across every job: default = 16', type=int)
 log_group = all_args.add_argument_group('Log Options')
 log_group.add_argument('--log-file', '-l', required=False, help='Log file location (Example: -l /tmp/createAMI.log)', type=str)
 log_group.add_argument('--log-level', '-ll', required=False, default='INFO', help='Log level: default = INFO (Example: -ll DEBUG)', type=str)
+log_group.add_argument('--log-json', '-lj', required=False, help='Structured JSON Lines log file location (Example: -lj /tmp/createAMI.jsonl)', type=str)
+copy_group = all_args.add_argument_group('Disaster Recovery Copy Options')
+copy_group.add_argument('--copy-to-regions', '-cr', required=False, help='Copy each AMI to these regions as soon as it is available, implies waiting for the AMIs (Example: -cr us-west-2,eu-west-1)', type=str)
+copy_group.add_argument('--copy-kms-key-id', '-ck', required=False, help='Re-encrypt copies with this KMS key id, ARN or alias, or a comma separated region=key list (Example: -ck us-west-2=alias/dr,eu-west-1=alias/dr)', type=str)
+copy_group.add_argument('--copy-max-concurrent', required=False, default=5, help='Maximum concurrent copies per destination region: default = 5', type=int)
+event_group = all_args.add_argument_group('Event Options (wait for EventBridge AMI state change events)')
+event_group.add_argument('--event-queue', required=False, help='SQS queue URL receiving EC2 AMI State Change events from EventBridge, images complete as soon as their event arrives (Example: --event-queue https://sqs.us-east-1.amazonaws.com/111111111111/ami-events)', type=str)
+event_group.add_argument('--event-fallback-interval', required=False, default=300, help='Seconds between polls for images whose events were missed when using --event-queue: default = 300', type=int)
+progress_group = all_args.add_argument_group('Progress Options')
+progress_group.add_argument('--progress', required=False, default='auto', choices=['auto', 'tty', 'log', 'off'], help='Report discovered, created, tagged and available counts, requests per second and ETA: tty = status line below the log output, log = a log line every --progress-interval seconds, auto = tty on a terminal otherwise log: default = auto', type=str)
+progress_group.add_argument('--progress-interval', required=False, default=progress_utils.DEFAULT_LOG_INTERVAL, help='Seconds between progress log lines: default = 30', type=int)
+progress_group.add_argument('--stall-after', required=False, default=progress_utils.DEFAULT_STALL_AFTER, help='Warn when no requests are sent and no work completes for this many seconds, 0 to never warn: default = 300', type=int)
+profile_group = all_args.add_argument_group('Profile Options')
+profile_group.add_argument('--profile', required=False, choices=['cpu', 'mem', 'wall'], help='Profile the run and save the reports alongside the log file, or in the current directory: cpu = cProfile of every thread, mem = tracemalloc top allocations, wall = sampled stacks of every thread', type=str)
+replay_group = all_args.add_argument_group('Record and Replay Options')
+cassette_group = replay_group.add_mutually_exclusive_group()
+cassette_group.add_argument('--record', required=False, help='Record every AWS API response to this cassette file, compressed if it ends in .gz or .zst (Example: --record /tmp/run.jsonl.gz)', type=str)
+cassette_group.add_argument('--replay', required=False, help='Serve AWS API calls from this recorded cassette file instead of AWS (Example: --replay /tmp/run.jsonl.gz)', type=str)
+replay_group.add_argument('--replay-latency', required=False, default=0.0, help='Multiple of the recorded response times to wait for when replaying, 1 to reproduce the original latencies: default = 0', type=float)
+engine_group = all_args.add_argument_group('Engine Options')
+engine_group.add_argument('--engine', required=False, default='threads', choices=['threads', 'async'], help='Run AWS calls in a thread pool or as coroutines on one asyncio event loop (requires aiobotocore): default = threads', type=str)
+engine_group.add_argument('--max-concurrency', required=False, default=ec2_async.DEFAULT_MAX_CONCURRENCY, help='Maximum AWS requests in flight with --engine async: default = 100', type=int)
+image_group = all_args.add_argument_group('Image Options')
+image_group.add_argument('--image-mode', required=False, default='create-image', choices=['create-image', 'snapshots'], help='Create AMIs with CreateImage, or with CreateSnapshots for crash-consistent snapshots of all of an instance\'s volumes followed by RegisterImage: default = create-image', type=str)
+reuse_group = all_args.add_argument_group('Reuse Options')
+reuse_group.add_argument('--reuse-window', required=False, default=60, help='Reuse an AMI of the instance created within this many minutes instead of creating another, 0 to always create: default = 60', type=int)
+change_group = all_args.add_argument_group('Change Detection Options')
+change_group.add_argument('--if-unchanged', required=False, default='create', choices=['create', 'skip', 'retag'], help='Action for instances whose volumes have not changed since their latest AMI: create a new AMI, skip the instance, or skip it and tag the latest AMI as verified: default = create', type=str)
+change_group.add_argument('--change-threshold', required=False, default=0, help='MiB written across an instance\'s volumes at or below which it is considered unchanged: default = 0', type=int)
 extra_group = all_args.add_mutually_exclusive_group()
 extra_group.add_argument('--list-only', '-lo','--dry-run','--check','-C', required=False, action='store_true', help='[Flag] List instances that would be backed up to AMI and exit without creating AMI')
 extra_group.add_argument('--wait', '-w', required=False, action='store_true', help='[Flag] Wait for AMI to be available')
@@ -44,18 +107,19 @@ args=all_args.parse_args()
 for key, value in vars(args).items():
     if (key == 'log_file' and not value is None):
         log_file=value
+    if (key == 'log_json' and not value is None):
+        log_json_file=value
     if key == 'log_level':
         log_level=value.upper()
 
-# Configure logging
-logging.basicConfig(
-    level=log_level,
-    format=log_format,
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(sys.stdout)
-    ]
-    )
+# Report progress on a status line below the console log output on a terminal, or as periodic log lines otherwise
+# The parent of --org and --accounts runs and --list-only runs have no AMIs to report on
+progress_mode = 'off' if args.list_only or ((args.org or args.accounts) and not args.account) else progress_utils.console_mode(args.progress)
+status_line = progress_utils.StatusLine(sys.stdout) if progress_mode == 'tty' else None
+
+# Configure logging - records are queued and written by a background listener thread
+output.configure_logging(log_level=log_level, log_format=log_format, log_file=log_file, json_file=log_json_file, stream=status_line or sys.stdout)
+progress = progress_utils.Progress(['discovered', 'created', 'tagged', 'available'], goal='available' if args.wait or args.copy_to_regions else 'tagged', mode=progress_mode, status_line=status_line, log_interval=args.progress_interval, stall_after=args.stall_after, name='AMIs')
 
 def main(): # Main function
     logging.info("===================")
@@ -63,7 +127,17 @@ def main(): # Main function
     logging.info("===================")
     print_args(args) # Print arguments passed from command line
     aws_connect(args) # Connect to AWS
+    if args.account:
+        connect_account() # Switch to the role in --account
+    elif args.org or args.accounts:
+        run_accounts() # Run this script for each account and exit
+    if args.jobs:
+        run_jobs() # Create AMIs for every job in the job file and exit
+    progress.start() # Report progress until the run is complete
     find_instances(args) # Find instances based on supplied arguments
+    if args.if_unchanged != 'create' and len(instance_ids) > 0:
+        skip_unchanged_instances() # Remove instances whose volumes have not changed since their latest AMI
+    progress.add('discovered', len(instance_ids))
     # If 1 or more instances are found iterate through all instances found and create AMI with tags
     logging.info("===================")
     # Verify if list only flag is set, print instances and exit
@@ -85,42 +159,133 @@ def main(): # Main function
             logging.info("Exiting without creating AMI(s)")
         sys.exit(0)
     # If list only flag is not set, create AMI and tag
-    if len(instance_ids) > 0:
+    if len(instance_ids) > 0 and args.engine == 'async':
+        create_amis_async() # Create, tag, wait for and confirm AMIs on one event loop
+    elif len(instance_ids) > 0:
+        if args.reuse_window > 0:
+            load_existing_images() # Index recent AMIs so instances that already have one are not imaged again
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(instance_ids)) as executor:
             for instance in instance_ids:
-                executor.submit(create_and_tag_ami, instance)
+                progress.track(executor.submit(create_and_tag_ami, instance))
+        if snapshot_sets:
+            register_snapshot_images() # Register AMIs as their snapshot sets complete
+        complete_amis() # Log the AMIs created, wait for them when --wait or --copy-to-regions is set, and confirm them
+    else:
+        logging.info("===================")
+        logging.info("No instances found!")
+        logging.info("===================")
+    progress.stop()
+    logging.info("All done!")
+    sys.exit(0)
+
+def complete_amis(): # Log the AMIs created, wait for them when --wait or --copy-to-regions is set, and confirm them
+    logging.info("===================")
+    logging.info("Created AMIs")
+    logging.info("===================")
+    for key, value in instance_amis.items():
+        logging.info("Image Name: %s - Image ID: %s", key, value)
+    logging.info("===================")
+    if args.wait or args.copy_to_regions:
+        logging.info("Waiting for AMIs to be available")
+        logging.info("===================")
+        logging.info("Checking AMI states.  Please be patient this may take a few minutes")
+        check_ami_states(list(instance_amis.values()))
+        logging.info("===================")
+        logging.info("Confirming Successful AMI Image IDs")
+        logging.info("===================")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(instance_amis))) as executor:
+        for key, value in instance_amis.items():
+            logging.debug("Image Name: %s - Image ID: %s", key, value)
+            executor.submit(confirm_ami_success,key,value)
+    logging.info("===================")
+
+def create_and_tag_ami(instance, tags=None, region=None): # Create and tag an AMI for an instance, tags are read from the instance unless given
+    if tags is None:
+        tags=get_tags(instance)
+    if reuse_existing_ami(instance, tags, region):
+        return
+    if args.image_mode == 'snapshots' and create_snapshot_set(instance, tags):
+        return
+    image_id=create_ami(instance,tags,region)
+    if image_id is not None:
+        tag_ami(image_id,tags,region)
+
+def create_amis_async(): # Run the async engine
+    try:
+        asyncio.run(create_and_tag_amis_async())
+    except ClientError as e:
+        logging.error("Error in create_amis_async: %s", e)
+        sys.exit(1)
+    except ImportError as e:
+        logging.error("Error in create_amis_async: %s - the async engine requires aiobotocore", e)
+        sys.exit(1)
+
+async def create_and_tag_amis_async(): # Create and tag AMIs as coroutines, then wait for and confirm them
+    global existing_images
+    async with ec2_async.AsyncEC2(profile=args.aws_profile, region=args.region, max_concurrency=args.max_concurrency) as ec2:
+        # One paginated DescribeInstances call returns the tags of every instance
+        instances = await ec2.describe_instances(instance_ids=instance_ids)
+        if args.reuse_window > 0:
+            existing_images = ec2_utils.ExistingImageIndex(await ec2.describe_images(owners=['self'], filters=ec2_utils.recent_date_filters(args.reuse_window)))
+            logging.info("Found %s AMIs created within the last %s minutes", len(existing_images.images), args.reuse_window)
+        await asyncio.gather(*(create_and_tag_ami_async(ec2, instance) for instance in instances))
+        if snapshot_sets:
+            # The threaded poller, which also reads --event-queue, waits in a worker thread so the event loop is not blocked
+            await asyncio.to_thread(register_snapshot_images) # Register AMIs as their snapshot sets complete
         logging.info("===================")
         logging.info("Created AMIs")
         logging.info("===================")
         for key, value in instance_amis.items():
-            logging.info("Image Name: {0} - Image ID: {1}".format(key, value))
+            logging.info("Image Name: %s - Image ID: %s", key, value)
         logging.info("===================")
-        if args.wait:
+        image_ids = [image_id for image_id in instance_amis.values() if image_id is not None]
+        if args.copy_to_regions:
+            # Copies are driven by the threaded copy pipeline once the images have been created, in a worker thread so the event loop is not blocked
             logging.info("Waiting for AMIs to be available")
             logging.info("===================")
-            logging.info("Checking AMI states.  Please be patient this may take a few minutes")
-            with concurrent.futures.ThreadPoolExecutor(max_workers=len(instance_amis)) as executor:
-                for key, value in instance_amis.items():
-                    executor.submit(check_ami_state,value)
-            logging.info("===================")
-            logging.info("Confirming Successful AMI Image IDs")
+            await asyncio.to_thread(check_ami_states, image_ids)
+            images = {image['ImageId']: image for image in await ec2.describe_images(image_ids=image_ids)} if image_ids else {}
+        elif args.wait:
+            logging.info("Waiting for AMIs to be available")
             logging.info("===================")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(instance_amis)) as executor:
-            for key, value in instance_amis.items():
-                logging.debug("Image Name: {0} - Image ID: {1}".format(key, value))
-                executor.submit(confirm_ami_success,key,value)
+            logging.info("Checking AMI states.  Please be patient this may take a few minutes")
+            images = await ec2.wait_for_images(image_ids, interval=30, callback=report_ami_state)
+        else:
+            images = {image['ImageId']: image for image in await ec2.describe_images(image_ids=image_ids)} if image_ids else {}
         logging.info("===================")
-    else:
+        logging.info("Confirming Successful AMI Image IDs")
         logging.info("===================")
-        logging.info("No instances found!")
+        for image_name, image_id in instance_amis.items():
+            if image_id in images and images[image_id]['State'] == 'available':
+                logging.info("Image %s (ID %s) is available", image_name, image_id)
         logging.info("===================")
-    logging.info("All done!")
-    sys.exit(0)
 
-def create_and_tag_ami(instance):
-    tags=get_tags(instance)
-    image_id=create_ami(instance,tags)
-    tag_ami(image_id,tags)
+async def create_and_tag_ami_async(ec2, instance): # Create and tag an AMI for an instance description
+    instance_id = instance['InstanceId']
+    try:
+        tags = ami_tags(instance_id, instance.get('Tags', []))
+        image_name = ami_name(tags)
+        if reuse_existing_ami(instance_id, tags):
+            return
+        if args.image_mode == 'snapshots' and ec2_utils.snapshot_image_supported(instance):
+            logging.info("Creating snapshots for instance %s", instance_id)
+            record_snapshot_set(instance, image_name, tags, await ec2.call('create_snapshots', **snapshot_request(instance_id, image_name, tags)))
+            return
+        logging.info("Creating AMI for instance %s", instance_id)
+        image_id = await ec2.create_image(instance_id, image_name)
+        logging.info("Image ID: %s, Image Name: %s, Image Description: %s", image_id, image_name, image_name)
+        instance_amis[image_name] = image_id
+        progress.add('created')
+        logging.info("Tagging AMI %s", image_id)
+        await ec2.create_tags([image_id], tags)
+        logging.info("Image %s tagged", image_id)
+        progress.add('tagged')
+    except ClientError as e:
+        logging.error("Error in create_and_tag_ami_async: %s", e)
+        progress.add('failed')
+    except Exception as e:
+        logging.error("Unexpected error in create_and_tag_ami_async: %s", e)
+        progress.add('failed')
 
 def print_args(args): # Print arguments passed from command line
     logging.info("Supplied arguments")
@@ -128,32 +293,203 @@ def print_args(args): # Print arguments passed from command line
     for key, value in vars(args).items():
         # Replace _ with space and capitalize first letter of each word
         key = key.replace("_"," ").title()
-        logging.info('{0} : {1}'.format(key, value))
+        logging.info('%s : %s', key, value)
     logging.info("===================")
 
 def aws_connect(args): # Connect to AWS
     try:
-        global session
+        global session, cassette
         logging.info("Connecting to AWS")
-        session = boto3.Session(profile_name=args.aws_profile,region_name=args.region)
+        if args.record or args.replay:
+            if args.engine == 'async':
+                logging.error("--record and --replay are not supported with --engine async")
+                sys.exit(1)
+            cassette = cassette_utils.Cassette(args.record or args.replay, mode='record' if args.record else 'replay', latency=args.replay_latency)
+            session = aws_utils.cassette_session(args.aws_profile, args.region, cassette)
+        else:
+            session = boto3.Session(profile_name=args.aws_profile,region_name=args.region)
+        progress.attach(session) # Count the requests sent by clients of the session
         logging.info("Connected to AWS")
-        logging.info("Session Details: {0}".format(session))
+        logging.info("Session Details: %s", session)
         logging.info("===================")
-    except ClientError as e:
-        logging.error("Error in aws_connect: {0}".format(e))
+    except (ClientError, OSError, ValueError) as e:
+        logging.error("Error in aws_connect: %s", e)
         sys.exit(1)
     except:
-        logging.error("Unexpected error in aws_connect: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in aws_connect: %s", sys.exc_info()[0])
+        sys.exit(1)
+
+def connect_account(): # Replace the session with one for the role in --account, refreshed before its credentials expire
+    try:
+        global session
+        if args.engine == 'async':
+            logging.error("--account, --org and --accounts are not supported with --engine async")
+            sys.exit(1)
+        assumed_roles = aws_utils.AssumedRoleSessions(session, role_name=args.role_name, session_name='CreateAndTagEC2AMI', duration=args.role_duration, external_id=args.external_id, cassette=cassette)
+        session = assumed_roles.get(args.account)
+        progress.attach(session)
+        logging.info("Using role %s in account %s", args.role_name, args.account)
+    except ClientError as e:
+        logging.error("Error in connect_account: %s", e)
+        sys.exit(1)
+
+def run_accounts(): # Run this script with --account for each account in a bounded pool of processes, then exit
+    try:
+        accounts = aws_utils.read_accounts(args.accounts) if args.accounts else aws_utils.list_accounts(session)
+    except (ClientError, OSError) as e:
+        logging.error("Error in run_accounts: %s", e)
+        sys.exit(1)
+    logging.info("Creating AMIs in %s accounts with role %s, %s at a time", len(accounts), args.role_name, args.org_max_workers)
+    results, failed = aws_utils.for_each_account(accounts, run_account, max_workers=args.org_max_workers)
+    logging.info("===================")
+    logging.info("Completed in %s of %s accounts", len(results), len(accounts))
+    if failed:
+        logging.error("Failed in %s accounts: %s", len(failed), ", ".join(sorted(failed)))
+        sys.exit(1)
+    sys.exit(0)
+
+def run_account(account): # Run this script for one account, relaying its output prefixed with the account ID
+    # Each account runs in its own process as instances and AMIs are tracked per run
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--account', account]
+    # Files written per run get the account ID added to their name, later arguments take precedence
+    for option, path in (('--log-file', args.log_file), ('--log-json', args.log_json), ('--record', args.record), ('--replay', args.replay)):
+        if path:
+            command += [option, account_path(path, account)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    for line in process.stdout:
+        logging.info("%s | %s", account, line.rstrip())
+    if process.wait() != 0:
+        raise RuntimeError("exited with status {}".format(process.returncode))
+    return process.returncode
+
+def account_path(path, account): # Add the account ID to a file name before its extensions (run.jsonl.gz -> run-<account>.jsonl.gz)
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition('.')
+    return os.path.join(directory, stem + '-' + account + dot + extensions)
+
+def load_jobs(): # Read the batch jobs file
+    try:
+        batch_jobs = jobs_utils.load_jobs(args.jobs, default_regions=[args.region])
+        for job in batch_jobs:
+            logging.info("Job %s: tags %s, instance IDs %s, regions %s, additional tags %s", job.name, job.tags, job.instance_ids, ", ".join(job.regions), job.add_tags)
+        if not batch_jobs:
+            logging.error("No jobs found in %s", args.jobs)
+            sys.exit(1)
+        return batch_jobs
+    except (OSError, ValueError, TypeError) as e:
+        logging.error("Error in load_jobs: %s", e)
+        sys.exit(1)
+
+def run_jobs(): # Create AMIs for every job in --jobs from one discovery pass per region through one shared pool, then exit
+    if any(not (value is None or key in non_filter_args) for key, value in vars(args).items()) or args.extra_tags or args.instance_ids:
+        logging.error("--jobs cannot be combined with tag filters, --extra-tags or --instance-ids, add them to a job instead")
+        sys.exit(1)
+    if args.engine != 'threads' or args.image_mode != 'create-image' or args.if_unchanged != 'create':
+        logging.error("--jobs supports --engine threads, --image-mode create-image and --if-unchanged create only")
+        sys.exit(1)
+    batch_jobs = load_jobs()
+    regions = sorted({region for job in batch_jobs for region in job.regions})
+    if args.copy_to_regions and len(regions) > 1:
+        logging.error("--copy-to-regions with --jobs supports jobs in a single region, not %s", ", ".join(regions))
+        sys.exit(1)
+    progress.start()
+    work = match_jobs(batch_jobs, discover_job_instances(batch_jobs, regions))
+    progress.add('discovered', len(work))
+    logging.info("===================")
+    if args.list_only:
+        logging.info("List Only Flag Set")
+        logging.info("Tags to be attached to AMI(s)")
+        logging.info("===================")
+        for (region, instance), tags in work.items():
+            logging.info("%s %s: %s", region, instance, tags)
+        logging.info("===================")
+        logging.info("Exiting without creating AMI(s)")
+        sys.exit(0)
+    if len(work) > 0:
+        # Every job's AMIs share one pool, so the slowest job does not hold back the others
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(work), args.jobs_max_workers)) as executor:
+            for (region, instance), tags in work.items():
+                progress.track(executor.submit(create_and_tag_ami, instance, tags, region))
+        complete_amis() # Log the AMIs created, wait for them when --wait or --copy-to-regions is set, and confirm them
+    else:
+        logging.info("===================")
+        logging.info("No instances found!")
+        logging.info("===================")
+    progress.stop()
+    logging.info("All done!")
+    sys.exit(0)
+
+def discover_job_instances(batch_jobs, regions): # Describe the instances the jobs could select with one paginated pass per region, regions in parallel
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            futures = {region: executor.submit(discover_region_instances, [job for job in batch_jobs if region in job.regions], region) for region in regions}
+            return {region: future.result() for region, future in futures.items()}
+    except ClientError as e:
+        logging.error("Error in discover_job_instances: %s", e)
         sys.exit(1)
 
+def discover_region_instances(batch_jobs, region): # Running and stopped instances of a region selected by the tag filters or instance IDs of its jobs
+    ec2 = session.client('ec2', region_name=region)
+    paginator = ec2.get_paginator('describe_instances')
+    states = {'Name': 'instance-state-name', 'Values': ['running', 'stopped']}
+    instances = {}
+    if any(job.tags for job in batch_jobs):
+        # Tag keys filtered on by every job narrow the pass, each job's own filters are then matched locally
+        filters = jobs_utils.shared_filters(batch_jobs) + [states]
+        logging.info("Finding instances in %s with filters: %s", region, filters)
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance
+    # Instance IDs not returned by the tag pass, filtered by ID so that IDs in other regions are not an error
+    missing = sorted({instance for job in batch_jobs for instance in job.instance_ids} - set(instances))
+    for start in range(0, len(missing), 200):
+        for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': missing[start:start + 200]}, states]):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance
+    logging.info("Found %s instances in %s", len(instances), region)
+    if args.reuse_window > 0:
+        # Index recent AMIs so instances that already have one are not imaged again
+        region_images[region] = ec2_utils.ExistingImageIndex.load(ec2, args.reuse_window)
+        logging.info("Found %s AMIs created within the last %s minutes in %s", len(region_images[region].images), args.reuse_window, region)
+    return instances
+
+def match_jobs(batch_jobs, instances): # Match every job against the discovered instances, returning (region, instance) --> AMI tags
+    work = {}
+    selected = {job.name: [] for job in batch_jobs}
+    add_tags = jobs_utils.parse_tag_list(args.add_tags)
+    for region, region_instances in instances.items():
+        for instance, description in region_instances.items():
+            tags = {tag['Key']: tag['Value'] for tag in description.get('Tags') or []}
+            matched = [job for job in batch_jobs if job.matches(tags, instance, region)]
+            if not matched:
+                continue
+            for job in matched:
+                selected[job.name].append(instance)
+            if len(matched) > 1:
+                logging.info("Instance %s is selected by jobs %s, one AMI is created with the additional tags of each", instance, ", ".join(job.name for job in matched))
+            # --add-tags apply to every job, later jobs in the file take precedence for the same key
+            instance_add_tags = dict(add_tags)
+            for job in matched:
+                instance_add_tags.update(job.add_tags)
+            # The tags are taken from the shared DescribeInstances result rather than read again for each instance
+            work[(region, instance)] = ami_tags(instance, description.get('Tags') or [], instance_add_tags)
+    for job in batch_jobs:
+        logging.info("Job %s: %s instances %s", job.name, len(selected[job.name]), selected[job.name])
+        not_found = [instance for instance in job.instance_ids if instance not in selected[job.name]]
+        if not_found:
+            logging.warning("Job %s: instance IDs not found or not running or stopped: %s", job.name, ", ".join(not_found))
+    return work
+
 def find_instances(args): # Find instances based on supplied arguments
     try:
         logging.info("Finding instances based on tags")
         ec2 = session.client('ec2')
         filters = []
         for key, value in vars(args).items():
-            logging.debug("{0} : {1}".format(key, value))
-            if not (value is None or key == 'aws_profile' or key == 'region' or key == 'log_file' or key == 'log_level' or key == 'list_only' or key == 'wait' or key == 'instance_ids' or key == 'extra_tags' or key == 'add_tags' ): # Ignore None values and profile, region, logging or additional tag details
+            logging.debug("%s : %s", key, value)
+            if not (value is None or key in non_filter_args): # Ignore None values and profile, region, logging or additional tag details
                 json_data = {'Name': 'tag:' + key.capitalize(), 'Values': [value]}
                 filters.append(json_data)
         # Handle extra-tags dictionary if supplied
@@ -165,154 +501,320 @@ def find_instances(args): # Find instances based on supplied arguments
                     key, value = tag.split('=')
                     json_data = {'Name': 'tag:' + key.capitalize(), 'Values': [value]}
                     filters.append(json_data)
-        logging.info("Filters: {0}".format(filters))
+        logging.info("Filters: %s", filters)
         if len(filters) > 0:
             reservations = ec2.describe_instances(Filters=filters)['Reservations']
             for reservation in reservations:
                 for instance in reservation['Instances']:
                     instance_ids.append(instance['InstanceId'])
-            logging.info("Found instances: {0}".format(instance_ids))
+            logging.info("Found instances: %s", instance_ids)
         else:
             logging.info("No filters supplied.  Bypassing tag based instance search")
         # Add directly provided instance IDs to list checking first if they are not already in the list
         if args.instance_ids:
             if args.instance_ids is not None:
-                logging.info("Direct instance IDs provided {0}".format(args.instance_ids))
+                logging.info("Direct instance IDs provided %s", args.instance_ids)
                 logging.info("Checking if they are not already in the list")
                 for instance in args.instance_ids.split(','):
                     if instance not in instance_ids:
-                        logging.info("Adding instance ID: {0}".format(instance))
+                        logging.info("Adding instance ID: %s", instance)
                         instance_ids.append(instance)
                     else:
-                        logging.info("Instance ID: {0} already in list".format(instance))
-                logging.info("All instances: {0}".format(instance_ids))
+                        logging.info("Instance ID: %s already in list", instance)
+                logging.info("All instances: %s", instance_ids)
     except ClientError as e:
-        logging.error("Error in find_instances: {0}".format(e))
-        logging.error("Arguments: {0}".format(args))
+        logging.error("Error in find_instances: %s", e)
+        logging.error("Arguments: %s", args)
         sys.exit(1)
     except ParamValidationError as e:
-        logging.error("Error in find_instances: {0}".format(e))
-        logging.error("Arguments: {0}".format(args))
+        logging.error("Error in find_instances: %s", e)
+        logging.error("Arguments: %s", args)
         sys.exit(1)
     except AttributeError as e:
-        logging.error("Error in find_instances: {0}".format(e))
-        logging.error("Arguments: {0}".format(args))
+        logging.error("Error in find_instances: %s", e)
+        logging.error("Arguments: %s", args)
         sys.exit(1)
     except:
-        logging.error("Unexpected error in find_instances: {0}".format(sys.exc_info()[0]))
-        logging.error("Unexpected error in find_instances! Arguments provided: {0}".format(args))
+        logging.error("Unexpected error in find_instances: %s", sys.exc_info()[0])
+        logging.error("Unexpected error in find_instances! Arguments provided: %s", args)
         sys.exit(1)
 
+def skip_unchanged_instances(): # Remove instances whose volumes have not changed since their latest AMI from the instance list
+    try:
+        logging.info("Checking for instances unchanged since their latest AMI")
+        ec2 = session.client('ec2')
+        latest_images = ec2_utils.latest_instance_images(ec2, instance_ids)
+        if not latest_images:
+            logging.info("No earlier AMIs found to compare against")
+            return
+        instances = []
+        for page in ec2.get_paginator('describe_instances').paginate(InstanceIds=list(latest_images)):
+            for reservation in page['Reservations']:
+                instances.extend(reservation['Instances'])
+        detector = ebs.ChangeDetector(ec2, session.client('ebs'), session.client('cloudwatch'), threshold=args.change_threshold * 1024 * 1024)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(instances), 20)) as executor:
+            unchanged = list(executor.map(lambda instance: detector.unchanged(instance, latest_images[instance['InstanceId']]), instances))
+        for instance, is_unchanged in zip(instances, unchanged):
+            if not is_unchanged:
+                continue
+            image = latest_images[instance['InstanceId']]
+            logging.info("Instance %s unchanged since image %s (%s), skipping", instance['InstanceId'], image['ImageId'], image['Name'])
+            instance_ids.remove(instance['InstanceId'])
+            if args.if_unchanged == 'retag' and not args.list_only:
+                ec2.create_tags(Resources=[image['ImageId']], Tags=[{'Key': 'VerifiedUnchanged', 'Value': date + ' ' + timestamp + ' UTC'}])
+                logging.info("Image %s tagged as verified unchanged", image['ImageId'])
+        logging.info("Instances to create AMIs for: %s", instance_ids)
+    except ClientError as e:
+        # Change detection is an optimisation, on failure every instance is imaged
+        logging.warning("Error in skip_unchanged_instances: %s - creating AMIs for all instances", e)
+
 def get_tags(instance): # Get tags for instances
     try:
-        logging.info("Getting tags for instance {0}".format(instance))
+        logging.info("Getting tags for instance %s", instance)
         ec2 = session.resource('ec2')
         ec2instance=ec2.Instance(instance)
-        logging.debug("Instance: {0}".format(ec2instance))
-        logging.debug("Tags: {0}".format(ec2instance.tags))
-        instance_tags = []
-        for tag in ec2instance.tags:
-            if (tag['Key'] == 'Name' or tag['Key'] == 'Product' or tag['Key'] == 'Environment' or tag['Key'] == 'Tenant' or tag['Key'] == 'Role'):
-                json_data = {'Key': tag['Key'], 'Value': tag['Value']}
-                instance_tags.append(json_data)
-        # Adding a Date tag
-        json_data = {'Key': 'Date', 'Value': date}
-        instance_tags.append(json_data)
-        # Adding a Time tag
-        json_data = {'Key': 'Timestamp', 'Value': timestamp + ' UTC'}
-        instance_tags.append(json_data)
-        # If args.add_tags is not empty add the additional tags to the list of tags to be attached to the AMI
-        if args.add_tags:
-            if args.add_tags is not None:
-                logging.debug("Additional tags provided: {0}".format(args.add_tags))
-                add_tags=args.add_tags.split(',')
-                logging.debug("Additional tags split: {0}".format(add_tags))
-                for tag in add_tags:
-                    key, value = tag.split('=')
-                    logging.debug("Adding tag: {0} with value: {1}".format(key, value))
-                    json_data = {'Key': key.capitalize(), 'Value': value}
-                    logging.debug("Adding tag: {0}".format(json_data))
-                    instance_tags.append(json_data)
-        logging.info("Instance {1} tags: {0}".format(instance_tags, instance))
-        return instance_tags
+        logging.debug("Instance: %s", ec2instance)
+        logging.debug("Tags: %s", ec2instance.tags)
+        return ami_tags(instance, ec2instance.tags)
     except ClientError as e:
-        logging.error("Error in get_tags: {0}".format(e))
+        logging.error("Error in get_tags: %s", e)
     except Exception as e:
-        logging.error("Unexpected error in get_tags: {0}".format(e))
-        logging.error("Unexpected error in get_tags: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in get_tags: %s", e)
+        logging.error("Unexpected error in get_tags: %s", sys.exc_info()[0])
 
-def create_ami(instance,tags): # Create AMI
+def ami_tags(instance, tags, add_tags=None): # Build the tags to attach to an AMI from its instance tags, with --add-tags or the given additional tags
+    instance_tags = []
+    for tag in tags:
+        if (tag['Key'] == 'Name' or tag['Key'] == 'Product' or tag['Key'] == 'Environment' or tag['Key'] == 'Tenant' or tag['Key'] == 'Role'):
+            json_data = {'Key': tag['Key'], 'Value': tag['Value']}
+            instance_tags.append(json_data)
+    # Adding a Date tag
+    json_data = {'Key': 'Date', 'Value': date}
+    instance_tags.append(json_data)
+    # Adding a Time tag
+    json_data = {'Key': 'Timestamp', 'Value': timestamp + ' UTC'}
+    instance_tags.append(json_data)
+    # Adding a source instance tag so later runs can find the AMIs already created from the instance
+    json_data = {'Key': ec2_utils.SOURCE_INSTANCE_TAG, 'Value': instance}
+    instance_tags.append(json_data)
+    # If args.add_tags is not empty add the additional tags to the list of tags to be attached to the AMI
+    if add_tags is None:
+        logging.debug("Additional tags provided: %s", args.add_tags)
+        add_tags = jobs_utils.parse_tag_list(args.add_tags)
+    for key, value in add_tags.items():
+        logging.debug("Adding tag: %s with value: %s", key, value)
+        json_data = {'Key': key.capitalize(), 'Value': value}
+        logging.debug("Adding tag: %s", json_data)
+        instance_tags.append(json_data)
+    logging.info("Instance %s tags: %s", instance, instance_tags)
+    return instance_tags
+
+def ami_name(tags): # AMI name from the instance Name tag, date and time
+    for tag in tags:
+        if tag['Key'] == 'Name':
+            return tag['Value'] + '-' + date + '-' + timestamp.replace(':', '')
+
+def load_existing_images(): # Index AMIs created within the reuse window with one paginated describe_images call
+    global existing_images
     try:
-        logging.info("Creating AMI for instance {0}".format(instance))
+        logging.info("Finding AMIs created within the last %s minutes", args.reuse_window)
         ec2 = session.client('ec2')
-        for tag in tags:
-            if tag['Key'] == 'Name':
-                image_name = tag['Value'] + '-' + date + '-' + timestamp.replace(':', '')
-                image_description = image_name
+        existing_images = ec2_utils.ExistingImageIndex.load(ec2, args.reuse_window)
+        logging.info("Found %s AMIs created within the last %s minutes", len(existing_images.images), args.reuse_window)
+    except ClientError as e:
+        logging.error("Error in load_existing_images: %s", e)
+        sys.exit(1)
+
+def reuse_existing_ami(instance, tags, region=None): # Record an existing AMI of the instance instead of creating another, returns True if one was found
+    index = existing_images if region is None else region_images.get(region)
+    if index is None or tags is None:
+        return False
+    image = index.find(instance, name=ami_name(tags), window=args.reuse_window)
+    if image is None:
+        return False
+    logging.info("Reusing image %s (%s) created %s from instance %s", image['ImageId'], image['Name'], image['CreationDate'], instance)
+    record_ami(image['Name'], image['ImageId'], region)
+    # A reused AMI already exists and is tagged
+    progress.add('created')
+    progress.add('tagged')
+    return True
+
+def create_ami(instance,tags,region=None): # Create AMI
+    try:
+        logging.info("Creating AMI for instance %s", instance)
+        ec2 = session.client('ec2', region_name=region)
+        image_name = ami_name(tags)
+        image_description = image_name
         response = ec2.create_image(InstanceId=instance, Name=image_name, Description=image_description, NoReboot=True)
-        logging.debug("Service response for creating AMI: {0}".format(response))
+        logging.debug("Service response for creating AMI: %s", response)
         for field in response:
             if field == 'ImageId':
                 image_id = response[field]
-        logging.info("Image ID: {0}, Image Name: {1}, Image Description: {2}".format(image_id, image_name, image_description))
-        instance_amis[image_name] = image_id
+        logging.info("Image ID: %s, Image Name: %s, Image Description: %s", image_id, image_name, image_description)
+        record_ami(image_name, image_id, region)
+        progress.add('created')
         return image_id
     except ClientError as e:
-        logging.error("Error in create_ami: {0}".format(e))
+        logging.error("Error in create_ami: %s", e)
+        progress.add('failed')
     except Exception as e:
-        logging.error("Unexpected error in create_ami: {0}".format(e))
-        logging.error("Unexpected error in create_ami: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in create_ami: %s", e)
+        progress.add('failed')
+        logging.error("Unexpected error in create_ami: %s", sys.exc_info()[0])
+
+def record_ami(image_name, image_id, region=None): # Remember an AMI created or reused by this run, and its region when it is not --region
+    if region is None:
+        instance_amis[image_name] = image_id
+    else:
+        # Jobs in several regions can create AMIs with the same name
+        instance_amis[region + ':' + image_name] = image_id
+        image_regions[image_id] = region
 
-def tag_ami(image_id, tags): # Tag AMI
+def create_snapshot_set(instance, tags): # Snapshot all volumes of an instance at once for a crash-consistent AMI, returns False if CreateImage must be used instead
     try:
-        logging.info("Tagging AMI {0}".format(image_id))
-        ec2 = session.resource('ec2')
+        ec2 = session.client('ec2')
+        description = ec2.describe_instances(InstanceIds=[instance])['Reservations'][0]['Instances'][0]
+        if not ec2_utils.snapshot_image_supported(description):
+            logging.info("Instance %s has a licensed platform, using CreateImage", instance)
+            return False
+        logging.info("Creating snapshots for instance %s", instance)
+        image_name = ami_name(tags)
+        record_snapshot_set(description, image_name, tags, ec2.create_snapshots(**snapshot_request(instance, image_name, tags)))
+        return True
+    except ClientError as e:
+        logging.error("Error in create_snapshot_set: %s - falling back to CreateImage for instance %s", e, instance)
+        return False
+
+def snapshot_request(instance, image_name, tags): # CreateSnapshots parameters for an instance
+    return {'InstanceSpecification': {'InstanceId': instance, 'ExcludeBootVolume': False}, 'Description': image_name, 'TagSpecifications': [{'ResourceType': 'snapshot', 'Tags': tags}]}
+
+def record_snapshot_set(instance, image_name, tags, response): # Remember a snapshot set until its AMI can be registered
+    snapshot_ids = [snapshot['SnapshotId'] for snapshot in response['Snapshots']]
+    logging.info("Snapshot IDs: %s, Image Name: %s", snapshot_ids, image_name)
+    snapshot_sets[instance['InstanceId']] = {'instance': instance, 'image_name': image_name, 'tags': tags, 'snapshot_ids': snapshot_ids}
+
+def register_snapshot_images(): # Wait for snapshot sets with one batched describe_snapshots call per poll, registering each AMI as soon as its set completes
+    try:
+        logging.info("Waiting for %s snapshot sets to complete before registering AMIs", len(snapshot_sets))
+        ec2 = session.client('ec2')
+        poller = image_poller(15)
+        for instance, snapshot_set in snapshot_sets.items():
+            poller.add_snapshots(args.region, snapshot_set['snapshot_ids'], functools.partial(register_snapshot_image, ec2, instance))
+        poller.run()
+    except ClientError as e:
+        logging.error("Error in register_snapshot_images: %s", e)
+
+def register_snapshot_image(ec2, instance, region, snapshots): # Register and tag an AMI from a completed snapshot set
+    try:
+        snapshot_set = snapshot_sets[instance]
+        image_name = snapshot_set['image_name']
+        failed = [snapshot['SnapshotId'] for snapshot in snapshots if snapshot['State'] != 'completed']
+        if failed:
+            logging.error("Snapshots %s for image %s failed", failed, image_name)
+            progress.add('failed')
+            return
+        image_id = ec2_utils.register_image_from_snapshots(ec2, snapshot_set['instance'], snapshots, image_name)
+        logging.info("Image ID: %s, Image Name: %s, registered from snapshots %s", image_id, image_name, snapshot_set['snapshot_ids'])
+        instance_amis[image_name] = image_id
+        progress.add('created')
+        tag_ami(image_id, snapshot_set['tags'])
+    except ClientError as e:
+        logging.error("Error in register_snapshot_image: %s", e)
+        progress.add('failed')
+
+def tag_ami(image_id, tags, region=None): # Tag AMI
+    try:
+        logging.info("Tagging AMI %s", image_id)
+        ec2 = session.resource('ec2', region_name=region)
         image = ec2.Image(image_id)
         image.create_tags(Tags=tags)
-        logging.debug("Adding tags: {0}".format(tags))
-        logging.info("Image {0} tagged".format(image_id))
+        logging.debug("Adding tags: %s", tags)
+        logging.info("Image %s tagged", image_id)
+        progress.add('tagged')
     except ClientError as e:
-        logging.error("Error in tag_ami: {0}".format(e))
+        logging.error("Error in tag_ami: %s", e)
+        progress.add('failed')
     except Exception as e:
-        logging.error("Unexpected error in tag_ami: {0}".format(e))
-        logging.error("Unexpected error in tag_ami: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in tag_ami: %s", e)
+        progress.add('failed')
+        logging.error("Unexpected error in tag_ami: %s", sys.exc_info()[0])
 
-def check_ami_state(image_id): # Check AMI state
+def image_poller(interval): # Poller for images and snapshot sets, driven by the --event-queue events with a polling fallback when set
+    if not args.event_queue:
+        return ec2_utils.ImagePoller(session, interval=interval)
+    events = ec2_utils.ImageStateEvents(session, args.event_queue)
+    return ec2_utils.ImagePoller(session, interval=args.event_fallback_interval, events=events)
+
+def check_ami_states(image_ids): # Check AMI states with one batched describe_images call per poll, copying images to other regions as they become available
     try:
-        logging.info("Checking AMI state for {0} every 30 seconds".format(image_id))
-        ec2 = session.client('ec2')
-        image_state = ec2.describe_images(ImageIds=[image_id])['Images'][0]['State']
-        logging.info("Image {1} state: {0}".format(image_state, image_id))
-        while image_state == 'pending':
-            time.sleep(30)
-            image_state = ec2.describe_images(ImageIds=[image_id])['Images'][0]['State']
-            logging.info("Image {1} state: {0}".format(image_state, image_id))
-            if image_state != 'pending':
-                if image_state == 'available':
-                    logging.debug("Image {0} is available".format(image_id))
-                    return True
-                elif image_state == 'failed':
-                    logging.error("Image {0} failed".format(image_id))
-                    return False
-                else:
-                    logging.warning("Image {0} is in unknown state: {1} please verify manually from the AWS Console".format(image_id, image_state))
-                    return False
+        poller = image_poller(30)
+        logging.info("Checking AMI state for %s images every %s seconds%s", len(image_ids), poller.interval, ' and as state change events arrive' if poller.events else '')
+        pipeline = None
+        if args.copy_to_regions:
+            destinations = [region.strip() for region in args.copy_to_regions.split(',')]
+            pipeline = ec2_utils.CopyPipeline(poller, next(iter(image_regions.values()), args.region), destinations, kms_key_ids=copy_kms_key_ids(destinations), max_concurrent=args.copy_max_concurrent)
+        for image_id in image_ids:
+            if image_id is None:
+                continue
+            poller.add(image_regions.get(image_id, args.region), image_id, functools.partial(source_ami_complete, pipeline))
+        poller.run()
+        if pipeline:
+            logging.info("===================")
+            logging.info("Copied AMIs")
+            logging.info("===================")
+            for (region, source_id), copy_id in pipeline.copies.items():
+                logging.info("Source Image ID: %s - Region: %s - Image ID: %s", source_id, region, copy_id)
+            for region, image_id in pipeline.failed:
+                logging.error("Image %s in %s failed", image_id, region)
+            for region, copy_id in pipeline.untagged:
+                logging.error("Copy %s in %s could not be tagged", copy_id, region)
     except ClientError as e:
-        logging.error("Error in check_ami_state: {0}".format(e))
+        logging.error("Error in check_ami_states: %s", e)
     except Exception as e:
-        logging.error("Unexpected error in check_ami_state: {0}".format(e))
-        logging.error("Unexpected error in check_ami_state: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in check_ami_states: %s", e)
+        logging.error("Unexpected error in check_ami_states: %s", sys.exc_info()[0])
+
+def source_ami_complete(pipeline, region, image): # Count an AMI that is no longer pending, then copy it to other regions or log its state
+    if pipeline:
+        progress.add('available' if image['State'] == 'available' else 'failed')
+        pipeline.source_complete(region, image)
+    else:
+        report_ami_state(region, image)
+
+def report_ami_state(region, image): # Log the final state of an AMI once it is no longer pending
+    image_id = image['ImageId']
+    image_state = image['State']
+    progress.add('available' if image_state == 'available' else 'failed')
+    logging.info("Image %s state: %s", image_id, image_state)
+    if image_state == 'available':
+        logging.debug("Image %s is available", image_id)
+    elif image_state == 'failed':
+        logging.error("Image %s failed", image_id)
+    else:
+        logging.warning("Image %s is in unknown state: %s please verify manually from the AWS Console", image_id, image_state)
+
+def copy_kms_key_ids(destinations): # KMS key to re-encrypt copies with for each destination region
+    if not args.copy_kms_key_id:
+        return {}
+    if '=' not in args.copy_kms_key_id:
+        return {region: args.copy_kms_key_id for region in destinations}
+    kms_key_ids = {}
+    for pair in args.copy_kms_key_id.split(','):
+        region, key_id = pair.split('=', 1)
+        kms_key_ids[region.strip()] = key_id.strip()
+    return kms_key_ids
 
 def confirm_ami_success(image_name,image_id): # Confirm AMI success
     try:
-        ec2 = session.client('ec2')
+        ec2 = session.client('ec2', region_name=image_regions.get(image_id))
         image_state = ec2.describe_images(ImageIds=[image_id])['Images'][0]['State']
         if image_state == 'available':
-            logging.info("Image {0} (ID {1}) is available".format(image_name,image_id))
+            logging.info("Image %s (ID %s) is available", image_name, image_id)
     except ClientError as e:
-        logging.error("Error in confirm_ami_success: {0}".format(e))
+        logging.error("Error in confirm_ami_success: %s", e)
     except Exception as e:
-        logging.error("Unexpected error in confirm_ami_success: {0}".format(e))
-        logging.error("Unexpected error in confirm_ami_success: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in confirm_ami_success: %s", e)
+        logging.error("Unexpected error in confirm_ami_success: %s", sys.exc_info()[0])
 
-main() # Call main function
+with profiling.Profiler(args.profile, profiling.profile_prefix(os.path.dirname(args.log_file) if args.log_file else None, 'CreateAndTagEC2AMI-{}{}-UTC'.format(args.account + '-' if args.account else '', datetime.now(timezone.utc).strftime('%Y-%m-%d_%H%M%S')))): # Profile the run when --profile is set
+    main() # Call main function
@@ -1,13 +1,21 @@
+import time
+init_started = time.perf_counter() # Start of the init phase, used by the cold start profile
+import os
 import sys
 import logging
-import time
+import threading
 import concurrent.futures
-import boto3
 from botocore.exceptions import ClientError,ParamValidationError
 from datetime import datetime
 
+# Import local modules - packaged alongside the handler, or from ../../PythonUtilities when run from the repo
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'PythonUtilities'))
+import modules.output as output
+import modules.ec2 as ec2_utils
+import modules.progress as progress_utils
+
 # Global Variables
-log_level=logging.DEBUG
+log_level=os.environ.get('LOG_LEVEL', 'INFO').upper()
 log_format='[%(levelname)s] %(asctime)s %(message)s'
 instance_ids=[]
 instance_amis={}
@@ -22,16 +30,54 @@ extra_tags = None
 add_tags = None
 instance_id_list= None
 wait = None
+reuse_window = None
+existing_images = None
 date = datetime.now().strftime('%Y-%m-%d')
 timestamp = datetime.now().strftime('%H:%M')
+# Cold start handling - see "Cold starts" in readme.md
+cold_start = True
+cold_start_profile = os.environ.get('COLD_START_PROFILE', 'false').lower() == 'true'
+init_type = os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE', 'on-demand')
+pre_initialize = os.environ.get('PRE_INITIALIZE', str(init_type in ('snap-start', 'provisioned-concurrency'))).lower() == 'true'
+profile_phases = []
+botocore_session = None
+ec2_clients = {}
+# Record or replay AWS API calls - see "Recording and replaying AWS calls" in readme.md
+cassette_path = os.environ.get('CASSETTE')
+cassette_mode = os.environ.get('CASSETTE_MODE', 'replay').lower()
+cassette_latency = float(os.environ.get('CASSETTE_LATENCY', '0'))
+# Profile invocations - cpu, mem or wall, see "Profiling" in readme.md
+profile_mode = os.environ.get('PROFILE', '').lower() or None
+# SQS queue of EventBridge AMI state change events used to wait for AMIs - see "Event-driven completion" in readme.md
+event_queue_url = os.environ.get('EVENT_QUEUE_URL')
+# Progress log lines - see "Progress" in readme.md
+progress_mode = os.environ.get('PROGRESS', 'log').lower()
+progress_interval = int(os.environ.get('PROGRESS_INTERVAL', progress_utils.DEFAULT_LOG_INTERVAL))
+progress = None
+client_lock = threading.Lock()
 
-# Configure logging
-logging.basicConfig(
-    level=log_level,
-    format=log_format
-    )
+# Configure logging - records are queued and written to stdout (CloudWatch) by a background listener thread
+output.configure_logging(log_level=log_level, log_format=log_format)
 
 def lambda_handler(event, context): # Main function
+    if profile_mode is None:
+        return handle_event(event, context)
+    # Imported on first use so the profilers are not loaded during the init phase unless needed
+    import modules.profiling as profiling
+    try:
+        with profiling.Profiler(profile_mode, profiling.profile_prefix('/tmp', 'CreateAndTagEC2AMI-' + datetime.now().strftime('%Y-%m-%d_%H%M%S'))):
+            return handle_event(event, context)
+    finally:
+        output.flush_logging() # Ensure the profile summary reaches CloudWatch before the environment is frozen
+
+def handle_event(event, context): # Create and tag AMIs for the instances matching the event
+    global date, timestamp, cold_start, progress
+    invoke_started = time.perf_counter()
+    if event.get('detail-type') == ec2_utils.IMAGE_STATE_EVENT:
+        return handle_image_state_event(event) # Invoked by the EventBridge rule rather than to create AMIs
+    # Module state survives between invocations of a warm (or restored) environment
+    instance_ids.clear()
+    instance_amis.clear()
     # Capturing variables values from request
     region = event.get('region')
     product_tag = event.get('product_tag')
@@ -44,32 +90,46 @@ def lambda_handler(event, context): # Main function
     add_tags = event.get('add_tags')
     instance_id_list = event.get('instance_id_list')
     wait = event.get('wait')
+    reuse_window = event.get('reuse_window')
+    queue_url = event.get('event_queue_url') or event_queue_url
+    event_fallback_interval = event.get('event_fallback_interval')
     # Setting default values for variables that need them if none are provided
     if region is None:
         region = 'us-east-1' # Default region
     if wait is None:
         wait = False # Default do not wait
+    if reuse_window is None:
+        reuse_window = 60 # Default reuse AMIs created within the last hour
+    if event_fallback_interval is None:
+        event_fallback_interval = 300 # Default poll every 5 minutes for images whose events were missed
     # Setting current date and time
     date = datetime.now().strftime('%Y-%m-%d')
     timestamp = datetime.now().strftime('%H:%M')
-    print_args(region=region,product=product_tag,environment=environment_tag,tenant=tenant_tag,role=role_tag,owner=owner_tag,name=name_tag,instance_id_list=instance_id_list,wait=wait) # Print arguments passed from command line
+    progress = progress_utils.Progress(['discovered', 'created', 'tagged', 'available'], goal='available' if wait == True else 'tagged', mode='off' if progress_mode == 'off' else 'log', log_interval=progress_interval, name='AMIs').start()
+    print_args(region=region,product=product_tag,environment=environment_tag,tenant=tenant_tag,role=role_tag,owner=owner_tag,name=name_tag,instance_id_list=instance_id_list,wait=wait,reuse_window=reuse_window) # Print arguments passed from command line
     find_instances(region=region,product=product_tag,environment=environment_tag,tenant=tenant_tag,role=role_tag,owner=owner_tag,name=name_tag,instance_id_list=instance_id_list,extra_tags=extra_tags,wait=wait) # Find instances based on supplied arguments
+    progress.add('discovered', len(instance_ids))
     # If 1 or more instances are found iterate through all instances found and create AMI with tags
     if len(instance_ids) > 0:
+        # Index recent AMIs so instances that already have one are not imaged again by a retried invocation
+        existing_images = load_existing_images(int(reuse_window)) if int(reuse_window) > 0 else None
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(instance_ids)) as executor:
             for instance in instance_ids:
-                executor.submit(create_and_tag_ami, instance, add_tags=add_tags)
+                progress.track(executor.submit(create_and_tag_ami, instance, add_tags=add_tags, existing_images=existing_images, reuse_window=int(reuse_window)))
             logging.info("===================")
         logging.info("Created AMIs")
         logging.info("===================")
         for key, value in instance_amis.items():
-            logging.info("Image Name: {0} - Image ID: {1}".format(key, value))
+            logging.info("Image Name: %s - Image ID: %s", key, value)
         logging.info("===================")
         if wait == True:
             logging.info("Checking AMI states.  Please be patient this may take a few minutes")
-            with concurrent.futures.ThreadPoolExecutor(max_workers=len(instance_amis)) as executor:
-                for key, value in instance_amis.items():
-                    executor.submit(check_ami_state,value)
+            if queue_url:
+                wait_for_image_events(list(instance_amis.values()), queue_url, int(event_fallback_interval))
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(instance_amis)) as executor:
+                    for key, value in instance_amis.items():
+                        executor.submit(check_ami_state,value)
             logging.info("===================")
         logging.info("Confirming Successful AMI Image IDs")
         logging.info("===================")
@@ -82,13 +142,71 @@ def lambda_handler(event, context): # Main function
         logging.info("===================")
         logging.info("No instances found!")
         logging.info("===================")
+    progress.stop()
     logging.info("All done!")
+    profile_phase('invoke', invoke_started)
+    if cold_start_profile:
+        logging.info("Cold start profile (%s start, %s): %s", 'cold' if cold_start else 'warm', init_type, ", ".join("%s %sms" % phase for phase in profile_phases))
+        profile_phases.clear()
+    cold_start = False
+    output.flush_logging() # Ensure queued records reach CloudWatch before the environment is frozen
     sys.exit(0)
 
-def create_and_tag_ami(instance, add_tags): # Create AMI and tag it
+def create_and_tag_ami(instance, add_tags, existing_images=None, reuse_window=0): # Create AMI and tag it
     tags=get_tags(instance, add_tags)
+    if existing_images is not None and tags is not None:
+        image = existing_images.find(instance, name=ami_name(tags), window=reuse_window)
+        if image is not None:
+            logging.info("Reusing image %s (%s) created %s from instance %s", image['ImageId'], image['Name'], image['CreationDate'], instance)
+            instance_amis[image['Name']] = image['ImageId']
+            # A reused AMI already exists and is tagged
+            progress.add('created')
+            progress.add('tagged')
+            return
     image_id=create_ami(instance,tags)
-    tag_ami(image_id,tags)
+    if image_id is not None:
+        tag_ami(image_id,tags)
+
+def profile_phase(phase, started): # Record the duration of an init or invoke phase when cold start profiling is enabled
+    if cold_start_profile:
+        profile_phases.append((phase, round((time.perf_counter() - started) * 1000, 1)))
+
+def ec2_client(): # Shared EC2 client - only the EC2 service model is loaded, on first use unless pre-initialized
+    global botocore_session
+    with client_lock:
+        if region not in ec2_clients:
+            started = time.perf_counter()
+            # botocore is used directly as boto3 also imports s3transfer and the resource models
+            import botocore.session
+            if botocore_session is None:
+                botocore_session = botocore.session.get_session()
+                if cassette_path:
+                    attach_cassette(botocore_session)
+                botocore_session.register('before-send', count_request)
+            ec2_clients[region] = botocore_session.create_client('ec2', region_name=region)
+            profile_phase('ec2_client', started)
+        return ec2_clients[region]
+
+def attach_cassette(session): # Record the session's AWS API calls to, or replay them from, the CASSETTE file
+    import modules.cassette as cassette_utils
+    cassette = cassette_utils.Cassette(cassette_path, mode=cassette_mode, latency=cassette_latency)
+    if cassette_mode == 'replay':
+        # Replayed requests never reach AWS, placeholder credentials are only used to sign them
+        session.set_credentials(cassette_utils.REPLAY_ACCESS_KEY_ID, cassette_utils.REPLAY_SECRET_ACCESS_KEY)
+    cassette.attach(session)
+
+def count_request(**kwargs): # Count an AWS request in the progress of the current invocation
+    if progress is not None:
+        progress.count_request()
+
+def before_snapshot(): # Pre-initialization hook - load the EC2 service model and create the client during the init phase
+    started = time.perf_counter()
+    ec2_client()
+    profile_phase('pre_initialize', started)
+
+def after_restore(): # SnapStart restore hook - clients are recreated from the loaded service model so they use the restored environment's credentials
+    with client_lock:
+        ec2_clients.clear()
 
 def print_args(**kwargs): # Print arguments passed from command line
     # kwargs=dict(kwargs)
@@ -97,16 +215,16 @@ def print_args(**kwargs): # Print arguments passed from command line
     for kw in kwargs:
         # Replace _ with space and capitalize first letter of each word
         key = kw.replace("_"," ").title()
-        logging.info('{0} : {1}'.format(key,kwargs[kw]))
+        logging.info('%s : %s', key, kwargs[kw])
     logging.info("===================")
 
 def find_instances(**kwargs): # Find instances based on supplied arguments
     try:
         logging.info("Finding instances based on tags")
-        ec2 = boto3.client('ec2', region_name=region)
+        ec2 = ec2_client()
         filters = []
         for kw in kwargs:
-            logging.debug("{0} : {1}".format(kw,kwargs[kw]))
+            logging.debug("%s : %s", kw, kwargs[kw])
             if not (kwargs[kw] is None or kw == 'aws_profile' or kw == 'region' or kw == 'log_file' or kw == 'log_level' or kw == 'wait' or kw == 'instance_id_list' or kw == 'extra_tags'): # Ignore None values and profile, region and logging details
                 json_data = dict(Name = 'tag:' + kw.capitalize(), Values = [kwargs[kw]])
                 filters.append(json_data)
@@ -119,13 +237,13 @@ def find_instances(**kwargs): # Find instances based on supplied arguments
                     key, value = tag.split('=')
                     json_data = {'Name': 'tag:' + key.capitalize(), 'Values': [value]}
                     filters.append(json_data)
-        logging.info("Filters: {0}".format(filters))
+        logging.info("Filters: %s", filters)
         if len(filters) > 0:
             reservations = ec2.describe_instances(Filters=filters)['Reservations']
             for reservation in reservations:
                 for instance in reservation['Instances']:
                     instance_ids.append(instance['InstanceId'])
-            logging.info("Found instances: {0}".format(instance_ids))
+            logging.info("Found instances: %s", instance_ids)
         else:
             logging.info("No filters supplied.  Bypassing tag based instance search")
         # Add directly provided instance IDs to list checking first if they are not already in the list
@@ -135,36 +253,45 @@ def find_instances(**kwargs): # Find instances based on supplied arguments
                     for instance in kwargs[kw].split(','):
                         if instance not in instance_ids:
                             instance_ids.append(instance)
-                            logging.info("Added instance ID: {0}".format(instance))
+                            logging.info("Added instance ID: %s", instance)
                         else:
-                            logging.info("Instance ID: {0} already in list".format(instance))
-            logging.info("All instances: {0}".format(instance_ids))
+                            logging.info("Instance ID: %s already in list", instance)
+            logging.info("All instances: %s", instance_ids)
     except ClientError as e:
-        logging.error("Error in find_instances: {0}".format(e))
-        logging.error("Arguments: {0}".format(kwargs))
+        logging.error("Error in find_instances: %s", e)
+        logging.error("Arguments: %s", kwargs)
         sys.exit(1)
     except ParamValidationError as param_error:
-        logging.error("Error in find_instances: {0}" .format(param_error))
-        logging.error("Arguments: {0}".format(kwargs))
+        logging.error("Error in find_instances: %s", param_error)
+        logging.error("Arguments: %s", kwargs)
         sys.exit(1) 
     except AttributeError as attr_error:
-        logging.error("Error in find_instances: {0}" .format(attr_error))
-        logging.error("Arguments: {0}".format(kwargs))
+        logging.error("Error in find_instances: %s", attr_error)
+        logging.error("Arguments: %s", kwargs)
         sys.exit(1)
     except:
-        logging.error("Unexpected error in find_instances! Arguments provided: {0}".format(kwargs))
-        logging.error("Unexpected error in find_instances: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in find_instances! Arguments provided: %s", kwargs)
+        logging.error("Unexpected error in find_instances: %s", sys.exc_info()[0])
+        sys.exit(1)
+
+def load_existing_images(reuse_window): # Index AMIs created within the reuse window with one paginated describe_images call
+    try:
+        logging.info("Finding AMIs created within the last %s minutes", reuse_window)
+        existing_images = ec2_utils.ExistingImageIndex.load(ec2_client(), reuse_window)
+        logging.info("Found %s AMIs created within the last %s minutes", len(existing_images.images), reuse_window)
+        return existing_images
+    except ClientError as e:
+        logging.error("Error in load_existing_images: %s", e)
         sys.exit(1)
 
 def get_tags(instance, add_tags): # Get tags for instances
     try:
-        logging.info("Getting tags for instance {0}".format(instance))
-        ec2 = boto3.resource('ec2', region_name=region)
-        ec2instance=ec2.Instance(instance)
-        logging.debug("Instance: {0}".format(ec2instance))
-        logging.debug("Tags: {0}".format(ec2instance.tags))
+        logging.info("Getting tags for instance %s", instance)
+        ec2instance = ec2_client().describe_instances(InstanceIds=[instance])['Reservations'][0]['Instances'][0]
+        logging.debug("Instance: %s", instance)
+        logging.debug("Tags: %s", ec2instance.get('Tags'))
         instance_tags = []
-        for tag in ec2instance.tags:
+        for tag in ec2instance.get('Tags', []):
             if (tag['Key'] == 'Name' or tag['Key'] == 'Product' or tag['Key'] == 'Environment' or tag['Key'] == 'Tenant' or tag['Key'] == 'Role'):
                 json_data = {'Key': tag['Key'], 'Value': tag['Value']}
                 instance_tags.append(json_data)
@@ -173,6 +300,9 @@ def get_tags(instance, add_tags): # Get tags for instances
         instance_tags.append(json_data)
         # Adding a Time tag
         json_data = {'Key': 'Timestamp', 'Value': timestamp + ' UTC'}
+        instance_tags.append(json_data)
+        # Adding a source instance tag so later invocations can find the AMIs already created from the instance
+        json_data = {'Key': ec2_utils.SOURCE_INSTANCE_TAG, 'Value': instance}
         instance_tags.append(json_data)
          # If add_tags is not empty add the additional tags to the list of tags to be attached to the AMI
         if add_tags is not None:
@@ -180,84 +310,150 @@ def get_tags(instance, add_tags): # Get tags for instances
                 key, value = tag.split('=')
                 json_data = {'Key': key, 'Value': value}
                 instance_tags.append(json_data)
-        logging.info("Instance {1} tags: {0}".format(instance_tags, instance))
+        logging.info("Instance %s tags: %s", instance, instance_tags)
         return instance_tags
     except ClientError as e:
-        logging.error("Error in get_tags: {0}".format(e))
+        logging.error("Error in get_tags: %s", e)
     except Exception as e:
-        logging.error("Unexpected error in get_tags: {0}".format(e))
-        logging.error("Unexpected error in get_tags: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in get_tags: %s", e)
+        logging.error("Unexpected error in get_tags: %s", sys.exc_info()[0])
 
 def create_ami(instance,tags): # Create AMI
     try:
-        logging.info("Creating AMI for instance {0}".format(instance))
-        ec2 = boto3.client('ec2', region_name=region)
-        for tag in tags:
-            if tag['Key'] == 'Name':
-                image_name = tag['Value'] + '-' + date + '-' + timestamp.replace(':', '')
-                image_description = image_name
+        logging.info("Creating AMI for instance %s", instance)
+        ec2 = ec2_client()
+        image_name = ami_name(tags)
+        image_description = image_name
         response = ec2.create_image(InstanceId=instance, Name=image_name, Description=image_description, NoReboot=True)
-        logging.debug("Service response for creating AMI: {0}".format(response))
+        logging.debug("Service response for creating AMI: %s", response)
         for field in response:
             if field == 'ImageId':
                 image_id = response[field]
-        logging.info("Image ID: {0}, Image Name: {1}, Image Description: {2}".format(image_id, image_name, image_description))
+        logging.info("Image ID: %s, Image Name: %s, Image Description: %s", image_id, image_name, image_description)
         instance_amis[image_name] = image_id
+        progress.add('created')
         return image_id
     except ClientError as e:
-        logging.error("Error in create_ami: {0}".format(e))
+        logging.error("Error in create_ami: %s", e)
+        progress.add('failed')
     except Exception as e:
-        logging.error("Unexpected error in create_ami: {0}".format(e))
-        logging.error("Unexpected error in create_ami: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in create_ami: %s", e)
+        progress.add('failed')
+        logging.error("Unexpected error in create_ami: %s", sys.exc_info()[0])
+
+def ami_name(tags): # AMI name from the instance Name tag, date and time
+    for tag in tags:
+        if tag['Key'] == 'Name':
+            return tag['Value'] + '-' + date + '-' + timestamp.replace(':', '')
 
 def tag_ami(image_id, tags): # Tag AMI
     try:
-        logging.info("Tagging AMI {0}".format(image_id))
-        ec2 = boto3.resource('ec2', region_name=region)
-        image = ec2.Image(image_id)
-        image.create_tags(Tags=tags)
-        logging.info("Adding tags: {0}".format(tags))
-        logging.info("Image {0} tagged".format(image_id))
+        logging.info("Tagging AMI %s", image_id)
+        ec2_client().create_tags(Resources=[image_id], Tags=tags)
+        logging.info("Adding tags: %s", tags)
+        logging.info("Image %s tagged", image_id)
+        progress.add('tagged')
     except ClientError as e:
-        logging.error("Error in tag_ami: {0}".format(e))
+        logging.error("Error in tag_ami: %s", e)
+        progress.add('failed')
     except Exception as e:
-        logging.error("Unexpected error in tag_ami: {0}".format(e))
-        logging.error("Unexpected error in tag_ami: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in tag_ami: %s", e)
+        progress.add('failed')
+        logging.error("Unexpected error in tag_ami: %s", sys.exc_info()[0])
 
 def check_ami_state(image_id): # Check AMI state
     try:
-        logging.info("Checking AMI state for {0} every 30 seconds".format(image_id))
-        ec2 = boto3.client('ec2', region_name=region)
+        logging.info("Checking AMI state for %s every 30 seconds", image_id)
+        ec2 = ec2_client()
         image_state = ec2.describe_images(ImageIds=[image_id])['Images'][0]['State']
-        logging.info("Image {1} state: {0}".format(image_state, image_id))
+        logging.info("Image %s state: %s", image_id, image_state)
         while image_state == 'pending':
             time.sleep(30)
             image_state = ec2.describe_images(ImageIds=[image_id])['Images'][0]['State']
-            logging.info("Image {1} state: {0}".format(image_state, image_id))
+            logging.info("Image %s state: %s", image_id, image_state)
             if image_state != 'pending':
+                progress.add('available' if image_state == 'available' else 'failed')
                 if image_state == 'available':
-                    logging.debug("Image {0} is available".format(image_id))
+                    logging.debug("Image %s is available", image_id)
                     return True
                 elif image_state == 'failed':
-                    logging.error("Image {0} failed".format(image_id))
+                    logging.error("Image %s failed", image_id)
                     return False
                 else:
-                    logging.warning("Image {0} is in unknown state: {1} please verify manually from the AWS Console".format(image_id, image_state))
+                    logging.warning("Image %s is in unknown state: %s please verify manually from the AWS Console", image_id, image_state)
                     return False
     except ClientError as e:
-        logging.error("Error in check_ami_state: {0}".format(e))
+        logging.error("Error in check_ami_state: %s", e)
+    except Exception as e:
+        logging.error("Unexpected error in check_ami_state: %s", e)
+        logging.error("Unexpected error in check_ami_state: %s", sys.exc_info()[0])
+
+def wait_for_image_events(image_ids, queue_url, interval): # Wait for AMIs as their state change events arrive on the queue, polling every interval seconds for missed events
+    try:
+        ec2 = ec2_client()
+        logging.info("Waiting for state change events for %s images from %s, checking all every %s seconds", len(image_ids), queue_url, interval)
+        poller = ec2_utils.ImagePoller(botocore_session, interval=interval, events=ec2_utils.ImageStateEvents(botocore_session, queue_url))
+        for image_id in image_ids:
+            if image_id is not None:
+                poller.add(ec2.meta.region_name, image_id, report_ami_state)
+        poller.run()
+    except ClientError as e:
+        logging.error("Error in wait_for_image_events: %s", e)
     except Exception as e:
-        logging.error("Unexpected error in check_ami_state: {0}".format(e))
-        logging.error("Unexpected error in check_ami_state: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in wait_for_image_events: %s", e)
+        logging.error("Unexpected error in wait_for_image_events: %s", sys.exc_info()[0])
+
+def report_ami_state(region, image): # Log the final state of an AMI once it is no longer pending
+    image_id = image['ImageId']
+    image_state = image['State']
+    if progress is not None:
+        progress.add('available' if image_state == 'available' else 'failed')
+    logging.info("Image %s state: %s", image_id, image_state)
+    if image_state == 'available':
+        logging.debug("Image %s is available", image_id)
+    elif image_state == 'failed':
+        logging.error("Image %s failed", image_id)
+    else:
+        logging.warning("Image %s is in unknown state: %s please verify manually from the AWS Console", image_id, image_state)
+
+def handle_image_state_event(event): # Report an AMI state change delivered by EventBridge, so invocations need not wait for their AMIs
+    state_event = ec2_utils.parse_state_event(event)
+    if state_event is None:
+        logging.warning("Ignoring event that is not an AMI state change: %s", event.get('detail-type'))
+        return
+    try:
+        for image_id in state_event['ids']:
+            images = ec2_client().describe_images(Filters=[{'Name': 'image-id', 'Values': [image_id]}])['Images']
+            # Only AMIs created by this function or the script carry the source instance tag
+            if not images or ec2_utils.get_tag(images[0], ec2_utils.SOURCE_INSTANCE_TAG) is None:
+                logging.debug("Ignoring state change of image %s: %s", image_id, state_event['state'])
+                continue
+            if images[0]['State'] == 'pending':
+                logging.info("Image %s (ID %s) is pending", images[0].get('Name'), image_id)
+            else:
+                report_ami_state(state_event['region'], images[0])
+    except ClientError as e:
+        logging.error("Error in handle_image_state_event: %s", e)
+    output.flush_logging() # Ensure queued records reach CloudWatch before the environment is frozen
 
 def confirm_ami_success(image_name,image_id): # Confirm AMI success
     try:
-        ec2 = boto3.client('ec2', region_name=region)
+        ec2 = ec2_client()
         image_state = ec2.describe_images(ImageIds=[image_id])['Images'][0]['State']
         if image_state == 'available':
-            logging.info("Image {0} (ID {1}) is available".format(image_name,image_id))
+            logging.info("Image %s (ID %s) is available", image_name, image_id)
     except ClientError as e:
-        logging.error("Error in confirm_ami_success: {0}".format(e))
+        logging.error("Error in confirm_ami_success: %s", e)
     except Exception as e:
-        logging.error("Unexpected error in confirm_ami_success: {0}".format(e))
-        logging.error("Unexpected error in confirm_ami_success: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in confirm_ami_success: %s", e)
+        logging.error("Unexpected error in confirm_ami_success: %s", sys.exc_info()[0])
+
+# SnapStart runtime hooks - snapshot_restore_py is provided by the Lambda Python runtime when SnapStart is enabled
+try:
+    from snapshot_restore_py import register_before_snapshot, register_after_restore
+    register_before_snapshot(before_snapshot)
+    register_after_restore(after_restore)
+except ImportError:
+    if pre_initialize:
+        before_snapshot() # Provisioned concurrency or PRE_INITIALIZE=true - create the client during init rather than the first invocation
+profile_phase('init', init_started)
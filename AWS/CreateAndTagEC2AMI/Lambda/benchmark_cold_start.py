@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import argparse
+import logging
+import subprocess
+
+# Import local modules - see ../../PythonUtilities
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'PythonUtilities'))
+import modules.output as output
+
+# Global Variables
+log_level=logging.INFO
+log_format='%(asctime)s [%(levelname)s] %(message)s'
+handler_dir = os.path.dirname(os.path.abspath(__file__))
+phases = ['init', 'restore', 'first_client', 'invoke', 'total']
+
+# Runs in a fresh interpreter for every sample so each one is a cold start
+driver = """
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import CreateAndTagEC2AMI as handler
+result = {'init': time.perf_counter() - started}
+if sys.argv[2] == 'snap-start':
+    restored = time.perf_counter()
+    handler.after_restore()
+    result['restore'] = time.perf_counter() - restored
+invoked = time.perf_counter()
+handler.ec2_client()
+result['first_client'] = time.perf_counter() - invoked
+if sys.argv[3]:
+    invoked = time.perf_counter()
+    try:
+        handler.lambda_handler(json.loads(sys.argv[3]), None)
+    except SystemExit:
+        pass
+    result['invoke'] = time.perf_counter() - invoked
+result['total'] = time.perf_counter() - started
+print(json.dumps({phase: round(seconds * 1000, 1) for phase, seconds in result.items()}))
+"""
+
+# Handle command line arguments
+all_args = argparse.ArgumentParser(description='Benchmark CreateAndTagEC2AMI Lambda cold starts by simulating the init and invoke phases in fresh interpreters')
+benchmark_group = all_args.add_argument_group('Benchmark Options')
+benchmark_group.add_argument('--runs', '-n', required=False, default=20, help='Number of cold starts to sample: default = 20', type=int)
+benchmark_group.add_argument('--mode', '-m', required=False, default='on-demand', choices=['on-demand', 'provisioned-concurrency', 'snap-start'], help='Initialization type to simulate: default = on-demand', type=str)
+benchmark_group.add_argument('--event', '-e', required=False, help='JSON event file to invoke the handler with after init - calls AWS (Example: -e params.json)', type=str)
+benchmark_group.add_argument('--replay', required=False, help='Serve the AWS API calls of --event from a cassette recorded with CASSETTE_MODE=record instead of AWS (Example: --replay /tmp/lambda.jsonl.gz)', type=str)
+benchmark_group.add_argument('--replay-latency', required=False, default=0.0, help='Multiple of the recorded response times to wait for when replaying: default = 0', type=float)
+benchmark_group.add_argument('--region', '-r', required=False, default='us-east-1', help='AWS Region for the simulated function: default = us-east-1', type=str)
+log_group = all_args.add_argument_group('Log Options')
+log_group.add_argument('--log-level', '-ll', required=False, default='INFO', help='Log level: default = INFO', type=str)
+args=all_args.parse_args()
+
+# Configure logging - records are queued and written by a background listener thread
+output.configure_logging(log_level=args.log_level.upper(), log_format=log_format)
+
+def main(): # Main function
+    event = ''
+    if args.event:
+        with open(args.event) as event_file:
+            event = json.dumps(json.load(event_file))
+    logging.info("Sampling %s %s cold starts", args.runs, args.mode)
+    samples = [cold_start(event) for run in range(args.runs)]
+    logging.info("===================")
+    logging.info("%-14s %8s %8s %8s %8s", 'Phase (ms)', 'p50', 'p90', 'p99', 'max')
+    for phase in phases:
+        values = [sample[phase] for sample in samples if phase in sample]
+        if values:
+            logging.info("%-14s %8.1f %8.1f %8.1f %8.1f", phase, percentile(values, 50), percentile(values, 90), percentile(values, 99), max(values))
+    logging.info("===================")
+
+def cold_start(event): # Simulate one cold start in a fresh interpreter and return its phase timings
+    env = dict(os.environ, AWS_LAMBDA_INITIALIZATION_TYPE=args.mode, AWS_DEFAULT_REGION=args.region, AWS_REGION=args.region, LOG_LEVEL='WARNING')
+    if args.replay:
+        env.update(CASSETTE=args.replay, CASSETTE_MODE='replay', CASSETTE_LATENCY=str(args.replay_latency))
+    result = subprocess.run([sys.executable, '-c', driver, handler_dir, args.mode, event], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        logging.error("Error in cold_start: %s", result.stderr.strip())
+        sys.exit(1)
+    sample = json.loads(result.stdout.strip().splitlines()[-1])
+    logging.debug("Sample: %s", sample)
+    return sample
+
+def percentile(values, percent): # Nearest rank percentile
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1))]
+
+main() # Call main function
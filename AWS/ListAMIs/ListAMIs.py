@@ -1,24 +1,63 @@
 #!/usr/bin/env python3
-import os, sys, asyncio
+import os, io, sys, asyncio
+import collections
+import fnmatch
+import concurrent.futures
 import csv, json, yaml
 import argparse
 import logging
 from datetime import datetime,timezone
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError,ParamValidationError
 
+# Import local modules - see ../PythonUtilities
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PythonUtilities'))
+import modules.output as output
+import modules.aws_connect as aws_utils
+import modules.cassette as cassette_utils
+import modules.profiling as profiling
+import modules.file_system as file_system
+import modules.s3 as s3
+import modules.kms as kms
+import modules.ec2 as ec2_utils
+import modules.ec2_async as ec2_async
+import modules.analytics as analytics
+import modules.columnar as columnar
+import modules.external_sort as external_sort
+import modules.dynamodb as dynamodb
+import modules.jobs as jobs_utils
+
 # Global Variables
 log_level=logging.INFO
 log_format='%(asctime)s [%(levelname)s] %(message)s'
 log_file="/dev/null"
+log_json_file=None
+cassette=None
+image_usage=None
+ec2_resources={}
+accounts=None
+assumed_roles=None
+batch_jobs=None
 date = datetime.now().strftime('%Y-%m-%d')
 timestamp = datetime.now(timezone.utc).strftime('%H%M%S')
 
+# Arguments that are options rather than tag filters
+non_filter_args = ['aws_profile', 'region', 'log_file', 'log_level', 'log_json', 'instance_ids', 'extra_tags', 'no_save', 'format', 'filename', 'output_dir', 'verbose', 'silent', 'compress', 'compress_level', 's3_uri', 's3_part_size', 's3_max_in_flight', 'kms_key_id', 'kms_data_key_max_age', 'kms_data_key_max_uses', 'prune', 'keep_last', 'keep_daily', 'keep_weekly', 'group_by', 'dry_run', 'journal', 'prune_workers', 'prune_rate', 'usage', 'usage_regions', 'analytics', 'analytics_group_by', 'snapshot_price', 'engine', 'max_concurrency', 'row_group_size', 'tag_columns', 'regions', 'sort_buffer', 'spill_dir', 'record', 'replay', 'replay_latency', 'profile', 'org', 'accounts', 'role_name', 'external_id', 'role_duration', 'org_max_workers', 'retag_rules', 'retag_set', 'retag_remove', 'retag_rename', 'retag_images_only', 'retag_workers', 'retag_rate', 'retag_batch_size', 'source', 'dynamodb_table', 'dynamodb_region', 'dynamodb_endpoint_url', 'dynamodb_writers', 'dynamodb_segments', 'dynamodb_index_tags', 'jobs']
+
 # Handle command line arguments
 all_args = argparse.ArgumentParser(description='AWS EC2 AMI Reporting')
 connection_group = all_args.add_argument_group('AWS Connection Details')
 connection_group.add_argument('--aws-profile', '-a', required=False, default='default', help='AWS Profile: default = default', type=str)
 connection_group.add_argument('--region', '-r', required=False, default='us-east-1',help="AWS Region: default = us-east-1 ", type=str)
+connection_group.add_argument('--regions', '-rs', required=False, help='Comma separated regions to search for AMIs, merged into one report sorted by creation date: default = --region (Example: -rs us-east-1,us-west-2)', type=str)
+org_group = all_args.add_argument_group('Organization Options (assume a role in each account)')
+org_group.add_argument('--org', required=False, help='Report on every active account in the AWS Organization, assuming --role-name in each', action='store_true')
+org_group.add_argument('--accounts', required=False, help='Comma separated account IDs, or a file with one account ID per line, to report on instead of the organization (Example: --accounts 111111111111,222222222222)', type=str)
+org_group.add_argument('--role-name', required=False, default=aws_utils.DEFAULT_ROLE_NAME, help='Role assumed in each account: default = OrganizationAccountAccessRole', type=str)
+org_group.add_argument('--external-id', required=False, help='External ID required by the role trust policy', type=str)
+org_group.add_argument('--role-duration', required=False, default=aws_utils.DEFAULT_ROLE_DURATION, help='Seconds assumed role credentials are requested for, they are refreshed before they expire: default = 3600', type=int)
+org_group.add_argument('--org-max-workers', required=False, default=aws_utils.DEFAULT_ACCOUNT_WORKERS, help='Maximum accounts searched at once: default = 8', type=int)
 instance_group = all_args.add_argument_group('Instance Details (Tags and/or Instance IDs)')
 instance_group.add_argument('--product', '-p', required=False,help="EC2 Instance Product Tag", type=str)
 instance_group.add_argument('--environment', '-e', required=False,help="EC2 Instance Environment Tag", type=str)
@@ -28,14 +67,76 @@ instance_group.add_argument('--owner', '-o', required=False,help="EC2 Instance O
 instance_group.add_argument('--name', '-n', required=False,help="EC2 Instance Name Tag", type=str)
 instance_group.add_argument('--extra-tags', '-x', required=False, help='Other tags that can be used to search for AMI images as a comma separated key=value list (Example: -x key1=value1,key2=value2)', type=str)
 instance_group.add_argument('--instance-ids', '-i', required=False, help='Instance IDs to create AMI from as a comma separated list', type=str)
+jobs_group = all_args.add_argument_group('Batch Job Options (many filter sets from one discovery pass per region)')
+jobs_group.add_argument('--jobs', required=False, help='YAML or JSON file of named jobs, each with its own tag filters and instance IDs, used instead of the tag and instance ID options, with a report saved for each job (Example: --jobs ./nightly-jobs.yml)', type=str)
 log_group = all_args.add_argument_group('Log Options')
 log_group.add_argument('--log-file', '-l', required=False, help='Log file location', type=str)
 log_group.add_argument('--log-level', '-ll', required=False, default='INFO', help='Log level: default = INFO', type=str)
+log_group.add_argument('--log-json', '-lj', required=False, help='Structured JSON Lines log file location', type=str)
 output_group = all_args.add_argument_group('Output Options')
 output_group.add_argument('--no-save', '-ns', required=False, help='Do not save list of AMIs', action='store_true')
-output_group.add_argument('--format', '-fm', required=False, default='csv', help='Output format. Accepted values: csv (default), json, yaml', type=str)
+output_group.add_argument('--format', '-fm', required=False, default='csv', help='Output format. Accepted values: csv (default), json, yaml, parquet, arrow', type=str)
 output_group.add_argument('--filename', '-f', required=False, help='File name for output: default = AMI-Report-<aws_profile>-<region>-<date>_<timestamp>.csv', type=str)
 output_group.add_argument('--output-dir', '-d', required=False, help='Directory to store output files: default = current directory', type=str)
+output_group.add_argument('--row-group-size', required=False, default=columnar.DEFAULT_BATCH_ROWS, help='Rows buffered per parquet row group or arrow record batch: default = 10000', type=int)
+output_group.add_argument('--tag-columns', required=False, help='Comma separated tag keys written as their own parquet/arrow columns alongside the Tags map, or all for every tag key found (Example: --tag-columns Product,Environment)', type=str)
+output_group.add_argument('--compress', '-z', required=False, choices=file_system.COMPRESSION_TYPES, help='Compress output files as they are written. Accepted values: gzip, zstd', type=str)
+output_group.add_argument('--compress-level', required=False, help='Compression level, gzip 1-9 or zstd 1-22: default = 6 for gzip, 3 for zstd', type=int)
+s3_group = all_args.add_argument_group('S3 Output Options')
+s3_group.add_argument('--s3-uri', '-su', required=False, help='Stream output files directly to S3 under this prefix instead of --output-dir (Example: -su s3://my-bucket/reports)', type=str)
+s3_group.add_argument('--s3-part-size', required=False, default=8, help='S3 multipart upload part size in MiB (minimum 5): default = 8', type=int)
+s3_group.add_argument('--s3-max-in-flight', required=False, default=4, help='Maximum number of S3 parts uploading at once: default = 4', type=int)
+kms_group = all_args.add_argument_group('Encryption Options')
+kms_group.add_argument('--kms-key-id', '-k', required=False, help='Envelope encrypt output files with a data key from this KMS key id, ARN or alias (Example: -k alias/ami-reports)', type=str)
+kms_group.add_argument('--kms-data-key-max-age', required=False, default=300, help='Maximum age in seconds of a cached KMS data key: default = 300', type=int)
+kms_group.add_argument('--kms-data-key-max-uses', required=False, default=100, help='Maximum number of files encrypted with one cached KMS data key: default = 100', type=int)
+usage_group = all_args.add_argument_group('Usage Options')
+usage_group.add_argument('--usage', '-u', required=False, help='Add InUse and UsedByCount columns counting instances and launch template versions using each AMI', action='store_true')
+usage_group.add_argument('--usage-regions', required=False, help='Comma separated regions scanned for instances and launch templates: default = --region', type=str)
+analytics_group = all_args.add_argument_group('Analytics Options')
+analytics_group.add_argument('--analytics', required=False, help='Report EBS snapshot storage, age, sharing and estimated monthly cost of the AMIs found', action='store_true')
+analytics_group.add_argument('--analytics-group-by', required=False, default='Product,Environment', help='Comma separated tag keys used to group snapshot storage: default = Product,Environment', type=str)
+analytics_group.add_argument('--snapshot-price', required=False, default=analytics.DEFAULT_PRICE_PER_GIB_MONTH, help='Snapshot storage price in USD per GiB-month: default = 0.05', type=float)
+retention_group = all_args.add_argument_group('Retention Options (deregister images and delete their snapshots)')
+retention_group.add_argument('--prune', required=False, help='Apply the retention policy to the AMIs found and deregister images that are not retained', action='store_true')
+retention_group.add_argument('--keep-last', required=False, default=0, help='Keep the N most recent images per group: default = 0', type=int)
+retention_group.add_argument('--keep-daily', required=False, default=0, help='Keep the most recent image for each of the last N days per group: default = 0', type=int)
+retention_group.add_argument('--keep-weekly', required=False, default=0, help='Keep the most recent image for each of the last N weeks per group: default = 0', type=int)
+retention_group.add_argument('--group-by', required=False, default='Name,Product', help='Comma separated tag keys used to group images for retention: default = Name,Product', type=str)
+retention_group.add_argument('--dry-run', required=False, help='Report and journal the images and snapshots that would be deleted, or the tags that would be changed, without changing them', action='store_true')
+retention_group.add_argument('--journal', required=False, help='JSON Lines journal of prune and retag actions, an existing prune journal is resumed (Example: --journal /tmp/prune.jsonl)', type=str)
+retention_group.add_argument('--prune-workers', required=False, default=16, help='Number of worker threads used to prune: default = 16', type=int)
+retention_group.add_argument('--prune-rate', required=False, default=20, help='Maximum prune API requests per second: default = 20', type=float)
+retag_group = all_args.add_argument_group('Retag Options (change the tags of the AMIs found and their snapshots)')
+retag_group.add_argument('--retag-rules', required=False, help='YAML or JSON file of retag rules, each with optional match, rename, set and remove keys (Example: --retag-rules ./retag.yml)', type=str)
+retag_group.add_argument('--retag-set', required=False, help='Tags to add or overwrite on every AMI found as a comma separated key=value list (Example: --retag-set Owner=platform,CostCentre=1234)', type=str)
+retag_group.add_argument('--retag-remove', required=False, help='Comma separated tag keys to remove from every AMI found (Example: --retag-remove Temp,OldOwner)', type=str)
+retag_group.add_argument('--retag-rename', required=False, help='Tag keys to rename on every AMI found as a comma separated old=new list (Example: --retag-rename env=Environment)', type=str)
+retag_group.add_argument('--retag-images-only', required=False, help='Do not change the tags of the AMI snapshots', action='store_true')
+retag_group.add_argument('--retag-workers', required=False, default=8, help='Number of worker threads used to retag: default = 8', type=int)
+retag_group.add_argument('--retag-rate', required=False, default=10, help='Maximum CreateTags and DeleteTags requests per second per account and region: default = 10', type=float)
+retag_group.add_argument('--retag-batch-size', required=False, default=ec2_utils.MAX_TAG_RESOURCES, help='Maximum resource IDs per CreateTags or DeleteTags call: default = 1000', type=int)
+inventory_group = all_args.add_argument_group('Inventory Options (shared DynamoDB inventory table)')
+inventory_group.add_argument('--source', required=False, default='ec2', choices=['ec2', 'dynamodb'], help='Read AMIs from the EC2 API, writing them to --dynamodb-table when set, or from the --dynamodb-table inventory without calling EC2: default = ec2', type=str)
+inventory_group.add_argument('--dynamodb-table', required=False, help='Inventory table the AMIs found are written to, or read from with --source dynamodb, created if it does not exist (Example: --dynamodb-table ami-inventory)', type=str)
+inventory_group.add_argument('--dynamodb-region', required=False, help='Region of the inventory table: default = --region', type=str)
+inventory_group.add_argument('--dynamodb-endpoint-url', required=False, help='DynamoDB endpoint, for DynamoDB Local (Example: --dynamodb-endpoint-url http://localhost:8000)', type=str)
+inventory_group.add_argument('--dynamodb-writers', required=False, default=dynamodb.DEFAULT_WRITERS, help='Number of threads writing BatchWriteItem batches: default = 4', type=int)
+inventory_group.add_argument('--dynamodb-segments', required=False, default=dynamodb.DEFAULT_SEGMENTS, help='Number of parallel Scan segments when reading the inventory: default = 4', type=int)
+inventory_group.add_argument('--dynamodb-index-tags', required=False, default=','.join(dynamodb.DEFAULT_INDEX_TAGS), help='Comma separated tag keys given their own index when the table is created, used to query by tag: default = Product,Environment', type=str)
+sort_group = all_args.add_argument_group('Sort Options')
+sort_group.add_argument('--sort-buffer', required=False, default=external_sort.DEFAULT_MAX_ITEMS, help='Maximum AMIs held in memory while sorting, across all regions, before sorted runs are spilled to temporary files: default = 10000', type=int)
+sort_group.add_argument('--spill-dir', required=False, help='Directory for sorted run temporary files: default = system temporary directory', type=str)
+profile_group = all_args.add_argument_group('Profile Options')
+profile_group.add_argument('--profile', required=False, choices=['cpu', 'mem', 'wall'], help='Profile the run and save the reports alongside the report: cpu = cProfile of every thread, mem = tracemalloc top allocations, wall = sampled stacks of every thread', type=str)
+replay_group = all_args.add_argument_group('Record and Replay Options')
+cassette_group = replay_group.add_mutually_exclusive_group()
+cassette_group.add_argument('--record', required=False, help='Record every AWS API response to this cassette file, compressed if it ends in .gz or .zst (Example: --record /tmp/run.jsonl.gz)', type=str)
+cassette_group.add_argument('--replay', required=False, help='Serve AWS API calls from this recorded cassette file instead of AWS (Example: --replay /tmp/run.jsonl.gz)', type=str)
+replay_group.add_argument('--replay-latency', required=False, default=0.0, help='Multiple of the recorded response times to wait for when replaying, 1 to reproduce the original latencies: default = 0', type=float)
+engine_group = all_args.add_argument_group('Engine Options')
+engine_group.add_argument('--engine', required=False, default='threads', choices=['threads', 'async'], help='Run AMI discovery with blocking boto3 calls or as coroutines on an asyncio event loop (requires aiobotocore): default = threads', type=str)
+engine_group.add_argument('--max-concurrency', required=False, default=ec2_async.DEFAULT_MAX_CONCURRENCY, help='Maximum AWS requests in flight with --engine async: default = 100', type=int)
 display_group = all_args.add_mutually_exclusive_group()
 display_group.add_argument('--verbose', '-v', required=False, help='Verbose output', action='store_true')
 display_group.add_argument('--silent', '-s', required=False, help='Do not display AMI details', action='store_true')
@@ -45,6 +146,8 @@ args=all_args.parse_args()
 for key, value in vars(args).items():
     if (key == 'log_file' and not value is None):
         log_file=value
+    if (key == 'log_json' and not value is None):
+        log_json_file=value
     if key == 'log_level':
         log_level=value.upper()
     if key == 'format':
@@ -66,15 +169,11 @@ for key, value in vars(args).items():
             # Strip trailing slash from output directory if provided
             args.output_dir = value.rstrip('/')
 
-# Configure logging
-logging.basicConfig(
-    level=log_level,
-    format=log_format,
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler(sys.stdout)
-    ]
-    )
+# Data keys are cached so that KMS GenerateDataKey is not called for every output file
+data_key_cache = kms.DataKeyCache(max_age=args.kms_data_key_max_age, max_uses=args.kms_data_key_max_uses)
+
+# Configure logging - records are queued and written by a background listener thread
+output.configure_logging(log_level=log_level, log_format=log_format, log_file=log_file, json_file=log_json_file)
 
 def main (): # Main function
     logging.info("===================")
@@ -82,20 +181,52 @@ def main (): # Main function
     logging.info("===================")
     print_args(args) # Print arguments passed from command line
     aws_connect(args) # Connect to AWS
+    connect_accounts() # Assume the organization role in each account when --org or --accounts is set
     # Build a list of filters based on provided arguments
     filters = prepare_tags(args)
     # prepare_tags(args) # Prepare list of filter tags for use in AWS API call
-    amis = find_amis(filters) # Find AMIs based on filter tags
-    # If verbose output is enabled, print AMI details
-    print_amis(amis) # Print AMIs found
-    # If no-save is not enabled, save AMI details to file
-    if not args.no_save:
-        save_output(amis) # Save AMI details to file
-    if not args.silent:
-        logging.info("===================")
-        logging.info("Found {0} AMI images".format(len(list(amis))))
-        logging.info("===================")
-        logging.info("Script Complete")
+    if args.prune and len(report_regions()) > 1:
+        logging.error("--prune supports a single region, not --regions %s", args.regions)
+        sys.exit(1)
+    if args.prune and accounts is not None:
+        logging.error("--prune supports a single account, not --org or --accounts")
+        sys.exit(1)
+    if args.prune and (args.retag_rules or args.retag_set or args.retag_remove or args.retag_rename):
+        # Retagging would target the images the prune has just deregistered
+        logging.error("--prune and the retag options cannot be used together, run them separately")
+        sys.exit(1)
+    if args.source == 'dynamodb' and not args.dynamodb_table:
+        logging.error("--source dynamodb requires --dynamodb-table")
+        sys.exit(1)
+    if args.jobs:
+        report_jobs(filters) # Report on every job in the job file from one search per region
+        return
+    amis = find_amis(filters) # Find AMIs based on filter tags, sorted per region and merged by creation date
+    try:
+        if args.dynamodb_table and args.source == 'ec2':
+            save_inventory(amis, filters) # Write the AMIs found to the shared inventory table
+        if args.usage:
+            find_usage() # Count instances and launch templates using each AMI
+        # If verbose output is enabled, print AMI details
+        print_amis(amis) # Print AMIs found
+        # If no-save is not enabled, save AMI details to file
+        if not args.no_save:
+            save_output(amis) # Save AMI details to file
+        if args.analytics:
+            analyse_storage(amis) # Report snapshot storage and estimated cost
+        if args.prune:
+            prune_amis(amis) # Deregister images not retained by the retention policy
+        if args.retag_rules or args.retag_set or args.retag_remove or args.retag_rename:
+            retag_amis(amis) # Change the tags of the AMIs found and their snapshots
+        if not args.silent:
+            logging.info("===================")
+            logging.info("Found %s AMI images", len(amis))
+            if image_usage is not None:
+                logging.info("Unused AMI images: %s", sum(1 for ami in amis if image_usage.get(ami.id, 0) == 0))
+            logging.info("===================")
+            logging.info("Script Complete")
+    finally:
+        amis.close() # Remove sorted run temporary files
 
 def print_args(args): # Print arguments passed from command line
     # If silent mode is enabled, do not print arguments
@@ -110,7 +241,7 @@ def print_args(args): # Print arguments passed from command line
     for key, value in vars(args).items():
         # Replace _ with space and capitalize first letter of each word
         key = key.replace("_"," ").title()
-        logging.info('{0} : {1}'.format(key, value))
+        logging.info('%s : %s', key, value)
     if args.no_save:
         logging.warning("No Save Mode Enabled: AMI details will not be saved to file")
         logging.warning("No Save Mode Enabled: Filename and Output Directory have been set to None")
@@ -118,30 +249,59 @@ def print_args(args): # Print arguments passed from command line
 
 def aws_connect(args): # Connect to AWS
     try:
-        global session
+        global session, cassette
         
         if args.verbose:
             logging.info("Connecting to AWS")
-        session = boto3.Session(profile_name=args.aws_profile,region_name=args.region)
+        if args.record or args.replay:
+            if args.engine == 'async':
+                logging.error("--record and --replay are not supported with --engine async")
+                sys.exit(1)
+            cassette = cassette_utils.Cassette(args.record or args.replay, mode='record' if args.record else 'replay', latency=args.replay_latency)
+            session = aws_utils.cassette_session(args.aws_profile, args.region, cassette)
+        else:
+            session = boto3.Session(profile_name=args.aws_profile,region_name=args.region)
         if not args.silent:
             logging.info("Connected to AWS")
         if args.verbose:
-            logging.info("Session Details: {0}".format(session))
+            logging.info("Session Details: %s", session)
         if not args.silent:
             logging.info("===================")
-    except ClientError as e:
-        logging.error("Error in aws_connect: {0}".format(e))
+    except (ClientError, OSError, ValueError) as e:
+        logging.error("Error in aws_connect: %s", e)
         sys.exit(1)
     except:
-        logging.error("Unexpected error in aws_connect: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in aws_connect: %s", sys.exc_info()[0])
         sys.exit(1)
 
+def connect_accounts(): # List the accounts to report on and prepare a cached assumed role session for each
+    try:
+        global accounts, assumed_roles
+        if not (args.org or args.accounts):
+            return
+        if args.engine == 'async':
+            logging.error("--org and --accounts are not supported with --engine async")
+            sys.exit(1)
+        assumed_roles = aws_utils.AssumedRoleSessions(session, role_name=args.role_name, session_name='ListAMIs', duration=args.role_duration, external_id=args.external_id, cassette=cassette)
+        accounts = aws_utils.read_accounts(args.accounts) if args.accounts else aws_utils.list_accounts(session)
+        if not args.silent:
+            logging.info("Searching %s accounts with role %s", len(accounts), args.role_name)
+    except ClientError as e:
+        logging.error("Error in connect_accounts: %s", e)
+        sys.exit(1)
+
+def account_session(account): # Session for an account, the connected session when not reporting on multiple accounts
+    return session if account is None else assumed_roles.get(account)
+
+def report_accounts(): # Accounts searched for AMIs, [None] for the connected account only
+    return accounts if accounts is not None else [None]
+
 def prepare_tags(args): # Prepare tags dictionary for use as filters in searching AMIs
     filters = []
     logging.debug("(prepare_tags) Preparing tags dictionary")
     for key, value in vars(args).items():
-        logging.debug("(prepare_tags) {0} : {1}".format(key, value))
-        if not (value is None or key == 'aws_profile' or key == 'region' or key == 'log_file' or key == 'log_level' or key == 'instance_ids' or key == 'extra_tags' or key == 'no_save' or key == 'format' or key == 'filename' or key == 'output_dir' or key == 'verbose' or key == 'silent' ): # Ignore None values and profile, region, logging, additional tags, or output details
+        logging.debug("(prepare_tags) %s : %s", key, value)
+        if not (value is None or key in non_filter_args): # Ignore None values and profile, region, logging, additional tags, or output details
             # Build search filters based on provided tag arguments
             json_data = {'Name': 'tag:' + key.capitalize(), 'Values': [value]}
             filters.append(json_data)
@@ -155,31 +315,245 @@ def prepare_tags(args): # Prepare tags dictionary for use as filters in searchin
                 filters.append(json_data)
     # If verbose output is enabled, print filters
     if args.verbose:
-        logging.info("Filters: {0}".format(filters))
+        logging.info("Filters: %s", filters)
     return filters
 
-def find_amis(filters): # Search for AMI images based on filters
+def load_jobs(): # Read the batch jobs file
+    try:
+        global batch_jobs
+        batch_jobs = jobs_utils.load_jobs(args.jobs, default_regions=report_regions())
+        if not args.silent:
+            for job in batch_jobs:
+                logging.info("Job %s: tags %s, instance IDs %s, regions %s", job.name, job.tags, job.instance_ids, ", ".join(job.regions))
+        if not batch_jobs:
+            logging.error("No jobs found in %s", args.jobs)
+            sys.exit(1)
+    except (OSError, ValueError, TypeError) as e:
+        logging.error("Error in load_jobs: %s", e)
+        sys.exit(1)
+
+def report_jobs(filters): # Search each region once for the AMIs of every job in --jobs, then report on each job
+    if filters or args.instance_ids:
+        logging.error("--jobs cannot be combined with tag filters, --extra-tags or --instance-ids, add them to a job instead")
+        sys.exit(1)
+    if args.prune or args.retag_rules or args.retag_set or args.retag_remove or args.retag_rename:
+        logging.error("--prune and the retag options are not supported with --jobs")
+        sys.exit(1)
+    load_jobs()
+    # Tag keys filtered on by every job narrow the search, unless a job also selects the AMIs of instance IDs
+    if not any(job.instance_ids for job in batch_jobs):
+        filters = jobs_utils.shared_filters(batch_jobs)
+    amis = find_amis(filters) # One search per region shared by every job
+    job_amis = {}
+    try:
+        if args.dynamodb_table and args.source == 'ec2':
+            save_inventory(amis, filters) # Write the AMIs found to the shared inventory table
+        if args.usage:
+            find_usage() # Count instances and launch templates using each AMI
+        # The AMIs of each job are matched locally in one pass and sorted within their share of the sort buffer
+        max_items = max(1, args.sort_buffer // len(batch_jobs))
+        sorters = {job.name: external_sort.SpillingSorter(key=image_sort_key, max_items=max_items, directory=args.spill_dir) for job in batch_jobs}
+        job_amis = {job.name: external_sort.SortedMerge([sorters[job.name]], key=image_sort_key, transform=image_resource) for job in batch_jobs}
+        for image in external_sort.SortedMerge(amis.sources, key=image_sort_key):
+            tags = {tag['Key']: tag['Value'] for tag in image.get('Tags') or []}
+            for job in batch_jobs:
+                if job.matches(tags, tags.get(ec2_utils.SOURCE_INSTANCE_TAG), image['Region']):
+                    sorters[job.name].add(image)
+        filename = args.filename
+        for job in batch_jobs:
+            output.log_message_section("Job {}".format(job.name), top=True, bottom=True)
+            print_amis(job_amis[job.name]) # Print AMIs found for the job
+            args.filename = filename + "-" + job.name
+            if not args.no_save:
+                save_output(job_amis[job.name]) # Save the job's AMI details to its own file
+            if args.analytics:
+                analyse_storage(job_amis[job.name]) # Report the job's snapshot storage and estimated cost
+        if not args.silent:
+            logging.info("===================")
+            logging.info("Found %s AMI images for %s jobs", len(amis), len(batch_jobs))
+            for job in batch_jobs:
+                logging.info("Job %s: %s AMI images", job.name, len(job_amis[job.name]))
+            logging.info("===================")
+            logging.info("Script Complete")
+    finally:
+        amis.close() # Remove sorted run temporary files
+        for merged in job_amis.values():
+            merged.close()
+
+def find_amis(filters): # Search for AMI images based on filters, returned as a re-iterable stream sorted oldest to newest
+    regions = report_regions()
     if not args.silent:
-        logging.info("Searching for AMIs")
+        logging.info("Searching for AMIs in %s", ", ".join(regions))
     try:
-        ec2 = session.resource('ec2')
-        amis = ec2.images.filter(Owners=['self'],Filters=filters)
-        logging.debug("(find_amis) Found {0} AMI images".format(len(list(amis))))
-        # Sort amis by creation date
-        logging.debug("(find_amis) Sorting AMI images by creation date - oldest first")
-        amis = sorted(amis, key=lambda x: x.creation_date, reverse=False) # Sorted oldest to newest
+        # Each region is sorted separately within its share of the sort buffer, then the regions are merged as they are read
+        max_items = max(1, args.sort_buffer // len(regions))
+        if args.source == 'dynamodb':
+            sorters = find_inventory_amis(regions, filters, max_items)
+        elif args.engine == 'async':
+            sorters = find_amis_async(regions, filters, max_items)
+        elif accounts is None:
+            sorters = find_account_amis(None, regions, filters, max_items)
+        else:
+            # Accounts whose role cannot be assumed or searched are logged and left out of the report
+            max_items = max(1, args.sort_buffer // (len(regions) * max(1, len(accounts))))
+            results, failed = aws_utils.for_each_account(accounts, lambda account: find_account_amis(account, regions, filters, max_items), max_workers=args.org_max_workers)
+            sorters = [sorter for account in accounts if account in results for sorter in results[account]]
+            if failed:
+                logging.warning("AMIs were not searched in %s of %s accounts: %s", len(failed), len(accounts), ", ".join(sorted(failed)))
+        amis = external_sort.SortedMerge(sorters, key=image_sort_key, transform=image_resource)
+        logging.debug("(find_amis) Found %s AMI images in %s sorted runs", len(amis), sum(len(sorter.runs) for sorter in sorters))
         return amis
     except ClientError as e:
-        logging.error("Error in find_amis: {0}".format(e))
+        logging.error("Error in find_amis: %s", e)
         sys.exit(1)
     except ParamValidationError as e:
-        logging.error("Error in find_amis: {0}".format(e))
+        logging.error("Error in find_amis: %s", e)
         sys.exit(1)
     except NameError as e:
-        logging.error("Error in find_amis: {0}".format(e))
+        logging.error("Error in find_amis: %s", e)
+        sys.exit(1)
+    except ImportError as e:
+        logging.error("Error in find_amis: %s - the async engine requires aiobotocore", e)
         sys.exit(1)
     except:
-        logging.error("Unexpected error in find_amis: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in find_amis: %s", sys.exc_info()[0])
+        sys.exit(1)
+
+def find_account_amis(account, regions, filters, max_items): # Search the regions of an account in parallel, returning a sorter per region
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        futures = [executor.submit(find_region_amis, region, filters, max_items, account) for region in regions]
+        try:
+            return [future.result() for future in futures]
+        except Exception:
+            # Remove the sorted runs of the regions that were searched before the error
+            for future in futures:
+                if future.exception() is None:
+                    future.result().close()
+            raise
+
+def find_region_amis(region, filters, max_items, account=None): # Page through the AMIs in a region into a sorter that spills sorted runs to disk
+    sorter = external_sort.SpillingSorter(key=image_sort_key, max_items=max_items, directory=args.spill_dir)
+    ec2_client = account_session(account).client('ec2', region_name=region)
+    source = {'Region': region} if account is None else {'Region': region, 'Account': account}
+    for page in ec2_utils.describe_image_pages(ec2_client, Owners=['self'], Filters=filters):
+        sorter.extend(dict(image, **source) for image in page['Images'])
+    logging.debug("(find_region_amis) %s %s: %s AMI images in %s sorted runs", account or '', region, len(sorter), len(sorter.runs))
+    return sorter
+
+def find_amis_async(regions, filters, max_items): # Describe AMIs in every region with the async engine, feeding each page into its region's sorter as it arrives
+    sorters = {region: external_sort.SpillingSorter(key=image_sort_key, max_items=max_items, directory=args.spill_dir) for region in regions}
+    async def describe_images(region):
+        async with ec2_async.AsyncEC2(profile=args.aws_profile, region=region, max_concurrency=args.max_concurrency) as ec2_client:
+            async for page in ec2_client.pages('describe_images', Owners=['self'], Filters=filters):
+                sorters[region].extend(dict(image, Region=region) for image in page['Images'])
+    async def describe_regions():
+        await asyncio.gather(*(describe_images(region) for region in regions))
+    try:
+        asyncio.run(describe_regions())
+    except Exception:
+        # Remove the sorted runs already spilled by every region
+        for sorter in sorters.values():
+            sorter.close()
+        raise
+    return list(sorters.values())
+
+def find_inventory_amis(regions, filters, max_items): # Read AMIs from the inventory table into a sorter per region, querying a tag index when a filter tag has one
+    client = dynamodb_client()
+    index_tags = [key.strip() for key in args.dynamodb_index_tags.split(',')]
+    tag_filters = {f['Name'][len('tag:'):]: f['Values'] for f in filters}
+    indexed = [key for key, values in tag_filters.items() if key in index_tags and not any(char in values[0] for char in '*?')]
+    if indexed:
+        logging.info("Querying %s for AMIs tagged %s=%s", args.dynamodb_table, indexed[0], tag_filters[indexed[0]][0])
+        items = dynamodb.query_inventory(client, args.dynamodb_table, tag_key=indexed[0], tag_value=tag_filters[indexed[0]][0])
+    else:
+        logging.info("Scanning %s for AMIs with %s segments", args.dynamodb_table, args.dynamodb_segments)
+        items = dynamodb.scan_inventory(client, args.dynamodb_table, segments=args.dynamodb_segments, kind='ami')
+    report_account_ids = set(accounts) if accounts is not None else {connected_account()}
+    sorters = {region: external_sort.SpillingSorter(key=image_sort_key, max_items=max_items, directory=args.spill_dir) for region in regions}
+    for item in items:
+        if item.get('Kind') != 'ami' or item['Region'] not in sorters or item.get('Account') not in report_account_ids:
+            continue
+        # Filters are matched locally with the same wildcards as the EC2 tag filters
+        if not all(key in item['Tags'] and any(fnmatch.fnmatchcase(item['Tags'][key], value) for value in values) for key, values in tag_filters.items()):
+            continue
+        image = item['Data']
+        if accounts is None:
+            image.pop('Account', None)
+        sorters[item['Region']].add(image)
+    return list(sorters.values())
+
+def save_inventory(amis, filters): # Write the AMIs found to the inventory table, deleting the items of AMIs no longer found when the search was not filtered
+    try:
+        client = dynamodb_client()
+        index_tags = [key.strip() for key in args.dynamodb_index_tags.split(',')]
+        if dynamodb.create_inventory_table(client, args.dynamodb_table, index_tags=index_tags):
+            logging.info("Created DynamoDB Table %s", args.dynamodb_table)
+        run_id = datetime.now(timezone.utc).isoformat()
+        default_account = connected_account() if accounts is None else None
+        logging.info("Writing %s AMIs to %s with %s writers", len(amis), args.dynamodb_table, args.dynamodb_writers)
+        with dynamodb.InventoryWriter(client, args.dynamodb_table, workers=args.dynamodb_writers) as writer:
+            for ami in amis:
+                image = ami.meta.data
+                tags = {tag['Key']: tag['Value'] for tag in image.get('Tags') or []}
+                writer.put(dynamodb.inventory_item('ami', image['ImageId'], image.get('Account') or default_account, image['Region'], image.get('Name'), image.get('CreationDate'), tags, image, run_id, index_tags=index_tags))
+            writer.flush()
+            if filters:
+                logging.info("Search was filtered, AMIs no longer found are left in %s", args.dynamodb_table)
+            else:
+                # Every AMI of each searched account and region was written by this run, any other item of theirs is stale
+                stale = sum(dynamodb.delete_stale_inventory(client, args.dynamodb_table, dynamodb.inventory_scope('ami', account or default_account, region), run_id, writer) for account in report_accounts() for region in report_regions())
+                logging.info("Deleting %s AMIs no longer found from %s unless rewritten by this run", stale, args.dynamodb_table)
+        logging.info("Wrote %s and deleted %s items in %s batches, %s retried, %s kept, %s failed", writer.summary['written'], writer.summary['deleted'], writer.summary['batches'], writer.summary['retries'], writer.summary['kept'], writer.summary['failed'])
+        if writer.summary['failed']:
+            sys.exit(1)
+    except ClientError as e:
+        logging.error("Error in save_inventory: %s", e)
+        sys.exit(1)
+
+def dynamodb_client(): # Client for the inventory table
+    return session.client('dynamodb', region_name=args.dynamodb_region or args.region, endpoint_url=args.dynamodb_endpoint_url)
+
+def connected_account(): # Account ID of the connected session
+    return session.client('sts').get_caller_identity()['Account']
+
+def image_sort_key(image): # Sort AMIs by creation date - ISO 8601 strings sort chronologically
+    return image['CreationDate']
+
+def image_resource(image): # ec2.Image object preloaded with its description, for the account and region it was found in
+    source = (image.get('Account'), image['Region'])
+    if source not in ec2_resources:
+        ec2_resources[source] = account_session(source[0]).resource('ec2', region_name=source[1])
+    ami = ec2_resources[source].Image(image['ImageId'])
+    # Setting meta.data marks the resource as loaded so attribute access does not call DescribeImages again
+    ami.meta.data = image
+    return ami
+
+def report_regions(): # Regions searched for AMIs
+    if batch_jobs is not None:
+        return sorted({region for job in batch_jobs for region in job.regions})
+    if args.regions:
+        return [region.strip() for region in args.regions.split(',')]
+    return [args.region]
+
+def find_usage(): # Build the set of in-use ImageIds from instances and launch templates
+    try:
+        global image_usage
+        regions = args.usage_regions.split(',') if args.usage_regions else report_regions()
+        if not args.silent:
+            logging.info("Searching for instances and launch templates using AMIs in %s", ", ".join(regions))
+        if accounts is None:
+            image_usage = ec2_utils.collect_image_usage(session, regions)
+        else:
+            # AMIs can be shared, so instances in every account are counted against every image
+            results, failed = aws_utils.for_each_account(accounts, lambda account: ec2_utils.collect_image_usage(account_session(account), regions), max_workers=args.org_max_workers)
+            if failed:
+                # Images used only in an account that was not scanned would be reported as unused
+                for account, error in sorted(failed.items()):
+                    logging.error("Error in find_usage: instances and launch templates were not counted in %s: %s", account, error)
+                sys.exit(1)
+            image_usage = sum(results.values(), collections.Counter())
+    except ClientError as e:
+        logging.error("Error in find_usage: %s", e)
         sys.exit(1)
 
 def print_amis(amis): # Print AMI details
@@ -188,86 +562,100 @@ def print_amis(amis): # Print AMI details
         if args.silent:
             return
         logging.info("===================")
-        logging.info("Found {0} AMI images".format(len(list(amis))))
+        logging.info("Found %s AMI images", len(amis))
         # If silent is not enabled, but verbose is also not set print short AMI details
         if not args.verbose:
             logging.info("===================")
             for ami in amis:
-                logging.info("ImageId: {0}, Name: {1}, Created Date: {2}".format(ami.image_id, ami.name, ami.creation_date))
+                if image_usage is not None:
+                    logging.info("ImageId: %s, Name: %s, Created Date: %s, Used By: %s", ami.image_id, ami.name, ami.creation_date, image_usage.get(ami.id, 0))
+                else:
+                    logging.info("ImageId: %s, Name: %s, Created Date: %s", ami.image_id, ami.name, ami.creation_date)
         # If verbose output is enabled, print AMI details
         if args.verbose:
             logging.info("===================")
             for ami in amis:
-                logging.info("ImageId: {0}".format(ami.id))
-                logging.info("Name: {0}".format(ami.name))
-                logging.info("Description: {0}".format(ami.description))
-                logging.info("CreationDate: {0}".format(ami.creation_date))
-                logging.info("State: {0}".format(ami.state))
-                logging.info("Architecture: {0}".format(ami.architecture))
-                logging.info("ImageType: {0}".format(ami.image_type))
-                logging.info("Hypervisor: {0}".format(ami.hypervisor))
-                logging.info("RootDeviceType: {0}".format(ami.root_device_type))
-                logging.info("VirtualizationType: {0}".format(ami.virtualization_type))
-                logging.info("Tags: {0}".format(ami.tags))
+                logging.info("ImageId: %s", ami.id)
+                logging.info("Name: %s", ami.name)
+                logging.info("Description: %s", ami.description)
+                logging.info("CreationDate: %s", ami.creation_date)
+                logging.info("State: %s", ami.state)
+                logging.info("Architecture: %s", ami.architecture)
+                logging.info("ImageType: %s", ami.image_type)
+                logging.info("Hypervisor: %s", ami.hypervisor)
+                logging.info("RootDeviceType: %s", ami.root_device_type)
+                logging.info("VirtualizationType: %s", ami.virtualization_type)
+                logging.info("Tags: %s", ami.tags)
+                if image_usage is not None:
+                    logging.info("UsedByCount: %s", image_usage.get(ami.id, 0))
                 logging.info("===================")
     except ClientError as e:
-        logging.error("Error in find_amis: {0}".format(e))
+        logging.error("Error in find_amis: %s", e)
         sys.exit(1)
     except:
-        logging.error("Unexpected error in find_amis: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in find_amis: %s", sys.exc_info()[0])
         sys.exit(1)
 
 def save_output(amis): # Save AMI details to file
     try:
         #Validate file format is either csv, json, or yaml and default to csv if not
         logging.debug("(save_output) Validating file format")
-        logging.debug("(save_output) File format: {0}".format(args.format))
-        logging.debug("(save_output) File name: {0}".format(args.filename))
-        if args.format == 'csv' or args.format == 'json' or args.format == 'yaml':
+        logging.debug("(save_output) File format: %s", args.format)
+        logging.debug("(save_output) File name: %s", args.filename)
+        if args.format == 'csv' or args.format == 'json' or args.format == 'yaml' or args.format in columnar.FORMATS:
             if not args.silent:
-                logging.info("Saving output in {0} format".format(args.format))
+                logging.info("Saving output in %s format", args.format)
         else:
             logging.warning("Invalid output format specified")
-            logging.warning("Valid formats are csv, json, or yaml")
+            logging.warning("Valid formats are csv, json, yaml, parquet or arrow")
             logging.warning("Defaulting to csv")
             args.format = 'csv'
-        # Validate output directory exists and create if not
-        logging.debug("(save_output) Validating output directory")
-        dirExists = os.path.isdir(args.output_dir)
-        if dirExists:
-            logging.debug("(save_output) Output directory exists")
+        # Extension including any compression suffix (e.g. .csv.gz)
+        extension = "." + args.format + output_extension()
+        if args.s3_uri:
+            # Output is streamed to S3 so there is no local directory or existing file to validate
+            logging.debug("(save_output) Streaming output to %s", args.s3_uri)
         else:
-            os.makedirs(args.output_dir)
-        # Valiate filename does not already exist and if it does, append a number to the end
-        logging.debug("(save_output) Validating file exists")
-        logging.debug("(save_output) Checking for {0}".format(args.output_dir + "/" + args.filename + "." + args.format))
-        fileExists = os.path.isfile(args.output_dir + "/" + args.filename + "." + args.format)
-        if fileExists:
-            logging.debug("(save_output) File exists")
-            i = 1
-            # Test if the provided filename already exists in the directory and if so, append a number to the end, increment the number if the file still exists
-            fileExists = os.path.isfile(args.output_dir + "/" + args.filename + "." + args.format)
-            if fileExists == True:
-                while fileExists == True:
-                    logging.debug("(save_output) Append value: {0}".format(i))
-                    i += 1
-                    logging.debug("(save_output) Append value: {0}".format(i))
-                    fileExists = os.path.isfile(args.output_dir + "/" + args.filename + "_" + str(i) + "." + args.format)
-                args.filename = args.filename + "_" + str(i)
-                logging.debug("(save_output) New filename: {0}.{1}".format(args.filename, args.format))
+            # Validate output directory exists and create if not
+            logging.debug("(save_output) Validating output directory")
+            dirExists = os.path.isdir(args.output_dir)
+            if dirExists:
+                logging.debug("(save_output) Output directory exists")
+            else:
+                os.makedirs(args.output_dir)
+            # Valiate filename does not already exist and if it does, append a number to the end
+            logging.debug("(save_output) Validating file exists")
+            logging.debug("(save_output) Checking for %s", args.output_dir + "/" + args.filename + extension)
+            fileExists = os.path.isfile(args.output_dir + "/" + args.filename + extension)
+            if fileExists:
+                logging.debug("(save_output) File exists")
+                i = 1
+                # Test if the provided filename already exists in the directory and if so, append a number to the end, increment the number if the file still exists
+                fileExists = os.path.isfile(args.output_dir + "/" + args.filename + extension)
+                if fileExists == True:
+                    while fileExists == True:
+                        logging.debug("(save_output) Append value: %s", i)
+                        i += 1
+                        logging.debug("(save_output) Append value: %s", i)
+                        fileExists = os.path.isfile(args.output_dir + "/" + args.filename + "_" + str(i) + extension)
+                    args.filename = args.filename + "_" + str(i)
+                    logging.debug("(save_output) New filename: %s%s", args.filename, extension)
         # Finalising the filename including extension
-        fullFilename = args.filename + "." + args.format
+        fullFilename = args.filename + extension
         if not args.silent:
-            logging.info("Creating {0}/{1}".format(args.output_dir, fullFilename))
+            logging.info("Creating %s", output_location(fullFilename))
         if args.format == 'csv':
             logging.debug("(save_output) Creating csv file")
             # asyncio.run(save_csv(amis, fullFilename)) # Requires save_csv to be async
             save_csv(amis, fullFilename)
+        if args.format in columnar.FORMATS:
+            logging.debug("(save_output) Creating %s file", args.format)
+            save_columnar(amis, fullFilename)
         if args.format == 'json':
             logging.debug("(save_output) Creating json file")
             logging.warning("JSON output not yet implemented")
             logging.warning("Defaulting to csv")
-            fullFilename = args.filename + '.csv'
+            fullFilename = args.filename + '.csv' + output_extension()
             save_csv(amis, fullFilename)
             # asyncio.run(save_json(amis, fullFilename)) # Requires save_json to be async
             # save_json(amis, fullFilename)
@@ -275,21 +663,21 @@ def save_output(amis): # Save AMI details to file
             logging.debug("(save_output) Creating yaml file")
             logging.warning("YAML output not yet implemented")
             logging.warning("Defaulting to csv")
-            fullFilename = args.filename + '.csv'
+            fullFilename = args.filename + '.csv' + output_extension()
             save_csv(amis, fullFilename)
             # asyncio.run(save_yaml(amis, fullFilename)) # Requires save_yaml to be async
             # save_yaml(amis, fullFilename)
     except OSError as e:
-        logging.error("Error in save_output: {0}".format(e))
+        logging.error("Error in save_output: %s", e)
         sys.exit(1)
     except TypeError as e:
-        logging.error("Error in save_output: {0}".format(e))
+        logging.error("Error in save_output: %s", e)
         sys.exit(1)
     except UnboundLocalError as e:
-        logging.error("Error in save_output: {0}".format(e))
+        logging.error("Error in save_output: %s", e)
         sys.exit(1)
     except:
-        logging.error("Unexpected error in save_output: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in save_output: %s", sys.exc_info()[0])
         sys.exit(1)
 
 def save_csv(amis, fullFileName): # Save AMI details to csv file
@@ -297,26 +685,239 @@ def save_csv(amis, fullFileName): # Save AMI details to csv file
         logging.debug("(save_csv) Saving AMI details to csv file")
         # Create CSV file at args.output_dir/fullFileName
         # Write header row
-        column_headers = ['ImageId', 'Name', 'Description', 'CreationDate', 'State', 'Architecture', 'ImageType', 'Hypervisor', 'RootDeviceType', 'VirtualizationType', 'Tags']
-        with open(args.output_dir + "/" + fullFileName, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=column_headers)
+        with open_output_file(fullFileName) as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=report_columns())
             writer.writeheader()
             # Write data rows
             for ami in amis:
-                writer.writerow({'ImageId': ami.id, 'Name': ami.name, 'Description': ami.description, 'CreationDate': ami.creation_date, 'State': ami.state, 'Architecture': ami.architecture, 'ImageType': ami.image_type, 'Hypervisor': ami.hypervisor, 'RootDeviceType': ami.root_device_type, 'VirtualizationType': ami.virtualization_type, 'Tags': ami.tags})
-        # Check to see if file was created
-        csvCreated = os.path.isfile(args.output_dir + "/" + fullFileName)
-        if csvCreated:
-            if not args.silent:
-                logging.info("File created successfully")
-            # Print path to file
-            logging.info("File saved to {0}/{1}".format(args.output_dir, fullFileName))
+                writer.writerow(ami_row(ami))
+        # The file is only renamed into place (or the S3 upload completed) once fully written, so reaching here means it exists
+        if not args.silent:
+            logging.info("File created successfully")
+        # Print path to file
+        logging.info("File saved to %s", output_location(fullFileName))
     except OSError as e:
-        logging.error("Error in save_csv: {0}".format(e))
+        logging.error("Error in save_csv: %s", e)
     except TypeError as e:
-        logging.error("Error in save_csv: {0}".format(e))
+        logging.error("Error in save_csv: %s", e)
+    except ClientError as e:
+        logging.error("Error in save_csv: %s", e)
     except:
-        logging.error("Unexpected error in save_csv: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in save_csv: %s", sys.exc_info()[0])
+
+def save_columnar(amis, fullFileName): # Save AMI details to a parquet or arrow file in batched row groups
+    try:
+        logging.debug("(save_columnar) Saving AMI details to %s file", args.format)
+        tag_keys = columnar_tag_keys(amis)
+        columns = [('ImageId', 'string'), ('Name', 'string'), ('Description', 'string'), ('CreationDate', 'timestamp'), ('State', 'dictionary'), ('Architecture', 'dictionary'), ('ImageType', 'dictionary'), ('Hypervisor', 'dictionary'), ('RootDeviceType', 'dictionary'), ('VirtualizationType', 'dictionary'), ('Tags', 'map')]
+        if len(report_regions()) > 1:
+            columns.insert(1, ('Region', 'dictionary'))
+        if accounts is not None:
+            columns.insert(1, ('AccountId', 'dictionary'))
+        columns += [('Tag_' + key, 'dictionary') for key in tag_keys]
+        if image_usage is not None:
+            columns += [('InUse', 'bool'), ('UsedByCount', 'int64')]
+        with open_output_stream(fullFileName) as stream, columnar.open_columnar_writer(stream, columns, args.format, batch_rows=args.row_group_size) as writer:
+            for ami in amis:
+                row = ami_row(ami)
+                tags = columnar.tags_to_dict(ami.tags)
+                row['Tags'] = tags
+                row['CreationDate'] = ec2_utils.image_creation_date(ami.meta.data)
+                for key in tag_keys:
+                    row['Tag_' + key] = tags.get(key)
+                writer.write_row(row)
+        logging.debug("(save_columnar) Wrote %s rows in %s batches", writer.rows, writer.batches)
+        if not args.silent:
+            logging.info("File created successfully")
+        logging.info("File saved to %s", output_location(fullFileName))
+    except OSError as e:
+        logging.error("Error in save_columnar: %s", e)
+    except ClientError as e:
+        logging.error("Error in save_columnar: %s", e)
+    except ImportError as e:
+        logging.error("Error in save_columnar: %s - parquet and arrow output require pyarrow", e)
+
+def columnar_tag_keys(amis): # Tag keys promoted to their own columns in parquet/arrow output
+    if not args.tag_columns:
+        return []
+    if args.tag_columns == 'all':
+        return sorted({tag['Key'] for ami in amis for tag in ami.tags or []})
+    return [key.strip() for key in args.tag_columns.split(',')]
+
+def report_columns(): # Column headers for report output
+    column_headers = ['ImageId', 'Name', 'Description', 'CreationDate', 'State', 'Architecture', 'ImageType', 'Hypervisor', 'RootDeviceType', 'VirtualizationType', 'Tags']
+    if len(report_regions()) > 1:
+        column_headers.insert(1, 'Region')
+    if accounts is not None:
+        column_headers.insert(1, 'AccountId')
+    if image_usage is not None:
+        column_headers += ['InUse', 'UsedByCount']
+    return column_headers
+
+def ami_row(ami): # Report row for an AMI, joined against the in-use ImageId counts when --usage is set
+    row = {'ImageId': ami.id, 'Name': ami.name, 'Description': ami.description, 'CreationDate': ami.creation_date, 'State': ami.state, 'Architecture': ami.architecture, 'ImageType': ami.image_type, 'Hypervisor': ami.hypervisor, 'RootDeviceType': ami.root_device_type, 'VirtualizationType': ami.virtualization_type, 'Tags': ami.tags}
+    if len(report_regions()) > 1:
+        row['Region'] = ami.meta.data['Region']
+    if accounts is not None:
+        row['AccountId'] = ami.meta.data['Account']
+    if image_usage is not None:
+        row['UsedByCount'] = image_usage.get(ami.id, 0)
+        row['InUse'] = row['UsedByCount'] > 0
+    return row
+
+def output_location(fullFileName): # Full path or S3 URI of an output file
+    if args.s3_uri:
+        return args.s3_uri.rstrip('/') + "/" + fullFileName
+    return args.output_dir + "/" + fullFileName
+
+def output_extension(): # File extension suffix for compression and encryption (e.g. .gz.enc)
+    extension = file_system.compression_extension(args.compress)
+    if args.kms_key_id:
+        extension += ".enc"
+    return extension
+
+def open_output_file(fullFileName): # Open a text stream for an output file, committed when the with block completes and discarded on error
+    stream, sink = output_stream(fullFileName)
+    return file_system.commit_on_success(io.TextIOWrapper(stream, encoding='utf-8', newline=''), sink)
+
+def open_output_stream(fullFileName): # Open a binary stream for an output file, committed when the with block completes and discarded on error
+    stream, sink = output_stream(fullFileName)
+    return file_system.commit_on_success(stream, sink)
+
+def output_stream(fullFileName): # Build the writer stack for an output file, written locally or streamed to S3
+    # Layers are stacked compression --> encryption --> atomic local file or S3 upload
+    if args.s3_uri:
+        logging.debug("(output_stream) Streaming %s to S3 in %s MiB parts", fullFileName, args.s3_part_size)
+        sink = s3.open_s3_writer(session.client('s3'), output_location(fullFileName), part_size=args.s3_part_size * 1024 * 1024, max_in_flight=args.s3_max_in_flight)
+    else:
+        # Written to a temporary file and renamed into place on completion so a failed run never leaves a partial report
+        sink = file_system.AtomicFileWriter(output_location(fullFileName))
+    stream = sink
+    if args.kms_key_id:
+        logging.debug("(output_stream) Encrypting %s with a data key from %s", fullFileName, args.kms_key_id)
+        stream = kms.open_encrypting_writer(stream, session.client('kms'), args.kms_key_id, cache=data_key_cache, encryption_context={'Report': 'ListAMIs'})
+    return file_system.compress_stream(stream, args.compress, args.compress_level), sink
+
+def analyse_storage(amis): # Report EBS snapshot storage, age and estimated cost of the AMIs found
+    group_by = tuple(key.strip() for key in args.analytics_group_by.split(','))
+    output.log_message_section("Snapshot storage analytics", top=True, bottom=True)
+    columns = analytics.flatten_snapshots((ami.meta.data for ami in amis), group_tags=group_by)
+    results = analytics.storage_analytics(columns, price_per_gib_month=args.snapshot_price)
+    totals = results['totals']
+    logging.info("Images: %s, Snapshots: %s, Shared snapshots: %s", totals['Images'], totals['Snapshots'], totals['SharedSnapshots'])
+    logging.info("Provisioned GiB: %s, Estimated monthly cost: $%.2f (upper bound at $%s per GiB-month)", totals['GiB'], totals['EstimatedMonthlyCost'], args.snapshot_price)
+    logging.info("GiB by volume type: %s", results['volume_types'])
+    for label, snapshots, gib in results['age_histogram']:
+        logging.info("Age %s: %s snapshots, %s GiB", label, snapshots, gib)
+    if not args.silent:
+        for group in results['groups']:
+            logging.info("%s: %s images, %s snapshots, %s GiB, $%.2f", ", ".join("{0}={1}".format(key, group[key]) for key in group_by), group['Images'], group['Snapshots'], group['GiB'], group['EstimatedMonthlyCost'])
+    if args.verbose:
+        for snapshot_id, images in results['shared_snapshots'].items():
+            logging.info("Shared snapshot: %s used by %s images", snapshot_id, images)
+    if not args.no_save:
+        save_storage_csv(results['groups'], group_by)
+
+def save_storage_csv(groups, group_by): # Save per group snapshot storage to a csv file alongside the report
+    try:
+        fullFileName = args.filename + "-storage.csv" + output_extension()
+        with open_output_file(fullFileName) as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=list(group_by) + ['Images', 'Snapshots', 'GiB', 'EstimatedMonthlyCost'])
+            writer.writeheader()
+            writer.writerows(groups)
+        logging.info("Storage analytics saved to %s", output_location(fullFileName))
+    except OSError as e:
+        logging.error("Error in save_storage_csv: %s", e)
+    except ClientError as e:
+        logging.error("Error in save_storage_csv: %s", e)
+
+def prune_amis(amis): # Apply retention policy and deregister images and their snapshots
+    try:
+        if args.keep_last <= 0 and args.keep_daily <= 0 and args.keep_weekly <= 0:
+            logging.error("--prune requires at least one of --keep-last, --keep-daily or --keep-weekly")
+            sys.exit(1)
+        group_by = tuple(key.strip() for key in args.group_by.split(','))
+        output.log_message_section("Applying retention policy", top=True, bottom=True)
+        logging.info("Keep last: %s, Keep daily: %s, Keep weekly: %s, Group by: %s", args.keep_last, args.keep_daily, args.keep_weekly, group_by)
+        images = [ami.meta.data for ami in amis]
+        keep, prune = ec2_utils.apply_retention_policy(images, keep_last=args.keep_last, keep_daily=args.keep_daily, keep_weekly=args.keep_weekly, group_by=group_by)
+        if image_usage is not None:
+            # Never prune images still used by an instance or launch template
+            keep += [(image, 'in-use') for image, reason in prune if image_usage.get(image['ImageId'], 0) > 0]
+            prune = [(image, reason) for image, reason in prune if image_usage.get(image['ImageId'], 0) == 0]
+        logging.info("Retaining %s images, pruning %s images", len(keep), len(prune))
+        if args.verbose:
+            for image, reason in keep:
+                logging.info("Keep: %s %s (%s)", image['ImageId'], image.get('Name'), reason)
+        if args.dry_run:
+            logging.warning("Dry run enabled. No images or snapshots will be deleted")
+        if len(prune) == 0:
+            return
+        journal = file_system.JsonLinesJournal(args.journal)
+        try:
+            ec2_client = session.client('ec2', config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}))
+            ec2_utils.prune_images(ec2_client, prune, keep=keep, dry_run=args.dry_run, journal=journal, workers=args.prune_workers, rate=args.prune_rate)
+        finally:
+            journal.close()
+    except ClientError as e:
+        logging.error("Error in prune_amis: %s", e)
+        sys.exit(1)
+    except OSError as e:
+        logging.error("Error in prune_amis: %s", e)
+        sys.exit(1)
+
+def retag_amis(amis): # Apply the retag rules to the AMIs found with batched create_tags and delete_tags calls per account and region
+    try:
+        rules = retag_rules()
+        output.log_message_section("Applying retag rules", top=True, bottom=True)
+        if args.dry_run:
+            logging.warning("Dry run enabled. No tags will be changed")
+        # Images are grouped by the account and region they were found in, each with its own client and request rate
+        groups = collections.OrderedDict()
+        for ami in amis:
+            groups.setdefault((ami.meta.data.get('Account'), ami.meta.data['Region']), []).append(ami.meta.data)
+        journal = file_system.JsonLinesJournal(args.journal)
+        try:
+            for (account, region), images in groups.items():
+                changes = ec2_utils.plan_retag(images, rules, include_snapshots=not args.retag_images_only)
+                logging.info("%s%s: retagging %s of %s images", account + ' ' if account else '', region, len(changes), len(images))
+                if len(changes) == 0:
+                    continue
+                ec2_client = account_session(account).client('ec2', region_name=region, config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}))
+                ec2_utils.retag_images(ec2_client, changes, dry_run=args.dry_run, journal=journal, workers=args.retag_workers, rate=args.retag_rate, batch_size=args.retag_batch_size)
+        finally:
+            journal.close()
+    except ClientError as e:
+        logging.error("Error in retag_amis: %s", e)
+        sys.exit(1)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        logging.error("Error in retag_amis: %s", e)
+        sys.exit(1)
+
+def retag_rules(): # Retag rules from --retag-rules followed by one rule for --retag-rename, --retag-set and --retag-remove
+    rules = []
+    if args.retag_rules:
+        with open(os.path.expanduser(args.retag_rules)) as f:
+            document = yaml.safe_load(f)
+        rules = document.get('rules', []) if isinstance(document, dict) else document
+        if not isinstance(rules, list) or not all(isinstance(rule, dict) for rule in rules):
+            raise ValueError("{} must contain a list of rules".format(args.retag_rules))
+        for rule in rules:
+            unknown = set(rule) - {'match', 'rename', 'set', 'remove'}
+            if unknown:
+                raise ValueError("Unknown retag rule keys {} in {}".format(", ".join(sorted(unknown)), args.retag_rules))
+    rule = {}
+    if args.retag_rename:
+        rule['rename'] = dict(pair.strip().split('=', 1) for pair in args.retag_rename.split(','))
+    if args.retag_set:
+        rule['set'] = dict(pair.strip().split('=', 1) for pair in args.retag_set.split(','))
+    if args.retag_remove:
+        rule['remove'] = [key.strip() for key in args.retag_remove.split(',')]
+    if rule:
+        rules.append(rule)
+    for rule in rules:
+        logging.info("Retag rule: %s", json.dumps(rule, sort_keys=True))
+    return rules
 
 # Note: issues serializing the boto3 ec2.Image object to json and yaml - both functions not implemented yet
 # Note: amis is a list of ec2.Image class objects
@@ -339,15 +940,15 @@ def save_json(amis, fullFileName): # Save AMI details to json file
             if not args.silent:
                 logging.info("File created successfully")
             # Print path to file
-            logging.info("File saved to {0}/{1}".format(args.output_dir, fullFileName))
+            logging.info("File saved to %s/%s", args.output_dir, fullFileName)
     except OSError as e:
-        logging.error("Error in save_json: {0}".format(e))
+        logging.error("Error in save_json: %s", e)
     except TypeError as e:
-        logging.error("Error in save_json: {0}".format(e))
+        logging.error("Error in save_json: %s", e)
     except AttributeError as e:
-        logging.error("Error in save_json: {0}".format(e))
+        logging.error("Error in save_json: %s", e)
     except:
-        logging.error("Unexpected error in save_json: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in save_json: %s", sys.exc_info()[0])
 
 def save_yaml(amis, fullFileName): # Save AMI details to yaml file
     try:
@@ -363,14 +964,15 @@ def save_yaml(amis, fullFileName): # Save AMI details to yaml file
             if not args.silent:
                 logging.info("File created successfully")
             # Print path to file
-            logging.info("File saved to {0}/{1}".format(args.output_dir, fullFileName))
+            logging.info("File saved to %s/%s", args.output_dir, fullFileName)
     except OSError as e:
-        logging.error("Error in save_yaml: {0}".format(e))
+        logging.error("Error in save_yaml: %s", e)
     except TypeError as e:
-        logging.error("Error in save_yaml: {0}".format(e))
+        logging.error("Error in save_yaml: %s", e)
     except yaml.representer.RepresenterError as e:
-        logging.error("Error in save_yaml: {0}".format(e))
+        logging.error("Error in save_yaml: %s", e)
     except:
-        logging.error("Unexpected error in save_yaml: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in save_yaml: %s", sys.exc_info()[0])
 
-main() # Call main function
\ No newline at end of file
+with profiling.Profiler(args.profile, profiling.profile_prefix(args.output_dir, args.filename)): # Profile the run when --profile is set
+    main() # Call main function
\ No newline at end of file
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""Analytics utilities
+
+Provides vectorized storage and cost analytics over an AMI inventory.  Each image's EBS BlockDeviceMappings are flattened once
+into columnar NumPy arrays, after which every aggregate is computed with array operations rather than per-row Python loops.
+
+Requires numpy (see requirements.txt).
+
+Functions:
+
+flatten_snapshots: Flatten image BlockDeviceMappings into columnar arrays
+storage_analytics: Compute storage, sharing, age and cost aggregates from flattened snapshot columns
+
+"""
+
+
+# Import global modules
+import logging
+from datetime import datetime, timezone
+
+# Import third-party modules
+import numpy as np
+
+
+# Standard tier EBS snapshot storage price in USD per GiB-month (us-east-1)
+DEFAULT_PRICE_PER_GIB_MONTH = 0.05
+# Upper edges, in days, of the snapshot age histogram buckets
+DEFAULT_AGE_BINS = (7, 30, 90, 180, 365)
+
+
+class _Factorizer:
+    """Map repeated values to dense integer codes"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+
+def flatten_snapshots(images, group_tags=('Product', 'Environment')):
+    """Flatten image EBS mappings into columns
+
+    Args:
+        images (iterable): EC2 image descriptions (dicts as returned by DescribeImages)
+        group_tags (tuple): Image tag keys to group storage by
+
+    Returns:
+        columns (dict): NumPy arrays with one entry per EBS mapping:
+            snapshot (code), volume_size (GiB), volume_type (code), created (datetime64[s]) and group (code),
+            plus image_group (code per image) and 'snapshot_ids', 'volume_types' and 'groups' lists to decode the codes
+    """
+    snapshots = []
+    volume_sizes = []
+    volume_types = []
+    created = []
+    group_codes = []
+    image_groups = []
+    snapshot_codes = _Factorizer()
+    type_codes = _Factorizer()
+    groups = _Factorizer()
+    for image in images:
+        tags = {tag['Key']: tag['Value'] for tag in image.get('Tags') or []}
+        group = groups.code(tuple(tags.get(key) for key in group_tags))
+        image_groups.append(group)
+        # CreationDate is ISO 8601 with a trailing Z, trimmed to seconds for datetime64
+        creation_date = image['CreationDate'][:19]
+        for mapping in image.get('BlockDeviceMappings') or []:
+            ebs = mapping.get('Ebs')
+            if not ebs or not ebs.get('SnapshotId'):
+                continue
+            snapshots.append(snapshot_codes.code(ebs['SnapshotId']))
+            volume_sizes.append(ebs.get('VolumeSize') or 0)
+            volume_types.append(type_codes.code(ebs.get('VolumeType') or 'standard'))
+            created.append(creation_date)
+            group_codes.append(group)
+    logging.debug("(flatten_snapshots) Flattened %s images into %s snapshot rows", len(image_groups), len(snapshots))
+    return {
+        'snapshot': np.array(snapshots, dtype=np.int64),
+        'volume_size': np.array(volume_sizes, dtype=np.int64),
+        'volume_type': np.array(volume_types, dtype=np.int64),
+        'created': np.array(created, dtype='datetime64[s]'),
+        'group': np.array(group_codes, dtype=np.int64),
+        'image_group': np.array(image_groups, dtype=np.int64),
+        'snapshot_ids': snapshot_codes.values,
+        'volume_types': type_codes.values,
+        'groups': groups.values,
+        'group_tags': group_tags,
+    }
+
+
+def storage_analytics(columns, now=None, price_per_gib_month=DEFAULT_PRICE_PER_GIB_MONTH, age_bins=DEFAULT_AGE_BINS):
+    """Compute storage aggregates from flattened snapshot columns
+
+    Snapshots referenced by more than one image (for example images copied within a region) are only counted once towards
+    storage.  Snapshot storage is estimated from the source volume size, which is an upper bound as EBS snapshots are
+    incremental.
+
+    Args:
+        columns (dict): Output of flatten_snapshots()
+        now (datetime): Reference time for ages, defaults to the current UTC time
+        price_per_gib_month (float): Snapshot storage price in USD per GiB-month
+        age_bins (tuple): Upper edges in days of the age histogram buckets
+
+    Returns:
+        analytics (dict):
+            totals: images, snapshots, unique snapshots, shared snapshots, GiB and estimated monthly cost
+            groups: list of per group dicts (tag values, images, snapshots, GiB, estimated monthly cost)
+            volume_types: GiB per volume type
+            age_histogram: list of (bucket label, snapshots, GiB)
+            shared_snapshots: dict of snapshot ID --> number of images referencing it
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    now = np.datetime64(now.replace(tzinfo=None), 's')
+    snapshot = columns['snapshot']
+
+    # Deduplicate snapshots shared between images, keeping the first mapping of each
+    unique_codes, first_index, reference_counts = np.unique(snapshot, return_index=True, return_counts=True)
+    volume_size = columns['volume_size'][first_index]
+    volume_type = columns['volume_type'][first_index]
+    group = columns['group'][first_index]
+    created = columns['created'][first_index]
+
+    group_count = len(columns['groups'])
+    group_gib = np.bincount(group, weights=volume_size, minlength=group_count)
+    group_snapshots = np.bincount(group, minlength=group_count)
+    group_images = np.bincount(columns['image_group'], minlength=group_count)
+
+    type_gib = np.bincount(volume_type, weights=volume_size, minlength=len(columns['volume_types']))
+
+    age_days = (now - created).astype('timedelta64[s]').astype(np.int64) / 86400.0
+    edges = np.array((0,) + tuple(age_bins) + (np.inf,), dtype=float)
+    bucket = np.clip(np.searchsorted(edges, age_days, side='right') - 1, 0, len(edges) - 2)
+    age_snapshots = np.bincount(bucket, minlength=len(edges) - 1)
+    age_gib = np.bincount(bucket, weights=volume_size, minlength=len(edges) - 1)
+    labels = ["{0}-{1}d".format(int(edges[i]), int(edges[i + 1])) if np.isfinite(edges[i + 1]) else "{0}d+".format(int(edges[i])) for i in range(len(edges) - 1)]
+
+    shared = reference_counts > 1
+    total_gib = float(volume_size.sum())
+    groups = []
+    for code in np.argsort(-group_gib):
+        entry = dict(zip(columns['group_tags'], columns['groups'][code]))
+        entry.update({'Images': int(group_images[code]), 'Snapshots': int(group_snapshots[code]), 'GiB': int(group_gib[code]), 'EstimatedMonthlyCost': round(float(group_gib[code]) * price_per_gib_month, 2)})
+        groups.append(entry)
+
+    return {
+        'totals': {
+            'Images': int(len(columns['image_group'])),
+            'SnapshotReferences': int(len(snapshot)),
+            'Snapshots': int(len(unique_codes)),
+            'SharedSnapshots': int(shared.sum()),
+            'GiB': int(total_gib),
+            'EstimatedMonthlyCost': round(total_gib * price_per_gib_month, 2),
+        },
+        'groups': groups,
+        'volume_types': {columns['volume_types'][code]: int(type_gib[code]) for code in range(len(type_gib))},
+        'age_histogram': [(labels[i], int(age_snapshots[i]), int(age_gib[i])) for i in range(len(labels))],
+        'shared_snapshots': {columns['snapshot_ids'][code]: int(count) for code, count in zip(unique_codes[shared], reference_counts[shared])},
+    }
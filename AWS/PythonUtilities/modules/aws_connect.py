@@ -1,29 +1,56 @@
 #!/usr/bin/env python3
 
 """AWS utilities
+
+Functions:
+
+aws_connect: Connect to AWS and return a boto3 session
+cassette_session: Create a boto3 session whose API calls are recorded to, or replayed from, a cassette
+list_accounts: List the active accounts of an AWS Organization
+read_accounts: Read account IDs from a comma separated list or a file
+for_each_account: Run a function for each account in a bounded thread pool
+
+Classes:
+
+AssumedRoleSessions: Cache of boto3 sessions for a role assumed in each account, refreshed before the credentials expire
+
 """
 
 
 # Import global modules
+import concurrent.futures
 import logging
 import os
 from os import environ
 import sys
+import threading
 
 # Import local modules
 import modules.output as output
+import modules.cassette as cassette_utils
 
 # Import third party modules - see requirements.txt
 import boto3
+import botocore.session
+from botocore.credentials import DeferredRefreshableCredentials
 from botocore.exceptions import ClientError
 
-def aws_connect(profile, region):
+
+# Role created in member accounts by AWS Organizations
+DEFAULT_ROLE_NAME = 'OrganizationAccountAccessRole'
+# Seconds assumed role credentials are requested for, they are refreshed 15 minutes before they expire
+DEFAULT_ROLE_DURATION = 3600
+DEFAULT_ACCOUNT_WORKERS = 8
+
+def aws_connect(profile, region, cassette=None):
     """Connect to AWS
 
     This function connects to AWS using the AWS CLI credentials or AWS Session Token and creates a boto3 session.
 
     Args:
-        args (list): List of arguments passed from command line and parsed by argparse in _parse_args()
+        profile (str): AWS Profile
+        region (str): AWS Region
+        cassette (modules.cassette.Cassette): Record the session's API calls to, or replay them from, this cassette
 
     Returns:
         aws_session (boto3.session.Session): AWS Session
@@ -31,13 +58,22 @@ def aws_connect(profile, region):
     """
 
     try:
-        logging.debug("Function: _aws_connect() started with args: profile = {}, region = {}".format(profile, region))
+        logging.debug("Function: _aws_connect() started with args: profile = %s, region = %s", profile, region)
 
         logging.info("Connecting to AWS")
 
+        # A replayed session never reaches AWS so does not need configured credentials
+        if cassette is not None and cassette.mode == 'replay':
+            aws_session = cassette_session(profile, region, cassette)
+            _print_aws_session_details(aws_session)
+            logging.debug("Function: _aws_connect() completed")
+            return aws_session
+
         # Test if AWS CLI credentials are configured and that the passed profile exists by using _check_aws_profile() and looking for a 0 return code, if a 0 return code is found use the profile and region passed to the script to create a boto3 session
         if _check_aws_profile(profile) == 0:
             aws_session = boto3.Session(profile_name=profile,region_name=region)
+            if cassette is not None:
+                cassette.attach(aws_session)
             # Print AWS Session Details using _print_aws_session_details() and then return to main()
             _print_aws_session_details(aws_session)
             logging.debug("Function: _aws_connect() completed")
@@ -45,6 +81,8 @@ def aws_connect(profile, region):
         # Test if AWS Session Token is set in the environment and if so use them to create a boto3 session
         if _check_aws_vars() == 0:
             aws_session = boto3.Session()
+            if cassette is not None:
+                cassette.attach(aws_session)
             # Print AWS Session Details using _print_aws_session_details() and then return to main()
             _print_aws_session_details(aws_session)
             logging.debug("Function: _aws_connect() completed")
@@ -56,13 +94,38 @@ def aws_connect(profile, region):
         return 1
 
     except ClientError as e:
-        logging.error("Error in _aws_connect: {0}".format(e))
+        logging.error("Error in _aws_connect: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _aws_connect: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in _aws_connect: %s", sys.exc_info()[0])
         return 1
 
 
+def cassette_session(profile, region, cassette):
+    """Create a boto3 session whose API calls are recorded to, or replayed from, a cassette
+
+    When recording the session uses the passed profile.  When replaying, requests are answered from the cassette before
+    they reach AWS, so the session is created with placeholder credentials and works without any AWS configuration.
+
+    Args:
+        profile (str): AWS Profile, ignored when replaying
+        region (str): AWS Region
+        cassette (modules.cassette.Cassette): Cassette to record to or replay from
+
+    Returns:
+        aws_session (boto3.session.Session): AWS Session
+
+    Example:
+        session = cassette_session('default', 'us-east-1', Cassette('/tmp/run.jsonl.gz', mode='replay'))
+    """
+    if cassette.mode == 'replay':
+        aws_session = boto3.Session(aws_access_key_id=cassette_utils.REPLAY_ACCESS_KEY_ID, aws_secret_access_key=cassette_utils.REPLAY_SECRET_ACCESS_KEY, region_name=region)
+    else:
+        aws_session = boto3.Session(profile_name=profile, region_name=region)
+    cassette.attach(aws_session)
+    return aws_session
+
+
 def _check_aws_profile(profile):
     """Check if the passed AWS Profile exists
 
@@ -77,7 +140,7 @@ def _check_aws_profile(profile):
     """
     # Check if AWS CLI credentials are configured and that the passed profile exists
     try:
-        logging.debug("Function: _check_aws_profile() started with args: profile = {}".format(profile))
+        logging.debug("Function: _check_aws_profile() started with args: profile = %s", profile)
 
         logging.info("Checking AWS CLI credentials")
 
@@ -95,22 +158,22 @@ def _check_aws_profile(profile):
             for line in f:
                 if line.startswith('['):
                     aws_profiles.append(line.strip('[]\n'))
-        logging.debug("AWS Profiles: {0}".format(aws_profiles))
+        logging.debug("AWS Profiles: %s", aws_profiles)
 
         if profile in aws_profiles:
-            logging.info("AWS CLI credentials are configured and profile {0} exists".format(profile))
+            logging.info("AWS CLI credentials are configured and profile %s exists", profile)
             logging.debug("Function: _check_aws_profile() completed")
             return 0
         else:
-            logging.error("AWS CLI credentials are not configured or profile {0} does not exist".format(profile))
+            logging.error("AWS CLI credentials are not configured or profile %s does not exist", profile)
             logging.debug("Function: _check_aws_profile() completed")
             return 1
 
     except ClientError as e:
-        logging.error("Error in _check_aws_profile: {0}".format(e))
+        logging.error("Error in _check_aws_profile: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _check_aws_profile: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in _check_aws_profile: %s", sys.exc_info()[0])
         return 1
 
 
@@ -126,24 +189,24 @@ def _print_aws_session_details(aws_session):
         None
     """
     try:
-        logging.debug("Function: _print_aws_session_details() started with args: aws_session = {}".format(aws_session))
+        logging.debug("Function: _print_aws_session_details() started with args: aws_session = %s", aws_session)
 
         output.log_message_section("AWS Session Details:", top=False, bottom=False)
 
-        logging.info("Profile: {0}".format(aws_session.profile_name))
-        logging.info("Region: {0}".format(aws_session.region_name))
-        logging.info("User: {0}".format(aws_session.client('sts').get_caller_identity().get('Arn')))
-        logging.debug("AWS Session: {0}".format(aws_session))
+        logging.info("Profile: %s", aws_session.profile_name)
+        logging.info("Region: %s", aws_session.region_name)
+        logging.info("User: %s", aws_session.client('sts').get_caller_identity().get('Arn'))
+        logging.debug("AWS Session: %s", aws_session)
 
         output.log_message_section("Connected to AWS", top=False, bottom=False)
 
         logging.debug("Function: _print_aws_session_details() completed")
 
     except ClientError as e:
-        logging.error("Error in _print_aws_session_details: {0}".format(e))
+        logging.error("Error in _print_aws_session_details: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _print_aws_session_details: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in _print_aws_session_details: %s", sys.exc_info()[0])
         return 1
 
 
@@ -179,8 +242,156 @@ def _check_aws_vars():
         return 0
 
     except ClientError as e:
-        logging.error("Error in _check_aws_vars: {0}".format(e))
+        logging.error("Error in _check_aws_vars: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _check_aws_vars: {0}".format(sys.exc_info()[0]))
-        return 1
\ No newline at end of file
+        logging.error("Unexpected error in _check_aws_vars: %s", sys.exc_info()[0])
+        return 1
+
+
+def list_accounts(session):
+    """List the active accounts of an AWS Organization
+
+    Args:
+        session (boto3.session.Session): AWS Session in the organization's management account or a delegated administrator
+
+    Returns:
+        accounts (list): Account IDs, sorted
+    """
+    accounts = []
+    paginator = session.client('organizations').get_paginator('list_accounts')
+    for page in paginator.paginate():
+        for account in page['Accounts']:
+            if account.get('Status', 'ACTIVE') == 'ACTIVE':
+                accounts.append(account['Id'])
+    logging.debug("(list_accounts) Found %s active accounts", len(accounts))
+    return sorted(accounts)
+
+
+def read_accounts(accounts):
+    """Read account IDs from a comma separated list or a file
+
+    Args:
+        accounts (str): Comma separated account IDs, or the path of a file with one account ID per line.  Anything after the
+            ID on a line, such as the account name, and lines starting with # are ignored
+
+    Returns:
+        accounts (list): Account IDs in the order given, without duplicates
+    """
+    if os.path.isfile(os.path.expanduser(accounts)):
+        with open(os.path.expanduser(accounts)) as account_file:
+            ids = [line.replace(',', ' ').split()[0] for line in account_file if line.strip() and not line.strip().startswith('#')]
+    else:
+        ids = [account.strip() for account in accounts.split(',') if account.strip()]
+    return list(dict.fromkeys(ids))
+
+
+class AssumedRoleSessions:
+    """Cache of boto3 sessions for a role assumed in each account
+
+    One session is kept per account and shared by every thread and region.  Credentials are requested from STS when the
+    session is first used and botocore refreshes them 15 minutes before they expire, so long runs across many accounts keep
+    working without assuming each role more than needed.  The account the base session belongs to is served by the base
+    session itself, as the organization role does not exist in the management account.  Every account session shares the
+    base session's botocore loader, so service models are read from disk once rather than once per account.
+
+    Args:
+        session (boto3.session.Session): AWS Session the roles are assumed from
+        role_name (str): Name of the role assumed in each account
+        session_name (str): Role session name, recorded in CloudTrail
+        duration (int): Seconds the credentials are requested for
+        external_id (str): External ID required by the role's trust policy, if any
+        cassette (modules.cassette.Cassette): Cassette the account sessions are recorded to or replayed from, if any
+
+    Example:
+        sessions = AssumedRoleSessions(aws_connect('default', 'us-east-1'), role_name='OrganizationAccountAccessRole')
+        for account in list_accounts(sessions.session):
+            sessions.get(account).client('ec2').describe_images(Owners=['self'])
+    """
+
+    def __init__(self, session, role_name=DEFAULT_ROLE_NAME, session_name='PythonUtilities', duration=DEFAULT_ROLE_DURATION, external_id=None, cassette=None):
+        self.session = session
+        self.role_name = role_name
+        self.session_name = session_name
+        self.duration = duration
+        self.external_id = external_id
+        self.cassette = cassette
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._sts = None
+        self._caller_account = None
+
+    def role_arn(self, account_id):
+        """Return the ARN of the role in an account"""
+        partition = self.session.get_partition_for_region(self.session.region_name or 'us-east-1')
+        return "arn:{}:iam::{}:role/{}".format(partition, account_id, self.role_name)
+
+    def caller_account(self):
+        """Return the account ID of the base session"""
+        with self._lock:
+            if self._caller_account is None:
+                self._caller_account = self._sts_client().get_caller_identity()['Account']
+            return self._caller_account
+
+    def _sts_client(self):
+        if self._sts is None:
+            self._sts = self.session.client('sts')
+        return self._sts
+
+    def _assume_role(self, account_id):
+        kwargs = {'RoleArn': self.role_arn(account_id), 'RoleSessionName': self.session_name, 'DurationSeconds': self.duration}
+        if self.external_id:
+            kwargs['ExternalId'] = self.external_id
+        credentials = self._sts_client().assume_role(**kwargs)['Credentials']
+        logging.debug("(AssumedRoleSessions) Assumed %s until %s", kwargs['RoleArn'], credentials['Expiration'])
+        return {'access_key': credentials['AccessKeyId'], 'secret_key': credentials['SecretAccessKey'], 'token': credentials['SessionToken'], 'expiry_time': credentials['Expiration'].isoformat()}
+
+    def get(self, account_id):
+        """Return the session for an account
+
+        Args:
+            account_id (str): AWS account ID
+
+        Returns:
+            aws_session (boto3.session.Session): Session using the role in the account, or the base session for its own account
+        """
+        if account_id == self.caller_account():
+            return self.session
+        with self._lock:
+            if account_id not in self._sessions:
+                account_session = botocore.session.get_session()
+                account_session.register_component('data_loader', self.session._session.get_component('data_loader'))
+                # botocore has no public setter for refreshable credentials, this is how its own AssumeRole provider sets them
+                account_session._credentials = DeferredRefreshableCredentials(refresh_using=lambda: self._assume_role(account_id), method='sts-assume-role')
+                if self.cassette is not None:
+                    self.cassette.attach(account_session, label=account_id)
+                self._sessions[account_id] = boto3.Session(botocore_session=account_session, region_name=self.session.region_name)
+            return self._sessions[account_id]
+
+
+def for_each_account(accounts, function, max_workers=DEFAULT_ACCOUNT_WORKERS):
+    """Run a function for each account in a bounded thread pool
+
+    An error in one account is logged and does not stop the others.
+
+    Args:
+        accounts (list): Account IDs
+        function (function): Called with each account ID
+        max_workers (int): Maximum number of accounts processed at once
+
+    Returns:
+        results (dict): Return value of the function keyed by account ID, for the accounts that succeeded
+        failed (dict): Exception keyed by account ID, for the accounts that failed
+    """
+    results = {}
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(accounts)))) as executor:
+        futures = {executor.submit(function, account): account for account in accounts}
+        for future in concurrent.futures.as_completed(futures):
+            account = futures[future]
+            try:
+                results[account] = future.result()
+            except Exception as e:
+                logging.error("Error in account %s: %s", account, e)
+                failed[account] = e
+    return results, failed
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""AWS API record and replay utilities
+
+Records the HTTP responses of every AWS API call made through a botocore or boto3 session to a cassette file, and serves
+them back later without touching the network, so a slow or failing production run can be reproduced and benchmarked
+offline against the same data.
+
+The cassette hooks two botocore events, so every client created from the session after attach() is covered whichever
+service or protocol it uses:
+
+    before-send: In replay mode returns the recorded response instead of sending the request.  In record mode notes the
+                 request and the time it was sent.
+    response-received: In record mode appends the raw response (status, headers and body) and the time taken to the cassette.
+
+Cassettes are JSON Lines, a header holding the format version followed by one interaction per line, compressed with gzip
+or zstd when the path ends in .gz or .zst.  Cassettes recorded in another format version are rejected on replay.  Request
+headers (including the signature) and request bodies are not stored, only a hash of each request used to match it on
+replay.  Response bodies are stored as returned by AWS so a cassette may contain sensitive data, such as KMS data keys, and
+should be protected like the credentials used to record it.
+
+Requests are matched on replay by method, URL and body, ignoring idempotency tokens, and by the label of the session that
+made them, so identical requests made with different credentials (for example in each account of an organization) are
+told apart.  Repeated identical requests, such
+as polling DescribeImages, are served their recorded responses in order.  Requests that differ from the recording, for
+example because a parameter includes the current time, fall back to the next unused response recorded for the same
+operation and endpoint.
+
+Classes:
+
+Cassette: Record AWS API responses to, or replay them from, a cassette file
+CassetteMiss: Raised when a replayed request has no recorded response
+
+"""
+
+
+# Import global modules
+import atexit
+import base64
+import functools
+import hashlib
+import io
+import json
+import logging
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode
+
+# Import local modules
+import modules.file_system as file_system
+
+# Import third-party modules
+from botocore.awsrequest import AWSResponse, HeadersDict
+
+
+CASSETTE_MODES = ('record', 'replay')
+# Format version written to the cassette header.  Version 1 cassettes, which have no header, keyed requests without the
+# session label and credential scope, so their requests can no longer be matched
+CASSETTE_VERSION = 2
+# Replayed requests are still signed before they are intercepted, these credentials are only ever used to sign them
+REPLAY_ACCESS_KEY_ID = 'AKIAREPLAYCASSETTE00'
+REPLAY_SECRET_ACCESS_KEY = 'replay-cassette-secret-access-key'
+# Request parameters generated per call that are ignored when matching requests
+IDEMPOTENCY_PARAMETERS = ('ClientToken', 'ClientRequestToken', 'IdempotencyToken')
+# Region and service of the SigV4 credential scope, which tell requests apart when one custom endpoint serves every region
+CREDENTIAL_SCOPE = re.compile(r'Credential=[^/]+/\d{8}/([^/]+)/([^/]+)/')
+
+
+class CassetteMiss(Exception):
+    """Raised when a replayed request has no recorded response"""
+
+
+class _ReplayBody(io.BytesIO):
+    # Raw response body with the urllib3 stream() method botocore reads non-streaming responses with
+    def stream(self, **kwargs):
+        yield self.getvalue()
+
+
+def _compression(path):
+    for compress, extension in file_system.COMPRESSION_EXTENSIONS.items():
+        if compress is not None and path.endswith(extension):
+            return compress
+    return None
+
+
+def request_key(method, url, body, label=None, scope=None):
+    """Return the key a request is matched on, ignoring idempotency tokens
+
+    Args:
+        method (str): HTTP method
+        url (str): Request URL
+        body (bytes): Request body, query string or JSON encoded.  File like bodies (uploads) are not read
+        label (str): Label of the session that made the request
+        scope (str): Region and service the request was signed for
+
+    Returns:
+        key (str): SHA-256 hex digest
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if not isinstance(body, (bytes, bytearray)):
+        body = b''
+    if body.startswith(b'{'):
+        try:
+            params = json.loads(body)
+            for name in IDEMPOTENCY_PARAMETERS:
+                params.pop(name, None)
+            body = json.dumps(params, sort_keys=True).encode('utf-8')
+        except ValueError:
+            pass
+    elif b'=' in body and b'Action=' in body:
+        # Query protocol services (EC2, STS, ...) send their parameters form encoded
+        params = [(name, value) for name, value in parse_qsl(body.decode('utf-8'), keep_blank_values=True) if name not in IDEMPOTENCY_PARAMETERS]
+        body = urlencode(params).encode('utf-8')
+    digest = hashlib.sha256()
+    digest.update(' '.join([label or '', scope or '', method, url]).encode('utf-8') + b'\n')
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class Cassette:
+    """Record AWS API responses to, or replay them from, a cassette file
+
+    Args:
+        path (str): Cassette file path, compressed when it ends in .gz or .zst
+        mode (str): record or replay
+        latency (float): Replay only, multiple of each recorded response time to wait before returning it, 0 to return
+            responses immediately and 1 to reproduce the original latencies
+
+    Example:
+        with Cassette('/tmp/ami-report.jsonl.gz', mode='record') as cassette:
+            session = boto3.Session(profile_name='default', region_name='us-east-1')
+            cassette.attach(session)
+            session.client('ec2').describe_images(Owners=['self'])
+    """
+
+    def __init__(self, path, mode='replay', latency=0.0):
+        if mode not in CASSETTE_MODES:
+            raise ValueError("Cassette mode must be one of {}, not {}".format(', '.join(CASSETTE_MODES), mode))
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.interactions = []
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._pending = threading.local()
+        self._file = None
+        self._started = time.monotonic()
+        self._by_key = {}
+        self._by_operation = {}
+        self._used = set()
+        logging.info("%s AWS API calls %s %s", 'Recording' if mode == 'record' else 'Replaying', 'to' if mode == 'record' else 'from', path)
+        if mode == 'record':
+            self._file = io.TextIOWrapper(file_system.compress_stream(open(path, 'wb'), _compression(path)), encoding='utf-8')
+            self._file.write(json.dumps({'version': CASSETTE_VERSION}) + '\n')
+            # Scripts exit with sys.exit() from many places, the cassette is still completed
+            atexit.register(self.close)
+        else:
+            self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def _load(self):
+        version = None
+        with io.TextIOWrapper(file_system.open_compressed(self.path), encoding='utf-8') as cassette:
+            for line in cassette:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if version is None and 'version' in entry:
+                    version = entry['version']
+                    continue
+                # Version 1 cassettes start straight with an interaction
+                version = version or 1
+                self.interactions.append(entry)
+        if version != CASSETTE_VERSION:
+            raise ValueError("Cassette {} is format version {}, this version replays format {} only - record it again".format(self.path, version, CASSETTE_VERSION))
+        for index, interaction in enumerate(self.interactions):
+            self._by_key.setdefault(interaction['key'], []).append(index)
+            self._by_operation.setdefault(self._operation(interaction['operation'], interaction['url'], interaction.get('label'), interaction.get('scope')), []).append(index)
+        logging.debug("(Cassette) Loaded %s interactions from %s", len(self.interactions), self.path)
+
+    @staticmethod
+    def _operation(operation, url, label=None, scope=None):
+        # Session label, operation, endpoint and credential scope, the fallback match for requests whose parameters differ from the recording
+        return "{} {} {} {}".format(label or '', operation, url.split('?')[0], scope or '')
+
+    def attach(self, session, label=None):
+        """Record or replay the API calls of clients created from a session from now on
+
+        Args:
+            session (obj): boto3.session.Session or botocore.session.Session
+            label (str): Label distinguishing the session's requests from identical requests made by other sessions, such
+                as the account ID of an assumed role session
+        """
+        register = session.events.register if hasattr(session, 'events') else session.register
+        register('before-send', functools.partial(self._before_send, label))
+        if self.mode == 'record':
+            # response-received rather than before-parse, which botocore only emits from 1.28
+            register('response-received', self._response_received)
+        logging.debug("(Cassette) Attached to session %s", label or '')
+
+    def _before_send(self, label, request, event_name, **kwargs):
+        operation = event_name.split('.')[-1]
+        authorization = request.headers.get('Authorization') or b''
+        scope = CREDENTIAL_SCOPE.search(authorization.decode('utf-8') if isinstance(authorization, bytes) else authorization)
+        scope = '/'.join(scope.groups()) if scope else None
+        key = request_key(request.method, request.url, request.body, label, scope)
+        if self.mode == 'record':
+            self._pending.request = {'label': label, 'scope': scope, 'operation': operation, 'url': request.url, 'key': key, 'sent': time.monotonic()}
+            return None
+        interaction = self._next(key, self._operation(operation, request.url, label, scope))
+        if self.latency > 0:
+            time.sleep(interaction['elapsed'] * self.latency)
+        if interaction.get('encoding') == 'base64':
+            body = base64.b64decode(interaction['body'])
+        else:
+            body = interaction['body'].encode('utf-8')
+        return AWSResponse(request.url, interaction['status'], HeadersDict(interaction['headers']), _ReplayBody(body))
+
+    def _next(self, key, operation):
+        # Unused exact match, then unused match for the operation, then the last exact or operation match repeated
+        candidates = (self._by_key.get(key, []), self._by_operation.get(operation, []))
+        with self._lock:
+            for indexes in candidates:
+                for index in indexes:
+                    if index not in self._used:
+                        self._used.add(index)
+                        return self.interactions[index]
+            for indexes in candidates:
+                if indexes:
+                    return self.interactions[indexes[-1]]
+        raise CassetteMiss("No recorded response in {} for {}".format(self.path, operation.strip()))
+
+    def _response_received(self, response_dict, event_name, **kwargs):
+        operation = event_name.split('.')[-1]
+        pending = getattr(self._pending, 'request', None)
+        self._pending.request = None
+        # No response_dict when the request failed without a response, such as a connection error
+        if pending is None or response_dict is None or pending['operation'] != operation:
+            return
+        body = response_dict['body']
+        if not isinstance(body, (bytes, bytearray)):
+            logging.warning("(Cassette) Streaming response of %s not recorded", operation)
+            return
+        interaction = {
+            'label': pending['label'],
+            'scope': pending['scope'],
+            'operation': pending['operation'],
+            'url': pending['url'],
+            'key': pending['key'],
+            'offset': round(pending['sent'] - self._started, 6),
+            'elapsed': round(time.monotonic() - pending['sent'], 6),
+            'status': response_dict['status_code'],
+            'headers': dict(response_dict['headers']),
+        }
+        try:
+            interaction['body'] = bytes(body).decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body'] = base64.b64encode(body).decode('ascii')
+            interaction['encoding'] = 'base64'
+        line = json.dumps(interaction, separators=(',', ':'))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+                self.recorded += 1
+
+    def close(self):
+        """Finish writing a recorded cassette"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                logging.info("Recorded %s AWS API calls to %s", self.recorded, self.path)
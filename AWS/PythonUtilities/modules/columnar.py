@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""Columnar output utilities
+
+Provides a writer for Apache Parquet and Arrow IPC files.  Rows are buffered into record batches of a fixed number of rows and
+each batch is written as a Parquet row group (or Arrow record batch) as soon as it is full, so memory use is bounded by the
+batch size rather than the size of the inventory.  The output stream only needs to support write(), so the writer can be
+stacked on the compression, encryption and S3 streams in modules.file_system, modules.kms and modules.s3.
+
+Requires pyarrow (see requirements.txt), which is imported on first use.
+
+Column types:
+
+    string      UTF-8 string
+    dictionary  Dictionary encoded string, for repetitive values such as state or architecture
+    int64       64-bit integer
+    float64     Double
+    bool        Boolean
+    timestamp   UTC timestamp in milliseconds, values are datetime objects
+    map         Map of string keys to string values, values are dicts or lists of (key, value) pairs
+    list        List of strings
+
+Functions:
+
+tags_to_dict: Convert an AWS tag list into a dictionary
+open_columnar_writer: Create a ColumnarWriter for a format name
+
+Classes:
+
+ColumnarWriter: Batched Parquet / Arrow IPC writer with bounded memory use
+
+"""
+
+
+# Import global modules
+import logging
+
+
+FORMATS = ('parquet', 'arrow')
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow'}
+DEFAULT_BATCH_ROWS = 10000
+
+
+def _arrow_type(pa, type_name):
+    types = {
+        'string': pa.string(),
+        'dictionary': pa.dictionary(pa.int32(), pa.string()),
+        'int64': pa.int64(),
+        'float64': pa.float64(),
+        'bool': pa.bool_(),
+        'timestamp': pa.timestamp('ms', tz='UTC'),
+        'map': pa.map_(pa.string(), pa.string()),
+        'list': pa.list_(pa.string()),
+    }
+    if type_name not in types:
+        raise ValueError("Unknown column type {0}, expected one of {1}".format(type_name, ", ".join(types)))
+    return types[type_name]
+
+
+def tags_to_dict(tags):
+    """Convert an AWS tag list into a dictionary
+
+    Args:
+        tags (list): Tags as [{'Key': key, 'Value': value}, ...], or None
+
+    Returns:
+        tags (dict): Tag key --> value
+    """
+    return {tag['Key']: tag['Value'] for tag in tags or []}
+
+
+class ColumnarWriter:
+    """Batched Parquet / Arrow IPC writer
+
+    Args:
+        stream (obj): Writable binary stream, closed when the writer is closed
+        columns (list): (column name, column type) pairs, see the module docstring for the column types
+        format (str): parquet or arrow
+        batch_rows (int): Rows per Parquet row group / Arrow record batch
+        compression (str): Parquet column compression codec (snappy, zstd, gzip or none), ignored for arrow
+
+    Example:
+        with ColumnarWriter(open('amis.parquet', 'wb'), [('ImageId', 'string'), ('State', 'dictionary')]) as writer:
+            writer.write_row({'ImageId': 'ami-123', 'State': 'available'})
+    """
+
+    def __init__(self, stream, columns, format='parquet', batch_rows=DEFAULT_BATCH_ROWS, compression='snappy'):
+        # Imported on first use so scripts that do not write columnar output do not require pyarrow
+        import pyarrow as pa
+        logging.debug("Function: ColumnarWriter() started with args: columns = %s, format = %s, batch_rows = %s", columns, format, batch_rows)
+        if format not in FORMATS:
+            raise ValueError("Unknown columnar format {0}, expected one of {1}".format(format, ", ".join(FORMATS)))
+        self._pa = pa
+        self.stream = stream
+        self.format = format
+        self.batch_rows = max(1, batch_rows)
+        self.rows = 0
+        self.batches = 0
+        self.schema = pa.schema([(name, _arrow_type(pa, type_name)) for name, type_name in columns])
+        self._buffers = {name: [] for name in self.schema.names}
+        self._buffered = 0
+        if format == 'parquet':
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(stream, self.schema, compression=compression)
+        else:
+            self._writer = pa.ipc.new_file(stream, self.schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # On error the footer is not written and the stream is left for the caller to abort (see file_system.commit_on_success)
+        if exc_type is None:
+            self.close()
+
+    def write_row(self, row):
+        """Buffer a row, writing a batch once batch_rows rows are buffered
+
+        Args:
+            row (dict): Column name --> value, missing columns are written as null
+        """
+        for name, values in self._buffers.items():
+            value = row.get(name)
+            if isinstance(value, dict):
+                value = list(value.items())
+            values.append(value)
+        self._buffered += 1
+        if self._buffered >= self.batch_rows:
+            self.flush()
+
+    def write_rows(self, rows):
+        """Buffer an iterable of rows"""
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        """Write any buffered rows as a record batch"""
+        if self._buffered == 0:
+            return
+        arrays = [self._pa.array(self._buffers[field.name], type=field.type) for field in self.schema]
+        batch = self._pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+        self.batches += 1
+        logging.debug("(ColumnarWriter) Wrote batch %s of %s rows", self.batches, batch.num_rows)
+        for values in self._buffers.values():
+            values.clear()
+        self._buffered = 0
+
+    def close(self):
+        """Write any buffered rows, the file footer, and close the stream"""
+        if self._writer is None:
+            return
+        try:
+            self.flush()
+            self._writer.close()
+        finally:
+            self._writer = None
+            self.stream.close()
+
+
+def open_columnar_writer(stream, columns, format, batch_rows=DEFAULT_BATCH_ROWS):
+    """Create a columnar writer
+
+    Args:
+        stream (obj): Writable binary stream
+        columns (list): (column name, column type) pairs
+        format (str): parquet or arrow
+        batch_rows (int): Rows per row group / record batch
+
+    Returns:
+        writer (ColumnarWriter): Columnar writer, closing it also closes the stream
+    """
+    return ColumnarWriter(stream, columns, format=format, batch_rows=batch_rows)
@@ -1,16 +1,54 @@
 #!/usr/bin/env python3
 
 """DynamoDB utilities
+
+Provides the Terraform lock table helpers and a shared inventory store of AMIs and Lambda functions, so that teams can read the
+inventory from one DynamoDB table instead of each calling the EC2 and Lambda APIs.
+
+Inventory table layout - one item per resource:
+
+ResourceId (hash key): AMI ID or Lambda function ARN
+Scope: <kind>#<account>#<region>, the hash key of the Scope-index GSI used to list and expire the resources of one account and region
+Kind, Account, Region, Name, Created: Resource kind (ami or lambda), location, name and creation or last modified time
+Tags: Map of the resource tags
+Tag_<Key>: Copy of each indexed tag, the hash key of the Tag_<Key>-index GSI with Created as the range key
+RunId: Identifier of the run that last wrote the item
+Data: JSON encoded resource description
+
+Functions:
+
+create_inventory_table: Create the inventory table with its Scope and tag GSIs if it does not exist
+tag_attribute: Attribute holding an indexed tag
+tag_index: GSI of an indexed tag
+inventory_scope: Scope-index hash key of the resources of one kind, account and region
+inventory_item: Build an inventory item for a resource
+scan_inventory: Read every inventory item with a segmented parallel Scan
+query_inventory: Read the inventory items of one scope, or with one value of an indexed tag, from a GSI
+delete_stale_inventory: Conditionally delete the items of a scope that were not written by the current run
+
+Classes:
+
+InventoryWriter: Write inventory items with BatchWriteItem from a pool of writer threads, retrying unprocessed items
+
 """
 
 
 # Import global modules
+import concurrent.futures
+import json
 import logging
+import queue
+import random
+import re
+import sys
+import threading
+import time
 
 # Import local modules
 import modules.output as output
 
 # Import third-party modules
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 from botocore.exceptions import ClientError
 
 
@@ -27,15 +65,15 @@ def _check_existing_dynamodb_table(dynamodb_client, dynamodb_table_name):
         table_exists (bool): True if the DynamoDB Table exists, False if it does not exist
     """
     try:
-        logging.debug("Function _check_existing_dynamodb_table called with arguments: dynamodb_client={0}, dynamodb_table_name={1}".format(dynamodb_client, dynamodb_table_name))
+        logging.debug("Function _check_existing_dynamodb_table called with arguments: dynamodb_client=%s, dynamodb_table_name=%s", dynamodb_client, dynamodb_table_name)
 
-        logging.info("Checking if DynamoDB Table {0} already exists".format(dynamodb_table_name))
+        logging.info("Checking if DynamoDB Table %s already exists", dynamodb_table_name)
 
         # Check if the DynamoDB Table already exists
         table_exists = False
         for table in dynamodb_client.list_tables()['TableNames']:
             if table == dynamodb_table_name:
-                logging.debug("DynamoDB Table {0} already exists".format(dynamodb_table_name))
+                logging.debug("DynamoDB Table %s already exists", dynamodb_table_name)
                 table_exists = True
                 break
 
@@ -44,13 +82,13 @@ def _check_existing_dynamodb_table(dynamodb_client, dynamodb_table_name):
         return table_exists
 
     except AttributeError as e:
-        logging.error("Error in _check_existing_dynamodb_table: {0}".format(e))
+        logging.error("Error in _check_existing_dynamodb_table: %s", e)
         return 1
     except ClientError as e:
-        logging.error("Error in _check_existing_dynamodb_table: {0}".format(e))
+        logging.error("Error in _check_existing_dynamodb_table: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _check_existing_dynamodb_table: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in _check_existing_dynamodb_table: %s", sys.exc_info()[0])
         return 1
 
 
@@ -66,7 +104,7 @@ def _store_dynamodb_table_details(dynamodb_table_name):
         dynamodb_table (str): Name of the DynamoDB Table
     """
     try:
-        logging.debug("Function _store_dynamodb_table_details called with arguments: dynamodb_table_name={0}".format(dynamodb_table_name))
+        logging.debug("Function _store_dynamodb_table_details called with arguments: dynamodb_table_name=%s", dynamodb_table_name)
 
         # Declare global variables to be updated in this function
         global dynamodb_table # Store the DynamoDB Table details
@@ -75,13 +113,13 @@ def _store_dynamodb_table_details(dynamodb_table_name):
         logging.debug("Function: _store_dynamodb_table_details() completed")
 
     except AttributeError as e:
-        logging.error("Error in _store_dynamodb_table_details: {0}".format(e))
+        logging.error("Error in _store_dynamodb_table_details: %s", e)
         return 1
     except ClientError as e:
-        logging.error("Error in _store_dynamodb_table_details: {0}".format(e))
+        logging.error("Error in _store_dynamodb_table_details: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _store_dynamodb_table_details: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in _store_dynamodb_table_details: %s", sys.exc_info()[0])
         return 1
 
 
@@ -97,7 +135,7 @@ def _create_dynamodb_table(args, aws_account_id, aws_session):
         dynamodb_table_name (str): Name of the DynamoDB Table
     """
     try:
-        logging.debug("Function _create_dynamodb_table called with arguments: args={0}, aws_account_id={1}, aws_session={2}".format(args, aws_account_id, aws_session))
+        logging.debug("Function _create_dynamodb_table called with arguments: args=%s, aws_account_id=%s, aws_session=%s", args, aws_account_id, aws_session)
 
         # Append the AWS Account ID to the DynamoDB Table name to ensure it is unique
         args.dynamodb_table_name = '{0}-{1}'.format(args.dynamodb_table_name, aws_account_id)
@@ -107,11 +145,11 @@ def _create_dynamodb_table(args, aws_account_id, aws_session):
             args.dynamodb_table_region = aws_session.region_name
 
         output.log_message_section("DynamoDB Table Configuration", top=True, bottom=True)
-        logging.info("DynamoDB Table Name: {0}".format(args.dynamodb_table_name))
-        logging.info("DynamoDB Table Region: {0}".format(args.dynamodb_table_region))
-        logging.info("DynamoDB Table Read Capacity: {0}".format(args.dynamodb_table_read_capacity))
-        logging.info("DynamoDB Table Write Capacity: {0}".format(args.dynamodb_table_write_capacity))
-        logging.info("DynamoDB Primary Key: {0}".format("LockID"))
+        logging.info("DynamoDB Table Name: %s", args.dynamodb_table_name)
+        logging.info("DynamoDB Table Region: %s", args.dynamodb_table_region)
+        logging.info("DynamoDB Table Read Capacity: %s", args.dynamodb_table_read_capacity)
+        logging.info("DynamoDB Table Write Capacity: %s", args.dynamodb_table_write_capacity)
+        logging.info("DynamoDB Primary Key: %s", "LockID")
         logging.info("========================================")
 
         # Create a DynamoDB client based on the passed dynamodb_table_region
@@ -119,7 +157,7 @@ def _create_dynamodb_table(args, aws_account_id, aws_session):
 
         # Check if the DynamoDB Table already exists
         if _check_existing_dynamodb_table(dynamodb_client, args.dynamodb_table_name) is True:
-            logging.info("DynamoDB Table {0} already exists".format(args.dynamodb_table_name))
+            logging.info("DynamoDB Table %s already exists", args.dynamodb_table_name)
             _store_dynamodb_table_details(args.dynamodb_table_name)
             logging.debug("Function: _create_dynamodb_table() completed")
             return
@@ -139,16 +177,16 @@ def _create_dynamodb_table(args, aws_account_id, aws_session):
         # Store the DynamoDB Table name in the global variable dynamodb_table
         _store_dynamodb_table_details(args.dynamodb_table_name)
 
-        logging.debug("Exiting Function _create_dynamodb_table with dynamodb_table_name: {0}".format(dynamodb_table_name))
+        logging.debug("Exiting Function _create_dynamodb_table with dynamodb_table_name: %s", dynamodb_table_name)
 
     except ClientError as e:
-        logging.error("Error in _create_dynamodb_table: {0}".format(e))
+        logging.error("Error in _create_dynamodb_table: %s", e)
         return 1
     except TypeError as e:
-        logging.error("Error in _create_dynamodb_table: {0}".format(e))
+        logging.error("Error in _create_dynamodb_table: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _create_dynamodb_table: {0}".format(sys.exc_info()[0]))
+        logging.error("Unexpected error in _create_dynamodb_table: %s", sys.exc_info()[0])
         return 1
 
 
@@ -169,22 +207,367 @@ def _print_s3_and_dynamodb_backend_details():
         output.log_message_section('S3 and DynamoDB Backend Details', top=True, bottom=False, divider='*')
         output.log_message_section('Add the configuration below to your Terraform configuration!', top=False, bottom=True, divider='*')
 
-        logging.info("S3 Bucket Name: {0}".format(s3_bucket_name))
-        logging.info("S3 Bucket Region: {0}".format(s3_bucket_region))
+        logging.info("S3 Bucket Name: %s", s3_bucket_name)
+        logging.info("S3 Bucket Region: %s", s3_bucket_region)
         if s3_kms_key_id is not None:
-            logging.info("KMS Key ID: {0}".format(s3_kms_key_id))
+            logging.info("KMS Key ID: %s", s3_kms_key_id)
         if s3_kms_key_arn is not None:
-            logging.info("KMS Key ARN: {0}".format(s3_kms_key_arn))
+            logging.info("KMS Key ARN: %s", s3_kms_key_arn)
         if s3_kms_key_alias is not None:
-            logging.info("KMS Key Alias: {0}".format(s3_kms_key_alias))
+            logging.info("KMS Key Alias: %s", s3_kms_key_alias)
         if dynamodb_table is not None:
-            logging.info("DynamoDB Table Name: {0}".format(dynamodb_table))
+            logging.info("DynamoDB Table Name: %s", dynamodb_table)
 
         logging.debug("Exiting Function: _print_s3_and_dynamodb_backend_details")
 
     except NameError as e:
-        logging.error("Error in _print_s3_and_dynamodb_backend_details: {0}".format(e))
+        logging.error("Error in _print_s3_and_dynamodb_backend_details: %s", e)
         return 1
     except:
-        logging.error("Unexpected error in _print_s3_and_dynamodb_backend_details: {0}".format(sys.exc_info()[0]))
-        return 1
\ No newline at end of file
+        logging.error("Unexpected error in _print_s3_and_dynamodb_backend_details: %s", sys.exc_info()[0])
+        return 1
+
+# Maximum put and delete requests per BatchWriteItem call
+MAX_BATCH_WRITE_ITEMS = 25
+# Attempts at writing the unprocessed items of a batch before they are counted as failed
+MAX_WRITE_ATTEMPTS = 8
+# Writer threads and Scan segments used by default
+DEFAULT_WRITERS = 4
+DEFAULT_SEGMENTS = 4
+# Tags copied to their own attribute with a GSI so the inventory can be queried by them
+DEFAULT_INDEX_TAGS = ('Product', 'Environment')
+# GSI listing the resources of one kind, account and region
+SCOPE_INDEX = 'Scope-index'
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def tag_attribute(key):
+    """Attribute holding an indexed tag, with characters not allowed in index names replaced"""
+    return 'Tag_' + re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+
+
+def tag_index(key):
+    """GSI of an indexed tag"""
+    return tag_attribute(key) + '-index'
+
+
+def inventory_scope(kind, account, region):
+    """Scope-index hash key of the resources of one kind, account and region"""
+    return '{}#{}#{}'.format(kind, account or '', region)
+
+
+def create_inventory_table(dynamodb_client, table_name, index_tags=DEFAULT_INDEX_TAGS):
+    """Create the inventory table if it does not exist
+
+    The table is created with on-demand billing, a Scope-index GSI and one GSI per indexed tag, and this function waits for it
+    to become active.  GSIs of tags added to index_tags after the table was created are not added, a warning is logged instead.
+
+    Args:
+        dynamodb_client (obj): Boto3 DynamoDB client object
+        table_name (str): Name of the inventory table
+        index_tags (list): Tag keys with their own GSI
+
+    Returns:
+        created (bool): True if the table was created, False if it already existed
+    """
+    try:
+        table = dynamodb_client.describe_table(TableName=table_name)['Table']
+        indexes = {index['IndexName'] for index in table.get('GlobalSecondaryIndexes', [])}
+        missing = [key for key in index_tags if tag_index(key) not in indexes]
+        if missing:
+            logging.warning("DynamoDB Table %s has no index for tags %s, they cannot be queried", table_name, ", ".join(missing))
+        return False
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+    logging.info("Creating DynamoDB Table %s with indexes for tags %s", table_name, ", ".join(index_tags))
+    attributes = [{'AttributeName': name, 'AttributeType': 'S'} for name in ['ResourceId', 'Scope', 'Created'] + [tag_attribute(key) for key in index_tags]]
+    indexes = [{'IndexName': SCOPE_INDEX, 'KeySchema': [{'AttributeName': 'Scope', 'KeyType': 'HASH'}, {'AttributeName': 'ResourceId', 'KeyType': 'RANGE'}], 'Projection': {'ProjectionType': 'ALL'}}]
+    indexes += [{'IndexName': tag_index(key), 'KeySchema': [{'AttributeName': tag_attribute(key), 'KeyType': 'HASH'}, {'AttributeName': 'Created', 'KeyType': 'RANGE'}], 'Projection': {'ProjectionType': 'ALL'}} for key in index_tags]
+    dynamodb_client.create_table(TableName=table_name, AttributeDefinitions=attributes, KeySchema=[{'AttributeName': 'ResourceId', 'KeyType': 'HASH'}], GlobalSecondaryIndexes=indexes, BillingMode='PAY_PER_REQUEST')
+    dynamodb_client.get_waiter('table_exists').wait(TableName=table_name)
+    return True
+
+
+def inventory_item(kind, resource_id, account, region, name, created, tags, data, run_id, index_tags=DEFAULT_INDEX_TAGS):
+    """Build an inventory item
+
+    Args:
+        kind (str): Resource kind, ami or lambda
+        resource_id (str): AMI ID or function ARN
+        account (str): Account ID, None if unknown
+        region (str): Region of the resource
+        name (str): Resource name
+        created (str): ISO 8601 creation or last modified time
+        tags (dict): Tag key --> value
+        data (dict): Resource description, stored JSON encoded
+        run_id (str): Identifier of the run writing the item
+        index_tags (list): Tag keys copied to their own attribute for their GSI
+
+    Returns:
+        item (dict): Item with Python values, as accepted by InventoryWriter.put()
+    """
+    tags = tags or {}
+    item = {'ResourceId': resource_id, 'Scope': inventory_scope(kind, account, region), 'Kind': kind, 'Region': region, 'Name': name or '', 'Tags': tags, 'RunId': run_id, 'Data': json.dumps(data, default=str)}
+    if account:
+        item['Account'] = account
+    # Index key attributes cannot be empty, so missing values are left out and the item is not in that index
+    if created:
+        item['Created'] = created
+    for key in index_tags:
+        if tags.get(key):
+            item[tag_attribute(key)] = tags[key]
+    return item
+
+
+def _deserialize(item):
+    item = {key: _deserializer.deserialize(value) for key, value in item.items()}
+    if 'Data' in item:
+        item['Data'] = json.loads(item['Data'])
+    return item
+
+
+class InventoryWriter:
+    """Write inventory items with BatchWriteItem
+
+    Items are buffered into batches of up to 25 put or delete requests, later requests for the same resource replacing earlier
+    ones, and each batch is written by a pool of writer threads.  Items DynamoDB leaves unprocessed, when a partition is
+    throttled, are retried with exponential backoff and jitter until MAX_WRITE_ATTEMPTS is reached.  At most four batches per
+    writer are queued at once, so memory stays bounded however many items are written.  Stale items are deleted one at a time
+    on the same threads with a conditional DeleteItem, see delete_stale().
+
+    Args:
+        dynamodb_client (obj): Boto3 DynamoDB client object
+        table_name (str): Name of the inventory table
+        workers (int): Number of writer threads
+
+    Example:
+        with InventoryWriter(dynamodb_client, 'ami-inventory') as writer:
+            for image in images:
+                writer.put(inventory_item('ami', image['ImageId'], ...))
+        logging.info("Wrote %s items", writer.summary['written'])
+    """
+
+    def __init__(self, dynamodb_client, table_name, workers=DEFAULT_WRITERS):
+        self.client = dynamodb_client
+        self.table_name = table_name
+        self.summary = {'written': 0, 'deleted': 0, 'kept': 0, 'failed': 0, 'batches': 0, 'retries': 0}
+        self._buffer = {}
+        self._futures = []
+        self._slots = threading.Semaphore(max(1, workers) * 4)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='InventoryWriter')
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        """Queue an item to be written, item values are Python types"""
+        self._add(item['ResourceId'], {'PutRequest': {'Item': {key: _serializer.serialize(value) for key, value in item.items()}}})
+
+    def delete(self, resource_id):
+        """Queue the item of a resource to be deleted"""
+        self._add(resource_id, {'DeleteRequest': {'Key': {'ResourceId': {'S': resource_id}}}})
+
+    def delete_stale(self, resource_id, run_id):
+        """Queue the item of a resource to be deleted unless it was written by run_id
+
+        The condition is checked by DynamoDB against the item itself, so an item rewritten by the current run is kept even if
+        it was read from an eventually consistent GSI that still showed its previous RunId.
+        """
+        self._submit(self._delete_stale, resource_id, run_id)
+
+    def _add(self, resource_id, request):
+        with self._lock:
+            self._buffer[resource_id] = request
+            if len(self._buffer) < MAX_BATCH_WRITE_ITEMS:
+                return
+            batch = list(self._buffer.values())
+            self._buffer = {}
+        self._submit(self._write, batch)
+
+    def _submit(self, function, *arguments):
+        # Blocks while the writers are behind, rather than queueing every item in memory
+        self._slots.acquire()
+        future = self._executor.submit(function, *arguments)
+        future.add_done_callback(lambda future: self._slots.release())
+        with self._lock:
+            self._futures = [pending for pending in self._futures if not pending.done()] + [future]
+
+    def _write(self, batch):
+        requests = batch
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as e:
+                logging.error("Error in InventoryWriter writing %s items: %s", len(requests), e)
+                break
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            with self._lock:
+                self.summary['batches'] += 1
+                for request in requests:
+                    if request not in unprocessed:
+                        self.summary['written' if 'PutRequest' in request else 'deleted'] += 1
+            if not unprocessed:
+                return
+            requests = unprocessed
+            with self._lock:
+                self.summary['retries'] += 1
+            # Exponential backoff with full jitter, from 50ms up to 5 seconds
+            time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+        with self._lock:
+            self.summary['failed'] += len(requests)
+        logging.error("Error in InventoryWriter: %s items were not written to %s", len(requests), self.table_name)
+
+    def _delete_stale(self, resource_id, run_id):
+        try:
+            self.client.delete_item(TableName=self.table_name, Key={'ResourceId': {'S': resource_id}}, ConditionExpression='attribute_not_exists(RunId) OR RunId <> :run', ExpressionAttributeValues={':run': {'S': run_id}})
+            outcome = 'deleted'
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logging.debug("(InventoryWriter) %s was written by this run, kept", resource_id)
+                outcome = 'kept'
+            else:
+                logging.error("Error in InventoryWriter deleting %s: %s", resource_id, e)
+                outcome = 'failed'
+        with self._lock:
+            self.summary[outcome] += 1
+
+    def flush(self):
+        """Write the buffered items and wait for every queued batch"""
+        with self._lock:
+            batch = list(self._buffer.values())
+            self._buffer = {}
+        if batch:
+            self._submit(self._write, batch)
+        with self._lock:
+            futures = list(self._futures)
+        concurrent.futures.wait(futures)
+
+    def close(self):
+        """Flush and stop the writer threads
+
+        Returns:
+            summary (dict): Counts of items written, deleted, kept by delete_stale() and failed, batches written and batches retried
+        """
+        self.flush()
+        self._executor.shutdown(wait=True)
+        return self.summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _scan_segment(dynamodb_client, table_name, segment, segments, kwargs, pages, stop):
+    try:
+        for page in dynamodb_client.get_paginator('scan').paginate(TableName=table_name, Segment=segment, TotalSegments=segments, **kwargs):
+            while not stop.is_set():
+                try:
+                    pages.put(page['Items'], timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+        pages.put(None)
+    except Exception as e:
+        pages.put(e)
+
+
+def scan_inventory(dynamodb_client, table_name, segments=DEFAULT_SEGMENTS, kind=None):
+    """Read every inventory item with a segmented parallel Scan
+
+    Each of segments threads scans its own segment of the table, so large tables are read at the throughput of several
+    partitions at once.  Pages are passed to the caller through a bounded queue as they arrive.
+
+    Args:
+        dynamodb_client (obj): Boto3 DynamoDB client object
+        table_name (str): Name of the inventory table
+        segments (int): Number of parallel Scan segments
+        kind (str): Only return items of this kind, ami or lambda
+
+    Yields:
+        item (dict): Inventory item with Python values and the decoded Data description
+    """
+    kwargs = {}
+    if kind is not None:
+        kwargs = {'FilterExpression': '#kind = :kind', 'ExpressionAttributeNames': {'#kind': 'Kind'}, 'ExpressionAttributeValues': {':kind': {'S': kind}}}
+    segments = max(1, segments)
+    pages = queue.Queue(maxsize=segments * 2)
+    stop = threading.Event()
+    threads = [threading.Thread(target=_scan_segment, args=(dynamodb_client, table_name, segment, segments, kwargs, pages, stop), name='ScanSegment-{}'.format(segment), daemon=True) for segment in range(segments)]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = segments
+        while remaining:
+            page = pages.get()
+            if page is None:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                for item in page:
+                    yield _deserialize(item)
+    finally:
+        # Stop the segment threads if the caller stops reading early or a segment failed
+        stop.set()
+
+
+def query_inventory(dynamodb_client, table_name, tag_key=None, tag_value=None, scope=None, attributes=None):
+    """Read the inventory items with one value of an indexed tag, or of one scope, from their GSI
+
+    Args:
+        dynamodb_client (obj): Boto3 DynamoDB client object
+        table_name (str): Name of the inventory table
+        tag_key (str): Indexed tag key
+        tag_value (str): Tag value
+        scope (str): Scope from inventory_scope(), used instead of a tag
+        attributes (list): Attribute names to return, default all
+
+    Yields:
+        item (dict): Inventory item with Python values, newest first when querying by tag
+    """
+    if scope is not None:
+        kwargs = {'IndexName': SCOPE_INDEX, 'ExpressionAttributeNames': {'#key': 'Scope'}, 'ExpressionAttributeValues': {':value': {'S': scope}}}
+    else:
+        kwargs = {'IndexName': tag_index(tag_key), 'ExpressionAttributeNames': {'#key': tag_attribute(tag_key)}, 'ExpressionAttributeValues': {':value': {'S': tag_value}}, 'ScanIndexForward': False}
+    if attributes:
+        kwargs['ExpressionAttributeNames'].update({'#a{}'.format(number): name for number, name in enumerate(attributes)})
+        kwargs['ProjectionExpression'] = ', '.join('#a{}'.format(number) for number in range(len(attributes)))
+    for page in dynamodb_client.get_paginator('query').paginate(TableName=table_name, KeyConditionExpression='#key = :value', **kwargs):
+        for item in page['Items']:
+            yield _deserialize(item)
+
+
+def delete_stale_inventory(dynamodb_client, table_name, scope, run_id, writer):
+    """Delete the items of a scope that were not written by the current run
+
+    The Scope-index GSI is eventually consistent, so items just rewritten by this run may still be listed with their previous
+    RunId.  Candidates are therefore deleted with a conditional DeleteItem (see InventoryWriter.delete_stale) that keeps any
+    item whose RunId is now run_id.  Nothing is deleted when some of the run's writes failed, as the items they would have
+    refreshed cannot be told apart from stale ones; call this after writer.flush().
+
+    Args:
+        dynamodb_client (obj): Boto3 DynamoDB client object
+        table_name (str): Name of the inventory table
+        scope (str): Scope from inventory_scope()
+        run_id (str): Identifier of the current run
+        writer (InventoryWriter): Writer the deletes are queued on
+
+    Returns:
+        candidates (int): Number of items queued for a conditional delete
+    """
+    if writer.summary['failed']:
+        logging.warning("%s items were not written, stale items of %s are not deleted", writer.summary['failed'], scope)
+        return 0
+    candidates = 0
+    for item in query_inventory(dynamodb_client, table_name, scope=scope, attributes=['ResourceId', 'RunId']):
+        if item.get('RunId') != run_id:
+            writer.delete_stale(item['ResourceId'], run_id)
+            candidates += 1
+    logging.debug("(delete_stale_inventory) %s: %s stale candidates", scope, candidates)
+    return candidates
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""EBS change detection utilities
+
+Estimates how much data has been written to an instance's EBS volumes since the snapshots behind its most recent AMI, so
+instances that have not changed do not need to be imaged again.
+
+For each volume, changes are measured in two parts:
+
+    1. If a newer completed snapshot of the volume exists (for example from Data Lifecycle Manager), the blocks that differ
+       between the AMI snapshot and that snapshot are counted with the EBS direct ListChangedBlocks API.
+    2. Writes made after the newest snapshot are measured with the CloudWatch VolumeWriteBytes metric, as the EBS direct
+       APIs only compare snapshots and cannot see a live volume.
+
+VolumeWriteBytes counts every write, including rewrites of the same block, so the estimate errs towards reporting a change.
+A volume that cannot be matched to a snapshot of the AMI, or whose comparison fails, is treated as changed.
+
+The EBS, EC2 and CloudWatch clients are passed in rather than created here, so the detector can be exercised offline with
+botocore.stub.Stubber.
+
+Functions:
+
+count_changed_blocks: Count the blocks that differ between two snapshots of the same volume lineage
+volume_write_bytes: Sum the bytes written to a volume over a time range from CloudWatch
+
+Classes:
+
+ChangeDetector: Measure the data changed on an instance's volumes since an AMI was created
+
+"""
+
+
+# Import global modules
+import logging
+import math
+from datetime import datetime, timezone
+
+# Import third-party modules
+from botocore.exceptions import ClientError
+
+
+# EBS direct API block size in bytes
+BLOCK_SIZE = 512 * 1024
+# Maximum results per ListChangedBlocks page
+LIST_CHANGED_BLOCKS_PAGE_SIZE = 10000
+# Maximum datapoints returned by one GetMetricStatistics call
+MAX_METRIC_DATAPOINTS = 1440
+# Multiple the period must be of by the age of the start time in days, as CloudWatch keeps older datapoints at coarser
+# resolution: 60 seconds up to 15 days, 300 seconds up to 63 days and 3600 seconds beyond
+METRIC_PERIOD_MULTIPLES = ((63, 3600), (15, 300), (0, 60))
+
+
+def count_changed_blocks(ebs_client, first_snapshot_id, second_snapshot_id, limit=None):
+    """Count the blocks that differ between two snapshots
+
+    Args:
+        ebs_client (obj): Boto3 EBS client object
+        first_snapshot_id (str): Earlier snapshot ID
+        second_snapshot_id (str): Later snapshot ID of the same volume lineage
+        limit (int): Stop paging once more than this many changed blocks have been counted, None to count every block
+
+    Returns:
+        changed (tuple): (changed block count, block size in bytes)
+    """
+    blocks = 0
+    block_size = 0
+    kwargs = {'FirstSnapshotId': first_snapshot_id, 'SecondSnapshotId': second_snapshot_id, 'MaxResults': LIST_CHANGED_BLOCKS_PAGE_SIZE}
+    while True:
+        response = ebs_client.list_changed_blocks(**kwargs)
+        blocks += len(response.get('ChangedBlocks', []))
+        block_size = response.get('BlockSize', block_size)
+        if 'NextToken' not in response or (limit is not None and blocks > limit):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    logging.debug("(count_changed_blocks) %s --> %s: %s changed blocks of %s bytes", first_snapshot_id, second_snapshot_id, blocks, block_size)
+    return blocks, block_size
+
+
+def volume_write_bytes(cloudwatch_client, volume_id, start, end=None):
+    """Return the bytes written to a volume over a time range
+
+    Args:
+        cloudwatch_client (obj): Boto3 CloudWatch client object
+        volume_id (str): EBS volume ID
+        start (datetime): Start of the range
+        end (datetime): End of the range, defaults to the current UTC time
+
+    Returns:
+        bytes (int): Sum of the VolumeWriteBytes metric over the range
+    """
+    now = datetime.now(timezone.utc)
+    end = end or now
+    # One call returns at most 1440 datapoints, and the period must be a multiple of the resolution kept for the start time
+    age_days = (now - start).total_seconds() / 86400
+    multiple = next((multiple for days, multiple in METRIC_PERIOD_MULTIPLES if age_days > days), 60)
+    period = max(300, (end - start).total_seconds() / MAX_METRIC_DATAPOINTS)
+    period = int(math.ceil(period / multiple)) * multiple
+    response = cloudwatch_client.get_metric_statistics(Namespace='AWS/EBS', MetricName='VolumeWriteBytes', Dimensions=[{'Name': 'VolumeId', 'Value': volume_id}], StartTime=start, EndTime=end, Period=period, Statistics=['Sum'])
+    return int(sum(datapoint['Sum'] for datapoint in response.get('Datapoints', [])))
+
+
+class ChangeDetector:
+    """Measure the data changed on an instance's volumes since an AMI was created
+
+    Args:
+        ec2_client (obj): Boto3 EC2 client object
+        ebs_client (obj): Boto3 EBS (direct APIs) client object
+        cloudwatch_client (obj): Boto3 CloudWatch client object
+        threshold (int): Changed bytes at or below which an instance is considered unchanged
+
+    Example:
+        detector = ChangeDetector(session.client('ec2'), session.client('ebs'), session.client('cloudwatch'), threshold=64 * 1024 * 1024)
+        if detector.unchanged(instance, image):
+            ...
+    """
+
+    def __init__(self, ec2_client, ebs_client, cloudwatch_client, threshold=0):
+        self.ec2 = ec2_client
+        self.ebs = ebs_client
+        self.cloudwatch = cloudwatch_client
+        self.threshold = threshold
+
+    def _snapshots(self, snapshot_ids):
+        response = self.ec2.describe_snapshots(SnapshotIds=snapshot_ids)
+        return {snapshot['SnapshotId']: snapshot for snapshot in response['Snapshots']}
+
+    def _latest_snapshot(self, volume_id, after):
+        # Newest completed snapshot of the volume started after the AMI snapshot, None if there is none
+        paginator = self.ec2.get_paginator('describe_snapshots')
+        latest = None
+        for page in paginator.paginate(OwnerIds=['self'], Filters=[{'Name': 'volume-id', 'Values': [volume_id]}, {'Name': 'status', 'Values': ['completed']}]):
+            for snapshot in page['Snapshots']:
+                if snapshot['StartTime'] > after and (latest is None or snapshot['StartTime'] > latest['StartTime']):
+                    latest = snapshot
+        return latest
+
+    def volume_changes(self, instance, image):
+        """Measure the changes to each EBS volume of an instance since an image of it was created
+
+        Args:
+            instance (dict): EC2 instance description
+            image (dict): EC2 image description of an earlier image of the instance
+
+        Returns:
+            changes (list): Per volume dicts of DeviceName, VolumeId, BaseSnapshotId and ChangedBytes (None if unknown)
+        """
+        image_snapshots = {mapping['DeviceName']: mapping['Ebs']['SnapshotId'] for mapping in image.get('BlockDeviceMappings') or [] if (mapping.get('Ebs') or {}).get('SnapshotId')}
+        snapshots = self._snapshots(list(image_snapshots.values())) if image_snapshots else {}
+        changes = []
+        for mapping in instance.get('BlockDeviceMappings') or []:
+            volume_id = (mapping.get('Ebs') or {}).get('VolumeId')
+            if not volume_id:
+                continue
+            base = snapshots.get(image_snapshots.get(mapping['DeviceName']))
+            change = {'DeviceName': mapping['DeviceName'], 'VolumeId': volume_id, 'BaseSnapshotId': base['SnapshotId'] if base else None, 'ChangedBytes': None}
+            changes.append(change)
+            # A volume added or replaced since the image has no baseline to compare against
+            if base is None or base.get('VolumeId') != volume_id:
+                continue
+            try:
+                changed = 0
+                since = base['StartTime']
+                latest = self._latest_snapshot(volume_id, since)
+                if latest is not None:
+                    blocks, block_size = count_changed_blocks(self.ebs, base['SnapshotId'], latest['SnapshotId'], limit=self.threshold // BLOCK_SIZE + 1)
+                    changed += blocks * block_size
+                    since = latest['StartTime']
+                if changed <= self.threshold:
+                    changed += volume_write_bytes(self.cloudwatch, volume_id, since)
+                change['ChangedBytes'] = changed
+            except ClientError as e:
+                logging.warning("(ChangeDetector) Unable to measure changes to %s since %s: %s", volume_id, base['SnapshotId'], e)
+            logging.debug("(ChangeDetector) %s %s %s changed bytes since %s", instance['InstanceId'], mapping['DeviceName'], change['ChangedBytes'], change['BaseSnapshotId'])
+        return changes
+
+    def unchanged(self, instance, image):
+        """Return True if no more than threshold bytes have changed across every volume of the instance since the image
+
+        Args:
+            instance (dict): EC2 instance description
+            image (dict): EC2 image description of an earlier image of the instance
+
+        Returns:
+            unchanged (bool): True if the image still represents the instance
+        """
+        changes = self.volume_changes(instance, image)
+        if not changes or any(change['ChangedBytes'] is None for change in changes):
+            return False
+        # A volume detached since the image would be restored by it
+        if len(changes) != len([mapping for mapping in image.get('BlockDeviceMappings') or [] if (mapping.get('Ebs') or {}).get('SnapshotId')]):
+            return False
+        return sum(change['ChangedBytes'] for change in changes) <= self.threshold
@@ -1,4 +1,1128 @@
 #!/usr/bin/env python3
 
 """EC2 utilities
-"""
\ No newline at end of file
+
+Functions operate on image dictionaries as returned by the EC2 DescribeImages API (or ec2.Image(...).meta.data).
+
+Functions:
+
+get_tag: Return the value of a tag on an EC2 resource
+image_creation_date: Parse an image CreationDate into a datetime
+image_snapshot_ids: Return the EBS snapshot IDs behind an image
+image_source_instance: Return the instance an image was created from
+latest_instance_images: Return the most recent available image of each instance
+recent_date_filters: DescribeImages filters matching the Date tags of images created within a window
+describe_image_pages: Yield the pages of a DescribeImages call, paginated when the installed botocore supports it
+snapshot_image_supported: Check whether an instance can be imaged from its snapshots with RegisterImage
+register_image_from_snapshots: Register an image from the crash-consistent snapshots of an instance's volumes
+apply_retention_policy: Split images into those to keep and those to prune based on keep-last/daily/weekly rules
+prune_images: Deregister images and delete their snapshots through a rate limited worker pool
+plan_retag: Work out the tag changes add, rename and remove rules make to a set of images
+format_tag_diff: Render the tag changes of an image as a one line diff
+retag_images: Apply tag changes to images and their snapshots with batched CreateTags and DeleteTags calls
+collect_image_usage: Count the instances and launch template versions using each ImageId across regions
+parse_state_event: Parse an EventBridge AMI state change or EBS snapshot completion event
+
+Classes:
+
+ExistingImageIndex: Index of recently created images by source instance and name, used to make image creation idempotent
+ImagePoller: Track pending images and snapshot sets in any number of regions with batched Describe calls per region per interval
+ImageStateEvents: Receive AMI state change and snapshot completion events from an SQS queue fed by EventBridge
+CopyPipeline: Copy images to other regions as soon as they become available, within per-region concurrency limits
+
+"""
+
+
+# Import global modules
+import collections
+import concurrent.futures
+import json
+import logging
+import math
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# Import local modules
+import modules.file_system as file_system
+import modules.output as output
+from modules.rate_limit import RateLimiter
+
+# Import third-party modules
+from botocore.exceptions import ClientError
+
+
+def get_tag(resource, key):
+    """Return the value of a tag on an EC2 resource
+
+    Args:
+        resource (dict): EC2 resource description containing a Tags list
+        key (str): Tag key
+
+    Returns:
+        value (str): Tag value, None if the tag is not set
+    """
+    for tag in resource.get('Tags') or []:
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+
+def image_creation_date(image):
+    """Parse an image CreationDate
+
+    Args:
+        image (dict): EC2 image description
+
+    Returns:
+        creation_date (datetime): Timezone aware creation date
+    """
+    return datetime.strptime(image['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+
+
+def image_snapshot_ids(image):
+    """Return the EBS snapshot IDs referenced by an image's BlockDeviceMappings
+
+    Args:
+        image (dict): EC2 image description
+
+    Returns:
+        snapshot_ids (list): Snapshot IDs
+    """
+    snapshot_ids = []
+    for mapping in image.get('BlockDeviceMappings') or []:
+        snapshot_id = (mapping.get('Ebs') or {}).get('SnapshotId')
+        if snapshot_id:
+            snapshot_ids.append(snapshot_id)
+    return snapshot_ids
+
+
+# Tag recording the instance an image was created from, DescribeImages does not return it for older images
+SOURCE_INSTANCE_TAG = 'SourceInstanceId'
+# Image states that can be reused rather than creating a new image
+REUSABLE_IMAGE_STATES = ('pending', 'available')
+
+
+def image_source_instance(image):
+    """Return the instance an image was created from
+
+    Args:
+        image (dict): EC2 image description
+
+    Returns:
+        instance_id (str): Instance ID from the SourceInstanceId tag or field, None if unknown
+    """
+    return get_tag(image, SOURCE_INSTANCE_TAG) or image.get('SourceInstanceId')
+
+
+def latest_instance_images(ec2_client, instance_ids, batch_size=200):
+    """Return the most recent available image created from each instance
+
+    Images are matched on the SourceInstanceId tag, so only images tagged by CreateAndTagEC2AMI are found.
+
+    Args:
+        ec2_client (obj): Boto3 EC2 client object
+        instance_ids (list): Instance IDs
+        batch_size (int): Maximum instance IDs per DescribeImages filter
+
+    Returns:
+        images (dict): Instance ID --> newest available image description, instances without one are omitted
+    """
+    instance_ids = list(instance_ids)
+    images = {}
+    for start in range(0, len(instance_ids), batch_size):
+        filters = [{'Name': 'tag:' + SOURCE_INSTANCE_TAG, 'Values': instance_ids[start:start + batch_size]}, {'Name': 'state', 'Values': ['available']}]
+        for page in describe_image_pages(ec2_client, Owners=['self'], Filters=filters):
+            for image in page['Images']:
+                instance_id = image_source_instance(image)
+                if instance_id not in images or image_creation_date(image) > image_creation_date(images[instance_id]):
+                    images[instance_id] = image
+    return images
+
+
+def snapshot_image_supported(instance):
+    """Return True if an instance can be imaged by registering its volume snapshots
+
+    Images registered from snapshots do not carry the billing codes of the instance's source image, so Windows and
+    Marketplace or licensed (non RunInstances usage operation) instances must be imaged with CreateImage.
+
+    Args:
+        instance (dict): EC2 instance description
+
+    Returns:
+        supported (bool): True if register_image_from_snapshots can be used
+    """
+    if instance.get('Platform') == 'windows' or instance.get('ProductCodes'):
+        return False
+    return instance.get('UsageOperation') in (None, 'RunInstances')
+
+
+def register_image_from_snapshots(ec2_client, instance, snapshots, name, description=None):
+    """Register an image from snapshots of an instance's EBS volumes
+
+    Block device mappings, volume types and performance settings are copied from the instance and its volumes, with each
+    volume replaced by its snapshot.
+
+    Args:
+        ec2_client (obj): Boto3 EC2 client object
+        instance (dict): EC2 instance description
+        snapshots (list): Completed snapshot descriptions, one per EBS volume, as created by CreateSnapshots
+        name (str): Image name
+        description (str): Image description, defaults to the name
+
+    Returns:
+        image_id (str): ID of the registered image
+    """
+    snapshot_ids = {snapshot['VolumeId']: snapshot['SnapshotId'] for snapshot in snapshots}
+    volumes = {volume['VolumeId']: volume for volume in ec2_client.describe_volumes(VolumeIds=list(snapshot_ids))['Volumes']}
+    mappings = []
+    for mapping in instance.get('BlockDeviceMappings') or []:
+        volume_id = (mapping.get('Ebs') or {}).get('VolumeId')
+        if volume_id not in snapshot_ids:
+            continue
+        volume = volumes[volume_id]
+        ebs = {'SnapshotId': snapshot_ids[volume_id], 'VolumeSize': volume['Size'], 'VolumeType': volume['VolumeType'], 'DeleteOnTermination': mapping['Ebs'].get('DeleteOnTermination', False)}
+        if volume['VolumeType'] in ('io1', 'io2', 'gp3') and volume.get('Iops'):
+            ebs['Iops'] = volume['Iops']
+        if volume['VolumeType'] == 'gp3' and volume.get('Throughput'):
+            ebs['Throughput'] = volume['Throughput']
+        mappings.append({'DeviceName': mapping['DeviceName'], 'Ebs': ebs})
+    kwargs = {'Name': name, 'Description': description or name, 'Architecture': instance['Architecture'], 'RootDeviceName': instance['RootDeviceName'], 'VirtualizationType': instance.get('VirtualizationType', 'hvm'), 'BlockDeviceMappings': mappings}
+    if instance.get('EnaSupport'):
+        kwargs['EnaSupport'] = True
+    if instance.get('BootMode'):
+        kwargs['BootMode'] = instance['BootMode']
+    response = ec2_client.register_image(**kwargs)
+    logging.debug("(register_image_from_snapshots) Service response for registering AMI: %s", response)
+    return response['ImageId']
+
+
+def recent_date_filters(window, now=None, date_format='%Y-%m-%d'):
+    """Return DescribeImages filters matching the Date tag of images created within a window
+
+    Args:
+        window (int): Window in minutes
+        now (datetime): End of the window, defaults to the current local time as used for the Date tag
+        date_format (str): Format of the Date tag
+
+    Returns:
+        filters (list): DescribeImages filters
+    """
+    now = now or datetime.now()
+    day = (now - timedelta(minutes=window)).date()
+    dates = []
+    while day <= now.date():
+        dates.append(day.strftime(date_format))
+        day += timedelta(days=1)
+    return [{'Name': 'tag:Date', 'Values': dates}]
+
+
+def describe_image_pages(ec2_client, **kwargs):
+    """Yield the pages of a DescribeImages call
+
+    DescribeImages can only be paginated from botocore 1.28.  Older releases, including the one the scripts pin, return every
+    image in a single response, which is yielded as the only page.
+
+    Args:
+        ec2_client (obj): Boto3 EC2 client object
+        **kwargs: DescribeImages parameters
+
+    Yields:
+        page (dict): DescribeImages response
+    """
+    if ec2_client.can_paginate('describe_images'):
+        yield from ec2_client.get_paginator('describe_images').paginate(**kwargs)
+    else:
+        yield ec2_client.describe_images(**kwargs)
+
+
+class ExistingImageIndex:
+    """Index of recently created images
+
+    Built once before creating images so that a repeated or retried run reuses the images it already created rather than
+    creating duplicates.  Images are indexed by their source instance and by name; only pending or available images are
+    reused.
+
+    Args:
+        images (iterable): EC2 image descriptions
+
+    Example:
+        index = ExistingImageIndex.load(ec2_client, window=60)
+        image = index.find('i-0123456789abcdef0', name='web-01-2022-09-12-1030', window=60)
+    """
+
+    def __init__(self, images):
+        self.images = list(images)
+        self.by_instance = {}
+        self.by_name = {}
+        for image in self.images:
+            self.by_name[image.get('Name')] = image
+            instance_id = image_source_instance(image)
+            if instance_id:
+                self.by_instance.setdefault(instance_id, []).append(image)
+        for images in self.by_instance.values():
+            images.sort(key=image_creation_date, reverse=True)
+
+    @classmethod
+    def load(cls, ec2_client, window, now=None):
+        """Build the index with one paginated DescribeImages(Owners=['self']) call
+
+        Args:
+            ec2_client (obj): Boto3 EC2 client object
+            window (int): Freshness window in minutes, only images tagged with a Date within the window are listed
+            now (datetime): End of the window, defaults to the current local time
+
+        Returns:
+            index (ExistingImageIndex): Index of the images found
+        """
+        filters = recent_date_filters(window, now)
+        images = []
+        for page in describe_image_pages(ec2_client, Owners=['self'], Filters=filters):
+            images.extend(page['Images'])
+        logging.debug("(ExistingImageIndex) Indexed %s images tagged with Date %s", len(images), filters[0]['Values'])
+        return cls(images)
+
+    def find(self, instance_id, name=None, window=None, now=None):
+        """Return an existing image to reuse for an instance
+
+        Args:
+            instance_id (str): Source instance ID
+            name (str): Name the new image would be created with, an existing image of that name from the same (or an unknown)
+                instance is always reused as creating it again would fail
+            window (int): Freshness window in minutes, images created by the instance within the window are reused
+            now (datetime): End of the window, defaults to the current UTC time
+
+        Returns:
+            image (dict): Image description, None if a new image should be created
+        """
+        image = self.by_name.get(name) if name else None
+        if image is not None and image['State'] in REUSABLE_IMAGE_STATES and image_source_instance(image) in (None, instance_id):
+            return image
+        if not window:
+            return None
+        oldest = (now or datetime.now(timezone.utc)) - timedelta(minutes=window)
+        for image in self.by_instance.get(instance_id, []):
+            if image_creation_date(image) < oldest:
+                break
+            if image['State'] in REUSABLE_IMAGE_STATES:
+                return image
+        return None
+
+
+def apply_retention_policy(images, keep_last=0, keep_daily=0, keep_weekly=0, group_by=('Name', 'Product')):
+    """Apply a retention policy to a set of images
+
+    Images are grouped by the values of the group_by tags and each group is considered newest first.  An image is kept if any
+    rule keeps it:
+
+    - keep_last: the newest N images
+    - keep_daily: the newest image on each of the N most recent days that have an image
+    - keep_weekly: the newest image in each of the N most recent ISO weeks that have an image
+
+    Images that have none of the group_by tags are never pruned as they were not created by a tagged backup, nor are images
+    that are still pending.
+
+    Args:
+        images (iterable): EC2 image descriptions
+        keep_last (int): Number of most recent images to keep per group
+        keep_daily (int): Number of daily images to keep per group
+        keep_weekly (int): Number of weekly images to keep per group
+        group_by (tuple): Tag keys used to group images
+
+    Returns:
+        keep, prune (tuple): Lists of (image, reason) tuples
+    """
+    logging.debug("Function: apply_retention_policy() started with args: keep_last = %s, keep_daily = %s, keep_weekly = %s, group_by = %s", keep_last, keep_daily, keep_weekly, group_by)
+    groups = {}
+    keep = []
+    for image in images:
+        group = tuple(get_tag(image, key) for key in group_by)
+        if all(value is None for value in group):
+            keep.append((image, 'ungrouped'))
+            continue
+        groups.setdefault(group, []).append(image)
+
+    prune = []
+    for group, group_images in groups.items():
+        group_images.sort(key=image_creation_date, reverse=True)
+        seen_days = set()
+        seen_weeks = set()
+        for index, image in enumerate(group_images):
+            created = image_creation_date(image)
+            day = created.date()
+            week = created.isocalendar()[:2]
+            reasons = []
+            if index < keep_last:
+                reasons.append('last')
+            # Images are newest first so the first image seen for a day or week is the one to keep
+            if day not in seen_days:
+                seen_days.add(day)
+                if len(seen_days) <= keep_daily:
+                    reasons.append('daily')
+            if week not in seen_weeks:
+                seen_weeks.add(week)
+                if len(seen_weeks) <= keep_weekly:
+                    reasons.append('weekly')
+            if image.get('State') == 'pending':
+                reasons.append('pending')
+            if reasons:
+                keep.append((image, ','.join(reasons)))
+            else:
+                prune.append((image, 'expired'))
+        logging.debug("(apply_retention_policy) Group %s: %s images", group, len(group_images))
+    return keep, prune
+
+
+def _prune_image(ec2_client, image, protected_snapshot_ids, completed, dry_run, journal, limiter):
+    image_id = image['ImageId']
+    result = {'images': 0, 'snapshots': 0, 'failed': 0}
+    if dry_run:
+        journal.record(resource=image_id, action='deregister_image', status='dry-run', name=image.get('Name'))
+        logging.info("[Dry Run] Would deregister %s (%s)", image_id, image.get('Name'))
+    elif image_id in completed:
+        logging.debug("(prune_images) %s already deregistered in a previous run", image_id)
+    else:
+        try:
+            limiter.acquire()
+            ec2_client.deregister_image(ImageId=image_id)
+            journal.record(resource=image_id, action='deregister_image', status='done', name=image.get('Name'))
+            logging.info("Deregistered %s (%s)", image_id, image.get('Name'))
+            result['images'] += 1
+        except ClientError as e:
+            journal.record(resource=image_id, action='deregister_image', status='failed', error=str(e))
+            logging.error("Error in prune_images deregistering %s: %s", image_id, e)
+            result['failed'] += 1
+            # Snapshots are still in use by the image so cannot be deleted
+            return result
+    for snapshot_id in image_snapshot_ids(image):
+        if snapshot_id in protected_snapshot_ids:
+            journal.record(resource=snapshot_id, action='delete_snapshot', status='skipped', reason='used by a retained image', image=image_id)
+            logging.info("Keeping snapshot %s as it is used by a retained image", snapshot_id)
+            continue
+        if dry_run:
+            journal.record(resource=snapshot_id, action='delete_snapshot', status='dry-run', image=image_id)
+            logging.info("[Dry Run] Would delete snapshot %s of %s", snapshot_id, image_id)
+            continue
+        if snapshot_id in completed:
+            continue
+        try:
+            limiter.acquire()
+            ec2_client.delete_snapshot(SnapshotId=snapshot_id)
+            journal.record(resource=snapshot_id, action='delete_snapshot', status='done', image=image_id)
+            logging.debug("Deleted snapshot %s of %s", snapshot_id, image_id)
+            result['snapshots'] += 1
+        except ClientError as e:
+            journal.record(resource=snapshot_id, action='delete_snapshot', status='failed', image=image_id, error=str(e))
+            logging.error("Error in prune_images deleting snapshot %s: %s", snapshot_id, e)
+            result['failed'] += 1
+    return result
+
+
+def prune_images(ec2_client, prune, keep=(), dry_run=True, journal=None, workers=16, rate=20):
+    """Deregister images and delete their EBS snapshots
+
+    Images are processed by a pool of worker threads sharing one token bucket so that the combined DeregisterImage and
+    DeleteSnapshot request rate stays under rate.  Each image is deregistered before its snapshots are deleted.  Snapshots that
+    are also referenced by a retained image are never deleted.
+
+    Every action is written to the journal as it completes.  Resources recorded as done in an existing journal are skipped, so
+    an interrupted run can be repeated with the same journal to finish the job.
+
+    Args:
+        ec2_client (obj): Boto3 EC2 client object
+        prune (list): (image, reason) tuples to prune, as returned by apply_retention_policy()
+        keep (list): (image, reason) tuples being retained
+        dry_run (bool): Only report and journal what would be deleted
+        journal (file_system.JsonLinesJournal): Journal of actions, None for no journal
+        workers (int): Number of worker threads
+        rate (float): Maximum API requests per second across all workers
+
+    Returns:
+        summary (dict): Counts of images deregistered, snapshots deleted and failures
+    """
+    logging.debug("Function: prune_images() started with args: images = %s, dry_run = %s, workers = %s, rate = %s", len(prune), dry_run, workers, rate)
+    if journal is None:
+        journal = file_system.JsonLinesJournal(None)
+    protected_snapshot_ids = set()
+    for image, reason in keep:
+        protected_snapshot_ids.update(image_snapshot_ids(image))
+    # Only deletions recorded as done are final, a snapshot skipped because a retained image used it may be prunable now
+    completed = journal.completed(done=('done',))
+    limiter = RateLimiter(rate)
+    summary = {'images': 0, 'snapshots': 0, 'failed': 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_prune_image, ec2_client, image, protected_snapshot_ids, completed, dry_run, journal, limiter) for image, reason in prune]
+        for future in concurrent.futures.as_completed(futures):
+            for key, value in future.result().items():
+                summary[key] += value
+    output.log_message_section("Pruned {0} images and {1} snapshots with {2} failures".format(summary['images'], summary['snapshots'], summary['failed']), top=True, bottom=True)
+    return summary
+
+
+# Maximum resource IDs per CreateTags or DeleteTags call
+MAX_TAG_RESOURCES = 1000
+# Error codes of CreateTags and DeleteTags naming a resource that does not exist, which fail the whole call
+INVALID_RESOURCE_ERRORS = ('InvalidAMIID', 'InvalidSnapshot')
+
+
+def plan_retag(images, rules, include_snapshots=True):
+    """Work out the tag changes rules make to a set of images
+
+    Rules are applied in order to each image's tags.  A rule applies to an image when every tag in its match mapping has the
+    given value, or is present at all when the value is None or '*'.  Matching rules then:
+
+    - rename: move the value of each old key to its new key
+    - set: add or overwrite tags
+    - remove: delete tag keys
+
+    Args:
+        images (list): EC2 image descriptions
+        rules (list): Rule dictionaries with optional match, rename, set and remove keys
+        include_snapshots (bool): Apply each image's changes to its EBS snapshots as well
+
+    Returns:
+        changes (list): One dictionary per image whose tags change, with image_id, name, resources (the image followed by its
+        snapshots), add (key --> value), remove (keys) and before (the image tags before the change)
+    """
+    changes = []
+    for image in images:
+        before = {tag['Key']: tag['Value'] for tag in image.get('Tags') or []}
+        after = dict(before)
+        for rule in rules:
+            match = rule.get('match') or {}
+            if not all(key in after and (value in (None, '*') or after[key] == str(value)) for key, value in match.items()):
+                continue
+            for old_key, new_key in (rule.get('rename') or {}).items():
+                if old_key in after:
+                    after[new_key] = after.pop(old_key)
+            for key, value in (rule.get('set') or {}).items():
+                after[key] = str(value)
+            for key in rule.get('remove') or []:
+                after.pop(key, None)
+        add = {key: value for key, value in after.items() if before.get(key) != value}
+        remove = sorted(key for key in before if key not in after)
+        if add or remove:
+            resources = [image['ImageId']] + (image_snapshot_ids(image) if include_snapshots else [])
+            changes.append({'image_id': image['ImageId'], 'name': image.get('Name'), 'resources': resources, 'add': add, 'remove': remove, 'before': before})
+    return changes
+
+
+def format_tag_diff(change):
+    """Render a tag change as +Key=Value, ~Key: old -> new and -Key=old entries"""
+    entries = []
+    for key, value in sorted(change['add'].items()):
+        if key in change['before']:
+            entries.append("~{}: {} -> {}".format(key, change['before'][key], value))
+        else:
+            entries.append("+{}={}".format(key, value))
+    for key in change['remove']:
+        entries.append("-{}={}".format(key, change['before'][key]))
+    return ", ".join(entries)
+
+
+def _tag_calls(changes, batch_size):
+    # Resources sharing the same tags to add, or the same keys to remove, are grouped into calls of up to batch_size IDs each
+    creates = collections.OrderedDict()
+    deletes = collections.OrderedDict()
+    for change in changes:
+        if change['add']:
+            creates.setdefault(tuple(sorted(change['add'].items())), []).extend(change['resources'])
+        if change['remove']:
+            deletes.setdefault(tuple(change['remove']), []).extend(change['resources'])
+    create_calls = [(tags, resources[start:start + batch_size]) for tags, resources in creates.items() for start in range(0, len(resources), batch_size)]
+    delete_calls = [(keys, resources[start:start + batch_size]) for keys, resources in deletes.items() for start in range(0, len(resources), batch_size)]
+    return create_calls, delete_calls
+
+
+def _tag_call(ec2_client, action, tags, resources, journal, limiter):
+    # Returns the resources changed, the resources that failed and the number of calls made
+    try:
+        limiter.acquire()
+        getattr(ec2_client, action)(Resources=resources, Tags=tags)
+        journal.record(action=action, status='done', resources=resources, tags=tags)
+        logging.debug("(retag_images) %s on %s resources: %s", action, len(resources), tags)
+        return resources, [], 1
+    except ClientError as e:
+        if len(resources) > 1 and e.response['Error']['Code'].startswith(INVALID_RESOURCE_ERRORS):
+            # One image deregistered or snapshot deleted since the plan fails the batch, so the batch is split in half until
+            # the missing resources are isolated and the rest are changed
+            logging.warning("(retag_images) %s on %s resources failed, retrying in halves: %s", action, len(resources), e)
+            middle = len(resources) // 2
+            first, second = (_tag_call(ec2_client, action, tags, half, journal, limiter) for half in (resources[:middle], resources[middle:]))
+            return first[0] + second[0], first[1] + second[1], 1 + first[2] + second[2]
+        journal.record(action=action, status='failed', resources=resources, tags=tags, error=str(e))
+        logging.error("Error in retag_images %s on %s resources: %s", action, len(resources), e)
+        return [], resources, 1
+
+
+def retag_images(ec2_client, changes, dry_run=True, journal=None, workers=8, rate=10, batch_size=MAX_TAG_RESOURCES):
+    """Apply tag changes to images and their snapshots with batched CreateTags and DeleteTags calls
+
+    Resources receiving the same tags are tagged together, up to batch_size resource IDs per CreateTags call, and resources
+    losing the same keys are untagged together with DeleteTags, so thousands of images need only a handful of calls.  Calls
+    are made by a pool of worker threads sharing one token bucket.  Every CreateTags call completes before any DeleteTags call
+    starts, and resources whose CreateTags call failed keep their old tags, so a renamed tag is never lost.  A call that fails
+    because one of its images or snapshots no longer exists is split in half and retried until only the missing resources fail.
+
+    Every call is written to the journal.  A run can be repeated after a failure, images already changed no longer differ from
+    the rules and are left alone.
+
+    Args:
+        ec2_client (obj): Boto3 EC2 client object for the region of the images
+        changes (list): Changes returned by plan_retag()
+        dry_run (bool): Only log and journal the changes
+        journal (file_system.JsonLinesJournal): Journal of calls, None for no journal
+        workers (int): Number of worker threads
+        rate (float): Maximum API requests per second across all workers
+        batch_size (int): Maximum resource IDs per call
+
+    Returns:
+        summary (dict): Counts of images and resources changed, calls made and resources that failed
+    """
+    logging.debug("Function: retag_images() started with args: images = %s, dry_run = %s, workers = %s, rate = %s", len(changes), dry_run, workers, rate)
+    if journal is None:
+        journal = file_system.JsonLinesJournal(None)
+    create_calls, delete_calls = _tag_calls(changes, max(1, min(batch_size, MAX_TAG_RESOURCES)))
+    summary = {'images': 0, 'resources': 0, 'calls': len(create_calls) + len(delete_calls), 'failed': 0}
+    if dry_run:
+        for change in changes:
+            journal.record(resource=change['image_id'], action='retag', status='dry-run', add=change['add'], remove=change['remove'], resources=change['resources'])
+            logging.info("[Dry Run] Would retag %s (%s) and %s snapshots: %s", change['image_id'], change['name'], len(change['resources']) - 1, format_tag_diff(change))
+        output.log_message_section("Would retag {0} images and {1} resources with {2} calls".format(len(changes), sum(len(change['resources']) for change in changes), summary['calls']), top=True, bottom=True)
+        return summary
+    limiter = RateLimiter(rate)
+    failed = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_tag_call, ec2_client, 'create_tags', [{'Key': key, 'Value': value} for key, value in tags], resources, journal, limiter) for tags, resources in create_calls]
+        summary['calls'] = 0
+        for future in concurrent.futures.as_completed(futures):
+            failed.update(future.result()[1])
+            summary['calls'] += future.result()[2]
+        # Only remove tags from resources that received their new tags
+        delete_calls = [(keys, [resource for resource in resources if resource not in failed]) for keys, resources in delete_calls]
+        delete_calls = [(keys, resources) for keys, resources in delete_calls if resources]
+        futures = [executor.submit(_tag_call, ec2_client, 'delete_tags', [{'Key': key} for key in keys], resources, journal, limiter) for keys, resources in delete_calls]
+        for future in concurrent.futures.as_completed(futures):
+            failed.update(future.result()[1])
+            summary['calls'] += future.result()[2]
+    for change in changes:
+        if not failed.intersection(change['resources']):
+            summary['images'] += 1
+            logging.info("Retagged %s (%s): %s", change['image_id'], change['name'], format_tag_diff(change))
+    summary['resources'] = sum(len(change['resources']) for change in changes) - len(failed)
+    summary['failed'] = len(failed)
+    output.log_message_section("Retagged {0} images and {1} resources with {2} calls and {3} failures".format(summary['images'], summary['resources'], summary['calls'], summary['failed']), top=True, bottom=True)
+    return summary
+
+
+# Instance states that still reference their image (terminated instances are excluded)
+ACTIVE_INSTANCE_STATES = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+
+
+def _scan_region_image_usage(session, region, include_launch_templates):
+    ec2_client = session.client('ec2', region_name=region)
+    usage = collections.Counter()
+    instances = 0
+    for page in ec2_client.get_paginator('describe_instances').paginate(Filters=[{'Name': 'instance-state-name', 'Values': ACTIVE_INSTANCE_STATES}]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                usage[instance['ImageId']] += 1
+                instances += 1
+    templates = 0
+    if include_launch_templates:
+        for page in ec2_client.get_paginator('describe_launch_templates').paginate():
+            for template in page['LaunchTemplates']:
+                templates += 1
+                for version_page in ec2_client.get_paginator('describe_launch_template_versions').paginate(LaunchTemplateId=template['LaunchTemplateId']):
+                    for version in version_page['LaunchTemplateVersions']:
+                        image_id = version.get('LaunchTemplateData', {}).get('ImageId')
+                        # Skip SSM parameter references (resolve:ssm:...) which cannot be matched to an ImageId
+                        if image_id and image_id.startswith('ami-'):
+                            usage[image_id] += 1
+    logging.debug("(collect_image_usage) %s: %s instances, %s launch templates, %s distinct images", region, instances, templates, len(usage))
+    return usage
+
+
+def collect_image_usage(session, regions, include_launch_templates=True, workers=8):
+    """Count references to each ImageId
+
+    This function streams DescribeInstances and DescribeLaunchTemplateVersions pages for each region in parallel and counts the
+    number of non-terminated instances and launch template versions referencing each ImageId.  Only the counts are kept so
+    memory is proportional to the number of distinct ImageIds rather than the number of instances.
+
+    Args:
+        session (boto3.session.Session): AWS Session
+        regions (list): Regions to scan
+        include_launch_templates (bool): Also count launch template versions
+        workers (int): Maximum number of regions scanned at once
+
+    Returns:
+        usage (collections.Counter): Number of references keyed by ImageId
+    """
+    logging.debug("Function: collect_image_usage() started with args: regions = %s, include_launch_templates = %s", regions, include_launch_templates)
+    usage = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(regions)))) as executor:
+        futures = {executor.submit(_scan_region_image_usage, session, region, include_launch_templates): region for region in regions}
+        for future in concurrent.futures.as_completed(futures):
+            usage.update(future.result())
+    logging.info("Found %s images in use across %s regions", len(usage), len(regions))
+    return usage
+
+
+# EventBridge detail types of the events ImageStateEvents consumes
+IMAGE_STATE_EVENT = 'EC2 AMI State Change'
+SNAPSHOT_EVENTS = ('EBS Multi-Volume Snapshots Completion Status', 'EBS Snapshot Notification')
+# Longest SQS long poll
+MAX_RECEIVE_WAIT = 20
+# Receives made once nothing is pending, to delete the events of images that completed by polling before their event arrived
+MAX_DRAIN_RECEIVES = 10
+# Seconds an image or snapshot set may stay pending before ImagePoller reports it as failed
+MAX_PENDING_SECONDS = 24 * 3600
+# Seconds an image or snapshot may be missing from DescribeImages or DescribeSnapshots before ImagePoller reports it as failed,
+# new resources take a moment to become visible and deregistered or deleted ones disappear
+MAX_NOT_FOUND_SECONDS = 600
+
+
+def parse_state_event(body):
+    """Parse an EventBridge AMI state change or EBS snapshot completion event
+
+    Events delivered through SNS, wrapped in a notification, are unwrapped first.
+
+    Args:
+        body (str): SQS message body, or an event already decoded to a dict (such as a Lambda event)
+
+    Returns:
+        event (dict): kind ('image' or 'snapshots'), region, ids and state of the event, None if the message is not an
+            AMI or snapshot event
+    """
+    try:
+        event = body if isinstance(body, dict) else json.loads(body)
+        if event.get('Type') == 'Notification' and 'Message' in event:
+            event = json.loads(event['Message'])
+    except (TypeError, ValueError, AttributeError):
+        return None
+    if not isinstance(event, dict) or event.get('source') != 'aws.ec2':
+        return None
+    detail = event.get('detail') or {}
+    if event.get('detail-type') == IMAGE_STATE_EVENT and detail.get('ImageId'):
+        return {'kind': 'image', 'region': event.get('region'), 'ids': [detail['ImageId']], 'state': detail.get('State')}
+    if event.get('detail-type') in SNAPSHOT_EVENTS:
+        # Snapshots are identified by ARN (arn:aws:ec2::us-east-1:snapshot/snap-0123456789abcdef0)
+        arns = [snapshot.get('snapshot_id') for snapshot in detail.get('snapshots') or []] or [detail.get('snapshot_id')]
+        ids = [arn.split('/')[-1] for arn in arns if arn]
+        if ids:
+            return {'kind': 'snapshots', 'region': event.get('region'), 'ids': ids, 'state': detail.get('result')}
+    return None
+
+
+class ImageStateEvents:
+    """Receive AMI state change and snapshot completion events from an SQS queue fed by EventBridge
+
+    An EventBridge rule matching "EC2 AMI State Change" (and, for snapshot sets, "EBS Multi-Volume Snapshots Completion
+    Status") events targets the queue.  receive() long polls the queue and returns the parsed events; messages about
+    resources the caller is not tracking are left on the queue, becoming visible again after visibility_timeout seconds, so
+    several runs can share a queue.  Messages are removed with delete() once they have been acted on.  ImagePoller deletes
+    the message of every image or snapshot it tracked, however the image completed, so only events of resources no run is
+    waiting for remain; give the queue a short message retention period, or a redrive policy to a dead-letter queue, so
+    those expire rather than being received by every run.
+
+    Args:
+        session (boto3.session.Session): AWS Session
+        queue_url (str): SQS queue URL, the queue's region is taken from the URL
+        visibility_timeout (int): Seconds a received message is hidden from other consumers
+
+    Example:
+        events = ImageStateEvents(session, 'https://sqs.us-east-1.amazonaws.com/111111111111/ami-events')
+        poller = ImagePoller(session, interval=300, events=events)
+    """
+
+    def __init__(self, session, queue_url, visibility_timeout=30):
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.received = 0
+        region = re.search(r'sqs[.-]([a-z0-9-]+)\.amazonaws\.com', queue_url)
+        create_client = session.client if hasattr(session, 'client') else session.create_client
+        self.client = create_client('sqs', region_name=region.group(1)) if region else create_client('sqs')
+
+    def receive(self, timeout):
+        """Wait up to timeout seconds (at most 20) for messages
+
+        Args:
+            timeout (float): Seconds to wait for a message
+
+        Returns:
+            events (list): Parsed events, each with the receipt handle of its message.  Messages that are not AMI or
+                snapshot events are deleted
+        """
+        wait = max(0, min(MAX_RECEIVE_WAIT, int(math.ceil(timeout))))
+        response = self.client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=wait, VisibilityTimeout=self.visibility_timeout)
+        events = []
+        unknown = []
+        for message in response.get('Messages', []):
+            event = parse_state_event(message['Body'])
+            if event is None:
+                unknown.append(message['ReceiptHandle'])
+                continue
+            event['receipt'] = message['ReceiptHandle']
+            events.append(event)
+            logging.debug("(ImageStateEvents) %s %s %s: %s", event['region'], event['kind'], event['ids'], event['state'])
+        self.received += len(events)
+        self.delete(unknown)
+        return events
+
+    def delete(self, receipts):
+        """Delete messages that have been acted on
+
+        Args:
+            receipts (list): Receipt handles of the messages
+        """
+        receipts = list(receipts)
+        for start in range(0, len(receipts), 10):
+            entries = [{'Id': str(index), 'ReceiptHandle': receipt} for index, receipt in enumerate(receipts[start:start + 10])]
+            response = self.client.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            for failure in response.get('Failed', []):
+                logging.warning("(ImageStateEvents) Failed to delete message: %s", failure.get('Message'))
+
+
+def _failed_image(image_id, code, message):
+    # Description passed to ImagePoller callbacks for an image that was given up on
+    return {'ImageId': image_id, 'State': 'failed', 'StateReason': {'Code': code, 'Message': message}}
+
+
+def _failed_snapshot(snapshot_id, message):
+    # Description passed to ImagePoller callbacks for a snapshot that was given up on
+    return {'SnapshotId': snapshot_id, 'State': 'error', 'StateMessage': message}
+
+
+class ImagePoller:
+    """Batched image and snapshot state polling
+
+    Images are registered with add() along with a callback.  Each poll makes one DescribeImages call per region (in batches of
+    batch_size image IDs) for every image still pending, rather than one call per image, and invokes the callback for each
+    image that has left the pending state.  Callbacks may add further images, for example the destination image of a copy,
+    which are then tracked by the same loop.
+
+    Sets of snapshots, such as those created together by CreateSnapshots, are registered with add_snapshots() and polled the
+    same way with DescribeSnapshots.  The callback is invoked once every snapshot of the set has left the pending state.
+
+    With an ImageStateEvents source the poller waits on its queue between polls instead of sleeping.  Each image or snapshot
+    set named by an event is described straight away, so it completes as soon as its event arrives, and the full batched
+    poll only runs every interval seconds to catch any events that were missed.
+
+    An image still pending timeout seconds after it was added, or missing from DescribeImages for not_found_timeout seconds (an
+    ID that was never created, or an image deregistered while pending), is given up on and its callback is invoked with a
+    failed image, {'ImageId': ..., 'State': 'failed', 'StateReason': {'Code': 'Poller.Timeout' or 'Poller.NotFound', ...}}, so
+    run() always returns.  Snapshots of a set are given up on the same way, and described with the error state.
+
+    Args:
+        session (boto3.session.Session): AWS Session
+        interval (int): Seconds between polls
+        batch_size (int): Maximum image IDs per DescribeImages call
+        events (ImageStateEvents): Optional source of AMI state change and snapshot completion events
+        timeout (float): Seconds an image or snapshot set may stay pending
+        not_found_timeout (float): Seconds an image or snapshot may be missing from DescribeImages or DescribeSnapshots
+    """
+
+    def __init__(self, session, interval=30, batch_size=100, events=None, timeout=MAX_PENDING_SECONDS, not_found_timeout=MAX_NOT_FOUND_SECONDS):
+        self.session = session
+        self.interval = interval
+        self.batch_size = batch_size
+        self.events = events
+        self.timeout = timeout
+        self.not_found_timeout = not_found_timeout
+        self._pending = {}
+        self._snapshot_sets = []
+        # (region, ID) of every image and snapshot completed, so their events are deleted whenever they arrive
+        self._completed = set()
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, region):
+        """Return a cached EC2 client for a region"""
+        with self._lock:
+            if region not in self._clients:
+                # boto3 sessions create clients with client(), botocore sessions with create_client()
+                create_client = self.session.client if hasattr(self.session, 'client') else self.session.create_client
+                self._clients[region] = create_client('ec2', region_name=region)
+            return self._clients[region]
+
+    def add(self, region, image_id, callback):
+        """Track an image until it leaves the pending state
+
+        Args:
+            region (str): Region of the image
+            image_id (str): Image ID
+            callback (function): Called as callback(region, image) with the image description once it is no longer pending, or
+                with a failed image when it times out
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._pending.setdefault(region, {})[image_id] = {'callback': callback, 'added': now, 'seen': now}
+
+    def add_snapshots(self, region, snapshot_ids, callback):
+        """Track a set of snapshots until none of them are pending
+
+        Args:
+            region (str): Region of the snapshots
+            snapshot_ids (list): Snapshot IDs
+            callback (function): Called as callback(region, snapshots) with the snapshot descriptions once none are pending.
+                Snapshots given up on, as images are, are described with the error state
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._snapshot_sets.append({'region': region, 'pending': set(snapshot_ids), 'snapshots': {}, 'callback': callback, 'added': now, 'seen': dict.fromkeys(snapshot_ids, now)})
+
+    def pending(self):
+        """Return the number of images and snapshot sets still pending"""
+        with self._lock:
+            return sum(len(images) for images in self._pending.values()) + len(self._snapshot_sets)
+
+    def _poll_snapshots(self, only_regions=None):
+        # One DescribeSnapshots call per region per batch for every snapshot of every pending set
+        completed = []
+        with self._lock:
+            regions = {}
+            for snapshot_set in self._snapshot_sets:
+                if only_regions is None or snapshot_set['region'] in only_regions:
+                    regions.setdefault(snapshot_set['region'], set()).update(snapshot_set['pending'])
+        for region, snapshot_ids in regions.items():
+            snapshot_ids = sorted(snapshot_ids)
+            states = {}
+            for start in range(0, len(snapshot_ids), self.batch_size):
+                response = self.client(region).describe_snapshots(Filters=[{'Name': 'snapshot-id', 'Values': snapshot_ids[start:start + self.batch_size]}])
+                for snapshot in response['Snapshots']:
+                    logging.debug("(ImagePoller) %s %s state: %s %s", region, snapshot['SnapshotId'], snapshot['State'], snapshot.get('Progress'))
+                    states[snapshot['SnapshotId']] = snapshot
+            now = time.monotonic()
+            with self._lock:
+                for snapshot_set in list(self._snapshot_sets):
+                    if snapshot_set['region'] != region:
+                        continue
+                    for snapshot_id in list(snapshot_set['pending']):
+                        snapshot = states.get(snapshot_id)
+                        if snapshot is not None:
+                            snapshot_set['seen'][snapshot_id] = now
+                        if snapshot is None and now - snapshot_set['seen'][snapshot_id] >= self.not_found_timeout:
+                            logging.error("(ImagePoller) %s %s not found for %s seconds, giving up", region, snapshot_id, int(now - snapshot_set['seen'][snapshot_id]))
+                            snapshot = _failed_snapshot(snapshot_id, 'Snapshot not found by DescribeSnapshots')
+                        elif snapshot is not None and snapshot['State'] == 'pending' and now - snapshot_set['added'] >= self.timeout:
+                            logging.error("(ImagePoller) %s %s still pending after %s seconds, giving up", region, snapshot_id, int(now - snapshot_set['added']))
+                            snapshot = _failed_snapshot(snapshot_id, 'Snapshot still pending when the poller timed out')
+                        if snapshot is not None and snapshot['State'] != 'pending':
+                            snapshot_set['pending'].discard(snapshot_id)
+                            snapshot_set['snapshots'][snapshot_id] = snapshot
+                    if not snapshot_set['pending']:
+                        self._snapshot_sets.remove(snapshot_set)
+                        self._completed.update((region, snapshot_id) for snapshot_id in snapshot_set['snapshots'])
+                        completed.append(snapshot_set)
+        for snapshot_set in completed:
+            snapshot_set['callback'](snapshot_set['region'], list(snapshot_set['snapshots'].values()))
+        return len(completed)
+
+    def poll_once(self):
+        """Poll every pending image once, invoking callbacks for completed images
+
+        Returns:
+            completed (int): Number of images and snapshot sets that completed during this poll
+        """
+        completed_sets = self._poll_snapshots()
+        with self._lock:
+            batches = [(region, list(images)) for region, images in self._pending.items() if images]
+        return self._poll_images(batches) + completed_sets
+
+    def _poll_images(self, batches):
+        completed = []
+        for region, image_ids in batches:
+            ec2_client = self.client(region)
+            for start in range(0, len(image_ids), self.batch_size):
+                batch = image_ids[start:start + self.batch_size]
+                # An image-id filter is used rather than ImageIds so a newly created image that is not yet visible does not fail the whole batch
+                response = ec2_client.describe_images(Filters=[{'Name': 'image-id', 'Values': batch}])
+                images = {image['ImageId']: image for image in response['Images']}
+                now = time.monotonic()
+                with self._lock:
+                    tracked = self._pending.get(region, {})
+                    for image_id in batch:
+                        entry = tracked.get(image_id)
+                        if entry is None:
+                            continue
+                        image = images.get(image_id)
+                        if image is not None:
+                            logging.debug("(ImagePoller) %s %s state: %s", region, image_id, image['State'])
+                            entry['seen'] = now
+                        if image is None and now - entry['seen'] >= self.not_found_timeout:
+                            logging.error("(ImagePoller) %s %s not found for %s seconds, giving up", region, image_id, int(now - entry['seen']))
+                            image = _failed_image(image_id, 'Poller.NotFound', 'Image not found by DescribeImages')
+                        elif image is not None and image['State'] == 'pending' and now - entry['added'] >= self.timeout:
+                            logging.error("(ImagePoller) %s %s still pending after %s seconds, giving up", region, image_id, int(now - entry['added']))
+                            image = dict(_failed_image(image_id, 'Poller.Timeout', 'Image still pending when the poller timed out'), Name=image.get('Name'))
+                        if image is None or image['State'] == 'pending':
+                            continue
+                        del tracked[image_id]
+                        self._completed.add((region, image_id))
+                        completed.append((entry['callback'], region, image))
+        for callback, region, image in completed:
+            callback(region, image)
+        return len(completed)
+
+    def _resolve_events(self, events):
+        # Describe only the tracked images and snapshot sets the events name, leaving other consumers' events on the queue
+        images = {}
+        snapshot_regions = set()
+        acted_on = set()
+        with self._lock:
+            for event in events:
+                if event['kind'] == 'image':
+                    tracked = [image_id for image_id in event['ids'] if image_id in self._pending.get(event['region'], {})]
+                    if tracked and event['state'] != 'pending':
+                        images.setdefault(event['region'], set()).update(tracked)
+                else:
+                    tracked = [snapshot_set for snapshot_set in self._snapshot_sets if snapshot_set['region'] == event['region'] and snapshot_set['pending'].intersection(event['ids'])]
+                    if tracked:
+                        snapshot_regions.add(event['region'])
+                if tracked:
+                    acted_on.add(event['receipt'])
+        completed = self._poll_snapshots(snapshot_regions) if snapshot_regions else 0
+        completed += self._poll_images([(region, sorted(image_ids)) for region, image_ids in images.items()])
+        with self._lock:
+            # Events of images and snapshots that already completed, by an earlier event or by polling, are deleted too
+            receipts = [event['receipt'] for event in events if event['receipt'] in acted_on or all((event['region'], resource_id) in self._completed for resource_id in event['ids'])]
+        self.events.delete(receipts)
+        return completed
+
+    def _drain_events(self):
+        # Delete the events that arrived for images completed by polling, without waiting for any more
+        for _ in range(MAX_DRAIN_RECEIVES):
+            try:
+                events = self.events.receive(0)
+            except ClientError as e:
+                logging.warning("Error receiving image state events: %s", e)
+                return
+            if not events:
+                return
+            self._resolve_events(events)
+
+    def _wait_for_events(self, timeout):
+        # Resolve images as their events arrive until the next full poll is due
+        deadline = time.monotonic() + timeout
+        while self.pending() > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                events = self.events.receive(remaining)
+            except ClientError as e:
+                logging.warning("Error receiving image state events, polling every %s seconds instead: %s", self.interval, e)
+                self.events = None
+                time.sleep(max(0, deadline - time.monotonic()))
+                return
+            if events:
+                self._resolve_events(events)
+
+    def run(self):
+        """Poll until no images are pending, waiting for events between polls when an event source is set
+
+        With an event source, the queue is read once more at the end to delete the events of images that completed by polling.
+        """
+        while self.pending() > 0:
+            self.poll_once()
+            if self.pending() > 0:
+                if self.events is None:
+                    logging.info("%s images or snapshot sets pending, checking again in %s seconds", self.pending(), self.interval)
+                    time.sleep(self.interval)
+                else:
+                    logging.info("%s images or snapshot sets pending, waiting for state change events, checking all again in %s seconds", self.pending(), self.interval)
+                    self._wait_for_events(self.interval)
+        if self.events is not None:
+            self._drain_events()
+
+
+class CopyPipeline:
+    """Copy images to other regions as soon as they are available
+
+    source_complete() is used as the ImagePoller callback for source images.  Each available source image is queued for every
+    destination region and copies are started immediately, up to max_concurrent copies in flight per destination region.
+    Destination images are tracked by the same ImagePoller and, as each completes, the next queued copy for that region starts.
+    This keeps copies overlapping with the remaining source snapshots while staying within the per-region copy limits.
+
+    Args:
+        poller (ImagePoller): Poller tracking source and destination images
+        source_region (str): Region of the source images
+        destination_regions (list): Regions to copy to
+        kms_key_ids (dict): Optional KMS key id, ARN or alias per destination region to re-encrypt copies with
+        max_concurrent (int): Maximum copies in flight per destination region
+        extra_tags (list): Tags added to every copy in addition to the source image tags
+    """
+
+    def __init__(self, poller, source_region, destination_regions, kms_key_ids=None, max_concurrent=5, extra_tags=None):
+        self.poller = poller
+        self.source_region = source_region
+        self.destination_regions = destination_regions
+        self.kms_key_ids = kms_key_ids or {}
+        self.max_concurrent = max_concurrent
+        self.extra_tags = extra_tags or []
+        self.copies = {}
+        self.failed = []
+        self.untagged = []
+        self._queues = {region: collections.deque() for region in destination_regions}
+        self._in_flight = {region: 0 for region in destination_regions}
+        self._lock = threading.Lock()
+
+    def source_complete(self, region, image):
+        """ImagePoller callback for source images"""
+        if image['State'] != 'available':
+            logging.error("Image %s is %s and will not be copied", image['ImageId'], image['State'])
+            self.failed.append((region, image['ImageId']))
+            return
+        logging.info("Image %s is available, queueing copies to %s", image['ImageId'], ", ".join(self.destination_regions))
+        for destination in self.destination_regions:
+            with self._lock:
+                self._queues[destination].append(image)
+            self._start_copies(destination)
+
+    def _start_copies(self, destination):
+        while True:
+            with self._lock:
+                if self._in_flight[destination] >= self.max_concurrent or not self._queues[destination]:
+                    return
+                image = self._queues[destination].popleft()
+                self._in_flight[destination] += 1
+            if not self._copy(destination, image):
+                with self._lock:
+                    self._in_flight[destination] -= 1
+
+    def _copy(self, destination, image):
+        ec2_client = self.poller.client(destination)
+        kwargs = {'SourceImageId': image['ImageId'], 'SourceRegion': self.source_region, 'Name': image['Name'], 'Description': image.get('Description') or image['Name']}
+        if destination in self.kms_key_ids:
+            kwargs['Encrypted'] = True
+            kwargs['KmsKeyId'] = self.kms_key_ids[destination]
+        try:
+            copy_id = ec2_client.copy_image(**kwargs)['ImageId']
+        except ClientError as e:
+            logging.error("Error in CopyPipeline copying %s to %s: %s", image['ImageId'], destination, e)
+            self.failed.append((destination, image['ImageId']))
+            return False
+        # The copy is running from here on, so it is tracked (and holds its slot) even if tagging it fails
+        logging.info("Copying %s (%s) to %s as %s", image['ImageId'], image['Name'], destination, copy_id)
+        self.copies[(destination, image['ImageId'])] = copy_id
+        self.poller.add(destination, copy_id, self._copy_complete)
+        tags = [tag for tag in image.get('Tags') or [] if not tag['Key'].startswith('aws:')]
+        tags += [{'Key': 'SourceImageId', 'Value': image['ImageId']}, {'Key': 'SourceRegion', 'Value': self.source_region}] + self.extra_tags
+        try:
+            ec2_client.create_tags(Resources=[copy_id], Tags=tags)
+        except ClientError as e:
+            logging.error("Error in CopyPipeline tagging copy %s of %s in %s: %s", copy_id, image['ImageId'], destination, e)
+            self.untagged.append((destination, copy_id))
+        return True
+
+    def _copy_complete(self, region, image):
+        if image['State'] == 'available':
+            logging.info("Copy %s in %s is available", image['ImageId'], region)
+        else:
+            logging.error("Copy %s in %s is %s", image['ImageId'], region, image['State'])
+            self.failed.append((region, image['ImageId']))
+        with self._lock:
+            self._in_flight[region] -= 1
+        self._start_copies(region)
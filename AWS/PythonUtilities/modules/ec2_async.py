@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""Asynchronous EC2 utilities
+
+Provides an optional asyncio engine built on aiobotocore.  Discovery, image creation, tagging and state polling run as
+coroutines on a single event loop, with an asyncio semaphore bounding the number of requests in flight, so thousands of
+concurrent requests do not need thousands of OS threads.
+
+Requires aiobotocore, which is imported on first use so the threaded engine does not depend on it.  It is not listed in the
+scripts' requirements.txt, install it with pip install aiobotocore==2.4.0, the release built on the scripts' botocore pin
+(see tests/requirements.txt).  Results are the same dictionaries returned by the boto3 client so they can be used with
+modules.ec2.
+
+Classes:
+
+AsyncEC2: Async context manager wrapping an aiobotocore EC2 client with bounded concurrency
+
+"""
+
+
+# Import global modules
+import asyncio
+import contextlib
+import logging
+import time
+
+# Import local modules
+import modules.ec2 as ec2_utils
+
+
+DEFAULT_MAX_CONCURRENCY = 100
+# Maximum values of a DescribeImages filter
+MAX_FILTER_VALUES = 200
+
+
+class AsyncEC2:
+    """Async EC2 client with bounded concurrency
+
+    Every request acquires the semaphore before it is sent and the HTTP connection pool is sized to match, so at most
+    max_concurrency requests are in flight however many coroutines are waiting.
+
+    Args:
+        profile (str): AWS profile name, None for the default credential chain
+        region (str): AWS region
+        max_concurrency (int): Maximum number of requests in flight
+        endpoint_url (str): EC2 endpoint, for a local stand-in such as moto server
+
+    Example:
+        async with AsyncEC2(profile='default', region='us-east-1') as ec2:
+            images = await ec2.describe_images(owners=['self'])
+    """
+
+    def __init__(self, profile=None, region=None, max_concurrency=DEFAULT_MAX_CONCURRENCY, endpoint_url=None):
+        self.profile = profile
+        self.region = region
+        self.max_concurrency = max_concurrency
+        self.endpoint_url = endpoint_url
+        self.client = None
+        self._semaphore = None
+        self._exit_stack = None
+
+    async def __aenter__(self):
+        # Imported on first use so scripts using the threaded engine do not require aiobotocore
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import AioSession
+        logging.debug("Function: AsyncEC2() started with args: profile = %s, region = %s, max_concurrency = %s", self.profile, self.region, self.max_concurrency)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._exit_stack = contextlib.AsyncExitStack()
+        session = AioSession(profile=self.profile)
+        config = AioConfig(max_pool_connections=self.max_concurrency, retries={'max_attempts': 10, 'mode': 'adaptive'})
+        self.client = await self._exit_stack.enter_async_context(session.create_client('ec2', region_name=self.region, endpoint_url=self.endpoint_url, config=config))
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self._exit_stack.aclose()
+        self.client = None
+
+    async def call(self, operation, **kwargs):
+        """Call an EC2 API operation within the concurrency limit
+
+        Args:
+            operation (str): Client method name (e.g. 'create_image')
+            **kwargs: Operation parameters
+
+        Returns:
+            response (dict): Service response
+        """
+        async with self._semaphore:
+            return await getattr(self.client, operation)(**kwargs)
+
+    async def pages(self, operation, **kwargs):
+        """Yield the pages of a paginated EC2 API operation as they arrive
+
+        Each page request is made within the concurrency limit, so many paginations can run side by side, and only one page
+        is held at a time.  Operations the installed botocore cannot paginate, such as DescribeImages before botocore 1.28,
+        return everything in a single response, which is yielded as the only page.
+
+        Args:
+            operation (str): Client method name (e.g. 'describe_images')
+            **kwargs: Operation parameters
+
+        Yields:
+            page (dict): Service response of each page
+        """
+        if not self.client.can_paginate(operation):
+            kwargs.pop('PaginationConfig', None)
+            yield await self.call(operation, **kwargs)
+            return
+        pages = self.client.get_paginator(operation).paginate(**kwargs).__aiter__()
+        while True:
+            async with self._semaphore:
+                try:
+                    page = await pages.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield page
+
+    async def paginate(self, operation, result_key, **kwargs):
+        """Return every item of a paginated EC2 API operation
+
+        Args:
+            operation (str): Client method name (e.g. 'describe_images')
+            result_key (str): Response key holding the items (e.g. 'Images')
+            **kwargs: Operation parameters
+
+        Returns:
+            items (list): Items from every page
+        """
+        items = []
+        async for page in self.pages(operation, **kwargs):
+            items.extend(page.get(result_key, []))
+        return items
+
+    async def describe_instances(self, filters=None, instance_ids=None):
+        """Return instance descriptions matching filters and/or instance IDs
+
+        Args:
+            filters (list): DescribeInstances filters
+            instance_ids (list): Instance IDs
+
+        Returns:
+            instances (list): Instance descriptions
+        """
+        kwargs = {}
+        if filters:
+            kwargs['Filters'] = filters
+        if instance_ids:
+            kwargs['InstanceIds'] = list(instance_ids)
+        reservations = await self.paginate('describe_instances', 'Reservations', **kwargs)
+        return [instance for reservation in reservations for instance in reservation['Instances']]
+
+    async def describe_images(self, owners=None, filters=None, image_ids=None):
+        """Return image descriptions
+
+        Image IDs are matched with an image-id filter rather than ImageIds, so an ID that does not exist (yet) is left out
+        instead of failing the whole call, and are described MAX_FILTER_VALUES at a time concurrently.
+
+        Args:
+            owners (list): Image owners (e.g. ['self'])
+            filters (list): DescribeImages filters
+            image_ids (list): Image IDs
+
+        Returns:
+            images (list): Image descriptions
+        """
+        kwargs = {}
+        if owners:
+            kwargs['Owners'] = list(owners)
+        filters = list(filters or [])
+        if not image_ids:
+            if filters:
+                kwargs['Filters'] = filters
+            return await self.paginate('describe_images', 'Images', **kwargs)
+        image_ids = sorted(set(image_ids))
+        batches = [image_ids[start:start + MAX_FILTER_VALUES] for start in range(0, len(image_ids), MAX_FILTER_VALUES)]
+        pages = await asyncio.gather(*(self.paginate('describe_images', 'Images', Filters=filters + [{'Name': 'image-id', 'Values': batch}], **kwargs) for batch in batches))
+        return [image for page in pages for image in page]
+
+    async def create_image(self, instance_id, name, description=None, no_reboot=True):
+        """Create an AMI from an instance
+
+        Returns:
+            image_id (str): ID of the new image
+        """
+        response = await self.call('create_image', InstanceId=instance_id, Name=name, Description=description or name, NoReboot=no_reboot)
+        logging.debug("(AsyncEC2) Service response for creating AMI: %s", response)
+        return response['ImageId']
+
+    async def create_tags(self, resource_ids, tags):
+        """Add tags to one or more resources"""
+        await self.call('create_tags', Resources=list(resource_ids), Tags=tags)
+
+    async def wait_for_images(self, image_ids, interval=30, batch_size=100, callback=None, timeout=ec2_utils.MAX_PENDING_SECONDS, not_found_timeout=ec2_utils.MAX_NOT_FOUND_SECONDS):
+        """Poll images until none are pending
+
+        Each poll describes every pending image in batches of batch_size, with the batches sent concurrently.  As with
+        modules.ec2.ImagePoller, an image still pending after timeout seconds, or missing from DescribeImages for
+        not_found_timeout seconds, is given up on and reported as a failed image.
+
+        Args:
+            image_ids (list): Image IDs to wait for
+            interval (int): Seconds between polls
+            batch_size (int): Maximum image IDs per DescribeImages call
+            callback (function): Called as callback(region, image) as each image leaves the pending state
+            timeout (float): Seconds an image may stay pending
+            not_found_timeout (float): Seconds an image may be missing from DescribeImages
+
+        Returns:
+            images (dict): Image ID --> final image description
+        """
+        started = time.monotonic()
+        seen = dict.fromkeys(image_ids, started)
+        pending = set(image_ids)
+        images = {}
+        while pending:
+            batches = [sorted(pending)[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+            # An image-id filter is used rather than ImageIds so a newly created image that is not yet visible does not fail the whole batch
+            responses = await asyncio.gather(*(self.call('describe_images', Filters=[{'Name': 'image-id', 'Values': batch}]) for batch in batches))
+            described = {image['ImageId']: image for response in responses for image in response['Images']}
+            now = time.monotonic()
+            for image_id in sorted(pending):
+                image = described.get(image_id)
+                if image is not None:
+                    logging.debug("(AsyncEC2) %s %s state: %s", self.region, image_id, image['State'])
+                    seen[image_id] = now
+                if image is None and now - seen[image_id] >= not_found_timeout:
+                    logging.error("(AsyncEC2) %s %s not found for %s seconds, giving up", self.region, image_id, int(now - seen[image_id]))
+                    image = {'ImageId': image_id, 'State': 'failed', 'StateReason': {'Code': 'Poller.NotFound', 'Message': 'Image not found by DescribeImages'}}
+                elif image is not None and image['State'] == 'pending' and now - started >= timeout:
+                    logging.error("(AsyncEC2) %s %s still pending after %s seconds, giving up", self.region, image_id, int(now - started))
+                    image = {'ImageId': image_id, 'Name': image.get('Name'), 'State': 'failed', 'StateReason': {'Code': 'Poller.Timeout', 'Message': 'Image still pending when the poller timed out'}}
+                if image is None or image['State'] == 'pending':
+                    continue
+                pending.discard(image_id)
+                images[image_id] = image
+                if callback is not None:
+                    callback(self.region, image)
+            if pending:
+                logging.info("%s images pending, checking again in %s seconds", len(pending), interval)
+                await asyncio.sleep(interval)
+        return images
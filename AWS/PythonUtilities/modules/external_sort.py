@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""External sort utilities
+
+Sorts streams of JSON serialisable items (such as DescribeImages results) with bounded memory.  Items are buffered up to a
+fixed count, after which the buffer is sorted and spilled to a temporary JSON Lines file as a sorted run.  Iterating merges
+the runs and any items still in memory with a heap based k-way merge, reading each run one item at a time, so memory use is
+bounded by the buffer size plus one item per run.  Several sorted streams, for example one per region, can be merged the same
+way into a single ordered stream.
+
+Classes:
+
+SpillingSorter: Sort a stream of items, spilling sorted runs to temporary files past a threshold
+SortedMerge: Re-iterable k-way merge of sorted streams
+
+"""
+
+
+# Import global modules
+import heapq
+import json
+import logging
+import os
+import tempfile
+
+
+DEFAULT_MAX_ITEMS = 10000
+
+
+def _read_run(path):
+    with open(path, 'r', encoding='utf-8') as run:
+        for line in run:
+            yield json.loads(line)
+
+
+class SpillingSorter:
+    """Sort a stream of items with bounded memory
+
+    Items are added with add() or extend().  Once max_items are buffered they are sorted and written to a temporary file.
+    Iterating yields every item in key order and can be repeated; the temporary files are removed by close().
+
+    Args:
+        key (function): Sort key
+        max_items (int): Maximum items held in memory before a sorted run is spilled to disk
+        directory (str): Directory for temporary files, defaults to the system temporary directory
+
+    Example:
+        with SpillingSorter(key=lambda image: image['CreationDate'], max_items=5000) as images:
+            for page in paginator.paginate(Owners=['self']):
+                images.extend(page['Images'])
+            for image in images:
+                ...
+    """
+
+    def __init__(self, key, max_items=DEFAULT_MAX_ITEMS, directory=None):
+        self.key = key
+        self.max_items = max(1, max_items)
+        self.directory = directory
+        self.runs = []
+        self._buffer = []
+        self._count = 0
+        self._sorted = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def add(self, item):
+        """Add an item, spilling a sorted run once max_items are buffered"""
+        self._buffer.append(item)
+        self._count += 1
+        self._sorted = False
+        if len(self._buffer) >= self.max_items:
+            self.spill()
+
+    def extend(self, items):
+        """Add an iterable of items"""
+        for item in items:
+            self.add(item)
+
+    def spill(self):
+        """Sort the buffered items and write them to a temporary file as a sorted run"""
+        if not self._buffer:
+            return
+        self._buffer.sort(key=self.key)
+        handle, path = tempfile.mkstemp(prefix='sort-run-', suffix='.jsonl', dir=self.directory)
+        with os.fdopen(handle, 'w', encoding='utf-8') as run:
+            for item in self._buffer:
+                run.write(json.dumps(item, separators=(',', ':')))
+                run.write('\n')
+        self.runs.append(path)
+        logging.debug("(SpillingSorter) Spilled run %s of %s items to %s", len(self.runs), len(self._buffer), path)
+        self._buffer = []
+
+    def __iter__(self):
+        if not self._sorted:
+            self._buffer.sort(key=self.key)
+            self._sorted = True
+        if not self.runs:
+            return iter(self._buffer)
+        return heapq.merge(*[_read_run(path) for path in self.runs], iter(self._buffer), key=self.key)
+
+    def close(self):
+        """Remove the temporary files"""
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.runs = []
+        self._buffer = []
+        self._count = 0
+
+
+class SortedMerge:
+    """Re-iterable k-way merge of sorted streams
+
+    Each iteration merges the sources with a heap holding one item per source, so the first items are yielded without
+    reading the whole of any source.
+
+    Args:
+        sources (list): Sorted re-iterable sources, such as SpillingSorter objects
+        key (function): Sort key the sources are ordered by
+        transform (function): Optional function applied to each item as it is yielded
+
+    Example:
+        with SortedMerge([us_east_1, eu_west_1], key=lambda image: image['CreationDate']) as images:
+            for image in images:
+                ...
+    """
+
+    def __init__(self, sources, key, transform=None):
+        self.sources = list(sources)
+        self.key = key
+        self.transform = transform
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def __len__(self):
+        return sum(len(source) for source in self.sources)
+
+    def __iter__(self):
+        merged = heapq.merge(*[iter(source) for source in self.sources], key=self.key)
+        if self.transform is None:
+            return merged
+        return (self.transform(item) for item in merged)
+
+    def close(self):
+        """Close every source that can be closed"""
+        for source in self.sources:
+            if hasattr(source, 'close'):
+                source.close()
@@ -1,11 +1,33 @@
 #!/usr/bin/env python3
 
 """File system utilities
+
+Functions:
+
+create_log_file: Create a log file and its directory if they do not exist
+compress_stream: Wrap a binary stream with a gzip or zstd compressor
+compression_extension: Return the file extension for a compression type
+open_compressed: Open a file for reading, decompressing it based on its extension
+commit_on_success: Context manager that commits an output on success and discards it on error
+
+Classes:
+
+ChainedWriter: Binary stream made of stacked writers
+AtomicFileWriter: Binary file written to a temporary file and renamed into place when closed
+JsonLinesJournal: Append only JSON Lines journal
+
 """
 
 
 # Import global modules
+import contextlib
+import gzip
+import io
+import json
 import os
+import tempfile
+import threading
+from datetime import datetime, timezone
 from pathlib import PureWindowsPath, PurePosixPath
 
 
@@ -57,4 +79,235 @@ def create_log_file(log_path):
 
     except Exception as e:
         print("An error occurred in create_log_file: {}".format(e))
-        return 1
\ No newline at end of file
+        return 1
+
+
+class ChainedWriter(io.BufferedIOBase):
+    """Binary stream made of stacked writers
+
+    Writes go to the outermost layer (e.g. a compressor) and close() closes every layer from the outside in, so wrappers that
+    do not close the stream they wrap (such as gzip.GzipFile) still flush and close the underlying sink.
+
+    Args:
+        layers (list): Writable binary streams ordered outermost first
+    """
+
+    def __init__(self, layers):
+        super().__init__()
+        self.layers = layers
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.layers[0].write(data)
+
+    def flush(self):
+        if not self.closed:
+            self.layers[0].flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            for layer in self.layers:
+                layer.close()
+
+
+COMPRESSION_TYPES = ('gzip', 'zstd')
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+# Default levels trade a little ratio for speed: gzip accepts 1-9, zstd 1-22
+DEFAULT_COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+
+
+def compress_stream(stream, compress=None, compress_level=None):
+    """Wrap a binary stream with a streaming compressor
+
+    Data is compressed as it is written so only the compressor window is held in memory.  zstd requires the zstandard
+    package, which is imported on first use.
+
+    Args:
+        stream (obj): Writable binary stream
+        compress (str): None, gzip or zstd
+        compress_level (int): Compression level, None for the compressor default
+
+    Returns:
+        stream (obj): Writable binary stream, closing it also closes the wrapped stream
+    """
+    if compress is None:
+        return stream
+    level = DEFAULT_COMPRESSION_LEVELS.get(compress) if compress_level is None else compress_level
+    if compress == 'gzip':
+        return ChainedWriter([gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=level), stream])
+    if compress == 'zstd':
+        import zstandard
+        return ChainedWriter([zstandard.ZstdCompressor(level=level).stream_writer(stream, closefd=False), stream])
+    raise ValueError("Unsupported compression: {0}".format(compress))
+
+
+def compression_extension(compress):
+    """Return the file extension for a compression type
+
+    Args:
+        compress (str): None, gzip or zstd
+
+    Returns:
+        extension (str): e.g. ".gz", or "" when not compressed
+    """
+    return COMPRESSION_EXTENSIONS[compress]
+
+
+def open_compressed(path):
+    """Open a file for reading, decompressing it if it ends in .gz or .zst
+
+    Args:
+        path (str): File path
+
+    Returns:
+        stream (obj): Readable binary stream of the decompressed content
+    """
+    if path.endswith(COMPRESSION_EXTENSIONS['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(COMPRESSION_EXTENSIONS['zstd']):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+class AtomicFileWriter(io.RawIOBase):
+    """Binary file written atomically
+
+    Data is written to a hidden temporary file in the target directory.  close() flushes and fsyncs the temporary file and
+    renames it over the target, so the target only ever holds a complete file; abort() deletes the temporary file instead.  If
+    the process dies part way through only the temporary file is left behind.
+
+    Args:
+        path (str): Target file path
+
+    Example:
+        with commit_on_success(AtomicFileWriter('/tmp/report.csv.gz')) as f:
+            f.write(b'ImageId\\n')
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = os.path.expanduser(path)
+        directory, name = os.path.split(self.path)
+        fd, self.temp_path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp', dir=directory or '.')
+        # mkstemp creates the file readable by the owner only, apply the permissions open() would have used
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.temp_path, 0o666 & ~umask)
+        self._file = os.fdopen(fd, 'wb')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed AtomicFileWriter")
+        return self._file.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self.temp_path, self.path)
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            super().close()
+
+    def abort(self):
+        """Discard the temporary file, leaving any existing target untouched"""
+        if self.closed:
+            return
+        self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        super().close()
+
+
+@contextlib.contextmanager
+def commit_on_success(stream, sink=None):
+    """Commit an output when the with block completes, discard it on error
+
+    Closing a stack of writers normally finalises the sink (renaming an AtomicFileWriter into place or completing an S3
+    upload), even when the block failed part way through.  Here the stack is only closed if the block succeeds; on error the
+    sink is aborted so no partial output is ever committed.
+
+    Args:
+        stream (obj): Outermost stream of the writer stack, yielded to the with block
+        sink (obj): Innermost writer with an abort() method, defaults to stream
+
+    Example:
+        sink = AtomicFileWriter('/tmp/report.csv.gz')
+        with commit_on_success(io.TextIOWrapper(compress_stream(sink, 'gzip')), sink) as f:
+            f.write('ImageId\\n')
+    """
+    sink = stream if sink is None else sink
+    try:
+        yield stream
+    except BaseException:
+        sink.abort()
+        raise
+    stream.close()
+
+
+class JsonLinesJournal:
+    """Append only JSON Lines journal
+
+    Each call to record() appends one JSON object and flushes it to disk immediately so that a crashed or interrupted run
+    leaves an accurate record of every action completed.  Entries already in the file can be read back with completed() to
+    resume a run without repeating work.
+
+    Args:
+        path (str): Journal file path, None to keep no journal
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            directory = os.path.dirname(os.path.expanduser(path))
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._file = open(os.path.expanduser(path), 'a')
+
+    def record(self, **entry):
+        """Append an entry, adding a UTC timestamp"""
+        if self._file is None:
+            return
+        entry = dict({'time': datetime.now(timezone.utc).isoformat()}, **entry)
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def completed(self, key='resource', status_key='status', done=('done', 'skipped')):
+        """Return the set of resources already recorded with a done status"""
+        finished = set()
+        if self.path is None or not os.path.isfile(os.path.expanduser(self.path)):
+            return finished
+        with open(os.path.expanduser(self.path)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partially written last line from an interrupted run
+                    continue
+                if entry.get(status_key) in done and key in entry:
+                    finished.add(entry[key])
+        return finished
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""Batch job utilities
+
+Runs many filter sets against one discovery pass.  A job file lists named jobs, each with the same filters as the
+-p/-e/-t/-rl/-o/-n/-x/-i command line options (name is the Name tag filter, the job itself is named by job) and its own
+additional tags.  Instances or images are described once per region with one paginated call, and every job's filters are
+matched locally against the shared result, so a nightly run of dozens of filter sets makes one DescribeInstances or
+DescribeImages pass per region instead of one per filter set.
+
+Tag filters are matched as the EC2 tag filters are: keys are capitalised (product -> Product), values are matched exactly
+with * and ? wildcards, and a job matches a resource when every one of its tag filters matches, or the resource is one of
+its instance_ids.
+
+Jobs are read from a YAML or JSON file:
+
+    jobs:
+      - job: operations-prod
+        product: operations-tools
+        environment: prod
+        add_tags: {Backup: nightly}
+      - job: gemini-appliances
+        tenant: gemini
+        role: appliance
+        extra_tags: {Costcentre: '1234'}
+        regions: [us-east-1, us-west-2]
+      - job: build-servers
+        name: build-*
+        instance_ids: [i-0123456789abcdef0]
+
+Functions:
+
+parse_tag_list: Parse a key=value,key=value list or mapping into a dict
+load_jobs: Read batch jobs from a YAML or JSON file
+shared_filters: DescribeInstances or DescribeImages filters covering the tag filters of every job
+
+Classes:
+
+BatchJob: Named filter set and additional tags of a batch job
+
+"""
+
+
+# Import global modules
+import collections
+import fnmatch
+import json
+
+
+# Job fields filtering on the tag of the same name, as the command line options do
+TAG_FIELDS = ('product', 'environment', 'tenant', 'role', 'owner', 'name')
+# Every field a job may have, so a misspelt filter fails instead of silently matching more resources
+JOB_FIELDS = ('job',) + TAG_FIELDS + ('extra_tags', 'instance_ids', 'add_tags', 'regions')
+
+
+def parse_tag_list(value):
+    """Parse tags given as a command line style list or a mapping
+
+    Args:
+        value (str or dict): key=value,key=value list, or a mapping of keys to values
+
+    Returns:
+        tags (dict): Tag key --> value
+    """
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return {str(key): str(tag_value) for key, tag_value in value.items()}
+    tags = {}
+    for pair in str(value).split(','):
+        key, _, tag_value = pair.partition('=')
+        tags[key.strip()] = tag_value.strip()
+    return tags
+
+
+def _id_list(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    return [str(item) for item in value]
+
+
+class BatchJob:
+    """Named filter set and additional tags of a batch job
+
+    Args:
+        job (str): Unique job name
+        product, environment, tenant, role, owner, name (str): Tag filters, as the command line options of the same name
+        extra_tags (str or dict): Other tag filters, as a key=value,key=value list or mapping
+        instance_ids (str or list): Instances selected in addition to those matching the tag filters
+        add_tags (str or dict): Additional tags for the images created by the job, as a key=value,key=value list or mapping
+        regions (list): Regions the job applies to
+    """
+
+    def __init__(self, job, product=None, environment=None, tenant=None, role=None, owner=None, name=None, extra_tags=None, instance_ids=None, add_tags=None, regions=None):
+        self.name = str(job)
+        fields = {'product': product, 'environment': environment, 'tenant': tenant, 'role': role, 'owner': owner, 'name': name}
+        self.tags = {key.capitalize(): str(value) for key, value in fields.items() if value is not None}
+        self.tags.update((key.capitalize(), value) for key, value in parse_tag_list(extra_tags).items())
+        self.instance_ids = _id_list(instance_ids)
+        self.add_tags = parse_tag_list(add_tags)
+        self.regions = list(regions or [])
+        if not self.tags and not self.instance_ids:
+            raise ValueError("Job {}: at least one tag filter or instance_ids is required".format(self.name))
+        if not self.regions:
+            raise ValueError("Job {}: regions are required".format(self.name))
+
+    def matches(self, tags, instance_id=None, region=None):
+        """Return True if a resource is selected by the job
+
+        Args:
+            tags (dict): Tags of the resource
+            instance_id (str): Instance ID of the resource, or of the instance an image was created from
+            region (str): Region of the resource, None to match any of the job's regions
+
+        Returns:
+            matches (bool): True if the resource is in one of the job's regions and matches its filters
+        """
+        if region is not None and region not in self.regions:
+            return False
+        if instance_id is not None and instance_id in self.instance_ids:
+            return True
+        return bool(self.tags) and all(key in tags and fnmatch.fnmatchcase(tags[key], value) for key, value in self.tags.items())
+
+
+def load_jobs(path, default_regions=None):
+    """Read batch jobs from a YAML or JSON file
+
+    Args:
+        path (str): File containing a list of jobs, or a mapping with a jobs list
+        default_regions (list): Regions of jobs that do not list any
+
+    Returns:
+        jobs (list): BatchJob objects
+    """
+    with open(path, 'r', encoding='utf-8') as job_file:
+        if path.endswith(('.yml', '.yaml')):
+            # Imported on first use as only YAML job files need PyYAML
+            import yaml
+            document = yaml.safe_load(job_file)
+        else:
+            document = json.load(job_file)
+    if isinstance(document, dict):
+        document = document.get('jobs', [])
+    jobs = []
+    for index, entry in enumerate(document or [], start=1):
+        entry = dict(entry)
+        if not entry.get('job'):
+            raise ValueError("Job {} of {}: job name is required".format(index, path))
+        unknown = sorted(set(entry) - set(JOB_FIELDS))
+        if unknown:
+            raise ValueError("Job {}: unknown fields {}".format(entry['job'], ', '.join(unknown)))
+        entry['regions'] = entry.get('regions') or default_regions
+        jobs.append(BatchJob(**entry))
+    names = [job.name for job in jobs]
+    duplicates = sorted(name for name, count in collections.Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError("Duplicate job names: {}".format(', '.join(duplicates)))
+    return jobs
+
+
+def shared_filters(jobs):
+    """Filters narrowing a discovery pass to the resources the jobs could match
+
+    A tag key filtered on by every job with tag filters becomes one filter with the union of their values (EC2 matches any of
+    a filter's values), so a file of jobs that all select a Product describes only those products.  Resources selected only
+    by instance_ids are not covered and are looked up separately.
+
+    Args:
+        jobs (list): BatchJob objects
+
+    Returns:
+        filters (list): DescribeInstances or DescribeImages tag filters, empty when no key is shared by every job
+    """
+    tagged = [job for job in jobs if job.tags]
+    if not tagged:
+        return []
+    keys = set(tagged[0].tags)
+    for job in tagged[1:]:
+        keys &= set(job.tags)
+    return [{'Name': 'tag:' + key, 'Values': sorted({job.tags[key] for job in tagged})} for key in sorted(keys)]
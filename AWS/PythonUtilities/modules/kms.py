@@ -1,4 +1,277 @@
 #!/usr/bin/env python3
 
 """KMS utilities
-"""
\ No newline at end of file
+
+Provides envelope encryption of report streams.  A data key is generated with KMS GenerateDataKey and used locally with
+AES-256-GCM to encrypt the stream chunk by chunk; only the KMS encrypted copy of the data key is stored with the output.
+Data keys are cached so that KMS is called once per key lifetime rather than once per file or chunk.
+
+Every stream is encrypted with its own key, derived from the data key with HKDF-SHA256 and a random 16 byte salt stored in
+the header, so the chunk nonces (the chunk sequence number) are only unique within a stream and streams sharing a cached
+data key never reuse a key and nonce pair.
+
+Requires the cryptography package (see requirements.txt).
+
+Encrypted stream layout (all integers big-endian):
+
+    header:  MAGIC | 16 byte salt | uint16 key id length | key id | uint32 encrypted data key length | encrypted data key
+             | uint32 encryption context length | encryption context (JSON)
+    chunks:  uint8 final flag | uint32 ciphertext length | 12 byte nonce | ciphertext + 16 byte GCM tag
+
+Each chunk is authenticated with the SHA-256 of the header, its sequence number and final flag so chunks cannot be
+reordered, dropped or truncated without decryption failing.
+
+Functions:
+
+open_encrypting_writer: Wrap a binary stream so everything written to it is envelope encrypted
+decrypt_stream: Decrypt an envelope encrypted stream
+
+Classes:
+
+DataKeyCache: Thread safe LRU cache of KMS data keys with maximum age and usage limits
+EnvelopeEncryptingWriter: Binary stream that encrypts chunks with a cached data key
+
+"""
+
+
+# Import global modules
+import collections
+import hashlib
+import io
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+
+MAGIC = b'KMSENV2\n'
+SALT_SIZE = 16
+# HKDF info binding derived keys to this format
+STREAM_KEY_INFO = b'KMSENV2 stream key'
+NONCE_SIZE = 12
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_AGE = 300
+DEFAULT_MAX_USES = 1000
+DEFAULT_MAX_ENTRIES = 32
+
+
+def _aesgcm(key):
+    # Imported on first use so modules that do not encrypt do not require the cryptography package
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    return AESGCM(key)
+
+
+def _stream_key(data_key, salt):
+    # Per-stream AES-256 key derived from the data key, so a cached data key is never used directly
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=STREAM_KEY_INFO).derive(data_key)
+
+
+class DataKeyCache:
+    """Cache of KMS data keys
+
+    Keys are cached per (key id, encryption context) in least recently used order.  An entry is discarded once it is older
+    than max_age seconds or has been handed out max_uses times, so a single plaintext data key is only ever used for a bounded
+    amount of data and time.
+
+    Args:
+        max_entries (int): Maximum number of cached data keys
+        max_age (int): Maximum age of a data key in seconds
+        max_uses (int): Maximum number of streams encrypted with one data key
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_age=DEFAULT_MAX_AGE, max_uses=DEFAULT_MAX_USES):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_data_key(self, kms_client, key_id, encryption_context=None):
+        """Return a data key, calling KMS GenerateDataKey only on a cache miss
+
+        Args:
+            kms_client (obj): Boto3 KMS client object
+            key_id (str): KMS key id, ARN or alias
+            encryption_context (dict): KMS encryption context bound to the data key
+
+        Returns:
+            plaintext, ciphertext_blob, key_arn (tuple): Data key, its KMS encrypted form, and the ARN of the KMS key used
+        """
+        encryption_context = encryption_context or {}
+        cache_key = (key_id, tuple(sorted(encryption_context.items())))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and (now - entry['created'] > self.max_age or entry['uses'] >= self.max_uses):
+                del self._entries[cache_key]
+                entry = None
+            if entry is not None:
+                entry['uses'] += 1
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry['plaintext'], entry['ciphertext'], entry['key_arn']
+        # Generate outside the lock so a slow KMS call does not block other threads using cached keys
+        response = kms_client.generate_data_key(KeyId=key_id, KeySpec='AES_256', EncryptionContext=encryption_context)
+        logging.debug("(DataKeyCache) Generated data key with %s", response['KeyId'])
+        with self._lock:
+            self.misses += 1
+            self._entries[cache_key] = {'plaintext': response['Plaintext'], 'ciphertext': response['CiphertextBlob'], 'key_arn': response['KeyId'], 'created': now, 'uses': 1}
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return response['Plaintext'], response['CiphertextBlob'], response['KeyId']
+
+    def clear(self):
+        """Discard all cached data keys"""
+        with self._lock:
+            self._entries.clear()
+
+
+class EnvelopeEncryptingWriter(io.RawIOBase):
+    """Binary stream that envelope encrypts data written to it
+
+    Plaintext is buffered to chunk_size and each chunk is sealed with AES-256-GCM and written to the wrapped stream, so memory
+    use is bounded by the chunk size.  close() writes the final chunk and closes the wrapped stream.
+
+    Args:
+        stream (obj): Writable binary stream receiving the encrypted output
+        kms_client (obj): Boto3 KMS client object
+        key_id (str): KMS key id, ARN or alias
+        cache (DataKeyCache): Data key cache, None to generate a data key for this stream only
+        encryption_context (dict): KMS encryption context, required again for decryption
+        chunk_size (int): Plaintext bytes per encrypted chunk
+    """
+
+    def __init__(self, stream, kms_client, key_id, cache=None, encryption_context=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        super().__init__()
+        self.stream = stream
+        self.chunk_size = chunk_size
+        encryption_context = encryption_context or {}
+        if cache is None:
+            cache = DataKeyCache(max_entries=1, max_uses=1)
+        plaintext_key, encrypted_key, key_arn = cache.get_data_key(kms_client, key_id, encryption_context)
+        salt = os.urandom(SALT_SIZE)
+        self._cipher = _aesgcm(_stream_key(plaintext_key, salt))
+        key_arn = key_arn.encode('utf-8')
+        context = json.dumps(encryption_context, sort_keys=True).encode('utf-8')
+        header = MAGIC + salt + struct.pack('>H', len(key_arn)) + key_arn + struct.pack('>I', len(encrypted_key)) + encrypted_key + struct.pack('>I', len(context)) + context
+        self._header_digest = hashlib.sha256(header).digest()
+        self._sequence = 0
+        self._buffer = bytearray()
+        self.stream.write(header)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed EnvelopeEncryptingWriter")
+        self._buffer += data
+        # Keep at least one byte back so the last chunk is always written by close() with the final flag set
+        while len(self._buffer) > self.chunk_size:
+            chunk = bytes(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+            self._write_chunk(chunk, final=False)
+        return len(data)
+
+    def _write_chunk(self, chunk, final):
+        # The key is unique to this stream, so the chunk sequence number is a unique nonce
+        nonce = bytes(NONCE_SIZE - 8) + struct.pack('>Q', self._sequence)
+        aad = self._header_digest + struct.pack('>QB', self._sequence, final)
+        ciphertext = self._cipher.encrypt(nonce, chunk, aad)
+        self.stream.write(struct.pack('>BI', final, len(ciphertext)) + nonce + ciphertext)
+        self._sequence += 1
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._write_chunk(bytes(self._buffer), final=True)
+            self._buffer = bytearray()
+        finally:
+            super().close()
+            self.stream.close()
+
+
+def open_encrypting_writer(stream, kms_client, key_id, cache=None, encryption_context=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Wrap a binary stream with envelope encryption
+
+    Args:
+        stream (obj): Writable binary stream receiving the encrypted output
+        kms_client (obj): Boto3 KMS client object
+        key_id (str): KMS key id, ARN or alias
+        cache (DataKeyCache): Shared data key cache, None to generate a new data key
+        encryption_context (dict): KMS encryption context
+        chunk_size (int): Plaintext bytes per encrypted chunk
+
+    Returns:
+        stream (obj): Writable binary stream, closing it also closes the wrapped stream
+
+    Example:
+        cache = DataKeyCache(max_age=600)
+        with open_encrypting_writer(open('/tmp/report.csv.enc', 'wb'), kms_client, 'alias/reports', cache) as f:
+            f.write(b'ImageId\\n')
+    """
+    logging.debug("Function: open_encrypting_writer() started with args: key_id = %s, encryption_context = %s, chunk_size = %s", key_id, encryption_context, chunk_size)
+    return io.BufferedWriter(EnvelopeEncryptingWriter(stream, kms_client, key_id, cache=cache, encryption_context=encryption_context, chunk_size=chunk_size), buffer_size=chunk_size)
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated envelope encrypted stream")
+    return data
+
+
+def decrypt_stream(kms_client, in_stream, out_stream):
+    """Decrypt an envelope encrypted stream
+
+    Args:
+        kms_client (obj): Boto3 KMS client object with kms:Decrypt on the key used for encryption
+        in_stream (obj): Readable binary stream written by EnvelopeEncryptingWriter
+        out_stream (obj): Writable binary stream receiving the plaintext
+
+    Returns:
+        bytes_written (int): Number of plaintext bytes written
+
+    Example:
+        with open('report.csv.enc', 'rb') as src, open('report.csv', 'wb') as dst:
+            decrypt_stream(kms_client, src, dst)
+    """
+    magic = _read_exact(in_stream, len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError("Not an envelope encrypted stream")
+    salt = _read_exact(in_stream, SALT_SIZE)
+    key_arn_length, = struct.unpack('>H', _read_exact(in_stream, 2))
+    key_arn = _read_exact(in_stream, key_arn_length)
+    encrypted_key_length, = struct.unpack('>I', _read_exact(in_stream, 4))
+    encrypted_key = _read_exact(in_stream, encrypted_key_length)
+    context_length, = struct.unpack('>I', _read_exact(in_stream, 4))
+    context = _read_exact(in_stream, context_length)
+    header = magic + salt + struct.pack('>H', key_arn_length) + key_arn + struct.pack('>I', encrypted_key_length) + encrypted_key + struct.pack('>I', context_length) + context
+    header_digest = hashlib.sha256(header).digest()
+
+    response = kms_client.decrypt(CiphertextBlob=encrypted_key, KeyId=key_arn.decode('utf-8'), EncryptionContext=json.loads(context))
+    cipher = _aesgcm(_stream_key(response['Plaintext'], salt))
+
+    sequence = 0
+    bytes_written = 0
+    while True:
+        final, length = struct.unpack('>BI', _read_exact(in_stream, 5))
+        nonce = _read_exact(in_stream, NONCE_SIZE)
+        ciphertext = _read_exact(in_stream, length)
+        aad = header_digest + struct.pack('>QB', sequence, final)
+        chunk = cipher.decrypt(nonce, ciphertext, aad)
+        out_stream.write(chunk)
+        bytes_written += len(chunk)
+        sequence += 1
+        if final:
+            break
+    return bytes_written
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""Lambda inventory utilities
+
+Compares ListFunctions results with the snapshot saved by the previous run, so that a daily inventory ships only the functions
+that are new, removed or modified since then, and indexes every function by CodeSha256 to group identical deployments across
+accounts and regions and flag functions whose copies run different code.
+
+The state file holds a watermark for each account and region, the latest LastModified listed there, and the previous
+snapshot of every function keyed by ARN.  Lambda updates LastModified whenever a function's code or configuration changes,
+so a function listed before at or before its region's watermark is unchanged and is passed over without comparing its
+description; only functions modified after the watermark are compared field by field.  ListFunctions cannot filter by
+LastModified, so every function is still listed, and the ARNs listed are compared with the snapshot to find removed
+functions.  Only the accounts and regions listed by the current run are compared, so a region that was not queried, or whose
+listing failed or was truncated, is carried forward rather than reported as removed.
+
+State file layout:
+
+    {"generated": "<ISO 8601 time of the run>",
+     "watermarks": {"<account>/<region>": "<latest LastModified>", ...},
+     "functions": {"<FunctionArn>": {<ListFunctions description>}, ...}}
+
+Functions:
+
+function_scope: Account and region of a function from its ARN
+scope_key: Watermark key of an account and region
+load_state: Read the watermarks and snapshot saved by the previous run
+diff_inventory: Compare the functions listed in each account and region with the previous snapshot
+code_index: Group functions by CodeSha256 and flag function names deployed with different code
+write_json: Write a JSON document atomically, compressed based on its extension
+
+"""
+
+
+# Import global modules
+import io
+import json
+import os
+from datetime import datetime, timezone
+
+# Import local modules
+import modules.file_system as file_system
+
+
+# ListFunctions LastModified format, e.g. 2019-04-10T17:55:15.983+0000
+LAST_MODIFIED_FORMAT = '%Y-%m-%dT%H:%M:%S.%f%z'
+# Fields of a function kept in the removed, drift and code index entries
+SUMMARY_FIELDS = ('FunctionName', 'FunctionArn', 'Runtime', 'CodeSha256', 'LastModified')
+
+
+def function_scope(function):
+    """Account and region of a function
+
+    Args:
+        function (dict): ListFunctions function description
+
+    Returns:
+        account, region (tuple): From the ARN - arn:aws:lambda:<region>:<account>:function:<name>
+    """
+    region, account = function['FunctionArn'].split(':')[3:5]
+    return account, region
+
+
+def scope_key(account, region):
+    """Watermark key of an account and region, e.g. 111111111111/us-east-1"""
+    return '{}/{}'.format(account, region)
+
+
+def _last_modified(value):
+    # Parsed so that watermarks do not depend on the offset format ListFunctions happens to return
+    return datetime.strptime(value, LAST_MODIFIED_FORMAT) if value else None
+
+
+def _summary(function):
+    account, region = function_scope(function)
+    return dict({field: function.get(field) for field in SUMMARY_FIELDS}, Account=account, Region=region)
+
+
+def load_state(path):
+    """Read the watermarks and snapshot saved by the previous run
+
+    Args:
+        path (str): State file, optionally gzip (.gz) or zstd (.zst) compressed
+
+    Returns:
+        state (dict): generated, watermarks and functions, empty when the file does not exist yet
+    """
+    if not os.path.exists(path):
+        return {'generated': None, 'watermarks': {}, 'functions': {}}
+    with file_system.open_compressed(path) as state_file:
+        state = json.load(state_file)
+    state.setdefault('watermarks', {})
+    state.setdefault('functions', {})
+    return state
+
+
+def diff_inventory(state, listings, generated=None):
+    """Compare the functions listed in each account and region with the previous snapshot
+
+    Args:
+        state (dict): State returned by load_state
+        listings (dict): Watermark key (see scope_key) --> list of every function listed in that account and region.  Scopes
+            left out, such as regions that were not queried, keep their previous functions and watermark
+        generated (str): ISO 8601 time of the run, defaults to now
+
+    Returns:
+        delta, state (tuple): The delta, with the added and modified function descriptions, the removed functions, the fields
+        changed in each modified function and the number unchanged, and the state to save for the next run
+    """
+    generated = generated or datetime.now(timezone.utc).isoformat()
+    previous = state.get('functions', {})
+    watermarks = dict(state.get('watermarks', {}))
+    functions = dict(previous)
+    delta = {'generated': generated, 'previous': state.get('generated'), 'scopes': sorted(listings), 'added': [], 'modified': [], 'removed': [], 'unchanged': 0}
+    for scope, listed in sorted(listings.items()):
+        watermark = _last_modified(watermarks.get(scope))
+        latest = watermarks.get(scope)
+        seen = set()
+        for function in listed:
+            arn = function['FunctionArn']
+            seen.add(arn)
+            functions[arn] = function
+            last_modified = _last_modified(function.get('LastModified'))
+            if last_modified is not None and (latest is None or last_modified > _last_modified(latest)):
+                latest = function['LastModified']
+            before = previous.get(arn)
+            if before is None:
+                delta['added'].append(function)
+            elif watermark is not None and last_modified is not None and last_modified <= watermark:
+                delta['unchanged'] += 1
+            else:
+                changed = sorted(key for key in set(before) | set(function) if before.get(key) != function.get(key))
+                if changed:
+                    delta['modified'].append({'function': function, 'changed': changed, 'previous': {field: before.get(field) for field in SUMMARY_FIELDS}})
+                else:
+                    delta['unchanged'] += 1
+        for arn, before in previous.items():
+            if arn not in seen and scope_key(*function_scope(before)) == scope:
+                delta['removed'].append(_summary(before))
+                del functions[arn]
+        if latest is not None:
+            watermarks[scope] = latest
+    return delta, {'generated': generated, 'watermarks': watermarks, 'functions': functions}
+
+
+def code_index(functions):
+    """Group functions by CodeSha256 and flag function names deployed with different code
+
+    Copies of a function deployed to several accounts or regions are identified by their function name.  A name whose copies
+    have more than one CodeSha256 has drifted.
+
+    Args:
+        functions (iterable): ListFunctions function descriptions
+
+    Returns:
+        index (dict): code, CodeSha256 --> the functions deployed with it, and drift, function name --> CodeSha256 --> its
+        copies, for the names deployed with more than one
+    """
+    by_code = {}
+    by_name = {}
+    for function in functions:
+        summary = _summary(function)
+        by_code.setdefault(function.get('CodeSha256'), []).append(summary)
+        by_name.setdefault(function['FunctionName'], {}).setdefault(function.get('CodeSha256'), []).append(summary)
+    order = lambda summary: (summary['Account'], summary['Region'], summary['FunctionName'])
+    return {
+        'code': {code: sorted(copies, key=order) for code, copies in sorted(by_code.items(), key=lambda item: str(item[0]))},
+        'drift': {name: {code: sorted(copies, key=order) for code, copies in codes.items()} for name, codes in sorted(by_name.items()) if len(codes) > 1},
+    }
+
+
+def write_json(path, document):
+    """Write a JSON document atomically, gzip or zstd compressed when the path ends in .gz or .zst
+
+    Args:
+        path (str): Target file path
+        document (obj): JSON serialisable document
+    """
+    compress = 'gzip' if path.endswith('.gz') else 'zstd' if path.endswith('.zst') else None
+    sink = file_system.AtomicFileWriter(path)
+    with file_system.commit_on_success(io.TextIOWrapper(file_system.compress_stream(sink, compress), encoding='utf-8'), sink) as json_file:
+        json.dump(document, json_file, default=str)
@@ -6,13 +6,160 @@ Provides functions to print messages to the console, and depending on configurat
 
 Functions:
 
+configure_logging: Configure non-blocking queue based logging to the console, a log file and optionally a JSON Lines file
+flush_logging: Block until all queued log records have been written
+stop_logging: Flush and stop the background log listener
 log_message_section: Print a message with a divider using the logging module
 print_message_section: Print a message with a divider using the print function
 
 """
 
 
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+
+# Background listener and queue shared by every configure_logging() call in the process
+_log_listener = None
+_log_queue = None
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format log records as a single line JSON object
+
+    Each record is written with its UTC timestamp, level, logger name, thread name and rendered message so that logs can be loaded by any JSON Lines aware tooling.
+    Any extra attributes passed with logging.<level>(..., extra={...}) are included as additional keys, and the traceback of a
+    record logged with exc_info (e.g. logging.exception()) as the exception key.
+    """
+
+    # Attributes present on every LogRecord that are not treated as extra fields
+    _reserved = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self._reserved and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() folds the traceback into the message and clears exc_text, this keeps it in exc_text so the
+    # JSON Lines handler writes it as its own key.  The console and log file formatters still append it to the message
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def configure_logging(log_level=logging.INFO, log_format='%(asctime)s [%(levelname)s] %(message)s', log_file=None, json_file=None, stream=sys.stdout):
+    """Configure non-blocking logging
+
+    This function replaces the handlers on the root logger with a single QueueHandler.  Worker threads only enqueue records, while a
+    QueueListener thread owns the console, log file and JSON Lines handlers and performs all formatting of timestamps and I/O.
+
+    Messages should be logged with lazy %-style arguments (e.g. logging.debug("Response: %s", response)) so that records below the
+    configured level are discarded without ever being formatted.
+
+    Args:
+        log_level (int|str): Log level for the root logger
+        log_format (str): Format used for the console and log file handlers
+        log_file (str): Path to a log file, None or /dev/null to log only to the console
+        json_file (str): Path to a JSON Lines log file, None to disable
+        stream (obj): Stream used for console output
+
+    Returns:
+        listener (logging.handlers.QueueListener): Running listener
+
+    Example:
+        configure_logging(log_level='DEBUG', log_file='/tmp/createAMI.log', json_file='/tmp/createAMI.jsonl')
+
+    """
+    global _log_listener, _log_queue
+
+    # Stop any previous listener so records are not written twice
+    stop_logging()
+
+    formatter = logging.Formatter(log_format)
+    handlers = []
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(formatter)
+    handlers.append(stream_handler)
+    if log_file is not None and log_file != '/dev/null':
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+    if json_file is not None:
+        json_handler = logging.FileHandler(json_file)
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+
+    # An unbounded queue.Queue is used (rather than SimpleQueue) so that flush_logging() can join() on it
+    _log_queue = queue.Queue(-1)
+    queue_handler = _QueueHandler(_log_queue)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(log_level)
+
+    _log_listener = logging.handlers.QueueListener(_log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+    return _log_listener
+
+
+def flush_logging():
+    """Flush queued log records
+
+    This function blocks until the listener has written every record queued so far.  Use before returning from a Lambda handler
+    as the execution environment may be frozen before the listener thread runs.
+
+    Returns:
+        None
+    """
+    if _log_listener is not None and _log_queue is not None:
+        _log_queue.join()
+
+
+def stop_logging():
+    """Stop the background log listener
+
+    This function flushes all queued records, stops the listener thread and closes its handlers.
+
+    Returns:
+        None
+    """
+    global _log_listener, _log_queue
+    if _log_listener is None:
+        return
+    listener = _log_listener
+    _log_listener = None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    _log_queue = None
 
 
 def log_message_section(message, top=True, bottom=False, divider="="):
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""Profiling utilities
+
+A single switch, shared by every entry point, that profiles a whole run and writes the reports next to its output:
+
+    cpu: Deterministic profile of every function call with cProfile.  Reports are a pstats file, which can be loaded with
+         `python -m pstats` or tools such as snakeviz, and a text summary sorted by cumulative time.  Threads started
+         while profiling, such as ThreadPoolExecutor workers, are profiled too and merged into the same report.
+    mem: Allocations traced with tracemalloc, reported as the lines allocating the most memory still held at the end of
+         the run along with the peak traced memory.
+    wall: Samples the stack of every thread at a fixed interval, so time spent waiting on AWS or on locks is measured
+          as well as CPU time.  Reports are a text summary per function and per thread group, and collapsed stacks that
+          can be rendered with flamegraph.pl or speedscope.
+
+Functions:
+
+profile_prefix: Return the path prefix profile reports are written to
+
+Classes:
+
+Profiler: Profile a run in cpu, mem or wall mode and write the reports when it stops
+
+"""
+
+
+# Import global modules
+import collections
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+
+PROFILE_MODES = ('cpu', 'mem', 'wall')
+# Number of functions or allocation sites in the text reports and in the logged summary
+DEFAULT_REPORT_LINES = 50
+DEFAULT_SUMMARY_LINES = 10
+# Seconds between stack samples in wall mode
+DEFAULT_SAMPLE_INTERVAL = 0.005
+# Frames kept per allocation traceback in mem mode, more frames make tracing and the report slower
+TRACEMALLOC_FRAMES = 5
+
+
+def profile_prefix(directory, name):
+    """Return the path prefix profile reports are written to
+
+    Args:
+        directory (str): Output directory, None for the current directory
+        name (str): Report file name excluding extension
+
+    Returns:
+        prefix (str): Path prefix, '-profile-<mode>.<extension>' is appended to it for each report
+    """
+    return os.path.join(os.path.expanduser(directory or '.'), name)
+
+
+def _thread_group(name):
+    # Group executor workers (ThreadPoolExecutor-0_3) by their pool
+    return re.sub(r'_\d+$', '', name)
+
+
+def _function_label(code):
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler:
+    """Profile a run in cpu, mem or wall mode and write the reports when it stops
+
+    Args:
+        mode (str): cpu, mem or wall, None to disable profiling
+        prefix (str): Path prefix of the report files (see profile_prefix())
+        interval (float): Seconds between stack samples in wall mode
+
+    Example:
+        with Profiler('cpu', profile_prefix('./reports', 'AMI-Report')):
+            main()
+    """
+
+    def __init__(self, mode, prefix, interval=DEFAULT_SAMPLE_INTERVAL):
+        if mode is not None and mode not in PROFILE_MODES:
+            raise ValueError("Profile mode must be one of {}, not {}".format(', '.join(PROFILE_MODES), mode))
+        self.mode = mode
+        self.prefix = prefix
+        self.interval = interval
+        self.reports = []
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._thread_profilers = []
+        self._sampler = None
+        self._stop = threading.Event()
+        self._samples = 0
+        self._self_counts = collections.Counter()
+        self._total_counts = collections.Counter()
+        self._thread_counts = collections.Counter()
+        self._stacks = collections.Counter()
+        self._started = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # Reports are also written when the run ends with sys.exit()
+        self.stop()
+
+    def start(self):
+        """Start profiling"""
+        if self.mode is None:
+            return
+        self._started = time.perf_counter()
+        if self.mode == 'cpu':
+            # From Python 3.12 cProfile uses sys.monitoring and one profiler sees every thread, before that each thread
+            # needs its own profiler, started by the profile hook threading runs first in every new thread
+            if sys.version_info < (3, 12):
+                threading.setprofile(self._start_thread_profiler)
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.mode == 'mem':
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        elif self.mode == 'wall':
+            self._sampler = threading.Thread(target=self._sample, name='ProfileSampler', daemon=True)
+            self._sampler.start()
+        logging.info("Profiling enabled (%s), reports will be saved to %s-profile-%s.*", self.mode, self.prefix, self.mode)
+
+    def _start_thread_profiler(self, frame, event, arg):
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._thread_profilers.append(profiler)
+        profiler.enable()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                group = _thread_group(names.get(ident, str(ident)))
+                stack = []
+                while frame is not None:
+                    stack.append(_function_label(frame.f_code))
+                    frame = frame.f_back
+                self._samples += 1
+                self._thread_counts[group] += 1
+                self._self_counts[stack[0]] += 1
+                self._total_counts.update(set(stack))
+                self._stacks[';'.join([group] + stack[::-1])] += 1
+
+    def stop(self):
+        """Stop profiling, write the reports and log a summary
+
+        Returns:
+            reports (list): Paths of the report files written
+        """
+        if self.mode is None or self._started is None:
+            return self.reports
+        elapsed = time.perf_counter() - self._started
+        self._started = None
+        directory = os.path.dirname(self.prefix)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        try:
+            if self.mode == 'cpu':
+                self._stop_cpu()
+            elif self.mode == 'mem':
+                self._stop_mem()
+            elif self.mode == 'wall':
+                self._stop_wall(elapsed)
+        except OSError as e:
+            logging.error("Error saving %s profile to %s: %s", self.mode, self.prefix, e)
+        for path in self.reports:
+            logging.info("Profile saved to %s", path)
+        return self.reports
+
+    def _write(self, extension, text):
+        path = "{}-profile-{}.{}".format(self.prefix, self.mode, extension)
+        with open(path, 'w') as report:
+            report.write(text)
+        self.reports.append(path)
+
+    def _log_summary(self, title, lines):
+        logging.info("%s", title)
+        for line in lines[:DEFAULT_SUMMARY_LINES]:
+            logging.info("  %s", line)
+
+    def _stop_cpu(self):
+        self._profiler.disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        stats = pstats.Stats(self._profiler)
+        with self._lock:
+            for profiler in self._thread_profilers:
+                stats.add(profiler)
+            threads = len(self._thread_profilers)
+        path = "{}-profile-cpu.pstats".format(self.prefix)
+        stats.dump_stats(path)
+        self.reports.append(path)
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(DEFAULT_REPORT_LINES)
+        self._write('txt', text.getvalue())
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('tottime').print_stats(DEFAULT_SUMMARY_LINES)
+        rows = [line.strip() for line in summary.getvalue().splitlines() if line.strip()]
+        header = next((index for index, line in enumerate(rows) if line.startswith('ncalls')), len(rows))
+        self._log_summary("CPU profile, top functions by own time ({} threads started while profiling):".format(threads), rows[header:])
+
+    def _stop_mem(self):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        by_line = snapshot.statistics('lineno')
+        lines = ["Traced memory: current {:.1f} MiB, peak {:.1f} MiB".format(current / 1048576.0, peak / 1048576.0), "", "Top allocations by line:"]
+        lines.extend(str(statistic) for statistic in by_line[:DEFAULT_REPORT_LINES])
+        lines.extend(["", "Top allocation tracebacks:"])
+        for statistic in snapshot.statistics('traceback')[:DEFAULT_SUMMARY_LINES]:
+            lines.append("{} blocks, {:.1f} KiB".format(statistic.count, statistic.size / 1024.0))
+            lines.extend("    " + line for line in statistic.traceback.format())
+        self._write('txt', "\n".join(lines) + "\n")
+        self._log_summary(lines[0] + ", top allocations:", [str(statistic) for statistic in by_line])
+
+    def _stop_wall(self, elapsed):
+        self._stop.set()
+        self._sampler.join()
+        self._stop.clear()
+        samples = max(1, self._samples)
+        lines = ["Wall clock: {:.2f}s, {} samples every {}s across {} thread groups".format(elapsed, self._samples, self.interval, len(self._thread_counts)), "", "Samples per thread group:"]
+        lines.extend("{:8d} {:6.1%}  {}".format(count, count / float(samples), group) for group, count in self._thread_counts.most_common())
+        lines.extend(["", "Top functions by samples on the stack (cumulative / own):"])
+        top = ["{:8d} {:6.1%} {:8d}  {}".format(count, count / float(samples), self._self_counts[function], function) for function, count in self._total_counts.most_common(DEFAULT_REPORT_LINES)]
+        lines.extend(top)
+        self._write('txt', "\n".join(lines) + "\n")
+        self._write('folded', "".join("{} {}\n".format(stack, count) for stack, count in self._stacks.most_common()))
+        by_self = ["{:6.1%}  {}".format(count / float(samples), function) for function, count in self._self_counts.most_common(DEFAULT_SUMMARY_LINES)]
+        self._log_summary(lines[0] + ", top functions by own samples:", by_self)
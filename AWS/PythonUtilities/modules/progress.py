@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+"""Progress utilities
+
+Provides live progress, throughput and ETA reporting for long running runs.  Work is counted as it moves through named stages
+(for example discovered, created, tagged and available), AWS API requests are counted from the sessions they are sent through,
+and a background thread reports the counts either as a single status line kept below the log output of a terminal, or as
+periodic log lines (with the counts as structured fields in the JSON Lines log) when output is not a terminal, such as in
+Lambda or when run from cron.
+
+Functions:
+
+console_mode: Choose between a terminal status line and periodic log lines for an output stream
+format_seconds: Format a number of seconds as 45s, 12m05s or 3h02m
+
+Classes:
+
+StatusLine: Console stream wrapper that keeps a single status line below the log records written through it
+Progress: Thread safe stage counters, request rates and ETA, reported by a background thread
+
+"""
+
+
+# Import global modules
+import collections
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+
+# Seconds of history used for the current rates and ETA, so they follow changes in throughput rather than the whole run average
+RATE_WINDOW = 60
+# Seconds between status line redraws on a terminal
+TTY_INTERVAL = 1
+# Seconds between progress log lines when output is not a terminal
+DEFAULT_LOG_INTERVAL = 30
+# Seconds without any stage or request activity after which a stall is reported, 0 to never report stalls
+DEFAULT_STALL_AFTER = 300
+
+
+def console_mode(mode='auto', stream=sys.stdout):
+    """Choose how progress is reported
+
+    Args:
+        mode (str): auto, tty, log or off
+        stream (obj): Console stream the logs are written to
+
+    Returns:
+        mode (str): tty when auto and the stream is an interactive terminal outside Lambda, log when auto otherwise, or mode
+    """
+    if mode != 'auto':
+        return mode
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        return 'log'
+    return 'tty' if hasattr(stream, 'isatty') and stream.isatty() else 'log'
+
+
+class StatusLine:
+    """Keep a status line below log output
+
+    Used as the console stream of the logging handlers.  Each write clears the status line, writes the log text and redraws the
+    status line below it, so log records and the status line never share a terminal line.
+
+    Args:
+        stream (obj): Terminal stream to write to
+
+    Example:
+        status_line = StatusLine(sys.stdout)
+        output.configure_logging(stream=status_line)
+        status_line.update("12/40 created")
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._text = ''
+        self._lock = threading.Lock()
+
+    def _clear(self):
+        if self._text:
+            self.stream.write('\r\x1b[K')
+
+    def _draw(self):
+        if self._text:
+            self.stream.write(self._text)
+
+    def write(self, text):
+        """Write log text above the status line"""
+        with self._lock:
+            self._clear()
+            self.stream.write(text)
+            if text.endswith('\n'):
+                self._draw()
+            self.stream.flush()
+
+    def flush(self):
+        with self._lock:
+            self.stream.flush()
+
+    def isatty(self):
+        return True
+
+    def update(self, text):
+        """Replace the status line, truncated to the terminal width"""
+        with self._lock:
+            self._clear()
+            self._text = text[:max(20, shutil.get_terminal_size().columns - 1)]
+            self._draw()
+            self.stream.flush()
+
+    def close(self):
+        """Remove the status line, leaving the cursor at the start of an empty line"""
+        with self._lock:
+            self._clear()
+            self._text = ''
+            self.stream.flush()
+
+
+class Progress:
+    """Live progress, throughput and ETA
+
+    Stages are counted with add() as work moves through them, and futures submitted to a ThreadPoolExecutor can be passed to
+    track() to count the tasks queued and running.  attach() counts every HTTP request sent through a session, retries
+    included, so the request rate can be compared with the API rate limits while sizing concurrency.
+
+    The total is the count of the first stage (such as discovered) and the ETA is the time to bring the goal stage, plus any
+    failed, up to it at the rate the goal stage has advanced over the last RATE_WINDOW seconds.
+
+    Reports are made by a background thread started by start() or by using the object as a context manager: a status line
+    redrawn every TTY_INTERVAL seconds in tty mode, or a log line every log_interval seconds in log mode, with the counts,
+    rates and ETA as a progress field of the JSON Lines log record.  A warning is logged once nothing has advanced for
+    stall_after seconds while work remains.  A summary is logged when reporting stops.
+
+    Args:
+        stages (list): Stage names in the order work moves through them, the first stage is the total
+        goal (str): Stage the ETA is calculated for, defaults to the last stage
+        mode (str): tty, log or off
+        status_line (StatusLine): Status line to draw on in tty mode
+        log_interval (int): Seconds between log lines in log mode
+        stall_after (int): Seconds without activity before a stall is reported, 0 to never report stalls
+        name (str): Name of the run used in the report
+
+    Example:
+        progress = Progress(['discovered', 'created', 'tagged', 'available'], mode='log')
+        progress.attach(session)
+        with progress:
+            progress.add('discovered', len(instance_ids))
+            ...
+            progress.add('created')
+    """
+
+    def __init__(self, stages, goal=None, mode='log', status_line=None, log_interval=DEFAULT_LOG_INTERVAL, stall_after=DEFAULT_STALL_AFTER, name='Progress'):
+        self.stages = list(stages)
+        self.goal = goal or self.stages[-1]
+        self.mode = mode
+        self.status_line = status_line
+        self.log_interval = log_interval
+        self.stall_after = stall_after
+        self.name = name
+        self.counts = collections.OrderedDict((stage, 0) for stage in self.stages)
+        self.failed = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.started = time.monotonic()
+        self._history = collections.deque([(self.started, 0, 0)])
+        self._activity = self.started
+        self._stalled = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def attach(self, session):
+        """Count the HTTP requests sent by clients created from a session from now on
+
+        Args:
+            session (obj): boto3.session.Session or botocore.session.Session
+        """
+        register = session.events.register if hasattr(session, 'events') else session.register
+        register('before-send', self.count_request)
+
+    def count_request(self, **kwargs):
+        """Count an HTTP request, used as a botocore before-send event handler"""
+        with self._lock:
+            self.requests += 1
+            self._activity = time.monotonic()
+
+    def add(self, stage, count=1):
+        """Count work reaching a stage
+
+        Args:
+            stage (str): Stage name, failed counts work that will not reach the goal
+            count (int): Number of items
+        """
+        with self._lock:
+            if stage == 'failed':
+                self.failed += count
+            else:
+                self.counts[stage] = self.counts.get(stage, 0) + count
+            self._activity = time.monotonic()
+
+    def track(self, future):
+        """Count a submitted future as in flight until it is done
+
+        Args:
+            future (concurrent.futures.Future): Future returned by executor.submit()
+
+        Returns:
+            future (concurrent.futures.Future): The same future
+        """
+        with self._lock:
+            self.in_flight += 1
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+            self._activity = time.monotonic()
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("Unexpected error in %s task: %s", self.name, future.exception())
+            self.add('failed')
+
+    def snapshot(self):
+        """Return the current counts, rates and ETA
+
+        Returns:
+            snapshot (dict): elapsed seconds, stage counts, failed, total, in_flight, requests, request_rate and goal_rate per
+            second over the last RATE_WINDOW seconds, eta seconds or None while unknown, and idle seconds since any activity
+        """
+        now = time.monotonic()
+        with self._lock:
+            counts = dict(self.counts)
+            done = counts.get(self.goal, 0) + self.failed
+            self._history.append((now, self.requests, done))
+            while len(self._history) > 2 and now - self._history[1][0] >= RATE_WINDOW:
+                self._history.popleft()
+            first_time, first_requests, first_done = self._history[0]
+            span = now - first_time
+            request_rate = (self.requests - first_requests) / span if span > 0 else 0.0
+            goal_rate = (done - first_done) / span if span > 0 else 0.0
+            total = counts.get(self.stages[0], 0)
+            remaining = max(0, total - done)
+            if remaining == 0 and total > 0:
+                eta = 0.0
+            elif goal_rate > 0:
+                eta = remaining / goal_rate
+            else:
+                eta = None
+            return {
+                'elapsed': round(now - self.started, 1),
+                'counts': counts,
+                'failed': self.failed,
+                'total': total,
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'request_rate': round(request_rate, 2),
+                'goal_rate': round(goal_rate, 3),
+                'eta': round(eta, 1) if eta is not None else None,
+                'idle': round(now - self._activity, 1),
+            }
+
+    def format(self, snapshot):
+        """Render a snapshot as one compact line"""
+        total = snapshot['total']
+        stages = ' '.join('{} {}'.format(stage, count if stage == self.stages[0] else '{}/{}'.format(count, total)) for stage, count in snapshot['counts'].items())
+        text = '{} {}'.format(self.name, stages)
+        if snapshot['failed']:
+            text += ' failed {}'.format(snapshot['failed'])
+        if snapshot['in_flight']:
+            text += ' | {} in flight'.format(snapshot['in_flight'])
+        text += ' | {} requests {:.1f}/s | elapsed {}'.format(snapshot['requests'], snapshot['request_rate'], format_seconds(snapshot['elapsed']))
+        if snapshot['eta'] is not None:
+            text += ' ETA {}'.format(format_seconds(snapshot['eta']))
+        return text
+
+    def report(self):
+        """Report the current progress once, logging a warning if work has stalled"""
+        snapshot = self.snapshot()
+        if self.mode == 'tty' and self.status_line is not None:
+            self.status_line.update(self.format(snapshot))
+        elif self.mode == 'log':
+            logging.info("%s", self.format(snapshot), extra={'progress': snapshot})
+        stalled = bool(self.stall_after) and snapshot['idle'] >= self.stall_after and snapshot['counts'].get(self.goal, 0) + snapshot['failed'] < snapshot['total']
+        if stalled and not self._stalled:
+            logging.warning("%s stalled: no requests or completed work for %s", self.name, format_seconds(snapshot['idle']), extra={'progress': snapshot})
+        self._stalled = stalled
+        return snapshot
+
+    def _run(self):
+        interval = TTY_INTERVAL if self.mode == 'tty' else self.log_interval
+        while not self._stop.wait(interval):
+            self.report()
+
+    def start(self):
+        """Start reporting from a background thread"""
+        if self.mode != 'off' and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='Progress', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop reporting and log a summary of the run"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.mode == 'tty' and self.status_line is not None:
+            self.status_line.close()
+        if self.mode != 'off':
+            snapshot = self.snapshot()
+            average = snapshot['requests'] / snapshot['elapsed'] if snapshot['elapsed'] else 0.0
+            logging.info("%s complete: %s, %s requests (%.1f/s average) in %s", self.name, ', '.join('{} {}'.format(count, stage) for stage, count in snapshot['counts'].items()) + (', {} failed'.format(snapshot['failed']) if snapshot['failed'] else ''), snapshot['requests'], average, format_seconds(snapshot['elapsed']), extra={'progress': snapshot})
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+def format_seconds(seconds):
+    """Format seconds as 45s, 12m05s or 3h02m"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    if seconds < 3600:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
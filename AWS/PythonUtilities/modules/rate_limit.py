@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""Rate limiting utilities
+
+Provides a thread safe token bucket used to keep worker pools under AWS API request rate limits.
+
+Classes:
+
+RateLimiter: Token bucket shared by any number of worker threads
+
+"""
+
+
+# Import global modules
+import threading
+import time
+
+
+class RateLimiter:
+    """Token bucket rate limiter
+
+    acquire() blocks until a token is available.  Tokens refill continuously at rate per second up to burst, so short bursts
+    are allowed while the sustained request rate never exceeds rate.
+
+    Args:
+        rate (float): Sustained requests per second, 0 or None for unlimited
+        burst (int): Maximum number of tokens that can accumulate, defaults to rate
+
+    Example:
+        limiter = RateLimiter(rate=20)
+        limiter.acquire()
+        ec2_client.deregister_image(ImageId=image_id)
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate or 1))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available and consume them"""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
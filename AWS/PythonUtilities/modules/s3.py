@@ -1,4 +1,200 @@
 #!/usr/bin/env python3
 
 """S3 utilities
-"""
\ No newline at end of file
+
+Provides a streaming writer that uploads report output to S3 using multipart upload without staging files on local disk.
+
+Functions:
+
+parse_s3_uri: Split an s3://bucket/key URI into bucket and key
+open_s3_writer: Open a binary, optionally compressed, stream that uploads to S3
+
+Classes:
+
+S3MultipartWriter: Binary stream that uploads fixed size parts through a bounded pool of in-flight uploads
+
+"""
+
+
+# Import global modules
+import concurrent.futures
+import io
+import logging
+import threading
+
+# Import local modules
+import modules.file_system as file_system
+
+# Import third-party modules
+from botocore.exceptions import ClientError
+
+
+# S3 requires every part except the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_IN_FLIGHT = 4
+
+
+def parse_s3_uri(s3_uri):
+    """Split an S3 URI
+
+    Args:
+        s3_uri (str): URI in the form s3://bucket/key
+
+    Returns:
+        bucket, key (tuple): Bucket name and object key (key may be empty)
+
+    Example:
+        parse_s3_uri("s3://my-bucket/reports/ami.csv") --> ("my-bucket", "reports/ami.csv")
+    """
+    if not s3_uri.startswith('s3://'):
+        raise ValueError("Invalid S3 URI (expected s3://bucket/key): {0}".format(s3_uri))
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    if not bucket:
+        raise ValueError("Invalid S3 URI (missing bucket): {0}".format(s3_uri))
+    return bucket, key
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """Binary stream that uploads to S3 with multipart upload
+
+    Data written is buffered until a full part is available, the part is then handed to a thread pool for upload.  At most
+    max_in_flight parts are held in memory waiting for upload; write() blocks once that limit is reached so memory use stays
+    at roughly (max_in_flight + 1) * part_size however large the report is.
+
+    The multipart upload is only started once the first part is full, output smaller than a single part is sent with a single
+    put_object call.  The upload is completed on close(), or aborted if any part fails so no incomplete parts are left billed
+    in the bucket.
+
+    Args:
+        s3_client (obj): Boto3 S3 client object
+        bucket (str): Target bucket
+        key (str): Target object key
+        part_size (int): Part size in bytes, minimum 5 MiB
+        max_in_flight (int): Maximum number of parts uploading or queued for upload at once
+        extra_args (dict): Extra arguments passed to create_multipart_upload/put_object (e.g. ServerSideEncryption, ContentType)
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=DEFAULT_PART_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, extra_args=None):
+        super().__init__()
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("S3 multipart part size must be at least {0} bytes".format(MIN_PART_SIZE))
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args or {}
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._part_number = 0
+        self._futures = []
+        self._error = None
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='s3-part')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        if self._error is not None:
+            raise self._error
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def _submit_part(self, part):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)
+            self._upload_id = response['UploadId']
+            logging.debug("(S3MultipartWriter) Started multipart upload %s for s3://%s/%s", self._upload_id, self.bucket, self.key)
+        # Blocks once max_in_flight parts are pending so the buffered data stays bounded
+        self._slots.acquire()
+        self._part_number += 1
+        future = self._executor.submit(self._upload_part, self._part_number, part)
+        future.add_done_callback(self._part_done)
+        self._futures.append(future)
+
+    def _upload_part(self, part_number, part):
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, PartNumber=part_number, Body=part)
+        logging.debug("(S3MultipartWriter) Uploaded part %s (%s bytes) of s3://%s/%s", part_number, len(part), self.bucket, self.key)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _part_done(self, future):
+        self._slots.release()
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self.extra_args)
+                logging.debug("(S3MultipartWriter) Uploaded s3://%s/%s with a single put_object (%s bytes)", self.bucket, self.key, len(self._buffer))
+            else:
+                if len(self._buffer) > 0:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id, MultipartUpload={'Parts': parts})
+                logging.debug("(S3MultipartWriter) Completed multipart upload of s3://%s/%s in %s parts", self.bucket, self.key, len(parts))
+            self._buffer = bytearray()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=True)
+            super().close()
+
+    def abort(self):
+        """Abort the upload, discarding any uploaded parts and buffered data
+
+        Nothing is written to the target object once the writer has been aborted.
+        """
+        if self.closed:
+            return
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        if self._upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+                logging.warning("Aborted multipart upload of s3://%s/%s", self.bucket, self.key)
+            except ClientError as e:
+                logging.error("Error in S3MultipartWriter.abort: %s", e)
+            self._upload_id = None
+        self._buffer = bytearray()
+        super().close()
+
+
+def open_s3_writer(s3_client, s3_uri, part_size=DEFAULT_PART_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT, compress=None, compress_level=None, extra_args=None):
+    """Open a binary stream that uploads to S3
+
+    This function returns a writable binary stream; closing the stream flushes any compressor and completes the upload.
+
+    Args:
+        s3_client (obj): Boto3 S3 client object
+        s3_uri (str): Target object as s3://bucket/key
+        part_size (int): Multipart part size in bytes
+        max_in_flight (int): Maximum number of parts held in memory for upload
+        compress (str): None or gzip
+        compress_level (int): Compression level, None for the compressor default
+        extra_args (dict): Extra arguments for the upload (e.g. ServerSideEncryption, ContentType)
+
+    Returns:
+        stream (obj): Writable binary stream
+
+    Example:
+        with io.TextIOWrapper(open_s3_writer(s3_client, "s3://bucket/report.csv.gz", compress='gzip'), newline='') as f:
+            csv.writer(f).writerow(['ImageId'])
+    """
+    bucket, key = parse_s3_uri(s3_uri)
+    logging.debug("Function: open_s3_writer() started with args: s3_uri = %s, part_size = %s, max_in_flight = %s, compress = %s", s3_uri, part_size, max_in_flight, compress)
+    writer = S3MultipartWriter(s3_client, bucket, key, part_size=part_size, max_in_flight=max_in_flight, extra_args=extra_args)
+    return file_system.compress_stream(writer, compress, compress_level)
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+
+"""Backup scheduling utilities
+
+Runs AMI backups continuously from a set of backup policies instead of one burst per cron run.  Each policy selects
+instances by tag (or ID) in one or more regions and accounts, and backs them up once every `every` within a window
+starting at `start` (UTC).  When a window opens the instances are discovered once and their backups are spread evenly across
+the window, in a stable shuffled order with random jitter within each instance's slot, so CreateImage calls and snapshot load
+are smooth rather than arriving together.
+
+Backups only start while the in-flight snapshots of their account, region and availability zone are under the configured
+caps; a backup that would exceed a cap waits until earlier images complete.  Images are tracked with ImagePoller and
+CreateImage calls go through a shared rate limiter.  Clients are created once per account and region and reused for every
+window, and assumed role sessions are refreshed before their credentials expire.
+
+Policies are read from a YAML or JSON file:
+
+    policies:
+      - name: operations-nightly
+        tags: {Product: operations-tools, Environment: prod}
+        regions: [us-east-1, us-west-2]
+        every: 1d
+        start: '01:00'
+        window: 4h
+        add_tags: {Backup: nightly}
+
+Functions:
+
+parse_duration: Parse a duration such as 90m, 6h or 1d into seconds
+load_policies: Read backup policies from a YAML or JSON file
+spread_times: Spread keys evenly across a window with jitter, in a stable shuffled order
+backup_tags: Build the tags for an image created by a policy
+
+Classes:
+
+BackupPolicy: Instance selector, frequency and window of a scheduled backup
+InFlightLimits: Caps on in-flight snapshots per account, region and availability zone
+BackupScheduler: Spread policy backups across their windows within the in-flight caps
+
+"""
+
+
+# Import global modules
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+# Import local modules
+import modules.ec2 as ec2_utils
+from modules.rate_limit import RateLimiter
+
+# Import third-party modules
+from botocore.exceptions import ClientError
+
+
+# Duration suffixes accepted by parse_duration, plain numbers are minutes
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+# Instance tags copied to the images, as CreateAndTagEC2AMI does
+COPIED_TAGS = ('Name', 'Product', 'Environment', 'Tenant', 'Role')
+# Tag recording the policy an image was created by
+POLICY_TAG = 'BackupPolicy'
+DEFAULT_JITTER = 0.5
+DEFAULT_POLL_INTERVAL = 60
+# Seconds an image may stay pending before its snapshots are released and it is counted as failed
+DEFAULT_IMAGE_TIMEOUT = ec2_utils.MAX_PENDING_SECONDS
+DEFAULT_CREATE_RATE = 2
+DEFAULT_WORKERS = 8
+
+
+def parse_duration(value):
+    """Parse a duration into seconds
+
+    Args:
+        value (str): Number followed by s, m, h, d or w (e.g. 90m, 6h or 1d), plain numbers are minutes
+
+    Returns:
+        seconds (int): Duration in seconds
+    """
+    text = str(value).strip().lower()
+    if text[-1:] in DURATION_UNITS:
+        return int(float(text[:-1]) * DURATION_UNITS[text[-1]])
+    return int(float(text) * 60)
+
+
+def _start_offset(value):
+    # Seconds after midnight UTC of a HH:MM start time
+    if isinstance(value, int):
+        # YAML reads an unquoted 01:00 as the sexagesimal number 60, minutes after midnight
+        return value * 60
+    hours, _, minutes = str(value).partition(':')
+    return int(hours) * 3600 + int(minutes or 0) * 60
+
+
+class BackupPolicy:
+    """Instance selector, frequency and window of a scheduled backup
+
+    Windows open every `every` seconds from `start` (UTC) on 1970-01-01, so a daily policy starting at 01:00 opens at 01:00
+    UTC every day and a 6 hourly policy starting at 00:30 opens at 00:30, 06:30, 12:30 and 18:30.
+
+    Args:
+        name (str): Policy name, tagged on every image as BackupPolicy
+        tags (dict): Instance tags to select instances by
+        instance_ids (list): Instances to back up in addition to those selected by tag
+        regions (list): Regions to back up instances in
+        accounts (list): Accounts to back up instances in, None for the account of the session
+        every (str): Frequency (see parse_duration)
+        start (str): Time of day (HH:MM UTC) the first window of each day opens
+        window (str): Duration of each window, defaults to every
+        add_tags (dict): Additional tags added to every image
+    """
+
+    def __init__(self, name, tags=None, instance_ids=None, regions=None, accounts=None, every='1d', start='00:00', window=None, add_tags=None):
+        self.name = name
+        self.tags = tags or {}
+        self.instance_ids = list(instance_ids or [])
+        self.regions = list(regions or [])
+        self.accounts = [str(account) for account in accounts] if accounts else [None]
+        self.every = parse_duration(every)
+        self.start = _start_offset(start)
+        self.window = parse_duration(window) if window else self.every
+        self.add_tags = add_tags or {}
+        if self.every <= 0 or not 0 < self.window <= self.every:
+            raise ValueError("Policy {}: window must be greater than 0 and no longer than every".format(name))
+        if not self.tags and not self.instance_ids:
+            raise ValueError("Policy {}: tags or instance_ids are required".format(name))
+        if not self.regions:
+            raise ValueError("Policy {}: regions are required".format(name))
+
+    def filters(self):
+        """DescribeInstances filters selecting the policy's instances by tag"""
+        return [{'Name': 'tag:' + key, 'Values': [str(value)]} for key, value in self.tags.items()] + [{'Name': 'instance-state-name', 'Values': ['running', 'stopped']}]
+
+    def occurrence(self, now):
+        """Return the window open at a time, or the next window to open
+
+        Args:
+            now (float): Epoch seconds
+
+        Returns:
+            start, end (tuple): Epoch seconds the window opens and closes
+        """
+        start = self.start + math.floor((now - self.start) / self.every) * self.every
+        if now >= start + self.window:
+            start += self.every
+        return start, start + self.window
+
+
+def load_policies(path, default_regions=None):
+    """Read backup policies from a YAML or JSON file
+
+    Args:
+        path (str): File containing a list of policies, or a mapping with a policies list
+        default_regions (list): Regions of policies that do not list any
+
+    Returns:
+        policies (list): BackupPolicy objects
+    """
+    with open(path, 'r', encoding='utf-8') as policy_file:
+        if path.endswith(('.yml', '.yaml')):
+            # Imported on first use as only YAML policy files need PyYAML
+            import yaml
+            document = yaml.safe_load(policy_file)
+        else:
+            document = json.load(policy_file)
+    if isinstance(document, dict):
+        document = document.get('policies', [])
+    policies = []
+    for entry in document or []:
+        entry = dict(entry)
+        entry.setdefault('regions', default_regions)
+        policies.append(BackupPolicy(**entry))
+    names = [policy.name for policy in policies]
+    duplicates = sorted(name for name, count in collections.Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError("Duplicate policy names: {}".format(', '.join(duplicates)))
+    return policies
+
+
+def spread_times(keys, start, end, jitter=DEFAULT_JITTER, seed=''):
+    """Spread keys evenly across a window with jitter
+
+    Keys are ordered by a hash of the seed and key, so each key keeps roughly the same place in every window (and so the same
+    interval between backups) while keys that sort together, such as instances launched together, are not backed up
+    together.  The window is divided into one slot per key and each key is placed at the centre of its slot, moved by up to
+    jitter of half a slot either way.
+
+    Args:
+        keys (iterable): Keys to place, such as instance IDs
+        start (float): Window start in epoch seconds
+        end (float): Window end in epoch seconds
+        jitter (float): 0 for evenly spaced times, up to 1 to move each time anywhere within its slot
+        seed (str): Seed of the order and jitter, such as the policy name
+
+    Returns:
+        times (dict): Key --> epoch seconds
+    """
+    keys = sorted(set(keys), key=lambda key: hashlib.sha256('{}:{}'.format(seed, key).encode('utf-8')).hexdigest())
+    if not keys:
+        return {}
+    slot = max(0.0, end - start) / len(keys)
+    times = {}
+    for index, key in enumerate(keys):
+        offset = random.Random('{}:{}:{}'.format(seed, key, start)).uniform(-jitter, jitter) * slot / 2
+        times[key] = start + (index + 0.5) * slot + offset
+    return times
+
+
+def backup_tags(instance, policy, when):
+    """Build the tags for an image created by a policy
+
+    Args:
+        instance (dict): EC2 instance description
+        policy (BackupPolicy): Policy creating the image
+        when (datetime): Time the image is created
+
+    Returns:
+        tags (list): Image tags
+    """
+    tags = [{'Key': tag['Key'], 'Value': tag['Value']} for tag in instance.get('Tags') or [] if tag['Key'] in COPIED_TAGS]
+    tags.append({'Key': 'Date', 'Value': when.strftime('%Y-%m-%d')})
+    tags.append({'Key': 'Timestamp', 'Value': when.strftime('%H:%M') + ' UTC'})
+    tags.append({'Key': ec2_utils.SOURCE_INSTANCE_TAG, 'Value': instance['InstanceId']})
+    tags.append({'Key': POLICY_TAG, 'Value': policy.name})
+    tags.extend({'Key': str(key), 'Value': str(value)} for key, value in policy.add_tags.items())
+    return tags
+
+
+class InFlightLimits:
+    """Caps on in-flight snapshots per account, region and availability zone
+
+    A backup counts the snapshots of every EBS volume of its instance until its image leaves the pending state.  A backup
+    larger than a cap may still start when nothing else is in flight under that cap, so large instances are not starved.
+
+    Args:
+        per_account (int): Maximum in-flight snapshots per account, 0 or None for no cap
+        per_region (int): Maximum in-flight snapshots per account and region
+        per_az (int): Maximum in-flight snapshots per account and availability zone
+    """
+
+    def __init__(self, per_account=None, per_region=None, per_az=None):
+        self.caps = {'account': per_account, 'region': per_region, 'az': per_az}
+        self.in_flight = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _keys(self, account, region, az):
+        return [('account', (account,)), ('region', (account, region)), ('az', (account, az))]
+
+    def acquire(self, account, region, az, count):
+        """Reserve count snapshots if every cap allows it, returns False without reserving otherwise"""
+        keys = self._keys(account, region, az)
+        with self._lock:
+            for scope, key in keys:
+                cap = self.caps[scope]
+                if cap and self.in_flight[(scope, key)] and self.in_flight[(scope, key)] + count > cap:
+                    return False
+            for scope, key in keys:
+                self.in_flight[(scope, key)] += count
+            return True
+
+    def release(self, account, region, az, count):
+        """Release snapshots reserved by acquire()"""
+        with self._lock:
+            for scope, key in self._keys(account, region, az):
+                self.in_flight[(scope, key)] -= count
+                if self.in_flight[(scope, key)] <= 0:
+                    del self.in_flight[(scope, key)]
+
+    def total(self):
+        """Return the number of snapshots in flight across every account"""
+        with self._lock:
+            return sum(count for (scope, key), count in self.in_flight.items() if scope == 'account')
+
+
+class BackupScheduler:
+    """Spread policy backups across their windows within the in-flight caps
+
+    run() discovers each policy's instances as its window opens and queues a backup for each at its spread time.  Due backups
+    are started by a worker pool once the in-flight caps allow, and pending images are polled every poll_interval seconds,
+    releasing their snapshots from the caps as they complete.  An image still pending after image_timeout seconds, or not
+    found by DescribeImages (see ImagePoller), is given up on and counted as failed, and its snapshots are released too, so a
+    stuck image cannot hold its account, region and availability zone at their caps.  A window opened while the scheduler was stopped is resumed
+    for the instances that have no image created since it opened.
+
+    Args:
+        policies (list): BackupPolicy objects
+        sessions (function): Returns the boto3 session for an account ID, or for None the session's own account
+        limits (InFlightLimits): In-flight snapshot caps
+        jitter (float): Jitter within each instance's slot (see spread_times())
+        poll_interval (int): Seconds between polls of pending images
+        image_timeout (float): Seconds an image may stay pending before it is counted as failed
+        create_rate (float): Maximum CreateImage requests per second across every account
+        workers (int): Worker threads creating images
+        dry_run (bool): Log each window's schedule without creating images
+
+    Example:
+        scheduler = BackupScheduler(load_policies('policies.yml', ['us-east-1']), lambda account: session, InFlightLimits(per_az=20))
+        scheduler.run()
+    """
+
+    def __init__(self, policies, sessions, limits, jitter=DEFAULT_JITTER, poll_interval=DEFAULT_POLL_INTERVAL, image_timeout=DEFAULT_IMAGE_TIMEOUT, create_rate=DEFAULT_CREATE_RATE, workers=DEFAULT_WORKERS, dry_run=False):
+        self.policies = policies
+        self.sessions = sessions
+        self.limits = limits
+        self.jitter = jitter
+        self.poll_interval = poll_interval
+        self.image_timeout = image_timeout
+        self.dry_run = dry_run
+        self.stats = collections.Counter()
+        self._limiter = RateLimiter(create_rate)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup')
+        self._queue = []
+        self._sequence = itertools.count()
+        self._planned = {}
+        self._clients = {}
+        self._pollers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def client(self, account, region):
+        """Return the cached EC2 client for an account and region"""
+        with self._lock:
+            if (account, region) not in self._clients:
+                self._clients[(account, region)] = self.sessions(account).client('ec2', region_name=region)
+            return self._clients[(account, region)]
+
+    def _poller(self, account):
+        with self._lock:
+            if account not in self._pollers:
+                self._pollers[account] = ec2_utils.ImagePoller(self.sessions(account), interval=self.poll_interval, timeout=self.image_timeout)
+            return self._pollers[account]
+
+    def pending(self):
+        """Return the number of images still pending"""
+        with self._lock:
+            pollers = list(self._pollers.values())
+        return sum(poller.pending() for poller in pollers)
+
+    def stop(self):
+        """Stop after the current step, images already started keep being created by EC2"""
+        self._stop.set()
+
+    def _discover(self, policy, account, region):
+        instances = {}
+        ec2 = self.client(account, region)
+        for page in ec2.get_paginator('describe_instances').paginate(Filters=policy.filters()):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    instances[instance['InstanceId']] = instance
+        missing = [instance_id for instance_id in policy.instance_ids if instance_id not in instances]
+        if missing:
+            try:
+                for page in ec2.get_paginator('describe_instances').paginate(InstanceIds=missing):
+                    for reservation in page['Reservations']:
+                        for instance in reservation['Instances']:
+                            instances[instance['InstanceId']] = instance
+            except ClientError as e:
+                # instance_ids may list instances in another of the policy's regions
+                logging.debug("(BackupScheduler) %s %s: %s", region, missing, e)
+        return instances
+
+    def _already_backed_up(self, account, region, instance_ids, start, now):
+        # Instances with an image created since the window opened, when resuming a window after a restart
+        if now - start < self.poll_interval:
+            return set()
+        minutes = int(math.ceil((now - start) / 60.0))
+        index = ec2_utils.ExistingImageIndex.load(self.client(account, region), minutes, now=datetime.fromtimestamp(now, timezone.utc))
+        return {instance_id for instance_id in instance_ids if index.find(instance_id, window=minutes, now=datetime.fromtimestamp(now, timezone.utc)) is not None}
+
+    def plan(self, policy, start, end, now):
+        """Discover a policy's instances and queue their backups across the rest of a window
+
+        Args:
+            policy (BackupPolicy): Policy to plan
+            start (float): Window start in epoch seconds
+            end (float): Window end in epoch seconds
+            now (float): Current epoch seconds, backups are spread from now when the window is already open
+
+        Returns:
+            queued (int): Number of backups queued
+        """
+        queued = 0
+        for account in policy.accounts:
+            for region in policy.regions:
+                try:
+                    instances = self._discover(policy, account, region)
+                    done = self._already_backed_up(account, region, instances, start, now)
+                except ClientError as e:
+                    logging.error("Error in BackupScheduler planning %s in %s %s: %s", policy.name, account or 'default account', region, e)
+                    self._count('errors')
+                    continue
+                if done:
+                    logging.info("Policy %s: %s instances in %s %s already backed up in this window", policy.name, len(done), account or '', region)
+                keys = ['{}/{}'.format(region, instance_id) for instance_id in instances if instance_id not in done]
+                times = spread_times(keys, max(start, now), end, self.jitter, seed='{}/{}'.format(policy.name, account))
+                if self.dry_run:
+                    for key, due in sorted(times.items(), key=lambda item: item[1]):
+                        logging.info("[Dry Run] Policy %s: would back up %s in %s at %s UTC", policy.name, key.split('/', 1)[1], account or region, _utc(due))
+                    times = {}
+                with self._lock:
+                    for key, due in times.items():
+                        instance = instances[key.split('/', 1)[1]]
+                        job = {'policy': policy, 'account': account, 'region': region, 'instance': instance, 'az': instance.get('Placement', {}).get('AvailabilityZone'), 'snapshots': max(1, len([mapping for mapping in instance.get('BlockDeviceMappings', []) if 'Ebs' in mapping])), 'end': end}
+                        heapq.heappush(self._queue, (due, next(self._sequence), job))
+                queued += len(times)
+                if keys:
+                    logging.info("Policy %s: %s instances in %s %s spread from %s to %s UTC, one every %.0f seconds", policy.name, len(keys), account or 'default account', region, _utc(max(start, now)), _utc(end), (end - max(start, now)) / len(keys))
+        return queued
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _plan_windows(self, now):
+        for policy in self.policies:
+            start, end = policy.occurrence(now)
+            if start > now or self._planned.get(policy.name) == start:
+                continue
+            self._planned[policy.name] = start
+            logging.info("Policy %s: window open from %s to %s UTC", policy.name, _utc(start), _utc(end))
+            self.plan(policy, start, end, now)
+
+    def _dispatch(self, now):
+        # Start every due backup the caps allow, leaving the rest queued in due order
+        deferred = []
+        started = []
+        with self._lock:
+            while self._queue and self._queue[0][0] <= now:
+                deferred.append(heapq.heappop(self._queue))
+        for entry in deferred:
+            job = entry[2]
+            if not self.limits.acquire(job['account'], job['region'], job['az'], job['snapshots']):
+                continue
+            started.append(entry)
+            if now > job['end']:
+                logging.warning("Policy %s: backup of %s starting after its window closed, waiting on in-flight snapshot caps", job['policy'].name, job['instance']['InstanceId'])
+                self._count('late')
+            self._executor.submit(self._create, job)
+        with self._lock:
+            for entry in deferred:
+                if entry not in started:
+                    heapq.heappush(self._queue, entry)
+        with self._lock:
+            self.stats['deferred'] += len(deferred) - len(started)
+        return len(started)
+
+    def _create(self, job):
+        instance = job['instance']
+        when = datetime.now(timezone.utc)
+        tags = backup_tags(instance, job['policy'], when)
+        name = '{}-{}'.format(ec2_utils.get_tag(instance, 'Name') or instance['InstanceId'], when.strftime('%Y-%m-%d-%H%M'))
+        tracked = False
+        try:
+            self._limiter.acquire()
+            # Tags are applied by CreateImage itself rather than with a separate CreateTags call
+            image_id = self.client(job['account'], job['region']).create_image(InstanceId=instance['InstanceId'], Name=name, Description=name, NoReboot=True, TagSpecifications=[{'ResourceType': 'image', 'Tags': tags}])['ImageId']
+            logging.info("Policy %s: creating %s (%s) from %s in %s, %s snapshots in flight", job['policy'].name, image_id, name, instance['InstanceId'], job['az'], self.limits.total())
+            self._count('created')
+            self._poller(job['account']).add(job['region'], image_id, functools.partial(self._complete, job))
+            tracked = True
+        except ClientError as e:
+            logging.error("Error in BackupScheduler creating an image of %s: %s", instance['InstanceId'], e)
+            self._count('errors')
+        finally:
+            # Snapshots of an image the poller is not tracking would otherwise never be released, whatever the error
+            if not tracked:
+                self.limits.release(job['account'], job['region'], job['az'], job['snapshots'])
+
+    def _complete(self, job, region, image):
+        self.limits.release(job['account'], region, job['az'], job['snapshots'])
+        if image['State'] == 'available':
+            logging.info("Image %s (%s) is available", image['ImageId'], image.get('Name'))
+            self._count('available')
+        else:
+            logging.error("Image %s (%s) is %s: %s", image['ImageId'], image.get('Name'), image['State'], image.get('StateReason', {}).get('Message'))
+            self._count('failed')
+
+    def _poll(self):
+        with self._lock:
+            pollers = list(self._pollers.values())
+        for poller in pollers:
+            try:
+                poller.poll_once()
+            except ClientError as e:
+                logging.warning("Error polling pending images, retrying in %s seconds: %s", self.poll_interval, e)
+
+    def _next_wake(self, now, next_poll):
+        # Backups held back by the caps can only start once a poll completes images, so they do not bring the wake forward
+        wakes = [next_poll if self.pending() else now + self.poll_interval]
+        with self._lock:
+            if self._queue and self._queue[0][0] > now:
+                wakes.append(self._queue[0][0])
+        wakes.extend(policy.occurrence(now)[0] for policy in self.policies if policy.occurrence(now)[0] > now)
+        return min(wakes)
+
+    def run(self, once=False):
+        """Run until stopped, or with once until the next window of every policy has been backed up
+
+        Args:
+            once (bool): Plan the open or next window of each policy only and return once its images complete
+
+        Returns:
+            stats (Counter): Images created, available, failed, errors, late and deferred start attempts
+        """
+        next_poll = time.time() + self.poll_interval
+        windows = {policy.name: policy.occurrence(time.time())[0] for policy in self.policies}
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                if once:
+                    # Only the first window of each policy is planned
+                    for policy in self.policies:
+                        if self._planned.get(policy.name) is None and windows[policy.name] <= now:
+                            self._planned[policy.name] = windows[policy.name]
+                            logging.info("Policy %s: window open from %s to %s UTC", policy.name, _utc(windows[policy.name]), _utc(windows[policy.name] + policy.window))
+                            self.plan(policy, windows[policy.name], windows[policy.name] + policy.window, now)
+                else:
+                    self._plan_windows(now)
+                self._dispatch(now)
+                if now >= next_poll:
+                    self._poll()
+                    next_poll = now + self.poll_interval
+                    if self.pending() or self._queue:
+                        logging.info("%s images pending, %s backups queued, %s snapshots in flight", self.pending(), len(self._queue), self.limits.total())
+                if once and len(self._planned) == len(self.policies) and not self._queue and not self.pending():
+                    # Wait for workers still creating images, then for those images to complete
+                    self._executor.shutdown(wait=True)
+                    if not self.pending():
+                        break
+                self._stop.wait(max(0.0, min(self._next_wake(time.time(), next_poll), next_poll) - time.time()))
+        finally:
+            self._executor.shutdown(wait=True)
+        logging.info("Scheduler stopped: %s", ", ".join("{} {}".format(key, value) for key, value in sorted(self.stats.items())) or 'no backups')
+        return self.stats
+
+
+def _utc(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,25 @@
+"""Shared fixtures for the PythonUtilities module tests
+
+Run from AWS/PythonUtilities with: python -m pytest tests
+"""
+
+# Import global modules
+import os
+import sys
+
+# Import third-party modules
+import pytest
+
+# The scripts add PythonUtilities to the path to import modules.<name>, the tests do the same
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+@pytest.fixture(autouse=True)
+def aws_credentials(monkeypatch):
+    """Fake credentials and region so no test can reach a real AWS account"""
+    for name in ('AWS_PROFILE', 'AWS_ENDPOINT_URL'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_SESSION_TOKEN', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,71 @@
+"""Tests of assumed role sessions and AWS API cassettes against moto"""
+
+# Import global modules
+import gzip
+import json
+
+# Import third-party modules
+import boto3
+import pytest
+from moto import mock_aws
+
+# Import local modules
+import modules.aws_connect as aws_utils
+import modules.cassette as cassette_utils
+
+MEMBER_ACCOUNT = '111111111111'
+
+
+@pytest.fixture
+def session():
+    with mock_aws():
+        yield boto3.session.Session(region_name='us-east-1')
+
+
+def test_assumed_role_sessions(session):
+    sessions = aws_utils.AssumedRoleSessions(session, role_name='OrganizationAccountAccessRole', session_name='tests')
+    assert sessions.get(sessions.caller_account()) is session
+    member = sessions.get(MEMBER_ACCOUNT)
+    assert sessions.get(MEMBER_ACCOUNT) is member
+    identity = member.client('sts').get_caller_identity()
+    assert identity['Account'] == MEMBER_ACCOUNT
+    assert ':assumed-role/OrganizationAccountAccessRole/tests' in identity['Arn']
+    assert sessions.role_arn(MEMBER_ACCOUNT) == 'arn:aws:iam::111111111111:role/OrganizationAccountAccessRole'
+
+
+def test_account_sessions_share_the_base_loader(session):
+    sessions = aws_utils.AssumedRoleSessions(session)
+    loader = session._session.get_component('data_loader')
+    assert all(sessions.get(account)._session.get_component('data_loader') is loader for account in (MEMBER_ACCOUNT, '222222222222'))
+
+
+def test_for_each_account_isolates_failures(session):
+    def describe(account):
+        if account == '222222222222':
+            raise ValueError('unreachable')
+        return account
+    results, failed = aws_utils.for_each_account([MEMBER_ACCOUNT, '222222222222'], describe, max_workers=2)
+    assert results == {MEMBER_ACCOUNT: MEMBER_ACCOUNT}
+    assert list(failed) == ['222222222222']
+
+
+def test_cassette_records_and_replays_account_sessions(tmp_path):
+    path = str(tmp_path / 'run.jsonl.gz')
+    with mock_aws(), cassette_utils.Cassette(path, mode='record') as cassette:
+        session = aws_utils.cassette_session(None, 'us-east-1', cassette)
+        sessions = aws_utils.AssumedRoleSessions(session, cassette=cassette)
+        recorded = {account: sessions.get(account).client('sts').get_caller_identity()['Account'] for account in (MEMBER_ACCOUNT, '222222222222')}
+    with gzip.open(path, 'rt') as cassette_file:
+        assert json.loads(cassette_file.readline()) == {'version': cassette_utils.CASSETTE_VERSION}
+    # Replayed without moto, so every response comes from the cassette
+    replay = cassette_utils.Cassette(path, mode='replay')
+    sessions = aws_utils.AssumedRoleSessions(aws_utils.cassette_session(None, 'us-east-1', replay), cassette=replay)
+    # The same request made in each account is told apart by the session label
+    assert {account: sessions.get(account).client('sts').get_caller_identity()['Account'] for account in reversed(list(recorded))} == recorded
+
+
+def test_cassettes_of_an_older_format_are_rejected(tmp_path):
+    path = tmp_path / 'old.jsonl'
+    path.write_text(json.dumps({'operation': 'DescribeImages', 'url': 'https://ec2.us-east-1.amazonaws.com/', 'key': 'abc', 'status': 200, 'headers': {}, 'body': '', 'elapsed': 0}) + '\n')
+    with pytest.raises(ValueError, match='format version 1'):
+        cassette_utils.Cassette(str(path), mode='replay')
@@ -0,0 +1,108 @@
+"""Tests of the inventory table writer, segmented scan and stale item sweep against moto"""
+
+# Import third-party modules
+import boto3
+import pytest
+from moto import mock_aws
+
+# Import local modules
+import modules.dynamodb as dynamodb
+
+TABLE = 'inventory'
+
+
+@pytest.fixture
+def client():
+    with mock_aws():
+        client = boto3.client('dynamodb', region_name='us-east-1')
+        dynamodb.create_inventory_table(client, TABLE)
+        yield client
+
+
+def _item(number, run_id, kind='ami', region='us-east-1'):
+    return dynamodb.inventory_item(kind, 'ami-{:08d}'.format(number), '111111111111', region, 'image-{}'.format(number), '2022-01-01T00:00:00Z', {'Product': 'tools'}, {'ImageId': number}, run_id)
+
+
+def _write(client, items, **kwargs):
+    with dynamodb.InventoryWriter(client, TABLE, **kwargs) as writer:
+        for item in items:
+            writer.put(item)
+    return writer
+
+
+def _run_ids(client):
+    return {item['ResourceId']: item['RunId'] for item in dynamodb.scan_inventory(client, TABLE)}
+
+
+def test_writer_retries_unprocessed_items(client, monkeypatch):
+    monkeypatch.setattr(dynamodb.time, 'sleep', lambda seconds: None)
+    batch_write_item = client.batch_write_item
+    throttled = []
+
+    def throttle_first_call(RequestItems):
+        # The first call writes half the batch and returns the rest as unprocessed, as a throttled partition does
+        if throttled:
+            return batch_write_item(RequestItems=RequestItems)
+        requests = RequestItems[TABLE]
+        throttled.extend(requests[len(requests) // 2:])
+        batch_write_item(RequestItems={TABLE: requests[:len(requests) // 2]})
+        return {'UnprocessedItems': {TABLE: list(throttled)}}
+
+    monkeypatch.setattr(client, 'batch_write_item', throttle_first_call)
+    writer = _write(client, [_item(number, 'run-1') for number in range(10)], workers=1)
+    assert throttled
+    assert writer.summary['written'] == 10
+    assert writer.summary['retries'] == 1
+    assert writer.summary['failed'] == 0
+    assert len(_run_ids(client)) == 10
+
+
+def test_writer_counts_items_left_unprocessed(client, monkeypatch):
+    monkeypatch.setattr(dynamodb.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(client, 'batch_write_item', lambda RequestItems: {'UnprocessedItems': RequestItems})
+    writer = _write(client, [_item(number, 'run-1') for number in range(3)])
+    assert writer.summary['failed'] == 3
+    assert writer.summary['retries'] == dynamodb.MAX_WRITE_ATTEMPTS
+
+
+def test_scan_reads_every_segment(client):
+    _write(client, [_item(number, 'run-1') for number in range(60)] + [_item(number, 'run-1', kind='lambda') for number in range(100, 110)])
+    items = list(dynamodb.scan_inventory(client, TABLE, segments=4))
+    assert len(items) == 70
+    assert len({item['ResourceId'] for item in items}) == 70
+    amis = list(dynamodb.scan_inventory(client, TABLE, segments=3, kind='ami'))
+    assert len(amis) == 60
+    assert amis[0]['Data'] == {'ImageId': int(amis[0]['ResourceId'][4:])}
+
+
+def test_stale_items_are_deleted(client):
+    _write(client, [_item(number, 'run-1') for number in range(5)])
+    scope = dynamodb.inventory_scope('ami', '111111111111', 'us-east-1')
+    with dynamodb.InventoryWriter(client, TABLE) as writer:
+        for number in range(3):
+            writer.put(_item(number, 'run-2'))
+        writer.flush()
+        assert dynamodb.delete_stale_inventory(client, TABLE, scope, 'run-2', writer) == 2
+    assert writer.summary['deleted'] == 2
+    assert _run_ids(client) == {'ami-{:08d}'.format(number): 'run-2' for number in range(3)}
+
+
+def test_rewritten_items_listed_by_a_stale_index_are_kept(client, monkeypatch):
+    _write(client, [_item(number, 'run-2') for number in range(3)])
+    scope = dynamodb.inventory_scope('ami', '111111111111', 'us-east-1')
+    # The GSI has not caught up with the rewrite and still lists the previous run
+    monkeypatch.setattr(dynamodb, 'query_inventory', lambda *args, **kwargs: iter([{'ResourceId': 'ami-{:08d}'.format(number), 'RunId': 'run-1'} for number in range(3)]))
+    with dynamodb.InventoryWriter(client, TABLE) as writer:
+        assert dynamodb.delete_stale_inventory(client, TABLE, scope, 'run-2', writer) == 3
+    assert writer.summary['kept'] == 3
+    assert writer.summary['deleted'] == 0
+    assert len(_run_ids(client)) == 3
+
+
+def test_sweep_is_skipped_after_failed_writes(client, monkeypatch):
+    _write(client, [_item(number, 'run-1') for number in range(5)])
+    scope = dynamodb.inventory_scope('ami', '111111111111', 'us-east-1')
+    with dynamodb.InventoryWriter(client, TABLE) as writer:
+        writer.summary['failed'] = 1
+        assert dynamodb.delete_stale_inventory(client, TABLE, scope, 'run-2', writer) == 0
+    assert len(_run_ids(client)) == 5
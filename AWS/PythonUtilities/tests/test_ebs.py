@@ -0,0 +1,72 @@
+"""Offline tests of the EBS change detector with stubbed EC2, EBS and CloudWatch clients"""
+
+# Import global modules
+from datetime import datetime, timedelta, timezone
+
+# Import third-party modules
+import boto3
+import pytest
+from botocore.stub import ANY, Stubber
+
+# Import local modules
+import modules.ebs as ebs
+
+
+@pytest.fixture
+def clients():
+    stubbed = {name: boto3.client(name, region_name='us-east-1') for name in ('ec2', 'ebs', 'cloudwatch')}
+    stubbers = {name: Stubber(client) for name, client in stubbed.items()}
+    for stubber in stubbers.values():
+        stubber.activate()
+    yield stubbed, stubbers
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+
+
+def _metric_params(volume_id, period):
+    return {'Namespace': 'AWS/EBS', 'MetricName': 'VolumeWriteBytes', 'Dimensions': [{'Name': 'VolumeId', 'Value': volume_id}], 'StartTime': ANY, 'EndTime': ANY, 'Period': period, 'Statistics': ['Sum']}
+
+
+@pytest.mark.parametrize('days, period', [(1, 300), (14, 900), (20, 1500), (62, 3900), (70, 7200), (400, 25200)])
+def test_metric_period_matches_the_retained_resolution(clients, days, period):
+    (stubbed, stubbers) = clients
+    start = datetime.now(timezone.utc) - timedelta(days=days)
+    stubbers['cloudwatch'].add_response('get_metric_statistics', {'Datapoints': [{'Sum': 1024.0}, {'Sum': 2048.0}]}, _metric_params('vol-1', period))
+    assert ebs.volume_write_bytes(stubbed['cloudwatch'], 'vol-1', start) == 3072
+
+
+def test_count_changed_blocks_pages_until_the_limit(clients):
+    (stubbed, stubbers) = clients
+    page = {'ChangedBlocks': [{'BlockIndex': index} for index in range(3)], 'BlockSize': ebs.BLOCK_SIZE, 'NextToken': 'next'}
+    stubbers['ebs'].add_response('list_changed_blocks', page, {'FirstSnapshotId': 'snap-1', 'SecondSnapshotId': 'snap-2', 'MaxResults': ebs.LIST_CHANGED_BLOCKS_PAGE_SIZE})
+    stubbers['ebs'].add_response('list_changed_blocks', page, {'FirstSnapshotId': 'snap-1', 'SecondSnapshotId': 'snap-2', 'MaxResults': ebs.LIST_CHANGED_BLOCKS_PAGE_SIZE, 'NextToken': 'next'})
+    assert ebs.count_changed_blocks(stubbed['ebs'], 'snap-1', 'snap-2', limit=4) == (6, ebs.BLOCK_SIZE)
+
+
+def _detector_responses(stubbers, changed_blocks, written=None, image_age_days=70):
+    created = datetime.now(timezone.utc) - timedelta(days=image_age_days)
+    latest = created + timedelta(days=image_age_days - 1)
+    stubbers['ec2'].add_response('describe_snapshots', {'Snapshots': [{'SnapshotId': 'snap-base', 'VolumeId': 'vol-1', 'StartTime': created, 'State': 'completed'}]}, {'SnapshotIds': ['snap-base']})
+    stubbers['ec2'].add_response('describe_snapshots', {'Snapshots': [{'SnapshotId': 'snap-dlm', 'VolumeId': 'vol-1', 'StartTime': latest, 'State': 'completed'}]}, {'OwnerIds': ['self'], 'Filters': ANY})
+    stubbers['ebs'].add_response('list_changed_blocks', {'ChangedBlocks': [{'BlockIndex': index} for index in range(changed_blocks)], 'BlockSize': ebs.BLOCK_SIZE})
+    # Writes since the newest snapshot are only measured while the changed blocks are within the threshold
+    if written is not None:
+        stubbers['cloudwatch'].add_response('get_metric_statistics', {'Datapoints': [{'Sum': float(written)}]}, _metric_params('vol-1', 300))
+
+
+INSTANCE = {'InstanceId': 'i-1', 'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': 'vol-1'}}]}
+IMAGE = {'ImageId': 'ami-1', 'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': 'snap-base'}}]}
+
+
+def test_unchanged_instance(clients):
+    (stubbed, stubbers) = clients
+    _detector_responses(stubbers, changed_blocks=1, written=1024)
+    detector = ebs.ChangeDetector(stubbed['ec2'], stubbed['ebs'], stubbed['cloudwatch'], threshold=ebs.BLOCK_SIZE + 1024)
+    assert detector.unchanged(INSTANCE, IMAGE)
+
+
+def test_changed_instance_skips_the_metric(clients):
+    (stubbed, stubbers) = clients
+    _detector_responses(stubbers, changed_blocks=5)
+    detector = ebs.ChangeDetector(stubbed['ec2'], stubbed['ebs'], stubbed['cloudwatch'], threshold=ebs.BLOCK_SIZE)
+    assert not detector.unchanged(INSTANCE, IMAGE)
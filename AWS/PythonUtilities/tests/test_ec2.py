@@ -0,0 +1,157 @@
+"""Tests of the EC2 image poller and copy pipeline against moto"""
+
+# Import global modules
+from datetime import datetime
+
+# Import third-party modules
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+# Import local modules
+import modules.ec2 as ec2_utils
+import modules.file_system as file_system
+
+
+@pytest.fixture
+def session():
+    with mock_aws():
+        yield boto3.session.Session(region_name='us-east-1')
+
+
+def _image(session, region='us-east-1', name='image'):
+    ec2 = session.client('ec2', region_name=region)
+    ami = ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+    instance = ec2.run_instances(ImageId=ami, MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+    return ec2.create_image(InstanceId=instance, Name=name)['ImageId']
+
+
+def test_poller_reports_available_images(session):
+    image_id = _image(session)
+    completed = []
+    poller = ec2_utils.ImagePoller(session, interval=0)
+    poller.add('us-east-1', image_id, lambda region, image: completed.append((region, image['ImageId'], image['State'])))
+    poller.run()
+    assert completed == [('us-east-1', image_id, 'available')]
+
+
+def test_poller_gives_up_on_images_that_are_never_found(session):
+    completed = []
+    poller = ec2_utils.ImagePoller(session, interval=0, not_found_timeout=0)
+    poller.add('us-east-1', 'ami-00000000000000000', lambda region, image: completed.append(image))
+    poller.run()
+    assert completed[0]['State'] == 'failed'
+    assert completed[0]['StateReason']['Code'] == 'Poller.NotFound'
+    assert poller.pending() == 0
+
+
+def test_poller_gives_up_on_images_pending_past_the_deadline(session, monkeypatch):
+    image_id = _image(session)
+    poller = ec2_utils.ImagePoller(session, interval=0, timeout=0)
+    describe_images = poller.client('us-east-1').describe_images
+
+    def still_pending(**kwargs):
+        response = describe_images(**kwargs)
+        for image in response['Images']:
+            image['State'] = 'pending'
+        return response
+
+    monkeypatch.setattr(poller.client('us-east-1'), 'describe_images', still_pending)
+    completed = []
+    poller.add('us-east-1', image_id, lambda region, image: completed.append(image))
+    poller.run()
+    assert [(image['ImageId'], image['State'], image['StateReason']['Code']) for image in completed] == [(image_id, 'failed', 'Poller.Timeout')]
+
+
+def test_copy_is_tracked_when_tagging_it_fails(session, monkeypatch):
+    image_id = _image(session, name='source')
+    poller = ec2_utils.ImagePoller(session, interval=0)
+    destination = poller.client('us-west-2')
+
+    def create_tags(**kwargs):
+        raise ClientError({'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded'}}, 'CreateTags')
+
+    monkeypatch.setattr(destination, 'create_tags', create_tags)
+    pipeline = ec2_utils.CopyPipeline(poller, 'us-east-1', ['us-west-2'], max_concurrent=1)
+    poller.add('us-east-1', image_id, pipeline.source_complete)
+    poller.run()
+    copy_id = pipeline.copies[('us-west-2', image_id)]
+    assert pipeline.untagged == [('us-west-2', copy_id)]
+    assert pipeline.failed == []
+    assert pipeline._in_flight['us-west-2'] == 0
+
+
+def test_resumed_prune_deletes_snapshots_skipped_by_the_previous_run(session, tmp_path):
+    ec2 = session.client('ec2')
+    images = [ec2.describe_images(ImageIds=[_image(session, name='image-{}'.format(number))])['Images'][0] for number in range(2)]
+    snapshot_id = ec2_utils.image_snapshot_ids(images[0])[0]
+    journal_path = str(tmp_path / 'prune.jsonl')
+    # The first run keeps the second image, which shares the first image's snapshot
+    shared = dict(images[1], BlockDeviceMappings=images[0]['BlockDeviceMappings'])
+    journal = file_system.JsonLinesJournal(journal_path)
+    ec2_utils.prune_images(ec2, [(images[0], 'old')], keep=[(shared, 'latest')], dry_run=False, journal=journal)
+    journal.close()
+    assert [snapshot['SnapshotId'] for snapshot in ec2.describe_snapshots(SnapshotIds=[snapshot_id])['Snapshots']] == [snapshot_id]
+    # Resumed once the second image is pruned too, the skipped snapshot is deleted
+    journal = file_system.JsonLinesJournal(journal_path)
+    summary = ec2_utils.prune_images(ec2, [(images[0], 'old'), (shared, 'old')], dry_run=False, journal=journal)
+    journal.close()
+    assert summary['snapshots'] >= 1
+    assert snapshot_id not in {snapshot['SnapshotId'] for snapshot in ec2.describe_snapshots(OwnerIds=['self'])['Snapshots']}
+
+
+def test_poller_gives_up_on_snapshots_that_are_never_found(session):
+    ec2 = session.client('ec2')
+    volume_id = ec2.create_volume(AvailabilityZone='us-east-1a', Size=8)['VolumeId']
+    snapshot_id = ec2.create_snapshot(VolumeId=volume_id)['SnapshotId']
+    completed = []
+    poller = ec2_utils.ImagePoller(session, interval=0, not_found_timeout=0)
+    poller.add_snapshots('us-east-1', [snapshot_id, 'snap-00000000000000000'], lambda region, snapshots: completed.append({snapshot['SnapshotId']: snapshot['State'] for snapshot in snapshots}))
+    poller.run()
+    assert completed == [{snapshot_id: 'completed', 'snap-00000000000000000': 'error'}]
+    assert poller.pending() == 0
+
+
+def test_retag_isolates_missing_resources(session, tmp_path, monkeypatch):
+    ec2 = session.client('ec2')
+    images = [ec2.describe_images(ImageIds=[_image(session, name='image-{}'.format(number))])['Images'][0] for number in range(4)]
+    changes = ec2_utils.plan_retag(images, [{'set': {'Owner': 'platform'}}], include_snapshots=False)
+    # One image is deregistered after the plan was made.  moto tags missing images, EC2 fails the whole call
+    missing = images[2]['ImageId']
+    ec2.deregister_image(ImageId=missing)
+    create_tags = ec2.create_tags
+
+    def fail_missing(Resources, Tags):
+        if missing in Resources:
+            raise ClientError({'Error': {'Code': 'InvalidAMIID.NotFound', 'Message': "The image id '[{}]' does not exist".format(missing)}}, 'CreateTags')
+        return create_tags(Resources=Resources, Tags=Tags)
+
+    monkeypatch.setattr(ec2, 'create_tags', fail_missing)
+    journal = file_system.JsonLinesJournal(str(tmp_path / 'retag.jsonl'))
+    summary = ec2_utils.retag_images(ec2, changes, dry_run=False, journal=journal)
+    journal.close()
+    assert summary['failed'] == 1
+    assert summary['images'] == 3
+    assert summary['calls'] > 1
+    tagged = {image['ImageId'] for image in ec2.describe_images(Filters=[{'Name': 'tag:Owner', 'Values': ['platform']}])['Images']}
+    assert tagged == {image['ImageId'] for image in images} - {missing}
+
+
+
+def test_existing_image_index_loads_without_pagination(session, monkeypatch):
+    ec2 = session.client('ec2')
+    image_id = _image(session, name='indexed')
+    ec2.create_tags(Resources=[image_id], Tags=[{'Key': 'Date', 'Value': '2022-01-01'}])
+    # botocore before 1.28 cannot paginate DescribeImages
+    monkeypatch.setattr(ec2, 'can_paginate', lambda operation: False)
+    index = ec2_utils.ExistingImageIndex.load(ec2, window=60, now=datetime(2022, 1, 1, 12))
+    assert index.by_name['indexed']['ImageId'] == image_id
+
+
+def test_latest_instance_images_without_pagination(session, monkeypatch):
+    ec2 = session.client('ec2')
+    image_ids = [_image(session, name='image-{}'.format(number)) for number in range(2)]
+    ec2.create_tags(Resources=image_ids, Tags=[{'Key': ec2_utils.SOURCE_INSTANCE_TAG, 'Value': 'i-00000000000000000'}])
+    monkeypatch.setattr(ec2, 'can_paginate', lambda operation: False)
+    assert ec2_utils.latest_instance_images(ec2, ['i-00000000000000000', 'i-11111111111111111'])['i-00000000000000000']['ImageId'] in image_ids
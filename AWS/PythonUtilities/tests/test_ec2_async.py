@@ -0,0 +1,90 @@
+"""Tests of the aiobotocore engine against a moto server"""
+
+# Import global modules
+import asyncio
+import socket
+
+# Import third-party modules
+import boto3
+import pytest
+
+# Import local modules
+import modules.ec2_async as ec2_async
+
+pytest.importorskip('aiobotocore')
+server = pytest.importorskip('moto.server')
+
+
+@pytest.fixture(scope='module')
+def endpoint_url():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    moto_server = server.ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    moto_server.start()
+    yield 'http://127.0.0.1:{}'.format(port)
+    moto_server.stop()
+
+
+@pytest.fixture
+def ec2(endpoint_url):
+    # The endpoint is passed explicitly, the pinned botocore does not read AWS_ENDPOINT_URL
+    return boto3.client('ec2', region_name='us-east-1', endpoint_url=endpoint_url)
+
+
+def _images(ec2, count):
+    ami = ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+    instances = ec2.run_instances(ImageId=ami, MinCount=count, MaxCount=count)['Instances']
+    return [ec2.create_image(InstanceId=instance['InstanceId'], Name='image-' + instance['InstanceId'])['ImageId'] for instance in instances]
+
+
+def _run(ec2, coroutine_function):
+    async def run():
+        async with ec2_async.AsyncEC2(region='us-east-1', max_concurrency=4, endpoint_url=ec2.meta.endpoint_url) as client:
+            return await coroutine_function(client)
+    return asyncio.run(run())
+
+
+def test_describe_instances_and_images(ec2):
+    image_ids = _images(ec2, 3)
+    instances = _run(ec2, lambda client: client.describe_instances(filters=[{'Name': 'instance-state-name', 'Values': ['running']}]))
+    assert len(instances) >= 3
+    # An unknown ID is left out rather than failing the call
+    images = _run(ec2, lambda client: client.describe_images(image_ids=image_ids + ['ami-00000000000000000']))
+    assert sorted(image['ImageId'] for image in images) == sorted(image_ids)
+
+
+def test_create_and_tag_image(ec2):
+    instance_id = ec2.run_instances(ImageId=ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId'], MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+
+    async def create(client):
+        image_id = await client.create_image(instance_id, 'async-image')
+        await client.create_tags([image_id], [{'Key': 'Product', 'Value': 'tools'}])
+        return image_id
+
+    image_id = _run(ec2, create)
+    image = ec2.describe_images(ImageIds=[image_id])['Images'][0]
+    assert image['Name'] == 'async-image'
+    assert image['Tags'] == [{'Key': 'Product', 'Value': 'tools'}]
+
+
+def test_wait_for_images_gives_up_on_missing_images(ec2):
+    image_ids = _images(ec2, 2)
+    reported = []
+    images = _run(ec2, lambda client: client.wait_for_images(image_ids + ['ami-00000000000000000'], interval=0, callback=lambda region, image: reported.append(image['ImageId']), not_found_timeout=0))
+    assert {image_id: image['State'] for image_id, image in images.items()} == {image_ids[0]: 'available', image_ids[1]: 'available', 'ami-00000000000000000': 'failed'}
+    assert images['ami-00000000000000000']['StateReason']['Code'] == 'Poller.NotFound'
+    assert sorted(reported) == sorted(images)
+
+
+def test_pages_are_yielded_as_they_arrive(ec2):
+    _images(ec2, 3)
+
+    async def count_pages(client):
+        sizes = []
+        async for page in client.pages('describe_images', Owners=['self'], PaginationConfig={'PageSize': 1}):
+            sizes.append(len(page['Images']))
+        return sizes
+
+    sizes = _run(ec2, count_pages)
+    assert sum(sizes) >= 3
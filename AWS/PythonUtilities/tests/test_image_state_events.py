@@ -0,0 +1,123 @@
+"""Tests of the SQS driven image completion, ImageStateEvents and the Lambda state event handler, against moto"""
+
+# Import global modules
+import importlib.util
+import json
+import os
+
+# Import third-party modules
+import boto3
+import pytest
+from moto import mock_aws
+
+# Import local modules
+import modules.ec2 as ec2_utils
+
+LAMBDA_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'CreateAndTagEC2AMI', 'Lambda', 'CreateAndTagEC2AMI.py')
+
+
+@pytest.fixture
+def session():
+    with mock_aws():
+        yield boto3.session.Session(region_name='us-east-1')
+
+
+@pytest.fixture
+def queue_url(session):
+    return session.client('sqs').create_queue(QueueName='ami-events')['QueueUrl']
+
+
+def _image(session, tags=None):
+    ec2 = session.client('ec2')
+    ami = ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+    instance = ec2.run_instances(ImageId=ami, MinCount=1, MaxCount=1)['Instances'][0]['InstanceId']
+    image_id = ec2.create_image(InstanceId=instance, Name='image-' + instance)['ImageId']
+    if tags:
+        ec2.create_tags(Resources=[image_id], Tags=[{'Key': key, 'Value': value} for key, value in tags.items()])
+    return image_id
+
+
+def _event(image_id, state='available', source='aws.ec2'):
+    return {'source': source, 'detail-type': ec2_utils.IMAGE_STATE_EVENT, 'region': 'us-east-1', 'detail': {'ImageId': image_id, 'State': state}}
+
+
+def _send(session, queue_url, *bodies):
+    for body in bodies:
+        session.client('sqs').send_message(QueueUrl=queue_url, MessageBody=json.dumps(body) if isinstance(body, dict) else body)
+
+
+def _messages(session, queue_url):
+    attributes = session.client('sqs').get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+    return int(attributes['ApproximateNumberOfMessages']) + int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+
+def test_parse_state_event():
+    assert ec2_utils.parse_state_event(_event('ami-1')) == {'kind': 'image', 'region': 'us-east-1', 'ids': ['ami-1'], 'state': 'available'}
+    wrapped = json.dumps({'Type': 'Notification', 'Message': json.dumps(_event('ami-1'))})
+    assert ec2_utils.parse_state_event(wrapped)['ids'] == ['ami-1']
+    snapshots = {'source': 'aws.ec2', 'detail-type': ec2_utils.SNAPSHOT_EVENTS[0], 'region': 'us-east-1', 'detail': {'result': 'succeeded', 'snapshots': [{'snapshot_id': 'arn:aws:ec2::us-east-1:snapshot/snap-1'}]}}
+    assert ec2_utils.parse_state_event(snapshots) == {'kind': 'snapshots', 'region': 'us-east-1', 'ids': ['snap-1'], 'state': 'succeeded'}
+    assert ec2_utils.parse_state_event('not json') is None
+    assert ec2_utils.parse_state_event(_event('ami-1', source='custom')) is None
+
+
+def test_event_of_a_tracked_image_completes_it(session, queue_url):
+    image_id = _image(session)
+    completed = []
+    poller = ec2_utils.ImagePoller(session, interval=60, events=ec2_utils.ImageStateEvents(session, queue_url))
+    poller.add('us-east-1', image_id, lambda region, image: completed.append(image['ImageId']))
+    _send(session, queue_url, _event(image_id), 'not an event')
+    assert poller._resolve_events(poller.events.receive(1)) == 1
+    assert completed == [image_id]
+    assert _messages(session, queue_url) == 0
+
+
+def test_events_of_images_completed_by_polling_are_deleted(session, queue_url):
+    image_ids = [_image(session) for _ in range(3)]
+    completed = []
+    poller = ec2_utils.ImagePoller(session, interval=60, events=ec2_utils.ImageStateEvents(session, queue_url))
+    for image_id in image_ids:
+        poller.add('us-east-1', image_id, lambda region, image: completed.append(image['ImageId']))
+    # The images are available on the first poll, before their events are read
+    _send(session, queue_url, *[_event(image_id, state) for image_id in image_ids for state in ('pending', 'available')])
+    poller.run()
+    assert sorted(completed) == sorted(image_ids)
+    assert _messages(session, queue_url) == 0
+
+
+def test_events_of_other_images_are_left_on_the_queue(session, queue_url):
+    image_id = _image(session)
+    poller = ec2_utils.ImagePoller(session, interval=60, events=ec2_utils.ImageStateEvents(session, queue_url, visibility_timeout=0))
+    poller.add('us-east-1', image_id, lambda region, image: None)
+    _send(session, queue_url, _event(image_id), _event('ami-0123456789abcdef0'))
+    poller.run()
+    assert _messages(session, queue_url) == 1
+    message = session.client('sqs').receive_message(QueueUrl=queue_url)['Messages'][0]
+    assert json.loads(message['Body'])['detail']['ImageId'] == 'ami-0123456789abcdef0'
+
+
+@pytest.fixture
+def lambda_function(session, monkeypatch):
+    spec = importlib.util.spec_from_file_location('create_and_tag_lambda', LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    reported = []
+    monkeypatch.setattr(module, 'report_ami_state', lambda region, image: reported.append((region, image['ImageId'], image['State'])))
+    module.reported = reported
+    return module
+
+
+def test_lambda_reports_state_changes_of_its_images(session, queue_url, lambda_function):
+    image_id = _image(session, tags={ec2_utils.SOURCE_INSTANCE_TAG: 'i-0123456789abcdef0'})
+    other_id = _image(session)
+    # Events are read back from the queue as EventBridge would deliver them to the function
+    _send(session, queue_url, _event(image_id), _event(other_id))
+    for message in session.client('sqs').receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']:
+        lambda_function.handle_image_state_event(json.loads(message['Body']))
+    assert lambda_function.reported == [('us-east-1', image_id, 'available')]
+
+
+def test_lambda_ignores_events_that_are_not_image_state_changes(lambda_function):
+    assert lambda_function.handle_event(_event('ami-0123456789abcdef0', source='custom'), None) is None
+    assert lambda_function.handle_image_state_event({'detail-type': ec2_utils.IMAGE_STATE_EVENT, 'source': 'aws.ec2', 'detail': {}}) is None
+    assert lambda_function.reported == []
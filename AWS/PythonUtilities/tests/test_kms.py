@@ -0,0 +1,76 @@
+"""Tests of KMS envelope encryption against moto"""
+
+# Import global modules
+import io
+import os
+
+# Import third-party modules
+import boto3
+import pytest
+from moto import mock_aws
+
+# Import local modules
+import modules.kms as kms
+
+
+@pytest.fixture
+def kms_client():
+    with mock_aws():
+        yield boto3.client('kms', region_name='us-east-1')
+
+
+@pytest.fixture
+def key_id(kms_client):
+    return kms_client.create_key()['KeyMetadata']['Arn']
+
+
+class _Output(io.BytesIO):
+    # Keeps the written bytes readable after the writer closes the stream
+    def close(self):
+        self.data = self.getvalue()
+        super().close()
+
+
+def _encrypt(kms_client, key_id, data, cache=None, chunk_size=1024):
+    output = _Output()
+    with kms.open_encrypting_writer(output, kms_client, key_id, cache=cache, encryption_context={'report': 'amis'}, chunk_size=chunk_size) as writer:
+        writer.write(data)
+    return output.data
+
+
+def _decrypt(kms_client, data):
+    plaintext = io.BytesIO()
+    kms.decrypt_stream(kms_client, io.BytesIO(data), plaintext)
+    return plaintext.getvalue()
+
+
+def test_round_trip(kms_client, key_id):
+    data = os.urandom(5000)
+    assert _decrypt(kms_client, _encrypt(kms_client, key_id, data)) == data
+    assert _decrypt(kms_client, _encrypt(kms_client, key_id, b'')) == b''
+
+
+def test_streams_sharing_a_data_key_use_their_own_keys(kms_client, key_id):
+    cache = kms.DataKeyCache()
+    data = b'ImageId\n' * 100
+    first, second = (_encrypt(kms_client, key_id, data, cache=cache) for _ in range(2))
+    assert cache.misses == 1 and cache.hits == 1
+    # Same data key and nonces, but a different salt and so a different stream key and ciphertext
+    salt_end = len(kms.MAGIC) + kms.SALT_SIZE
+    assert first[salt_end:salt_end + 100] == second[salt_end:salt_end + 100]
+    assert first[len(kms.MAGIC):salt_end] != second[len(kms.MAGIC):salt_end]
+    assert first[-len(data):] != second[-len(data):]
+    assert _decrypt(kms_client, first) == _decrypt(kms_client, second) == data
+
+
+def test_tampered_chunks_fail(kms_client, key_id):
+    encrypted = bytearray(_encrypt(kms_client, key_id, os.urandom(3000)))
+    encrypted[-1] ^= 1
+    with pytest.raises(Exception):
+        _decrypt(kms_client, bytes(encrypted))
+
+
+
+def test_other_formats_are_rejected(kms_client):
+    with pytest.raises(ValueError, match='Not an envelope encrypted stream'):
+        _decrypt(kms_client, b'KMSENV1\n' + os.urandom(64))
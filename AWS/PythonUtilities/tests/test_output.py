@@ -0,0 +1,43 @@
+"""Tests of the queue based logging configuration"""
+
+# Import global modules
+import io
+import json
+import logging
+
+# Import third-party modules
+import pytest
+
+# Import local modules
+import modules.output as output
+
+
+@pytest.fixture
+def root_logger():
+    # configure_logging() replaces the root handlers, including those pytest captures logs with
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield root
+    output.stop_logging()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_json_lines_keep_the_traceback_as_its_own_key(root_logger, tmp_path):
+    console = io.StringIO()
+    json_file = tmp_path / 'log.jsonl'
+    output.configure_logging(json_file=str(json_file), stream=console)
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logging.exception("Division failed for %s", 'report', extra={'region': 'us-east-1'})
+    output.stop_logging()
+    entry = json.loads(json_file.read_text().splitlines()[-1])
+    assert entry['message'] == 'Division failed for report'
+    assert entry['region'] == 'us-east-1'
+    assert entry['exception'].startswith('Traceback') and 'ZeroDivisionError' in entry['exception']
+    # The console still shows the traceback after the message
+    assert 'Division failed for report\nTraceback' in console.getvalue()
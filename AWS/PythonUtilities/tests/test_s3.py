@@ -0,0 +1,72 @@
+"""Tests of the streaming S3 writer against moto"""
+
+# Import global modules
+import gzip
+import io
+import os
+
+# Import third-party modules
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+# Import local modules
+import modules.s3 as s3
+
+BUCKET = 'reports'
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _write(writer, data, chunk_size=1024 * 1024):
+    for start in range(0, len(data), chunk_size):
+        writer.write(data[start:start + chunk_size])
+
+
+def test_multipart_upload_in_parts_of_the_minimum_size(s3_client):
+    data = os.urandom(2 * s3.MIN_PART_SIZE + 1000)
+    writer = s3.S3MultipartWriter(s3_client, BUCKET, 'large.bin', part_size=s3.MIN_PART_SIZE, max_in_flight=2)
+    _write(writer, data)
+    writer.close()
+    response = s3_client.get_object(Bucket=BUCKET, Key='large.bin')
+    assert response['Body'].read() == data
+    # Multipart uploads have an ETag ending in the number of parts
+    assert response['ETag'].strip('"').endswith('-3')
+    assert 'Uploads' not in s3_client.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_small_output_is_sent_with_put_object(s3_client):
+    writer = s3.S3MultipartWriter(s3_client, BUCKET, 'small.csv')
+    writer.write(b'ImageId\nami-00000000000000000\n')
+    writer.close()
+    response = s3_client.get_object(Bucket=BUCKET, Key='small.csv')
+    assert response['Body'].read() == b'ImageId\nami-00000000000000000\n'
+    assert '-' not in response['ETag']
+    assert 'Uploads' not in s3_client.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_abort_leaves_no_object_or_pending_upload(s3_client):
+    writer = s3.S3MultipartWriter(s3_client, BUCKET, 'aborted.bin', part_size=s3.MIN_PART_SIZE)
+    _write(writer, os.urandom(s3.MIN_PART_SIZE + 1000))
+    # The first part started a multipart upload
+    assert len(s3_client.list_multipart_uploads(Bucket=BUCKET)['Uploads']) == 1
+    writer.abort()
+    assert writer.closed
+    assert 'Uploads' not in s3_client.list_multipart_uploads(Bucket=BUCKET)
+    with pytest.raises(ClientError):
+        s3_client.head_object(Bucket=BUCKET, Key='aborted.bin')
+
+
+def test_gzip_output_round_trips(s3_client):
+    lines = ''.join('ami-{:017d},image-{}\n'.format(number, number) for number in range(10000))
+    with io.TextIOWrapper(s3.open_s3_writer(s3_client, 's3://{}/report.csv.gz'.format(BUCKET), compress='gzip'), encoding='utf-8', newline='') as report:
+        report.write(lines)
+    body = s3_client.get_object(Bucket=BUCKET, Key='report.csv.gz')['Body'].read()
+    assert gzip.decompress(body).decode('utf-8') == lines
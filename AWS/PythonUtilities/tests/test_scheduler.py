@@ -0,0 +1,62 @@
+"""Tests of the backup scheduler's in-flight snapshot caps against moto"""
+
+# Import third-party modules
+import boto3
+import pytest
+from botocore.exceptions import EndpointConnectionError
+from moto import mock_aws
+
+# Import local modules
+import modules.scheduler as scheduler
+
+
+@pytest.fixture
+def session():
+    with mock_aws():
+        yield boto3.session.Session(region_name='us-east-1')
+
+
+def _job(session, limits):
+    # A backup job as plan() queues it, with its snapshots already reserved as _dispatch() does
+    ec2 = session.client('ec2')
+    ami = ec2.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+    instance = ec2.run_instances(ImageId=ami, MinCount=1, MaxCount=1)['Instances'][0]
+    job = {'policy': scheduler.BackupPolicy('test', tags={'Product': 'operations-tools'}, regions=['us-east-1']), 'account': None, 'region': 'us-east-1', 'instance': instance, 'az': instance['Placement']['AvailabilityZone'], 'snapshots': 1, 'end': 0}
+    assert limits.acquire(job['account'], job['region'], job['az'], job['snapshots'])
+    return job
+
+
+def test_image_pending_past_the_timeout_releases_its_snapshots(session, monkeypatch):
+    limits = scheduler.InFlightLimits(per_az=1)
+    backups = scheduler.BackupScheduler([], lambda account: session, limits, image_timeout=0)
+    job = _job(session, limits)
+    client = backups._poller(None).client('us-east-1')
+    describe_images = client.describe_images
+
+    def still_pending(**kwargs):
+        response = describe_images(**kwargs)
+        for image in response['Images']:
+            image['State'] = 'pending'
+        return response
+
+    monkeypatch.setattr(client, 'describe_images', still_pending)
+    backups._create(job)
+    assert limits.total() == 1
+    backups._poll()
+    assert limits.total() == 0
+    assert backups.pending() == 0
+    assert backups.stats['failed'] == 1
+
+
+def test_create_error_releases_its_snapshots(session, monkeypatch):
+    limits = scheduler.InFlightLimits(per_az=1)
+    backups = scheduler.BackupScheduler([], lambda account: session, limits)
+    job = _job(session, limits)
+
+    def unreachable(**kwargs):
+        raise EndpointConnectionError(endpoint_url='https://ec2.us-east-1.amazonaws.com')
+
+    monkeypatch.setattr(backups.client(None, 'us-east-1'), 'create_image', unreachable)
+    with pytest.raises(EndpointConnectionError):
+        backups._create(job)
+    assert limits.total() == 0
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os, re, sys
+import json
+import argparse
+import logging
+from datetime import datetime,timezone
+import boto3
+from botocore.exceptions import ClientError
+
+# Import local modules - see ../PythonUtilities
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PythonUtilities'))
+import modules.output as output
+import modules.columnar as columnar
+import modules.file_system as file_system
+import modules.dynamodb as dynamodb
+import modules.lambda_inventory as lambda_inventory
+
+# Global Variables
+log_level=logging.INFO
+log_format='%(asctime)s [%(levelname)s] %(message)s'
+
+# Columns written for each Lambda function - repetitive values are dictionary encoded
+lambda_columns = [('FunctionName', 'string'), ('FunctionArn', 'string'), ('Region', 'dictionary'), ('Runtime', 'dictionary'), ('Handler', 'string'), ('PackageType', 'dictionary'), ('Architectures', 'list'), ('MemorySize', 'int64'), ('Timeout', 'int64'), ('CodeSize', 'int64'), ('CodeSha256', 'string'), ('Version', 'dictionary'), ('Role', 'dictionary'), ('LastModified', 'timestamp')]
+
+# Region in the file names written by query_aws_lambda.sh - lambda_functions_[<profile>_]<region>_<date>_<time>.json
+region_pattern = re.compile(r'_([a-z]{2}(?:-[a-z]+)+-\d+)_\d{4}-\d{2}-\d{2}_\d{6}\.json')
+
+# Handle command line arguments
+all_args = argparse.ArgumentParser(description='Convert query_aws_lambda.sh ListFunctions JSON output to Parquet or Arrow, write it to a DynamoDB inventory table, and/or report the functions changed since the last run')
+all_args.add_argument('files', nargs='+', help='ListFunctions JSON files written by query_aws_lambda.sh, optionally gzip (.gz) or zstd (.zst) compressed', type=str)
+output_group = all_args.add_argument_group('Output Options')
+output_group.add_argument('--format', '-fm', required=False, default='parquet', choices=columnar.FORMATS, help='Output format. Accepted values: parquet (default), arrow', type=str)
+output_group.add_argument('--filename', '-f', required=False, help='Output file name including extension, required unless --dynamodb-table is set (Example: -f output/lambda_functions.parquet)', type=str)
+output_group.add_argument('--row-group-size', required=False, default=columnar.DEFAULT_BATCH_ROWS, help='Rows buffered per parquet row group or arrow record batch: default = 10000', type=int)
+inventory_group = all_args.add_argument_group('Inventory Options (shared DynamoDB inventory table)')
+inventory_group.add_argument('--dynamodb-table', required=False, help='Inventory table the functions are written to, created if it does not exist (Example: --dynamodb-table lambda-inventory)', type=str)
+inventory_group.add_argument('--aws-profile', '-a', required=False, default='default', help='AWS Profile used to write to the inventory table: default = default', type=str)
+inventory_group.add_argument('--dynamodb-region', required=False, default='us-east-1', help='Region of the inventory table: default = us-east-1', type=str)
+inventory_group.add_argument('--dynamodb-endpoint-url', required=False, help='DynamoDB endpoint, for DynamoDB Local (Example: --dynamodb-endpoint-url http://localhost:8000)', type=str)
+inventory_group.add_argument('--dynamodb-writers', required=False, default=dynamodb.DEFAULT_WRITERS, help='Number of threads writing BatchWriteItem batches: default = 4', type=int)
+inventory_group.add_argument('--dynamodb-index-tags', required=False, default=','.join(dynamodb.DEFAULT_INDEX_TAGS), help='Comma separated tag keys given their own index when the table is created: default = Product,Environment', type=str)
+incremental_group = all_args.add_argument_group('Incremental Options (changes since the last run)')
+incremental_group.add_argument('--state', required=False, help='State file of the per-region LastModified watermarks and the previous snapshot, read and then replaced, compressed if it ends in .gz or .zst (Example: --state output/lambda_state.json.gz)', type=str)
+incremental_group.add_argument('--delta', required=False, help='JSON file of the functions added, modified and removed since the run that saved --state (Example: --delta output/lambda_delta.json)', type=str)
+incremental_group.add_argument('--drift-index', required=False, help='JSON file grouping every function by CodeSha256 and listing the function names deployed with different code (Example: --drift-index output/lambda_code_index.json)', type=str)
+incremental_group.add_argument('--account', required=False, help='Account ID of the files, so regions listing no functions are compared too: default = the account in the function ARNs', type=str)
+log_group = all_args.add_argument_group('Log Options')
+log_group.add_argument('--log-level', '-ll', required=False, default='INFO', help='Log level: default = INFO', type=str)
+args=all_args.parse_args()
+if not (args.filename or args.dynamodb_table or args.state or args.drift_index):
+    all_args.error("at least one of --filename, --dynamodb-table, --state or --drift-index is required")
+if args.delta and not args.state:
+    all_args.error("--delta requires --state")
+
+# Configure logging - records are queued and written by a background listener thread
+output.configure_logging(log_level=args.log_level.upper(), log_format=log_format)
+
+def main(): # Main function
+    if args.filename:
+        save_columnar() # Write the functions to a parquet or arrow file
+    if args.dynamodb_table:
+        save_inventory() # Write the functions to the shared inventory table
+    if args.state or args.drift_index:
+        save_incremental() # Write the changes since the last run and the code index, then save the state for the next run
+
+def save_columnar(): # Write the functions of every file to one parquet or arrow file
+    try:
+        rows = 0
+        # Written to a temporary file and renamed into place on completion so a failed run never leaves a partial file
+        with file_system.commit_on_success(file_system.AtomicFileWriter(args.filename)) as stream, columnar.open_columnar_writer(stream, lambda_columns, args.format, batch_rows=args.row_group_size) as writer:
+            for file_name in args.files:
+                logging.info("Reading %s", file_name)
+                for function in read_functions(file_name):
+                    writer.write_row(function_row(function))
+                    rows += 1
+        logging.info("Wrote %s functions to %s", rows, args.filename)
+    except OSError as e:
+        logging.error("Error in main: %s", e)
+        sys.exit(1)
+    except ValueError as e:
+        logging.error("Error in main: %s", e)
+        sys.exit(1)
+    except ImportError as e:
+        logging.error("Error in main: %s - parquet and arrow output require pyarrow", e)
+        sys.exit(1)
+
+def save_inventory(): # Write the functions of every file to the inventory table, deleting the items of functions no longer listed in their account and region
+    try:
+        client = boto3.Session(profile_name=args.aws_profile).client('dynamodb', region_name=args.dynamodb_region, endpoint_url=args.dynamodb_endpoint_url)
+        index_tags = [key.strip() for key in args.dynamodb_index_tags.split(',')]
+        if dynamodb.create_inventory_table(client, args.dynamodb_table, index_tags=index_tags):
+            logging.info("Created DynamoDB Table %s", args.dynamodb_table)
+        run_id = datetime.now(timezone.utc).isoformat()
+        scopes = set()
+        with dynamodb.InventoryWriter(client, args.dynamodb_table, workers=args.dynamodb_writers) as writer:
+            for file_name in args.files:
+                logging.info("Writing %s to %s", file_name, args.dynamodb_table)
+                for function in read_functions(file_name):
+                    # arn:aws:lambda:<region>:<account>:function:<name>
+                    region, account = function['FunctionArn'].split(':')[3:5]
+                    scopes.add(dynamodb.inventory_scope('lambda', account, region))
+                    writer.put(dynamodb.inventory_item('lambda', function['FunctionArn'], account, region, function['FunctionName'], function.get('LastModified'), function.get('Tags'), function, run_id, index_tags=index_tags))
+            writer.flush()
+            # Each file lists every function of its account and region, any other item of theirs is stale
+            stale = sum(dynamodb.delete_stale_inventory(client, args.dynamodb_table, scope, run_id, writer) for scope in sorted(scopes))
+            logging.info("Deleting %s functions no longer listed from %s unless rewritten by this run", stale, args.dynamodb_table)
+        logging.info("Wrote %s and deleted %s items in %s batches, %s retried, %s kept, %s failed", writer.summary['written'], writer.summary['deleted'], writer.summary['batches'], writer.summary['retries'], writer.summary['kept'], writer.summary['failed'])
+        if writer.summary['failed']:
+            sys.exit(1)
+    except ClientError as e:
+        logging.error("Error in save_inventory: %s", e)
+        sys.exit(1)
+    except (OSError, ValueError) as e:
+        logging.error("Error in save_inventory: %s", e)
+        sys.exit(1)
+
+def save_incremental(): # Compare the functions with the state of the last run, write the delta and code index, then replace the state
+    try:
+        state = lambda_inventory.load_state(args.state) if args.state else {'watermarks': {}, 'functions': {}}
+        logging.info("Previous state: %s functions from %s", len(state['functions']), state.get('generated') or 'no previous run')
+        listings = {}
+        for file_name in args.files:
+            scope, functions = read_listing(file_name)
+            if scope is not None:
+                listings.setdefault(scope, []).extend(functions)
+        delta, state = lambda_inventory.diff_inventory(state, listings)
+        logging.info("Compared %s regions: %s added, %s modified, %s removed, %s unchanged", len(listings), len(delta['added']), len(delta['modified']), len(delta['removed']), delta['unchanged'])
+        if args.delta:
+            lambda_inventory.write_json(args.delta, delta)
+            logging.info("Delta saved to %s", args.delta)
+        if args.drift_index:
+            index = lambda_inventory.code_index(state['functions'].values())
+            lambda_inventory.write_json(args.drift_index, index)
+            logging.info("Code index of %s CodeSha256 values saved to %s, %s functions have drifted", len(index['code']), args.drift_index, len(index['drift']))
+            for name, codes in index['drift'].items():
+                logging.warning("Function %s is deployed with %s different CodeSha256 values", name, len(codes))
+        if args.state:
+            # Saved last, so if an output fails the next run compares against the same snapshot again
+            lambda_inventory.write_json(args.state, state)
+            logging.info("State of %s functions saved to %s", len(state['functions']), args.state)
+    except (OSError, ValueError, KeyError) as e:
+        logging.error("Error in save_incremental: %s", e)
+        sys.exit(1)
+
+def read_listing(file_name): # Watermark scope and functions of a ListFunctions JSON file, the scope is None when the file cannot be compared
+    with file_system.open_compressed(file_name) as json_file:
+        listing = json.load(json_file)
+    functions = listing.get('Functions', [])
+    if listing.get('NextToken'):
+        # The listing was cut off by --max-items, functions missing from it have not been removed
+        logging.warning("%s lists only the first %s functions, it is left out of the comparison", file_name, len(functions))
+        return None, functions
+    if functions:
+        return lambda_inventory.scope_key(*lambda_inventory.function_scope(functions[0])), functions
+    region = region_pattern.search(os.path.basename(file_name))
+    if args.account and region:
+        return lambda_inventory.scope_key(args.account, region.group(1)), functions
+    logging.warning("%s lists no functions and its account or region is not known, removed functions are not detected for it", file_name)
+    return None, functions
+
+def read_functions(file_name): # Functions listed in a ListFunctions JSON file
+    with file_system.open_compressed(file_name) as json_file:
+        return json.load(json_file).get('Functions', [])
+
+def function_row(function): # Columnar row for a Lambda function
+    row = dict(function)
+    # Region is the fourth field of the ARN - arn:aws:lambda:<region>:<account>:function:<name>
+    row['Region'] = function['FunctionArn'].split(':')[3]
+    row['Architectures'] = function.get('Architectures', ['x86_64'])
+    if function.get('LastModified'):
+        row['LastModified'] = datetime.strptime(function['LastModified'], '%Y-%m-%dT%H:%M:%S.%f%z')
+    return row
+
+main() # Call main function
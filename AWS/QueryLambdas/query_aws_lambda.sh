@@ -8,6 +8,15 @@ REQUIRED_APPS=(aws date jq yq)
 REQUIRED_FIELDS=(FunctionName FunctionArn Runtime LastModified)
 # Max items to be queried per region
 MAX_ITEMS=1000
+# Output format - csv (default), or parquet/arrow which are written alongside the CSV file by ConvertLambdaInventory.py
+OUTPUT_FORMAT=${OUTPUT_FORMAT:-csv}
+# Directory containing this script and ConvertLambdaInventory.py
+SCRIPT_DIR=$(cd "$(dirname "$0")" && pwd)
+# Compression for the JSON and CSV files - none (default), gzip or zstd - and optional compression level
+COMPRESS=${COMPRESS:-}
+COMPRESS_LEVEL=${COMPRESS_LEVEL:-}
+# State file of the previous run - when set only the functions changed since the last run are written to a delta file
+STATE_FILE=${STATE_FILE:-}
 
 # Function to call to get the current date and time - used for logging output primarily
 function dateTime {
@@ -19,9 +28,64 @@ function fileDateTime {
     date +"%Y-%m-%d_%H%M%S"
 }
 
+# Function to write the output of a command to a file atomically
+# Output is compressed into a hidden temporary file which is only renamed into place once the command has succeeded
+# Usage: writeFile <file> <command> [args...]
+function writeFile {
+    local FILE=$1
+    shift
+    local TEMP_FILE="$(dirname ${FILE})/.$(basename ${FILE}).$$.tmp"
+    if (set -o pipefail; "$@" | ${COMPRESS_CMD} > "${TEMP_FILE}") && mv "${TEMP_FILE}" "${FILE}"; then
+        return 0
+    fi
+    rm -f "${TEMP_FILE}"
+    return 1
+}
+
+# Function to read a file written by writeFile, decompressing it based on its extension
+function readFile {
+    case "$1" in
+        *.gz) gzip -dc "$1" ;;
+        *.zst) zstd -q -dc "$1" ;;
+        *) cat "$1" ;;
+    esac
+}
+
 echo "$(dateTime) [INFO] Starting script"
 echo "$(dateTime) [INFO] Checking for required applications"
 
+# Columnar output formats are written with python3 and pyarrow
+if [[ ${OUTPUT_FORMAT} == "parquet" ]] || [[ ${OUTPUT_FORMAT} == "arrow" ]]; then
+    REQUIRED_APPS+=(python3)
+elif [[ ${OUTPUT_FORMAT} != "csv" ]]; then
+    echo "$(dateTime) [ERROR] Invalid OUTPUT_FORMAT ${OUTPUT_FORMAT}"
+    echo "$(dateTime) [WARN] Valid formats are csv, parquet or arrow"
+    exit 1
+fi
+
+# The delta and drift index are written with python3
+if [[ ! -z "${STATE_FILE}" ]] && [[ ! " ${REQUIRED_APPS[@]} " =~ " python3 " ]]; then
+    REQUIRED_APPS+=(python3)
+fi
+
+# Compressed output is streamed through gzip or zstd
+if [[ ${COMPRESS} == "gzip" ]]; then
+    REQUIRED_APPS+=(gzip)
+    COMPRESS_CMD="gzip -c -${COMPRESS_LEVEL:-6}"
+    COMPRESS_EXTENSION=".gz"
+elif [[ ${COMPRESS} == "zstd" ]]; then
+    REQUIRED_APPS+=(zstd)
+    COMPRESS_CMD="zstd -q -c -${COMPRESS_LEVEL:-3}"
+    COMPRESS_EXTENSION=".zst"
+elif [[ -z "${COMPRESS}" ]]; then
+    COMPRESS_CMD="cat"
+    COMPRESS_EXTENSION=""
+else
+    echo "$(dateTime) [ERROR] Invalid COMPRESS ${COMPRESS}"
+    echo "$(dateTime) [WARN] Valid compression types are gzip or zstd"
+    exit 1
+fi
+
 # Confirm that the required applications are installed
 for APP in "${REQUIRED_APPS[@]}"; do
     if ! command -v $APP &> /dev/null; then
@@ -201,19 +265,25 @@ if [[ -z "${PROFILE}" ]]; then
     echo "$(dateTime) [INFO] Querying AWS for Lambda functions using Access Key ID: ${ACCESS_KEY_ID}"
     for REGION in "${QUERY_REGIONS[@]}"; do
         echo "$(dateTime) [INFO] Querying ${REGION}"
-        aws lambda list-functions --max-items ${MAX_ITEMS} --region ${REGION} --aws-access-key-id ${ACCESS_KEY_ID} --aws-secret-access-key ${SECRET_ACCESS_KEY} --output json > ${OUTPUT_DIR}/lambda_functions_${REGION}_$(fileDateTime).json
+        JSON_FILE=${OUTPUT_DIR}/lambda_functions_${REGION}_$(fileDateTime).json${COMPRESS_EXTENSION}
+        if ! writeFile ${JSON_FILE} aws lambda list-functions --max-items ${MAX_ITEMS} --region ${REGION} --aws-access-key-id ${ACCESS_KEY_ID} --aws-secret-access-key ${SECRET_ACCESS_KEY} --output json; then
+            echo "$(dateTime) [WARN] Query of ${REGION} failed, no file created"
+        fi
     done
 else
     echo "$(dateTime) [INFO] Querying AWS for Lambda functions using profile: ${PROFILE}"
     for REGION in "${QUERY_REGIONS[@]}"; do
         echo "$(dateTime) [INFO] Querying ${REGION}"
-        aws lambda list-functions --max-items ${MAX_ITEMS} --region ${REGION} --profile ${PROFILE} --output json > ${OUTPUT_DIR}/lambda_functions_${PROFILE}_${REGION}_$(fileDateTime).json
+        JSON_FILE=${OUTPUT_DIR}/lambda_functions_${PROFILE}_${REGION}_$(fileDateTime).json${COMPRESS_EXTENSION}
+        if ! writeFile ${JSON_FILE} aws lambda list-functions --max-items ${MAX_ITEMS} --region ${REGION} --profile ${PROFILE} --output json; then
+            echo "$(dateTime) [WARN] Query of ${REGION} failed, no file created"
+        fi
     done
 fi
 
 # If the json file is empty, then remove it
-for FILE in $(find ${OUTPUT_DIR} -type f -name "*.json"); do
-    if [[ ! -s ${FILE} ]]; then
+for FILE in $(find ${OUTPUT_DIR} -type f -name "*.json${COMPRESS_EXTENSION}"); do
+    if [[ -z "$(readFile ${FILE} | head -c 1)" ]]; then
         echo "$(dateTime) [WARN] ${FILE} is empty, removing file"
         rm ${FILE}
     fi
@@ -228,17 +298,24 @@ CSV_HEADER=$(IFS=, ; echo "${REQUIRED_FIELDS[*]}")
 JSON_SEARCH_STRING=$(IFS=, ; echo "${REQUIRED_FIELDS[*]/#/.}")
 # echo "$(dateTime) [DEBUG] JSON search string: ${JSON_SEARCH_STRING}"
 
+# Function to print the CSV header and a CSV row for every function in the JSON files
+function buildCsv {
+    echo ${CSV_HEADER}
+    for FILE in ${OUTPUT_DIR}/lambda_functions_*.json${COMPRESS_EXTENSION}; do
+        readFile ${FILE} | jq -r ".Functions[] | [${JSON_SEARCH_STRING}] | @csv" || return 1
+    done
+}
+
 # If one or more files were created then continue
-if [[ ! -z  $(find ${OUTPUT_DIR} -maxdepth 1 -name 'lambda_functions_*.json') ]]; then
+if [[ ! -z  $(find ${OUTPUT_DIR} -maxdepth 1 -name "lambda_functions_*.json${COMPRESS_EXTENSION}") ]]; then
     echo "$(dateTime) [INFO] Creating CSV file"
     # Build file name using fileDateTime function
-    CSV_FILE_NAME="lambda_functions_${fileDateTime}.csv"
-    # Create CSV file by echoing the CSV_HEADER string to the file
-    echo ${CSV_HEADER} > ${OUTPUT_DIR}/${CSV_FILE_NAME}
-    # Loop through all files created and append to CSV file
-    for FILE in ${OUTPUT_DIR}/lambda_functions_*.json; do
-        jq -r ".Functions[] | [${JSON_SEARCH_STRING}] | @csv" ${FILE} >> ${OUTPUT_DIR}/${CSV_FILE_NAME}
-    done
+    CSV_FILE_NAME="lambda_functions_$(fileDateTime).csv${COMPRESS_EXTENSION}"
+    # Create CSV file from the CSV_HEADER string and every JSON file created
+    if ! writeFile ${OUTPUT_DIR}/${CSV_FILE_NAME} buildCsv; then
+        echo "$(dateTime) [ERROR] Failed to create CSV file"
+        exit 1
+    fi
     echo "$(dateTime) [INFO] CSV file created"
 else
     echo "$(dateTime) [ERROR] No files were created"
@@ -254,4 +331,41 @@ else
     echo "$(dateTime) [INFO] CSV file created: ${OUTPUT_DIR}/${CSV_FILE_NAME}"
 fi
 
+# If a columnar format was requested, convert the JSON files to a single parquet or arrow file
+if [[ ${OUTPUT_FORMAT} != "csv" ]]; then
+    if [[ ! -z "${PROFILE}" ]]; then
+        COLUMNAR_FILE_NAME="${PROFILE}_lambda_functions_$(fileDateTime).${OUTPUT_FORMAT}"
+    else
+        COLUMNAR_FILE_NAME="lambda_functions_$(fileDateTime).${OUTPUT_FORMAT}"
+    fi
+    echo "$(dateTime) [INFO] Creating ${OUTPUT_FORMAT} file"
+    if python3 ${SCRIPT_DIR}/ConvertLambdaInventory.py --format ${OUTPUT_FORMAT} --filename ${OUTPUT_DIR}/${COLUMNAR_FILE_NAME} ${OUTPUT_DIR}/lambda_functions_*.json${COMPRESS_EXTENSION}; then
+        echo "$(dateTime) [INFO] ${OUTPUT_FORMAT} file created: ${OUTPUT_DIR}/${COLUMNAR_FILE_NAME}"
+    else
+        echo "$(dateTime) [ERROR] Failed to create ${OUTPUT_FORMAT} file"
+        exit 1
+    fi
+fi
+
+# If a state file was given, write the functions added, modified or removed since the last run and the CodeSha256 drift index
+if [[ ! -z "${STATE_FILE}" ]]; then
+    if [[ ! -z "${PROFILE}" ]]; then
+        DELTA_FILE_NAME="${PROFILE}_lambda_delta_$(fileDateTime).json${COMPRESS_EXTENSION}"
+        INDEX_FILE_NAME="${PROFILE}_lambda_code_index_$(fileDateTime).json${COMPRESS_EXTENSION}"
+    else
+        DELTA_FILE_NAME="lambda_delta_$(fileDateTime).json${COMPRESS_EXTENSION}"
+        INDEX_FILE_NAME="lambda_code_index_$(fileDateTime).json${COMPRESS_EXTENSION}"
+    fi
+    # The account ID is the fifth field of the caller ARN, so regions with no functions are compared too
+    ACCOUNT_ID=$(echo ${CONNECT_SUCCESS} | cut -d: -f5)
+    echo "$(dateTime) [INFO] Comparing with the previous run in ${STATE_FILE}"
+    if python3 ${SCRIPT_DIR}/ConvertLambdaInventory.py --state ${STATE_FILE} --delta ${OUTPUT_DIR}/${DELTA_FILE_NAME} --drift-index ${OUTPUT_DIR}/${INDEX_FILE_NAME} --account ${ACCOUNT_ID} ${OUTPUT_DIR}/lambda_functions_*.json${COMPRESS_EXTENSION}; then
+        echo "$(dateTime) [INFO] Delta file created: ${OUTPUT_DIR}/${DELTA_FILE_NAME}"
+        echo "$(dateTime) [INFO] Code index file created: ${OUTPUT_DIR}/${INDEX_FILE_NAME}"
+    else
+        echo "$(dateTime) [ERROR] Failed to create delta file"
+        exit 1
+    fi
+fi
+
 echo "$(dateTime) [INFO] Script complete"
\ No newline at end of file